@@ -40,19 +40,75 @@ import multiprocessing
 from numba import jit, float32, int32, boolean, float64
 import numba
 import time
+import mppool
 
 # compiled function to get weight for each event and each grid point
-@jit(float32[:,:,:](float32[:,:,:], float32[:,:,:]))
+#   the weight of an event is the number of events with azimuth difference < 20 deg or > 340 deg
+#   for each grid point, the azimuths are sorted and the numbers of events are counted with binary search,
+#   O(Nevent*log(Nevent)) instead of O(Nevent^2), grid points are processed in parallel
+@jit(float32[:,:,:](float32[:,:,:], float32[:,:,:]), nopython=True, parallel=True)
 def _get_azi_weight(aziALL, validALL):
     Nevent, Nlon, Nlat  = aziALL.shape
     weightALL           = np.zeros((Nevent, Nlon, Nlat), dtype=np.float32)
-    for ilon in xrange(Nlon):
-        for ilat in xrange(Nlat):
-            for i in xrange(Nevent):
-                for j in xrange(Nevent):
-                    delAzi                      = abs(aziALL[i, ilon, ilat] - aziALL[j, ilon, ilat])
-                    if delAzi < 20. or delAzi > 340.:
-                        weightALL[i, ilon, ilat]+= validALL[i, ilon, ilat]    
+    for inode in numba.prange(Nlon*Nlat):
+        ilon            = inode // Nlat
+        ilat            = inode % Nlat
+        # NaN azimuths are excluded, their weights are zero (NaN differences fail both comparisons of the pairwise count)
+        ievArr          = np.zeros(Nevent, dtype=np.int64)
+        Nvalid          = 0
+        for iev in range(Nevent):
+            if not np.isnan(aziALL[iev, ilon, ilat]):
+                ievArr[Nvalid]  = iev
+                Nvalid          += 1
+        azi             = np.zeros(Nvalid, dtype=np.float32)
+        for k in range(Nvalid):
+            azi[k]      = aziALL[ievArr[k], ilon, ilat]
+        isort           = np.argsort(azi)
+        sazi            = azi[isort]
+        for k in range(Nvalid):
+            a           = sazi[k]
+            # first index with delAzi < 20
+            lo          = 0
+            hi          = k
+            while lo < hi:
+                mid     = (lo + hi) // 2
+                if abs(a - sazi[mid]) < 20.:
+                    hi  = mid
+                else:
+                    lo  = mid + 1
+            ibeg        = lo
+            # last index + 1 with delAzi < 20
+            lo          = k + 1
+            hi          = Nvalid
+            while lo < hi:
+                mid     = (lo + hi) // 2
+                if abs(a - sazi[mid]) < 20.:
+                    lo  = mid + 1
+                else:
+                    hi  = mid
+            iend        = lo
+            # number of events with delAzi > 340 before k
+            lo          = 0
+            hi          = k
+            while lo < hi:
+                mid     = (lo + hi) // 2
+                if abs(a - sazi[mid]) > 340.:
+                    lo  = mid + 1
+                else:
+                    hi  = mid
+            Nprefix     = lo
+            # number of events with delAzi > 340 after k
+            lo          = k + 1
+            hi          = Nvalid
+            while lo < hi:
+                mid     = (lo + hi) // 2
+                if abs(a - sazi[mid]) > 340.:
+                    hi  = mid
+                else:
+                    lo  = mid + 1
+            Nsuffix     = Nvalid - lo
+            iev         = ievArr[isort[k]]
+            weightALL[iev, ilon, ilat]  = validALL[iev, ilon, ilat]*(iend - ibeg + Nprefix + Nsuffix)
     return weightALL
 
 # compiled function to evaluate station distribution 
@@ -124,6 +180,419 @@ def _check_station_distribution(lons, lats, Nvalid_min):
     else:
         return False
 
+#----------------------------------------------------------------------------------------------
+# functions for stacking in spatial tiles (eikonal_stack/helm_stack)
+#   all the statistics are computed for each grid point independently (the anisotropic stacking
+#   also uses the near neighbor grid points, which are included as halo rows of the tile),
+#   the grid is split into tiles along latitude so that the event arrays of a tile fit
+#   in the memory budget, the results are identical to stacking the whole grid at once
+#----------------------------------------------------------------------------------------------
+# approximate memory usage (in bytes) of the stacking for each measurement (event and grid point)
+_stack_bytes_per_measurement    = 128
+
+def _get_stack_tiles(Nx, Ny, Nevent, maxmem=None, halo=0):
+    """get the row ranges of tiles for stacking
+    ==============================================================================================
+    ::: input parameters :::
+    Nx, Ny      - number of grid points in latitude/longitude
+    Nevent      - number of events
+    maxmem      - memory budget in GB, None for one tile of the whole grid
+    halo        - number of halo rows on each side of a tile
+    ::: output :::
+    tiles       - list of (r0, r1), rows r0 to r1-1 are the output rows of a tile
+    ==============================================================================================
+    """
+    if maxmem is None:
+        return [(0, Nx)]
+    Nrow        = int(maxmem*(1024.**3)/(_stack_bytes_per_measurement*max(Nevent, 1)*Ny)) - 2*halo
+    if Nrow < 1:
+        warnings.warn('memory budget too small: '+str(maxmem)+' GB, one row per tile is used', UserWarning, stacklevel=1)
+        Nrow    = 1
+    return [(r0, min(r0 + Nrow, Nx)) for r0 in range(0, Nx, Nrow)]
+
+def _isotropic_stacking(slownessALL, aziALL, reason_nALL, Nmeasure, use_numba=True):
+    """isotropic stacking of slowness for eikonal_stack and helm_stack
+    ==============================================================================================
+    ::: input parameters :::
+    slownessALL - slowness, shape: Nevent, Nx, Ny
+    aziALL      - azimuth, shape: Nevent, Nx, Ny
+    reason_nALL - index array indicating validity of data, shape: Nevent, Nx, Ny
+    Nmeasure    - number of raw measurements, shape: Nx, Ny
+    use_numba   - use numba for large array manipulation or not
+    ::: output :::
+    slowness_sumQC, slowness_stdQC, NmeasureQC, weightsumQC
+                - weighted mean/std of slowness, number of measurements and sum of weights after quality control
+    tempvel     - velocity (1/slowness_sumQC)
+    tempsem     - standard error of the mean of velocity
+    index_outlier
+                - index array for outliers, shape: Nevent, Nx, Ny
+    ==============================================================================================
+    """
+    Nevent, Nx, Ny                  = slownessALL.shape
+    validALL                        = np.zeros((Nevent, Nx, Ny), dtype='float32')
+    #-----------------------------------------------
+    # Get weight for each grid point per event
+    #-----------------------------------------------
+    if use_numba:
+        validALL[reason_nALL==0]    = 1
+        weightALL                   = _get_azi_weight(aziALL, validALL)
+        weightALL[reason_nALL!=0]   = 0
+        weightALL[weightALL!=0]     = 1./weightALL[weightALL!=0]
+        weightsum                   = np.sum(weightALL, axis=0)
+    else:
+        azi_event1                  = np.broadcast_to(aziALL, (Nevent, Nevent, Nx, Ny))
+        azi_event2                  = np.swapaxes(azi_event1, 0, 1)
+        validALL[reason_nALL==0]    = 1
+        validALL4                   = np.broadcast_to(validALL, (Nevent, Nevent, Nx, Ny))
+        # use numexpr for very large array manipulations
+        del_aziALL                  = numexpr.evaluate('abs(azi_event1-azi_event2)')
+        index_azi                   = numexpr.evaluate('(1*(del_aziALL<20)+1*(del_aziALL>340))*validALL4')
+        weightALL                   = numexpr.evaluate('sum(index_azi, 0)')
+        weightALL[reason_nALL!=0]   = 0
+        weightALL[weightALL!=0]     = 1./weightALL[weightALL!=0]
+        weightsum                   = np.sum(weightALL, axis=0)
+    #-----------------------------------------------
+    # reduce large weight to some value.
+    #-----------------------------------------------
+    avgArr                          = np.zeros((Nx, Ny))
+    avgArr[Nmeasure!=0]             = weightsum[Nmeasure!=0]/Nmeasure[Nmeasure!=0]
+    # bug fixed, 02/07/2018
+    signALL                         = weightALL.copy()
+    signALL[signALL!=0]             = 1.
+    stdArr                          = np.sum( signALL*(weightALL-avgArr)**2, axis=0)
+    stdArr[Nmeasure!=0]             = stdArr[Nmeasure!=0]/Nmeasure[Nmeasure!=0]
+    stdArr                          = np.sqrt(stdArr)
+    threshhold                      = np.broadcast_to(avgArr+3.*stdArr, weightALL.shape)
+    weightALL[weightALL>threshhold] = threshhold[weightALL>threshhold] # threshhold truncated weightALL
+    # recompute weight arrays after large weight value reduction
+    weightsum                       = np.sum(weightALL, axis=0)
+    weightsumALL                    = np.broadcast_to(weightsum, weightALL.shape)
+    # weight over all events, note that before this, weightALL is weight over events in azimuth bin
+    weightALL[weightsumALL!=0]      = weightALL[weightsumALL!=0]/weightsumALL[weightsumALL!=0] 
+    ###
+    weightALL[weightALL==1.]        = 0. # data will be discarded if no other data within 20 degree
+    #-----------------------------------------------
+    # Compute mean/std of slowness
+    #-----------------------------------------------
+    slownessALL2                    = slownessALL*weightALL
+    slowness_sum                    = np.sum(slownessALL2, axis=0)
+    slowness_sumALL                 = np.broadcast_to(slowness_sum, weightALL.shape)
+    # weighted standard deviation
+    # formula: https://www.itl.nist.gov/div898/software/dataplot/refman2/ch2/weightsd.pdf
+    signALL                         = weightALL.copy()
+    signALL[signALL!=0]             = 1.
+    MArr                            = np.sum(signALL, axis=0)
+    temp                            = weightALL*(slownessALL-slowness_sumALL)**2
+    temp                            = np.sum(temp, axis=0)
+    slowness_std                    = np.zeros(temp.shape)
+    tind                            = (weightsum!=0)*(MArr!=1)*(MArr!=0)
+    slowness_std[tind]              = np.sqrt(temp[tind]/ ( weightsum[tind]*(MArr[tind]-1)/MArr[tind] ) )
+    slowness_stdALL                 = np.broadcast_to(slowness_std, weightALL.shape)
+    #-----------------------------------------------
+    # discard outliers of slowness
+    #-----------------------------------------------
+    weightALLQC                     = weightALL.copy()
+    index_outlier                   = (np.abs(slownessALL-slowness_sumALL))>2.*slowness_stdALL
+    index_outlier                   += reason_nALL != 0
+    weightALLQC[index_outlier]      = 0
+    weightsumQC                     = np.sum(weightALLQC, axis=0)
+    NmALL                           = np.sign(weightALLQC)
+    NmeasureQC                      = np.sum(NmALL, axis=0)
+    weightsumQCALL                  = np.broadcast_to(weightsumQC, weightALL.shape)
+    weightALLQC[weightsumQCALL!=0]  = weightALLQC[weightsumQCALL!=0]/weightsumQCALL[weightsumQCALL!=0]
+    temp                            = weightALLQC*slownessALL
+    slowness_sumQC                  = np.sum(temp, axis=0)
+    # new
+    signALLQC                       = weightALLQC.copy()
+    signALLQC[signALLQC!=0]         = 1.
+    MArrQC                          = np.sum(signALLQC, axis=0)
+    temp                            = weightALLQC*(slownessALL-slowness_sumQC)**2
+    temp                            = np.sum(temp, axis=0)
+    slowness_stdQC                  = np.zeros(temp.shape)
+    # weightsumQC != 0 implies MArrQC != 0
+    tind                            = (weightsumQC!=0)*(MArrQC!=1)
+    slowness_stdQC[tind]            = np.sqrt(temp[tind]/ ( weightsumQC[tind]*(MArrQC[tind]-1)/MArrQC[tind] ))
+    tempvel                         = slowness_sumQC.copy()
+    tempvel[tempvel!=0]             = 1./ tempvel[tempvel!=0]
+    #----------------------------------------------------------------------------------------
+    # standard error of the mean, updated on 09/20/2018
+    # formula: https://en.wikipedia.org/wiki/Weighted_arithmetic_mean#Statistical_properties
+    #----------------------------------------------------------------------------------------
+    slownessALL_temp                = slownessALL.copy()
+    slownessALL_temp[slownessALL_temp==0.]\
+                                    = 0.3
+    if np.any(weightALLQC[slownessALL==0.]> 0.):
+        raise ValueError('Check weight array!')
+    temp                            = (weightALLQC*(1./slownessALL_temp-tempvel))**2
+    temp                            = np.sum(temp, axis=0)
+    tempsem                         = np.zeros(temp.shape)
+    tind                            = (weightsumQC!=0)*(MArrQC!=1)
+    tempsem[tind]                   = np.sqrt( temp[tind] * ( MArrQC[tind]/(weightsumQC[tind])**2/(MArrQC[tind]-1) ) ) 
+    return slowness_sumQC, slowness_stdQC, NmeasureQC, weightsumQC, tempvel, tempsem, index_outlier
+
+# compiled function for the anisotropic stacking of helm_stack
+#   the measurements at the nine grid points ix + (0, gridx, 2*gridx), iy + (0, gridy, 2*gridy) are stacked,
+#   each grid point of the stencil is scanned once, the number of measurements, mean and sum of squared
+#   deviations for each bin are accumulated in a single pass (Welford's algorithm) and merged over the stencil,
+#   output grid points are processed in parallel.
+#   Same as the former per-bin version: the measurements of a stencil point are used for the mean only if there
+#   are at least two of them in the bin, but the single ones still contribute to the sum of squared deviations
+#   (which is left unnormalized if no stencil point has two measurements in the bin)
+@jit(numba.types.Tuple((float64[:, :, :], float64[:, :, :], float64[:, :, :], float64[:, :, :]))\
+     (float32[:, :, :], float64[:, :, :], float64[:, :], numba.boolean[:, :, :], int32, int32, float32, float32, int32),\
+     nopython=True, parallel=True)
+def _anisotropic_stacking_helm_kernel(aziALL, slownessALL, slowness_sumQC, index_outlier, gridx, gridy, minazi, d_bin, N_bin):
+    Nevent, Nx, Ny  = aziALL.shape
+    Nx_trim         = Nx - 2*gridx
+    Ny_trim         = Ny - 2*gridy
+    nmin_bin        = 2
+    # number of measurements in each bin
+    histArr         = np.zeros((N_bin, Nx_trim, Ny_trim))
+    # slowness in each bin
+    slow_sum_ani    = np.zeros((N_bin, Nx_trim, Ny_trim))
+    # slowness uncertainties for each bin
+    slow_un         = np.zeros((N_bin, Nx_trim, Ny_trim))
+    # velocity uncertainties for each bin
+    vel_un          = np.zeros((N_bin, Nx_trim, Ny_trim))
+    for inode in numba.prange(Nx_trim*Ny_trim):
+        ix          = inode // Ny_trim
+        iy          = inode % Ny_trim
+        # measurements used for the mean
+        sumNbin     = np.zeros(N_bin)
+        dslow_mean  = np.zeros(N_bin)
+        dslow_m2    = np.zeros(N_bin)
+        vel_mean    = np.zeros(N_bin)
+        vel_m2      = np.zeros(N_bin)
+        # single measurements of a stencil point, sum and sum of squares
+        Nsingle     = np.zeros(N_bin)
+        dslow_s1    = np.zeros(N_bin)
+        dslow_s2    = np.zeros(N_bin)
+        vel_s1      = np.zeros(N_bin)
+        vel_s2      = np.zeros(N_bin)
+        # statistics of one stencil point
+        Npt         = np.zeros(N_bin)
+        dslow_pt    = np.zeros(N_bin)
+        dslow_pt2   = np.zeros(N_bin)
+        vel_pt      = np.zeros(N_bin)
+        vel_pt2     = np.zeros(N_bin)
+        for ishift_x in range(3):
+            for ishift_y in range(3):
+                px      = ix + ishift_x*gridx
+                py      = iy + ishift_y*gridy
+                Npt[:]      = 0.
+                dslow_pt[:] = 0.
+                dslow_pt2[:]= 0.
+                vel_pt[:]   = 0.
+                vel_pt2[:]  = 0.
+                for iev in range(Nevent):
+                    if index_outlier[iev, px, py]:
+                        continue
+                    # float32 arithmetic, same binning as the former numpy version
+                    ibin_temp   = np.floor((aziALL[iev, px, py] - minazi)/d_bin)
+                    # NaN azimuth is also discarded
+                    if not (ibin_temp >= 0 and ibin_temp < N_bin):
+                        continue
+                    ibin        = int(ibin_temp)
+                    slow        = slownessALL[iev, px, py]
+                    temp_dslow  = slow - slowness_sumQC[px, py]
+                    if slow != 0.:
+                        temp_vel= 1./slow
+                    else:
+                        temp_vel= 0.
+                    # Welford's update
+                    Npt[ibin]       += 1
+                    delta           = temp_dslow - dslow_pt[ibin]
+                    dslow_pt[ibin]  += delta/Npt[ibin]
+                    dslow_pt2[ibin] += delta*(temp_dslow - dslow_pt[ibin])
+                    delta           = temp_vel - vel_pt[ibin]
+                    vel_pt[ibin]    += delta/Npt[ibin]
+                    vel_pt2[ibin]   += delta*(temp_vel - vel_pt[ibin])
+                for ibin in range(N_bin):
+                    if Npt[ibin] >= nmin_bin:
+                        # merge the statistics of the stencil point (Chan et al.)
+                        Ntotal          = sumNbin[ibin] + Npt[ibin]
+                        delta           = dslow_pt[ibin] - dslow_mean[ibin]
+                        dslow_mean[ibin]+= delta*Npt[ibin]/Ntotal
+                        dslow_m2[ibin]  += dslow_pt2[ibin] + delta*delta*sumNbin[ibin]*Npt[ibin]/Ntotal
+                        delta           = vel_pt[ibin] - vel_mean[ibin]
+                        vel_mean[ibin]  += delta*Npt[ibin]/Ntotal
+                        vel_m2[ibin]    += vel_pt2[ibin] + delta*delta*sumNbin[ibin]*Npt[ibin]/Ntotal
+                        sumNbin[ibin]   = Ntotal
+                    elif Npt[ibin] == 1:
+                        Nsingle[ibin]   += 1
+                        dslow_s1[ibin]  += dslow_pt[ibin]
+                        dslow_s2[ibin]  += dslow_pt[ibin]**2
+                        vel_s1[ibin]    += vel_pt[ibin]
+                        vel_s2[ibin]    += vel_pt[ibin]**2
+        for ibin in range(N_bin):
+            # squared deviations of the single measurements from the mean
+            dslow_un    = dslow_m2[ibin] + dslow_s2[ibin] - 2.*dslow_mean[ibin]*dslow_s1[ibin] + Nsingle[ibin]*dslow_mean[ibin]**2
+            vel_un_temp = vel_m2[ibin] + vel_s2[ibin] - 2.*vel_mean[ibin]*vel_s1[ibin] + Nsingle[ibin]*vel_mean[ibin]**2
+            if sumNbin[ibin] != 0:
+                dslow_un    = np.sqrt(dslow_un/(sumNbin[ibin] - 1)/sumNbin[ibin])
+                vel_un_temp = np.sqrt(vel_un_temp/(sumNbin[ibin] - 1)/sumNbin[ibin])
+            histArr[ibin, ix, iy]       = sumNbin[ibin]
+            slow_sum_ani[ibin, ix, iy]  = dslow_mean[ibin]
+            slow_un[ibin, ix, iy]       = dslow_un
+            vel_un[ibin, ix, iy]        = vel_un_temp
+    return histArr, slow_sum_ani, slow_un, vel_un
+
+def _anisotropic_stacking_helm(aziALL, slownessALL, slowness_sumQC, index_outlier, gridx, gridy, minazi, maxazi, N_bin):
+    """anisotropic stacking for helm_stack, the measurements at nine grid points (spacing: gridx/gridy) are stacked
+        see _anisotropic_stacking_helm_kernel
+    ==============================================================================================
+    ::: output :::
+    histArr_cutted, slow_sum_ani_cutted, slow_un_cutted, vel_un_cutted
+                - shape: N_bin, Nx - 2*gridx, Ny - 2*gridy
+    ==============================================================================================
+    """
+    # bin width, same expression as the former version (integer division for integer azimuth limits)
+    d_bin                           = (maxazi-minazi)/N_bin
+    return _anisotropic_stacking_helm_kernel(np.asarray(aziALL, dtype=np.float32), np.asarray(slownessALL, dtype=np.float64),\
+                np.asarray(slowness_sumQC, dtype=np.float64), np.asarray(index_outlier, dtype=bool), np.int32(gridx), np.int32(gridy),\
+                np.float32(minazi), np.float32(d_bin), np.int32(N_bin))
+
+#-------------------------------------------------------------------------------------------------
+# chunked layout of per-event eikonal results
+#   per-event groups (default layout): Eikonal_run_x/%g_sec/evid/appV ...
+#   chunked layout: Eikonal_run_x/%g_sec/appV ..., one (Nevent, Nlat, Nlon) chunked and compressed
+#       dataset for each quantity, event information (evid, evlo, evla, Ntotal_grd, Nvalid_grd) is
+#       stored in (Nevent,) arrays, row iev of all the datasets belongs to event evid[iev]
+#-------------------------------------------------------------------------------------------------
+_event_info_names   = ['evlo', 'evla', 'Ntotal_grd', 'Nvalid_grd']
+
+def _is_chunked_layout(per_group):
+    """check whether the per-period group is in chunked layout or not
+    """
+    return per_group.attrs.get('layout', 'group') == 'chunked'
+
+def _get_event_list(per_group):
+    """get the event id list of a per-period group, for both layouts
+    """
+    if _is_chunked_layout(per_group):
+        return [str(evid) for evid in per_group['evid'][()]]
+    return per_group.keys()
+
+def _read_event_data(per_group, iev, evid, name):
+    """read the data array/attribute of an event, for both layouts
+    ==============================================================================================
+    ::: input parameters :::
+    per_group   - per-period group
+    iev         - index of the event in the list from _get_event_list
+    evid        - event id
+    name        - name of the dataset (appV, az ...) or attribute (evlo, Ntotal_grd ...)
+    ==============================================================================================
+    """
+    if _is_chunked_layout(per_group):
+        return per_group[name][iev]
+    event_group = per_group[evid]
+    if name in _event_info_names:
+        return event_group.attrs[name]
+    return event_group[name][()]
+
+def _get_lowcov(per_group, evLst, coverage):
+    """get the events with coverage rate ({Number of valid grid points}/{Number of total grid points}) lower than coverage
+    """
+    Nevent      = len(evLst)
+    is_lowcov   = np.zeros(Nevent, dtype=np.bool)
+    if _is_chunked_layout(per_group):
+        Ntotal_grd  = per_group['Ntotal_grd'][()].astype(np.float64)
+        Nvalid_grd  = per_group['Nvalid_grd'][()].astype(np.float64)
+        ind         = Ntotal_grd > 0.
+        is_lowcov[ind]  = Nvalid_grd[ind]/Ntotal_grd[ind] < coverage
+        return is_lowcov
+    for iev in range(Nevent):
+        event_group                 = per_group[evLst[iev]]
+        try:
+            Ntotal_grd              = event_group.attrs['Ntotal_grd']
+            Nvalid_grd              = event_group.attrs['Nvalid_grd']
+            if float(Nvalid_grd)/float(Ntotal_grd)< coverage:
+                is_lowcov[iev]      = True
+        except:
+            pass
+    return is_lowcov
+
+class ChunkedEventWriter(object):
+    """
+    A class to append the per-event eikonal results of one period to the chunked datasets
+    ==============================================================================================
+    ::: parameters :::
+    per_group   - per-period group
+    compression - compression filter of the datasets (None for no compression)
+    chunk_kb    - approximate size of a chunk of the per-event arrays in kB
+    ----------------------------------------------------------------------------------------------
+    the per-event arrays (Nevent, Nlat, Nlon) are chunked as (1, rows, Nlon), i.e. blocked along latitude,
+    so that a tile of rows read by eikonal_stack/helm_stack (maxmem) only decompresses the chunks
+    overlapping the tile, and the whole frame is still written at once for each event.
+    smaller chunks reduce the data read for narrow tiles, at the cost of compression ratio and overhead
+    ==============================================================================================
+    """
+    def __init__(self, per_group, compression='gzip', compression_opts=4, chunk_kb=64.):
+        if (not _is_chunked_layout(per_group)) and len(per_group.keys()) > 0:
+            raise ValueError('Per-event groups exist in '+per_group.name+', chunked layout can not be used!')
+        per_group.attrs['layout']   = 'chunked'
+        self.per_group          = per_group
+        self.compression        = compression
+        self.compression_opts   = compression_opts
+        self.chunk_kb           = chunk_kb
+        if compression is None:
+            self.compression_opts   = None
+        if 'evid' in per_group:
+            self.evidict        = dict([(str(evid), iev) for iev, evid in enumerate(per_group['evid'][()])])
+        else:
+            per_group.create_dataset(name='evid', shape=(0,), maxshape=(None,), dtype=h5py.special_dtype(vlen=str), chunks=(1024,))
+            self.evidict        = {}
+        self.Nevent             = len(self.evidict)
+        return
+    
+    def _require_dataset(self, name, data):
+        """get the dataset, create one with shape (Nevent, data.shape) if it does not exist
+        """
+        if name in self.per_group:
+            return self.per_group[name]
+        data    = np.asarray(data)
+        if data.ndim == 0:
+            chunks  = (1024, )
+            opts    = {}
+        elif data.ndim == 1:
+            chunks  = (1, ) + data.shape
+            opts    = {'compression': self.compression, 'compression_opts': self.compression_opts, 'shuffle': self.compression is not None}
+        else:
+            # blocked along latitude, all the longitudes of a row are in one chunk
+            rowbytes= data.dtype.itemsize*np.prod(data.shape[1:])
+            Nrow    = int(min(data.shape[0], max(1, self.chunk_kb*1024./rowbytes)))
+            chunks  = (1, Nrow) + data.shape[1:]
+            opts    = {'compression': self.compression, 'compression_opts': self.compression_opts, 'shuffle': self.compression is not None}
+        return self.per_group.create_dataset(name=name, shape=(self.Nevent,)+data.shape, maxshape=(None,)+data.shape,\
+                        dtype=data.dtype, chunks=chunks, **opts)
+    
+    def write(self, evid, evinfo, evdata):
+        """write the results of an event, existing results of the same event will be overwritten
+        ==============================================================================================
+        ::: input parameters :::
+        evid        - event id
+        evinfo      - dictionary of event information (evlo, evla, Ntotal_grd, Nvalid_grd)
+        evdata      - dictionary of data arrays (appV, reason_n, proAngle, az, baz, travelT ...)
+        ==============================================================================================
+        """
+        evid            = str(evid)
+        if evid in self.evidict:
+            iev         = self.evidict[evid]
+        else:
+            iev         = self.Nevent
+            self.Nevent += 1
+            self.evidict[evid]  = iev
+            # extend all the datasets by one event
+            for name in self.per_group.keys():
+                self.per_group[name].resize(self.Nevent, axis=0)
+            self.per_group['evid'][iev] = evid
+        for name, data in evinfo.items() + evdata.items():
+            dset        = self._require_dataset(name, data)
+            if dset.shape[0] < self.Nevent:
+                dset.resize(self.Nevent, axis=0)
+            dset[iev]   = data
+        return
+
 def to_percent(y, position):
     # Ignore the passed in position. This has the effect of scaling the default
     # tick locations.
@@ -178,21 +647,20 @@ def plot_fault_lines(mapobj, infname, lw=2, color='red'):
         x, y  = mapobj(lonlst, latlst)
         mapobj.plot(x, y,  lw = lw, color=color)
 
-@jit(numba.types.Tuple((float64[:, :, :], float64[:, :, :], float64[:, :, :], float64[:, :]))\
-     (int32, int32, float32, float32, int32, float64[:, :], float64[:, :, :], float64[:, :], float64[:, :, :], numba.boolean[:, :, :]))
+# compiled function for anisotropic stacking
+#   each measurement is binned once, the number of measurements, mean and sum of squared deviations of
+#   slowness perturbation and velocity for each (bin, grid point) are accumulated in a single pass (Welford's algorithm),
+#   grid points are processed in parallel
+@jit(numba.types.Tuple((float64[:, :, :], float64[:, :, :], float64[:, :, :], float64[:, :, :], float64[:, :]))\
+     (int32, int32, float64, float64, int32, int32[:, :], float32[:, :, :], float64[:, :], float64[:, :, :], numba.boolean[:, :, :]),\
+     nopython=True, parallel=True)
 def _anisotropic_stacking(gridx, gridy, maxazi, minazi, N_bin, Nmeasure, aziALL,\
         slowness_sumQC, slownessALL, index_outlier):
     Nevent, Nx, Ny  = aziALL.shape
     Nx_trim         = Nx - (gridx - 1)
     Ny_trim         = Ny - (gridy - 1)
     NmeasureAni     = np.zeros((Nx_trim, Ny_trim), dtype=np.float64) # for quality control
-    for ishift_x in range(gridx):
-        for ishift_y in range(gridy):
-            for ix in range(Nx_trim):
-                for iy in range(Ny_trim):
-                    NmeasureAni[ix, iy]  += Nmeasure[ix + ishift_x, iy + ishift_y]
-    # initialization of anisotropic parameters
-    d_bin           = float((maxazi-minazi)/N_bin)
+    d_bin           = (maxazi-minazi)/N_bin
     # number of measurements in each bin
     histArr         = np.zeros((N_bin, Nx_trim, Ny_trim))
     # slowness in each bin
@@ -201,79 +669,47 @@ def _anisotropic_stacking(gridx, gridy, maxazi, minazi, N_bin, Nmeasure, aziALL,
     dslow_un        = np.zeros((N_bin, Nx_trim, Ny_trim))
     # velocity uncertainties for each bin
     vel_un          = np.zeros((N_bin, Nx_trim, Ny_trim))
-    #----------------------------------------------------------------------------------
-    # Loop over azimuth bins to get slowness, velocity and number of measurements
-    #----------------------------------------------------------------------------------
-    for ibin in range(N_bin):
-        sumNbin                     = np.zeros((Nx_trim, Ny_trim))
-        # slowness arrays
-        dslowbin                    = np.zeros((Nx_trim, Ny_trim))
-        dslow_un_ibin               = np.zeros((Nx_trim, Ny_trim))
-        dslow_mean                  = np.zeros((Nx_trim, Ny_trim))
-        # velocity arrays
-        velbin                      = np.zeros((Nx_trim, Ny_trim))
-        vel_un_ibin                 = np.zeros((Nx_trim, Ny_trim))
-        vel_mean                    = np.zeros((Nx_trim, Ny_trim))
-        for ix in range(Nx_trim):
-            for iy in range(Ny_trim):
-                for ishift_x in range(gridx):
-                    for ishift_y in range(gridy):
-                        for iev in range(Nevent):
-                            azi         = aziALL[iev, ix + ishift_x, iy + ishift_y]
-                            ibin_temp   = np.floor((azi - minazi)/d_bin)
-                            if ibin_temp != ibin:
-                                continue
-                            is_outlier  = index_outlier[iev, ix + ishift_x, iy + ishift_y]
-                            if is_outlier:
-                                continue
-                            temp_dslow  = slownessALL[iev, ix + ishift_x, iy + ishift_y] - slowness_sumQC[ix + ishift_x, iy + ishift_y]
-                            if slownessALL[iev, ix + ishift_x, iy + ishift_y] != 0.:
-                                temp_vel= 1./slownessALL[iev, ix + ishift_x, iy + ishift_y]
-                            else:
-                                temp_vel= 0.
-                            sumNbin[ix, iy]     += 1
-                            dslowbin[ix, iy]    += temp_dslow
-                            velbin[ix, iy]      += temp_vel
-                # end nested loop of grid shifting
-                if sumNbin[ix, iy] >= 2:
-                    vel_mean[ix, iy]            = velbin[ix, iy] / sumNbin[ix, iy]
-                    dslow_mean[ix, iy]          = dslowbin[ix, iy] / sumNbin[ix, iy]
-                else:
-                    sumNbin[ix, iy]             = 0
-        # compute uncertainties
-        for ix in range(Nx_trim):
-            for iy in range(Ny_trim):
-                for ishift_x in range(gridx):
-                    for ishift_y in range(gridy):
-                        for iev in range(Nevent):
-                            azi                     = aziALL[iev, ix + ishift_x, iy + ishift_y]
-                            ibin_temp               = np.floor((azi - minazi)/d_bin)
-                            if ibin_temp != ibin:
-                                continue
-                            is_outlier              = index_outlier[iev, ix + ishift_x, iy + ishift_y]
-                            if is_outlier:
-                                continue
-                            if slownessALL[iev, ix + ishift_x, iy + ishift_y] != 0.:
-                                temp_vel            = 1./slownessALL[iev, ix + ishift_x, iy + ishift_y]
-                            else:
-                                temp_vel            = 0.
-                            temp_vel_mean           = vel_mean[ix, iy]
-                            vel_un_ibin[ix, iy]     += (temp_vel - temp_vel_mean)**2
-                            temp_dslow              = slownessALL[iev, ix + ishift_x, iy + ishift_y] - slowness_sumQC[ix + ishift_x, iy + ishift_y]
-                            temp_dslow_mean         = dslow_mean[ix, iy]
-                            dslow_un_ibin[ix, iy]   += (temp_dslow - temp_dslow_mean)**2
-        for ix in range(Nx_trim):
-            for iy in range(Ny_trim):
-                if sumNbin[ix, iy] < 2:
-                    continue
-                vel_un_ibin[ix, iy]             = np.sqrt(vel_un_ibin[ix, iy]/(sumNbin[ix, iy] - 1)/sumNbin[ix, iy])
-                vel_un[ibin, ix, iy]            = vel_un_ibin[ix, iy]
-                dslow_un_ibin[ix, iy]           = np.sqrt(dslow_un_ibin[ix, iy]/(sumNbin[ix, iy] - 1)/sumNbin[ix, iy])
-                dslow_un[ibin, ix, iy]          = dslow_un_ibin[ix, iy]
-                histArr[ibin, ix, iy]           = sumNbin[ix, iy]
-                dslow_sum_ani[ibin, ix, iy]     = dslow_mean[ix, iy]
+    for inode in numba.prange(Nx_trim*Ny_trim):
+        ix          = inode // Ny_trim
+        iy          = inode % Ny_trim
+        sumNbin     = np.zeros(N_bin)
+        dslow_mean  = np.zeros(N_bin)
+        dslow_m2    = np.zeros(N_bin)
+        vel_mean    = np.zeros(N_bin)
+        vel_m2      = np.zeros(N_bin)
+        for ishift_x in range(gridx):
+            for ishift_y in range(gridy):
+                NmeasureAni[ix, iy] += Nmeasure[ix + ishift_x, iy + ishift_y]
+                for iev in range(Nevent):
+                    if index_outlier[iev, ix + ishift_x, iy + ishift_y]:
+                        continue
+                    ibin_temp   = np.floor((aziALL[iev, ix + ishift_x, iy + ishift_y] - minazi)/d_bin)
+                    # NaN azimuth is also discarded
+                    if not (ibin_temp >= 0 and ibin_temp < N_bin):
+                        continue
+                    ibin        = int(ibin_temp)
+                    slow        = slownessALL[iev, ix + ishift_x, iy + ishift_y]
+                    temp_dslow  = slow - slowness_sumQC[ix + ishift_x, iy + ishift_y]
+                    if slow != 0.:
+                        temp_vel= 1./slow
+                    else:
+                        temp_vel= 0.
+                    # Welford's update
+                    sumNbin[ibin]   += 1
+                    delta           = temp_dslow - dslow_mean[ibin]
+                    dslow_mean[ibin]+= delta/sumNbin[ibin]
+                    dslow_m2[ibin]  += delta*(temp_dslow - dslow_mean[ibin])
+                    delta           = temp_vel - vel_mean[ibin]
+                    vel_mean[ibin]  += delta/sumNbin[ibin]
+                    vel_m2[ibin]    += delta*(temp_vel - vel_mean[ibin])
+        for ibin in range(N_bin):
+            if sumNbin[ibin] < 2:
+                continue
+            vel_un[ibin, ix, iy]        = np.sqrt(vel_m2[ibin]/(sumNbin[ibin] - 1)/sumNbin[ibin])
+            dslow_un[ibin, ix, iy]      = np.sqrt(dslow_m2[ibin]/(sumNbin[ibin] - 1)/sumNbin[ibin])
+            histArr[ibin, ix, iy]       = sumNbin[ibin]
+            dslow_sum_ani[ibin, ix, iy] = dslow_mean[ibin]
     return dslow_sum_ani, dslow_un, vel_un, histArr, NmeasureAni
-        
 
 
 class EikonalTomoDataSet(h5py.File):
@@ -316,10 +752,15 @@ class EikonalTomoDataSet(h5py.File):
         subgroup    = self['Eikonal_run_%d' %runid]
         pers        = self.attrs['period_array']
         perid       = '%d_sec' %pers[0]
-        Nevent      = len(subgroup[perid].keys())
+        evLst       = _get_event_list(subgroup[perid])
+        Nevent      = len(evLst)
         outstr      += '--- number of (virtual) events                  - '+str(Nevent)+'\n'
-        evid        = subgroup[perid].keys()[0]
-        evgrp       = subgroup[perid][evid]
+        if _is_chunked_layout(subgroup[perid]):
+            outstr  += '--- layout                                      - chunked, (Nevent, Nlat, Nlon) datasets, evid array \n'
+            evgrp   = subgroup[perid]
+        else:
+            evid    = evLst[0]
+            evgrp   = subgroup[perid][evid]
         outstr      += '--- attributes for each event                   - evlo, evla, Nvalid_grd, Ntotal_grd \n'
         outstr      += '--- appV (apparent velocity)                    - '+str(evgrp['appV'].shape)+'\n'
         try:    
@@ -641,27 +1082,36 @@ class EikonalTomoDataSet(h5py.File):
         return
     
     def xcorr_eikonal_mp(self, inasdffname, workingdir, fieldtype='Tph', channel='ZZ', data_type='FieldDISPpmf2interp',\
-                runid=0, new_group=True, deletetxt=True, verbose=False, subsize=1000, nprocess=None, cdist=150., mindp=10, pers=None):
+                runid=0, new_group=True, deletetxt=True, verbose=False, subsize=1000, nprocess=None, cdist=150., mindp=10, pers=None, chunksize=None, timeout=None,\
+                layout='group'):
         """
         Compute gradient of travel time for cross-correlation data with multiprocessing
         =================================================================================================================
         ::: input parameters :::
         inh5fname   - input hdf5 data file
-        workingdir  - working directory
+        workingdir  - working directory for the scratch files of gmt surface (the results are returned by the workers directly)
         fieldtype   - fieldtype (Tph or Tgr)
         channel     - channel for analysis (default = ZZ )
         data_type   - data type
                      (default='FieldDISPpmf2interp', aftan measurements with phase-matched filtering and jump correction)
         runid       - run id
-        deletetxt   - delete output txt files in working directory
-        subsize     - subsize of processing list, use to prevent lock in multiprocessing process
+        deletetxt   - delete the working directory if it exists
+        subsize     - not used, kept for backward compatibility (tasks are dynamically scheduled by mppool)
         nprocess    - number of processes
+        chunksize   - number of fields sent to a worker at once, default is decided by mppool.pool_map
+        timeout     - timeout for each field in sec, None for no timeout
         cdist       - distance for nearneighbor station criteria
         mindp       - minnimum required number of data points for eikonal operator
+        layout      - layout of the output per-event results
+                        'group'     - one group for each event, with small datasets of each quantity
+                        'chunked'   - one (Nevent, Nlat, Nlon) chunked and compressed dataset for each quantity,
+                                        and (Nevent,) arrays of event id and event information
         =================================================================================================================
         """
         if fieldtype!='Tph' and fieldtype!='Tgr':
             raise ValueError('Wrong field type: '+fieldtype+' !')
+        if layout!='group' and layout!='chunked':
+            raise ValueError('Wrong layout: '+layout+' !')
         if new_group:
             create_group        = False
             while (not create_group):
@@ -708,9 +1158,6 @@ class EikonalTomoDataSet(h5py.File):
             else:
                 dper        = str(del_per)
                 persfx      = str(int(per))+'sec'+dper.split('.')[1]
-            working_per     = workingdir+'/'+str(per)+'sec'
-            if not os.path.isdir(working_per):
-                os.makedirs(working_per)
             for evid in evLst:
                 netcode1, stacode1  = evid.split('.')
                 try:
@@ -734,73 +1181,63 @@ class EikonalTomoDataSet(h5py.File):
                 fieldLst.append(field2d)
         #-----------------------------------------
         # Computing gradient with multiprocessing
+        #   the results are written to hdf5 dataset in
+        #   the parent process as soon as they are
+        #   received, while workers keep computing
         #-----------------------------------------
-        if len(fieldLst) > subsize:
-            Nsub                    = int(len(fieldLst)/subsize)
-            for isub in range(Nsub):
-                print '--- eikonal computation subset:', isub,'in',Nsub,'sets'
-                cfieldLst           = fieldLst[isub*subsize:(isub+1)*subsize]
-                EIKONAL             = partial(eikonal4mp, workingdir=workingdir, channel=channel, cdist=cdist)
-                pool                = multiprocessing.Pool(processes=nprocess)
-                pool.map(EIKONAL, cfieldLst) #make our results with a map call
-                pool.close() #we are not adding any more processes
-                pool.join() #tell it to wait until all threads are done before going on
-            cfieldLst               = fieldLst[(isub+1)*subsize:]
-            EIKONAL                 = partial(eikonal4mp, workingdir=workingdir, channel=channel, cdist=cdist)
-            pool                    = multiprocessing.Pool(processes=nprocess)
-            pool.map(EIKONAL, cfieldLst) #make our results with a map call
-            pool.close() #we are not adding any more processes
-            pool.join() #tell it to wait until all threads are done before going on
-        else:
-            print '--- eikonal computation, one set'
-            EIKONAL                 = partial(eikonal4mp, workingdir=workingdir, channel=channel, cdist=cdist)
-            pool                    = multiprocessing.Pool(processes=nprocess)
-            pool.map(EIKONAL, fieldLst) #make our results with a map call
-            pool.close() #we are not adding any more processes
-            pool.join() #tell it to wait until all threads are done before going on
-        #-----------------------------------------
-        # Read data into hdf5 dataset
-        #-----------------------------------------
+        per_groups              = {}
+        writers                 = {}
         for per in pers:
-            print '*** reading gradient data for: '+str(per)+' sec'
-            working_per = workingdir+'/'+str(per)+'sec'
-            per_group   = group.create_group( name='%g_sec'%( per ) )
-            for evid in evLst:
-                infname = working_per+'/'+evid+'_field2d.npz'
-                if not os.path.isfile(infname):
-                    if verbose:
-                        print 'No data for:', evid
-                    continue
-                InArr           = np.load(infname)
-                appV            = InArr['arr_0']
-                reason_n        = InArr['arr_1']
-                proAngle        = InArr['arr_2']
-                az              = InArr['arr_3']
-                baz             = InArr['arr_4']
-                Zarr            = InArr['arr_5']
-                Ngrd            = InArr['arr_6']
-                lat1, elv1, lon1= inDbase.waveforms[evid].coordinates.values()
-                # save data to hdf5 dataset
-                event_group     = per_group.create_group(name=evid)
-                event_group.attrs.create(name = 'evlo', data=lon1)
-                event_group.attrs.create(name = 'evla', data=lat1)
-                # added 04/05/2018
-                event_group.attrs.create(name = 'Ntotal_grd', data=Ngrd[0])
-                event_group.attrs.create(name = 'Nvalid_grd', data=Ngrd[1])
-                #
-                appVdset        = event_group.create_dataset(name='appV', data=appV)
-                reason_ndset    = event_group.create_dataset(name='reason_n', data=reason_n)
-                proAngledset    = event_group.create_dataset(name='proAngle', data=proAngle)
-                azdset          = event_group.create_dataset(name='az', data=az)
-                bazdset         = event_group.create_dataset(name='baz', data=baz)
-                Tdset           = event_group.create_dataset(name='travelT', data=Zarr)
-        if deletetxt:
+            perid               = '%g_sec'%( per )
+            per_groups[perid]   = group.create_group( name=perid )
+            if layout == 'chunked':
+                writers[perid]  = ChunkedEventWriter(per_groups[perid])
+        def _write_event(index, results):
+            field2d             = fieldLst[index]
+            perid               = '%g_sec'%( field2d.period )
+            evid                = field2d.evid
+            if results is None:
+                if verbose:
+                    print 'No data for:', evid
+                return
+            appV, reason_n, proAngle, az, baz, Zarr, Ngrd\
+                                = results
+            lat1, elv1, lon1    = inDbase.waveforms[evid].coordinates.values()
+            if layout == 'chunked':
+                writers[perid].write(evid, evinfo={'evlo': lon1, 'evla': lat1, 'Ntotal_grd': Ngrd[0], 'Nvalid_grd': Ngrd[1]},\
+                    evdata={'appV': appV, 'reason_n': reason_n, 'proAngle': proAngle, 'az': az, 'baz': baz, 'travelT': Zarr})
+                return
+            # save data to hdf5 dataset
+            event_group         = per_groups[perid].create_group(name=evid)
+            event_group.attrs.create(name = 'evlo', data=lon1)
+            event_group.attrs.create(name = 'evla', data=lat1)
+            # added 04/05/2018
+            event_group.attrs.create(name = 'Ntotal_grd', data=Ngrd[0])
+            event_group.attrs.create(name = 'Nvalid_grd', data=Ngrd[1])
+            #
+            appVdset            = event_group.create_dataset(name='appV', data=appV)
+            reason_ndset        = event_group.create_dataset(name='reason_n', data=reason_n)
+            proAngledset        = event_group.create_dataset(name='proAngle', data=proAngle)
+            azdset              = event_group.create_dataset(name='az', data=az)
+            bazdset             = event_group.create_dataset(name='baz', data=baz)
+            Tdset               = event_group.create_dataset(name='travelT', data=Zarr)
+            return
+        # working directories of each period for the gmt scratch files, created before the workers start
+        for per in pers:
+            working_per         = workingdir+'/'+str(per)+'sec'
+            if not os.path.isdir(working_per):
+                os.makedirs(working_per)
+        print '--- eikonal computation: '+str(len(fieldLst))+' fields'
+        EIKONAL                 = partial(eikonal4mp, workingdir=workingdir, channel=channel, cdist=cdist, return_data=True)
+        mppool.pool_map(EIKONAL, fieldLst, nprocess=nprocess, chunksize=chunksize, timeout=timeout, callback=_write_event)
+        mppool.close_pool()
+        if deletetxt and os.path.isdir(workingdir):
             shutil.rmtree(workingdir)
         return
     
     def xcorr_eikonal_raydbase_mp(self, inh5fname, workingdir, rayruntype=0, rayrunid=0, period=None, crifactor=0.5, crilimit=10.,\
             fieldtype='Tph', channel='ZZ', data_type='FieldDISPpmf2interp', runid=0, new_group=True, \
-                deletetxt=True, verbose=False, subsize=1000, nprocess=None, cdist=150., mindp=10, pers=None):
+                deletetxt=True, verbose=False, subsize=1000, nprocess=None, cdist=150., mindp=10, pers=None, chunksize=None, timeout=None):
         """
         Compute gradient of travel time for cross-correlation data according to ray tomography database,
             with multiprocessing
@@ -814,8 +1251,10 @@ class EikonalTomoDataSet(h5py.File):
                      (default='FieldDISPpmf2interp', aftan measurements with phase-matched filtering and jump correction)
         runid       - run id
         deletetxt   - delete output txt files in working directory
-        subsize     - subsize of processing list, use to prevent lock in multiprocessing process
+        subsize     - not used, kept for backward compatibility (tasks are dynamically scheduled by mppool)
         nprocess    - number of processes
+        chunksize   - number of fields sent to a worker at once, default is decided by mppool.pool_map
+        timeout     - timeout for each field in sec, None for no timeout
         cdist       - distance for nearneighbor station criteria
         mindp       - minnimum required number of data points for eikonal operator
         =================================================================================================================
@@ -911,29 +1350,10 @@ class EikonalTomoDataSet(h5py.File):
         #-----------------------------------------
         # Computing gradient with multiprocessing
         #-----------------------------------------
-        if len(fieldLst) > subsize:
-            Nsub                    = int(len(fieldLst)/subsize)
-            for isub in range(Nsub):
-                print 'Subset:', isub,'in',Nsub,'sets'
-                cfieldLst           = fieldLst[isub*subsize:(isub+1)*subsize]
-                EIKONAL             = partial(eikonal4mp, workingdir=workingdir, channel=channel, cdist=cdist)
-                pool                = multiprocessing.Pool(processes=nprocess)
-                pool.map(EIKONAL, cfieldLst) #make our results with a map call
-                pool.close() #we are not adding any more processes
-                pool.join() #tell it to wait until all threads are done before going on
-            cfieldLst               = fieldLst[(isub+1)*subsize:]
-            EIKONAL                 = partial(eikonal4mp, workingdir=workingdir, channel=channel, cdist=cdist)
-            pool                    = multiprocessing.Pool(processes=nprocess)
-            pool.map(EIKONAL, cfieldLst) #make our results with a map call
-            pool.close() #we are not adding any more processes
-            pool.join() #tell it to wait until all threads are done before going on
-        else:
-            print 'Computing eikonal tomography'
-            EIKONAL                 = partial(eikonal4mp, workingdir=workingdir, channel=channel, cdist=cdist)
-            pool                    = multiprocessing.Pool(processes=nprocess)
-            pool.map(EIKONAL, fieldLst) #make our results with a map call
-            pool.close() #we are not adding any more processes
-            pool.join() #tell it to wait until all threads are done before going on
+        print 'Computing eikonal tomography'
+        EIKONAL                 = partial(eikonal4mp, workingdir=workingdir, channel=channel, cdist=cdist)
+        mppool.pool_map(EIKONAL, fieldLst, nprocess=nprocess, chunksize=chunksize, timeout=timeout)
+        mppool.close_pool()
         #-----------------------------------------
         # Read data into hdf5 dataset
         #-----------------------------------------
@@ -979,7 +1399,7 @@ class EikonalTomoDataSet(h5py.File):
         return
     
     def xcorr_eikonal_mp_lowmem(self, inasdffname, workingdir, fieldtype='Tph', channel='ZZ', data_type='FieldDISPpmf2interp', runid=0,
-                deletetxt=True, verbose=False, subsize=1000, nprocess=None, cdist=150., mindp=10):
+                deletetxt=True, verbose=False, subsize=1000, nprocess=None, cdist=150., mindp=10, chunksize=None, timeout=None):
         """
         Low memory version of xcorr_eikonal_mp
         """
@@ -989,7 +1409,7 @@ class EikonalTomoDataSet(h5py.File):
             pers        = np.array([per])
             self.xcorr_eikonal_mp(inasdffname=inasdffname, workingdir=workingdir, fieldtype=fieldtype, channel=channel,\
                     data_type=data_type, runid=runid, new_group=False, deletetxt=deletetxt, verbose=verbose, subsize=subsize, nprocess=nprocess,\
-                        cdist=cdist, mindp=mindp, pers=pers)
+                        cdist=cdist, mindp=mindp, pers=pers, chunksize=chunksize, timeout=timeout)
         return
         
     def quake_eikonal(self, inasdffname, workingdir, fieldtype='Tph', channel='Z', data_type='FieldDISPpmf2interp',
@@ -1238,13 +1658,14 @@ class EikonalTomoDataSet(h5py.File):
     
     def quake_eikonal_mp(self, inasdffname, workingdir, fieldtype='Tph', channel='Z', data_type='FieldDISPpmf2interp',
                 pre_qual_ctrl=True, btime_qc=None, etime_qc = None, incat=None, evid_lst=None,  runid=0, merge=True,
-                    deletetxt=True, verbose=True, subsize=1000, nprocess=None, amplplc=False, cdist=150., mindp=50, pers=None):
+                    deletetxt=True, verbose=True, subsize=1000, nprocess=None, amplplc=False, cdist=150., mindp=50, pers=None, chunksize=None, timeout=None,
+                        layout='group'):
         """
         Compute gradient of travel time for cross-correlation data with multiprocessing
         =======================================================================================================================
         ::: input parameters :::
         inasdffname     - input ASDF data file
-        workingdir      - working directory
+        workingdir      - working directory for the scratch files of gmt surface (the results are returned by the workers directly)
         fieldtype       - fieldtype (Tph or Tgr)
         channel         - channel for analysis
         data_type       - data type
@@ -1258,16 +1679,24 @@ class EikonalTomoDataSet(h5py.File):
         evid_lst        - event id list corresponding to incat
         --------------------------------------
         runid           - run id
-        deletetxt       - delete output txt files in working directory
-        subsize         - subsize of processing list, use to prevent lock in multiprocessing process
+        deletetxt       - delete the working directory if it exists
+        subsize         - not used, kept for backward compatibility (tasks are dynamically scheduled by mppool)
         nprocess        - number of processes
+        chunksize       - number of fields sent to a worker at once, default is decided by mppool.pool_map
+        timeout         - timeout for each field in sec, None for no timeout
         amplplc         - compute amplitude Laplacian term or not
         cdist           - distance for nearneighbor station criteria
         mindp           - minnimum required number of data points for eikonal operator
+        layout          - layout of the output per-event results
+                            'group'     - one group for each event, with small datasets of each quantity
+                            'chunked'   - one (Nevent, Nlat, Nlon) chunked and compressed dataset for each quantity,
+                                            and (Nevent,) arrays of event id and event information
         =======================================================================================================================
         """
         if fieldtype!='Tph' and fieldtype!='Tgr':
             raise ValueError('Wrong field type: '+fieldtype+' !')
+        if layout!='group' and layout!='chunked':
+            raise ValueError('Wrong layout: '+layout+' !')
         # merge data to existing group or not
         if merge:
             try:
@@ -1306,6 +1735,7 @@ class EikonalTomoDataSet(h5py.File):
         nlon_lplc           = self.attrs['nlon_lplc']
         fdict               = { 'Tph': 2, 'Tgr': 3, 'amp': 4}
         fieldLst            = []
+        evinfoLst           = []
         # load catalog from input ASDF file
         inDbase             = pyasdf.ASDFDataSet(inasdffname)
         # if incat and evid_lst is specified, skip quality control
@@ -1401,10 +1831,6 @@ class EikonalTomoDataSet(h5py.File):
             else:
                 dper        = str(del_per)
                 persfx      = str(int(per))+'sec'+dper.split('.')[1]
-            working_per     = workingdir+'/'+str(per)+'sec'
-            if not os.path.isdir(working_per):
-                os.makedirs(working_per)
-            per_group       = group.require_group( name='%g_sec'%( per ) )
             evnumb          = 0
             for event in cat:
                 evnumb      +=1
@@ -1455,102 +1881,88 @@ class EikonalTomoDataSet(h5py.File):
                     field2dAmp.read_array(lonArr = dataArr[:,0], latArr = dataArr[:,1], ZarrIn = dataArr[:, fdict['amp']] )
                     fieldpair.append(field2dAmp)
                 fieldLst.append(fieldpair)
+                evinfoLst.append((porigin.longitude, evla))
             # return fieldLst
         #----------------------------------------
         # Computing gradient with multiprocessing
+        #   the results are written to hdf5 dataset
+        #   in the parent process as soon as they
+        #   are received, while workers keep computing
         #----------------------------------------
-        if len(fieldLst) > subsize:
-            Nsub                = int(len(fieldLst)/subsize)
-            for isub in range(Nsub):
-                print '--- eikonal/helmholtz computation: subset:', isub,'in',Nsub,'sets'
-                cfieldLst       = fieldLst[isub*subsize:(isub+1)*subsize]
-                HELMHOTZ        = partial(helmhotz4mp, workingdir=workingdir, channel=channel, amplplc=amplplc, cdist=cdist)
-                pool            = multiprocessing.Pool(processes=nprocess)
-                pool.map(HELMHOTZ, cfieldLst) #make our results with a map call
-                pool.close() #we are not adding any more processes
-                pool.join() #tell it to wait until all threads are done before going on
-            cfieldLst           = fieldLst[(isub+1)*subsize:]
-            HELMHOTZ            = partial(helmhotz4mp, workingdir=workingdir, channel=channel, amplplc=amplplc, cdist=cdist)
-            pool                = multiprocessing.Pool(processes=nprocess)
-            pool.map(HELMHOTZ, cfieldLst) #make our results with a map call
-            pool.close() #we are not adding any more processes
-            pool.join() #tell it to wait until all threads are done before going on
-        else:
-            print '--- eikonal/helmholtz computation: one set'
-            HELMHOTZ            = partial(helmhotz4mp, workingdir=workingdir, channel=channel, amplplc=amplplc, cdist=cdist)
-            pool                = multiprocessing.Pool(processes=nprocess)
-            pool.map(HELMHOTZ, fieldLst) #make our results with a map call
-            pool.close() #we are not adding any more processes
-            pool.join() #tell it to wait until all threads are done before going on
-        #-----------------------------------
-        # read data into hdf5 dataset
-        #-----------------------------------
+        per_groups              = {}
+        writers                 = {}
         for per in pers:
-            print '--- reading gradient data for: '+str(per)+' sec'
-            working_per         = workingdir+'/'+str(per)+'sec'
-            per_group           = group.require_group( name='%g_sec'%( per ) )
-            evnumb              = 0
-            for event in cat:
-                evnumb          += 1
-                # added on 2018-10-10
-                if pre_qual_ctrl:
-                    evid        = evid_lst[evnumb-1]
-                    qc_evid     = 'E%05d' % evnumb
-                else:
-                    evid        = 'E%05d' % evnumb
-                infname         = working_per+'/'+evid+'_field2d.npz'
-                if not os.path.isfile(infname):
-                    print '--- No data for:', evid
-                    continue
-                InArr           = np.load(infname)
-                appV            = InArr['arr_0']
-                reason_n        = InArr['arr_1']
-                proAngle        = InArr['arr_2']
-                az              = InArr['arr_3']
-                baz             = InArr['arr_4']
-                Zarr            = InArr['arr_5']
+            perid               = '%g_sec'%( per )
+            per_groups[perid]   = group.require_group( name=perid )
+            if layout == 'chunked':
+                writers[perid]  = ChunkedEventWriter(per_groups[perid])
+            elif _is_chunked_layout(per_groups[perid]):
+                raise ValueError(per_groups[perid].name+' is in chunked layout, use layout=\'chunked\' for merging!')
+        def _write_event(index, results):
+            field2d             = fieldLst[index][0]
+            perid               = '%g_sec'%( field2d.period )
+            evid                = field2d.evid
+            if results is None:
+                print '--- No data for:', evid
+                return
+            appV, reason_n, proAngle, az, baz, Zarr\
+                                = results[:6]
+            Ngrd                = results[-1]
+            if amplplc:
+                lplc_amp, corV, reason_n_helm\
+                                = results[6:9]
+            evlo, evla          = evinfoLst[index]
+            if layout == 'chunked':
+                evdata          = {'appV': appV, 'reason_n': reason_n, 'proAngle': proAngle, 'az': az, 'baz': baz, 'travelT': Zarr}
                 if amplplc:
-                    lplc_amp        = InArr['arr_6']
-                    corV            = InArr['arr_7']
-                    reason_n_helm   = InArr['arr_8']
-                    Ngrd            = InArr['arr_9']
-                else:
-                    Ngrd            = InArr['arr_6']
-                porigin         = event.preferred_origin()
-                evlo            = porigin.longitude
-                evla            = porigin.latitude
-                evdp            = porigin.depth
-                # save data to hdf5 dataset
-                event_group     = per_group.require_group(name=evid)
-                event_group.attrs.create(name = 'evlo', data=evlo)
-                event_group.attrs.create(name = 'evla', data=evla)
-                # added 04/05/2018
-                event_group.attrs.create(name = 'Ntotal_grd', data=Ngrd[0])
-                event_group.attrs.create(name = 'Nvalid_grd', data=Ngrd[1])
-                # eikonal results
-                appVdset        = event_group.create_dataset(name='appV', data=appV)
-                reason_ndset    = event_group.create_dataset(name='reason_n', data=reason_n)
-                proAngledset    = event_group.create_dataset(name='proAngle', data=proAngle)
-                azdset          = event_group.create_dataset(name='az', data=az)
-                bazdset         = event_group.create_dataset(name='baz', data=baz)
-                Tdset           = event_group.create_dataset(name='travelT', data=Zarr)
-                if amplplc:
-                    lplc_ampdset    = event_group.create_dataset(name='lplc_amp', data=lplc_amp)
-                    corV_dset       = event_group.create_dataset(name='corV', data=corV)
-                    reason_nhelmdset= event_group.create_dataset(name='reason_n_helm', data=reason_n_helm)
-        if deletetxt:
+                    evdata.update({'lplc_amp': lplc_amp, 'corV': corV, 'reason_n_helm': reason_n_helm})
+                writers[perid].write(evid, evinfo={'evlo': evlo, 'evla': evla, 'Ntotal_grd': Ngrd[0], 'Nvalid_grd': Ngrd[1]}, evdata=evdata)
+                return
+            # save data to hdf5 dataset
+            event_group         = per_groups[perid].require_group(name=evid)
+            event_group.attrs.create(name = 'evlo', data=evlo)
+            event_group.attrs.create(name = 'evla', data=evla)
+            # added 04/05/2018
+            event_group.attrs.create(name = 'Ntotal_grd', data=Ngrd[0])
+            event_group.attrs.create(name = 'Nvalid_grd', data=Ngrd[1])
+            # eikonal results
+            appVdset            = event_group.create_dataset(name='appV', data=appV)
+            reason_ndset        = event_group.create_dataset(name='reason_n', data=reason_n)
+            proAngledset        = event_group.create_dataset(name='proAngle', data=proAngle)
+            azdset              = event_group.create_dataset(name='az', data=az)
+            bazdset             = event_group.create_dataset(name='baz', data=baz)
+            Tdset               = event_group.create_dataset(name='travelT', data=Zarr)
+            if amplplc:
+                lplc_ampdset    = event_group.create_dataset(name='lplc_amp', data=lplc_amp)
+                corV_dset       = event_group.create_dataset(name='corV', data=corV)
+                reason_nhelmdset= event_group.create_dataset(name='reason_n_helm', data=reason_n_helm)
+            return
+        # working directories of each period for the gmt scratch files, created before the workers start
+        for per in pers:
+            working_per         = workingdir+'/'+str(per)+'sec'
+            if not os.path.isdir(working_per):
+                os.makedirs(working_per)
+        print '--- eikonal/helmholtz computation: '+str(len(fieldLst))+' fields'
+        HELMHOTZ            = partial(helmhotz4mp, workingdir=workingdir, channel=channel, amplplc=amplplc, cdist=cdist, return_data=True)
+        mppool.pool_map(HELMHOTZ, fieldLst, nprocess=nprocess, chunksize=chunksize, timeout=timeout, callback=_write_event)
+        mppool.close_pool()
+        if deletetxt and os.path.isdir(workingdir):
             shutil.rmtree(workingdir)
         return
     
     def quake_eikonal_mp_lowmem(self, inasdffname, workingdir, fieldtype='Tph', channel='Z', data_type='FieldDISPpmf2interp',
                     pre_qual_ctrl=True, btime_qc = None, etime_qc = None, runid=0, deletetxt=True, verbose=False,
-                        subsize=1000, nprocess=None, amplplc=False, cdist=150., mindp=50, Tmin=-999., Tmax=999.):
+                        subsize=1000, nprocess=None, amplplc=False, cdist=150., mindp=50, Tmin=-999., Tmax=999., chunksize=None, timeout=None,
+                            maxpending=None, layout='group'):
         """
-        Low memory version of xcorr_eikonal_mp
+        Low memory version of quake_eikonal_mp
+        Each task is one event with the field data of all periods, the tasks are generated while the catalog is being
+        looped over, and only a limited number of tasks (maxpending) are kept in memory.
+        The catalog and the field data of each event are read only once.
         =======================================================================================================================
         ::: input parameters :::
         inasdffname     - input ASDF data file
-        workingdir      - working directory
+        workingdir      - working directory for the scratch files of gmt surface (the results are returned by the workers directly)
         fieldtype       - fieldtype (Tph or Tgr)
         channel         - channel for analysis
         data_type       - data type
@@ -1562,107 +1974,180 @@ class EikonalTomoDataSet(h5py.File):
         etime_qc        - end time for quality control
         --------------------------------------
         runid           - run id
-        deletetxt       - delete output txt files in working directory
-        subsize         - subsize of processing list, use to prevent lock in multiprocessing process
+        deletetxt       - delete the working directory if it exists
+        subsize         - not used, kept for backward compatibility (tasks are dynamically scheduled by mppool)
         nprocess        - number of processes
+        chunksize       - not used, kept for backward compatibility (each task is one event)
+        timeout         - timeout in sec, None for no timeout
+        maxpending      - maximum number of events being processed/waiting for a worker, default is decided by mppool.pool_stream
         amplplc         - compute amplitude Laplacian term or not
         cdist           - distance for nearneighbor station criteria
         mindp           - minnimum required number of data points for eikonal operator
         Tmin/Tmax       - minimum/maxsimum period for computation
+        layout          - layout of the output per-event results, see quake_eikonal_mp
         =======================================================================================================================
         """
-        pers_dbase      = self.attrs['period_array']
-        #-------------------------------------------------------------------------------------------------
-        # quality control for the data before performing eikonal/Helmholtz operation, added 10/10/2018
-        #-------------------------------------------------------------------------------------------------
-        inDbase         = pyasdf.ASDFDataSet(inasdffname)
+        if fieldtype!='Tph' and fieldtype!='Tgr':
+            raise ValueError('Wrong field type: '+fieldtype+' !')
+        if layout!='group' and layout!='chunked':
+            raise ValueError('Wrong layout: '+layout+' !')
+        # merge data to existing group
+        try:
+            group           = self.create_group( name = 'Eikonal_run_'+str(runid) )
+            group.attrs.create(name = 'fieldtype', data=fieldtype[1:])
+        except ValueError:
+            print 'Merging Eikonal run id: ',runid
+            group           = self.require_group( name = 'Eikonal_run_'+str(runid) )
+        pers_dbase          = self.attrs['period_array']
+        pers                = pers_dbase[(pers_dbase >= Tmin)*(pers_dbase <= Tmax)]
+        for per in pers_dbase:
+            if per < Tmin or per > Tmax:
+                print '=== SKIP: eikonal tomography for T = '+str(per)+' sec'
+        grdinfo             = {'minlon': self.attrs['minlon'], 'maxlon': self.attrs['maxlon'], 'dlon': self.attrs['dlon'],\
+                               'minlat': self.attrs['minlat'], 'maxlat': self.attrs['maxlat'], 'dlat': self.attrs['dlat']}
+        per_groups          = {}
+        writers             = {}
+        for per in pers:
+            perid               = '%g_sec'%( per )
+            per_groups[perid]   = group.require_group( name=perid )
+            if layout == 'chunked':
+                writers[perid]  = ChunkedEventWriter(per_groups[perid])
+            elif _is_chunked_layout(per_groups[perid]):
+                raise ValueError(per_groups[perid].name+' is in chunked layout, use layout=\'chunked\' for merging!')
+        persfxdict          = {}
+        for per in pers_dbase:
+            del_per         = per-int(per)
+            if del_per == 0.:
+                persfxdict[per] = str(int(per))+'sec'
+            else:
+                dper        = str(del_per)
+                persfxdict[per] = str(int(per))+'sec'+dper.split('.')[1]
+        inDbase             = pyasdf.ASDFDataSet(inasdffname)
         print '--- loading catalog'
-        cat             = inDbase.events
+        cat                 = inDbase.events
         print '--- end loading catalog'
-        L               = len(cat)
-        datalst         = inDbase.auxiliary_data[data_type].list()
-        if pre_qual_ctrl:
-            print '--- quality control for events'
-            qc_cat              = obspy.Catalog()
-            evnumb              = 0
-            qc_evnumb           = 0
-            evid_lst            = []
-            if btime_qc is not None:
-                btime_qc        = obspy.UTCDateTime(btime_qc)
-            else:
-                btime_qc        = obspy.UTCDateTime('1900-01-01')
-            if etime_qc is not None:
-                etime_qc        = obspy.UTCDateTime(etime_qc)
-            else:
-                etime_qc        = obspy.UTCDateTime('2599-01-01')
+        L                   = len(cat)
+        datalst             = inDbase.auxiliary_data[data_type].list()
+        if btime_qc is not None:
+            btime_qc        = obspy.UTCDateTime(btime_qc)
+        else:
+            btime_qc        = obspy.UTCDateTime('1900-01-01')
+        if etime_qc is not None:
+            etime_qc        = obspy.UTCDateTime(etime_qc)
+        else:
+            etime_qc        = obspy.UTCDateTime('2599-01-01')
+        fdict               = { 'Tph': 2, 'Tgr': 3, 'amp': 4}
+        Naccept             = [0]
+        #-------------------------------------------------------------------------------------------------
+        # generator of tasks, quality control for the data before performing eikonal/Helmholtz operation
+        #-------------------------------------------------------------------------------------------------
+        def _get_tasks():
+            evnumb          = 0
             for event in cat:
-                evnumb          += 1
-                evid            = 'E%05d' % evnumb
-                outstr          = ''
-                porigin         = event.preferred_origin()
-                evlo            = porigin.longitude
-                evla            = porigin.latitude
-                evdp            = porigin.depth
-                otime           = porigin.time
-                pmag            = event.preferred_magnitude()
-                magnitude       = pmag.mag
-                Mtype           = pmag.magnitude_type
+                evnumb      += 1
+                evid        = 'E%05d' % evnumb
+                porigin     = event.preferred_origin()
+                evlo        = porigin.longitude
+                evla        = porigin.latitude
+                otime       = porigin.time
+                pmag        = event.preferred_magnitude()
+                magnitude   = pmag.mag
+                Mtype       = pmag.magnitude_type
                 event_descrip   = event.event_descriptions[0].text+', '+event.event_descriptions[0].type
-                dataid          = evid+'_'+channel
+                dataid      = evid+'_'+channel
                 if not dataid in datalst:
                     continue
-                if otime < btime_qc or otime > etime_qc:
+                if pre_qual_ctrl and (otime < btime_qc or otime > etime_qc):
                     print('--- SKIP: Event ' + str(evnumb)+'/'+str(L)+' : '+ str(otime)+' '+ event_descrip+', '+Mtype+' = '+str(magnitude))
                     continue
-                # loop over periods
-                skip_this_event     = True
-                for iper in range(pers_dbase.size):
-                    per             = pers_dbase[iper]
-                    del_per         = per-int(per)
-                    if del_per == 0.:
-                        persfx      = str(int(per))+'sec'
-                    else:
-                        dper        = str(del_per)
-                        persfx      = str(int(per))+'sec'+dper.split('.')[1]
+                # read the field data of all periods, quality control and selection of the periods for computation
+                skip_this_event = pre_qual_ctrl
+                perdata     = []
+                for per in pers_dbase:
+                    if (not skip_this_event) and (per < Tmin or per > Tmax):
+                        continue
                     try:
-                        subdset     = inDbase.auxiliary_data[data_type][evid+'_'+channel][persfx]
+                        subdset = inDbase.auxiliary_data[data_type][dataid][persfxdict[per]]
                     except KeyError:
                         continue
-                    dataArr         = subdset.data.value
-                    if dataArr.shape[0] < mindp:
-                        continue
-                    lons            = dataArr[:, 0]
-                    lats            = dataArr[:, 1]
-                    if _check_station_distribution(lons, lats, np.int32(mindp/2.5)):
+                    dataArr     = subdset.data.value
+                    if skip_this_event and dataArr.shape[0] >= mindp and \
+                            _check_station_distribution(dataArr[:, 0], dataArr[:, 1], np.int32(mindp/2.5)):
                         skip_this_event = False
-                        break
+                    if per < Tmin or per > Tmax:
+                        continue
+                    if dataArr[:, fdict[fieldtype]].size <= mindp:
+                        continue
+                    if not _check_station_distribution(dataArr[:, 0], dataArr[:, 1], np.int32(mindp/2.)):
+                        continue
+                    perdata.append((per, dataArr))
                 if skip_this_event:
-                    print('--- SKIP: Event ' + str(evnumb)+'/'+str(L)+' : '+ str(otime)+' '+ event_descrip+', '+Mtype+' = '+str(magnitude))
+                    if verbose:
+                        print('--- SKIP: Event ' + str(evnumb)+'/'+str(L)+' : '+ str(otime)+' '+ event_descrip+', '+Mtype+' = '+str(magnitude))
                     continue
-                print('--- ACCEPT: Event ' + str(evnumb)+'/'+str(L)+' : '+ str(otime)+' '+ event_descrip+', '+Mtype+' = '+str(magnitude))
-                qc_evnumb           += 1
-                qc_cat              += event
-                evid_lst.append(evid)
-            Lqc                     = len(qc_cat)
-            print '--- end quality control, events number = '+str(Lqc)+'/'+str(L)
-        else:
-            qc_cat                  = None
-            evid_lst                = None
-        # Loop over periods
-        for per in pers_dbase:
-            if per < Tmin or per > Tmax:
-                print '=== SKIP: eikonal tomography for T = '+str(per)+' sec'
-                continue
-            print '=== eikonal tomography for T = '+str(per)+' sec'
-            start       = time.time()
-            pers        = np.array([per])
-            self.quake_eikonal_mp(inasdffname=inasdffname, workingdir=workingdir, fieldtype=fieldtype, channel=channel, data_type=data_type,
-                pre_qual_ctrl=False, btime_qc=btime_qc, etime_qc=etime_qc, runid=runid, merge=True, deletetxt=deletetxt,
-                    verbose=verbose, subsize=subsize, nprocess=nprocess, amplplc=amplplc, cdist=cdist, mindp=mindp, pers=pers,
-                            incat = qc_cat, evid_lst=evid_lst)
-            print '=== elasped time = '+str(time.time() - start)+' sec'
+                if pre_qual_ctrl and verbose:
+                    print('--- ACCEPT: Event ' + str(evnumb)+'/'+str(L)+' : '+ str(otime)+' '+ event_descrip+', '+Mtype+' = '+str(magnitude))
+                Naccept[0]  += 1
+                if len(perdata) == 0:
+                    continue
+                yield (evid, evlo, evla, perdata)
+        #-------------------------------------------------------
+        # write results of an event to hdf5 dataset
+        #-------------------------------------------------------
+        def _write_event(index, evresults):
+            evid, evlo, evla, perresults    = evresults
+            for per, results in perresults:
+                perid           = '%g_sec'%( per )
+                if results is None:
+                    print '--- No data for: '+evid+', '+str(per)+' sec'
+                    continue
+                appV, reason_n, proAngle, az, baz, Zarr\
+                                = results[:6]
+                Ngrd            = results[-1]
+                if layout == 'chunked':
+                    evdata      = {'appV': appV, 'reason_n': reason_n, 'proAngle': proAngle, 'az': az, 'baz': baz, 'travelT': Zarr}
+                    if amplplc:
+                        evdata.update({'lplc_amp': results[6], 'corV': results[7], 'reason_n_helm': results[8]})
+                    writers[perid].write(evid, evinfo={'evlo': evlo, 'evla': evla, 'Ntotal_grd': Ngrd[0], 'Nvalid_grd': Ngrd[1]}, evdata=evdata)
+                    continue
+                event_group     = per_groups[perid].require_group(name=evid)
+                event_group.attrs.create(name = 'evlo', data=evlo)
+                event_group.attrs.create(name = 'evla', data=evla)
+                event_group.attrs.create(name = 'Ntotal_grd', data=Ngrd[0])
+                event_group.attrs.create(name = 'Nvalid_grd', data=Ngrd[1])
+                # eikonal results
+                appVdset        = event_group.create_dataset(name='appV', data=appV)
+                reason_ndset    = event_group.create_dataset(name='reason_n', data=reason_n)
+                proAngledset    = event_group.create_dataset(name='proAngle', data=proAngle)
+                azdset          = event_group.create_dataset(name='az', data=az)
+                bazdset         = event_group.create_dataset(name='baz', data=baz)
+                Tdset           = event_group.create_dataset(name='travelT', data=Zarr)
+                if amplplc:
+                    lplc_ampdset    = event_group.create_dataset(name='lplc_amp', data=results[6])
+                    corV_dset       = event_group.create_dataset(name='corV', data=results[7])
+                    reason_nhelmdset= event_group.create_dataset(name='reason_n_helm', data=results[8])
+            return
+        # working directories of each period for the gmt scratch files, created before the workers start
+        for per in pers:
+            working_per         = workingdir+'/'+str(per)+'sec'
+            if not os.path.isdir(working_per):
+                os.makedirs(working_per)
+        print '=== eikonal tomography for T = '+str(pers)+' sec'
+        start               = time.time()
+        QUAKE               = partial(quake_event4mp, workingdir=workingdir, fieldtype=fieldtype, channel=channel, amplplc=amplplc,\
+                                cdist=cdist, grdinfo=grdinfo)
+        Nevent, failed      = mppool.pool_stream(QUAKE, _get_tasks(), callback=_write_event, nprocess=nprocess, maxpending=maxpending,\
+                                timeout=timeout, verbose=verbose, allow_failure=True)
+        mppool.close_pool()
+        if len(failed) > 0:
+            print '--- '+str(len(failed))+' events not finished within the timeout, no results saved'
+        if pre_qual_ctrl:
+            print '--- end quality control, events number = '+str(Naccept[0])+'/'+str(L)
+        print '=== '+str(Nevent)+' events, elasped time = '+str(time.time() - start)+' sec'
+        if deletetxt and os.path.isdir(workingdir):
+            shutil.rmtree(workingdir)
         return
-
+    
     def eikonal_stack_old(self, runid=0, minazi=-180, maxazi=180, N_bin=20, threshmeasure=80, anisotropic=False, \
                 spacing_ani=0.6, coverage=0.1, use_numba=True):
         """
@@ -2129,7 +2614,7 @@ class EikonalTomoDataSet(h5py.File):
         return
     
     def eikonal_stack(self, runid=0, minazi=-180, maxazi=180, N_bin=20, threshmeasure=80, anisotropic=False, \
-                spacing_ani=0.3, coverage=0.1, use_numba=True, azi_amp_tresh=0.1):
+                spacing_ani=0.3, coverage=0.1, use_numba=True, azi_amp_tresh=0.1, maxmem=None):
         """
         Stack gradient results to perform Eikonal Tomography
         =================================================================================================================
@@ -2142,6 +2627,9 @@ class EikonalTomoDataSet(h5py.File):
         anisotropic     - perform anisotropic parameters determination or not
         coverage        - required coverage rate ({Number of valid grid points}/{Number of total grid points})
         use_numba       - use numba for large array manipulation or not, faster and much less memory requirement
+        maxmem          - memory budget in GB for stacking, None for stacking the whole grid at once
+                            if specified, the grid is split into tiles along latitude, the data of each tile is read
+                            from the database and stacked separately, the results are identical
         -----------------------------------------------------------------------------------------------------------------
         version history:
             Dec 6th, 2016   - add function to use numba, faster and much less memory consumption
@@ -2171,6 +2659,7 @@ class EikonalTomoDataSet(h5py.File):
             del self['Eikonal_stack_'+str(runid)]
             group_out   = self.create_group( name = 'Eikonal_stack_'+str(runid) )
         #
+        halo            = 0
         if anisotropic:
             grid_factor                 = int(np.ceil(spacing_ani/dlat))
             gridx                       = grid_factor
@@ -2182,169 +2671,134 @@ class EikonalTomoDataSet(h5py.File):
             print '--- anisotropic grid factor = '+ str(gridx)+'/'+str(gridy)
             group_out.attrs.create(name = 'gridx', data = gridx)
             group_out.attrs.create(name = 'gridy', data = gridy)
+            halo                        = (gridx - 1)/2
         # attributes for output group
         group_out.attrs.create(name = 'anisotropic', data = anisotropic)
         group_out.attrs.create(name = 'N_bin', data = N_bin)
         group_out.attrs.create(name = 'minazi', data = minazi)
         group_out.attrs.create(name = 'maxazi', data = maxazi)
         group_out.attrs.create(name = 'fieldtype', data = group.attrs['fieldtype'])
+        Nx              = Nlat-2*nlat_grad
+        Ny              = Nlon-2*nlon_grad
         for per in pers:
             print '--- stacking eikonal results for: '+str(per)+' sec'
             per_group   = group['%g_sec'%( per )]
-            Nevent      = len(per_group.keys())
-            # initialize data arrays 
-            Nmeasure    = np.zeros((Nlat-2*nlat_grad, Nlon-2*nlon_grad), dtype=np.int32)
-            weightALL   = np.zeros((Nevent, Nlat-2*nlat_grad, Nlon-2*nlon_grad))
-            slownessALL = np.zeros((Nevent, Nlat-2*nlat_grad, Nlon-2*nlon_grad))
-            aziALL      = np.zeros((Nevent, Nlat-2*nlat_grad, Nlon-2*nlon_grad), dtype='float32')
-            reason_nALL = np.zeros((Nevent, Nlat-2*nlat_grad, Nlon-2*nlon_grad))
-            validALL    = np.zeros((Nevent, Nlat-2*nlat_grad, Nlon-2*nlon_grad), dtype='float32')
-            #-----------------------------------------------------
-            # Loop over events to get eikonal maps for each event
-            #-----------------------------------------------------
-            print '*** reading data'
-            for iev in range(Nevent):
-                evid                        = per_group.keys()[iev]
-                event_group                 = per_group[evid]
-                az                          = event_group['az'].value
-                #-------------------------------------------------
-                # get apparent velocities for individual event
-                #-------------------------------------------------
-                velocity                    = event_group['appV'].value
-                reason_n                    = event_group['reason_n'].value
-                oneArr                      = np.ones((Nlat-2*nlat_grad, Nlon-2*nlon_grad), dtype=np.int32)
-                oneArr[reason_n!=0]         = 0
-                slowness                    = np.zeros((Nlat-2*nlat_grad, Nlon-2*nlon_grad), dtype=np.float32)
-                slowness[velocity!=0]       = 1./velocity[velocity!=0]                
-                slownessALL[iev, :, :]      = slowness
-                reason_nALL[iev, :, :]      = reason_n
-                aziALL[iev, :, :]           = az
-                Nmeasure                    += oneArr
-                # quality control of coverage
-                try:
-                    Ntotal_grd              = event_group.attrs['Ntotal_grd']
-                    Nvalid_grd              = event_group.attrs['Nvalid_grd']
-                    if float(Nvalid_grd)/float(Ntotal_grd)< coverage:
-                        reason_nALL[iev, :, :]  = np.ones((Nlat-2*nlat_grad, Nlon-2*nlon_grad))
-                except:
-                    pass
-            #----------------------------
-            # isotropic stacking
-            #----------------------------
-            print '*** Stacking data'
+            evLst       = _get_event_list(per_group)
+            Nevent      = len(evLst)
+            ischunked   = _is_chunked_layout(per_group)
+            # quality control of coverage
+            is_lowcov   = _get_lowcov(per_group, evLst, coverage)
+            # events are stacked in the order of event id, the rows of chunked layout are in the order of writing
+            evorder     = np.argsort(evLst, kind='mergesort')
+            # output arrays
+            Nmeasure        = np.zeros((Nx, Ny), dtype=np.int32)
+            slowness_sumQC  = np.zeros((Nx, Ny))
+            slowness_stdQC  = np.zeros((Nx, Ny))
+            NmeasureQC      = np.zeros((Nx, Ny))
+            weightsumQC     = np.zeros((Nx, Ny))
+            tempvel         = np.zeros((Nx, Ny))
+            tempsem         = np.zeros((Nx, Ny))
+            if anisotropic:
+                out_ani     = np.zeros((4, N_bin, Nx, Ny))
+                NmeasureAni = np.zeros((Nx, Ny))
+            tiles           = _get_stack_tiles(Nx=Nx, Ny=Ny, Nevent=Nevent, maxmem=maxmem, halo=halo)
+            for r0, r1 in tiles:
+                if len(tiles) > 1:
+                    print '*** tile: rows '+str(r0)+' - '+str(r1)+' of '+str(Nx)
+                # rows of the tile, including halo rows for anisotropic stacking
+                e0                          = max(0, r0 - halo)
+                e1                          = min(Nx, r1 + halo)
+                # initialize data arrays 
+                Nmeasure_tile               = np.zeros((e1-e0, Ny), dtype=np.int32)
+                slownessALL                 = np.zeros((Nevent, e1-e0, Ny))
+                aziALL                      = np.zeros((Nevent, e1-e0, Ny), dtype='float32')
+                reason_nALL                 = np.zeros((Nevent, e1-e0, Ny))
+                #-----------------------------------------------------
+                # Loop over events to get eikonal maps for each event
+                #-----------------------------------------------------
+                print '*** reading data'
+                if ischunked:
+                    # read the tile of all events with one hyperslab for each quantity
+                    az_tile                 = per_group['az'][:, e0:e1, :]
+                    velocity_tile           = per_group['appV'][:, e0:e1, :]
+                    reason_n_tile           = per_group['reason_n'][:, e0:e1, :]
+                for iev in range(Nevent):
+                    irow                    = evorder[iev]
+                    if ischunked:
+                        az                  = az_tile[irow]
+                        velocity            = velocity_tile[irow]
+                        reason_n            = reason_n_tile[irow]
+                    else:
+                        event_group         = per_group[evLst[irow]]
+                        az                  = event_group['az'][e0:e1, :]
+                        #-------------------------------------------------
+                        # get apparent velocities for individual event
+                        #-------------------------------------------------
+                        velocity            = event_group['appV'][e0:e1, :]
+                        reason_n            = event_group['reason_n'][e0:e1, :]
+                    oneArr                  = np.ones((e1-e0, Ny), dtype=np.int32)
+                    oneArr[reason_n!=0]     = 0
+                    slowness                = np.zeros((e1-e0, Ny), dtype=np.float32)
+                    slowness[velocity!=0]   = 1./velocity[velocity!=0]                
+                    slownessALL[iev, :, :]  = slowness
+                    reason_nALL[iev, :, :]  = reason_n
+                    aziALL[iev, :, :]       = az
+                    Nmeasure_tile           += oneArr
+                    if is_lowcov[irow]:
+                        reason_nALL[iev, :, :]  = np.ones((e1-e0, Ny))
+                #----------------------------
+                # isotropic stacking
+                #----------------------------
+                print '*** Stacking data'
+                # discard grid points where number of raw measurements is low, added Sep 26th, 2018
+                index_discard               = Nmeasure_tile < 50
+                reason_nALL[:, index_discard]   = 10
+                slowness_sumQC_tile, slowness_stdQC_tile, NmeasureQC_tile, weightsumQC_tile, tempvel_tile, tempsem_tile, index_outlier\
+                                            = _isotropic_stacking(slownessALL, aziALL, reason_nALL, Nmeasure_tile, use_numba=use_numba)
+                # store the output rows of the tile
+                Nmeasure[r0:r1, :]          = Nmeasure_tile[r0-e0:r1-e0, :]
+                slowness_sumQC[r0:r1, :]    = slowness_sumQC_tile[r0-e0:r1-e0, :]
+                slowness_stdQC[r0:r1, :]    = slowness_stdQC_tile[r0-e0:r1-e0, :]
+                NmeasureQC[r0:r1, :]        = NmeasureQC_tile[r0-e0:r1-e0, :]
+                weightsumQC[r0:r1, :]       = weightsumQC_tile[r0-e0:r1-e0, :]
+                tempvel[r0:r1, :]           = tempvel_tile[r0-e0:r1-e0, :]
+                tempsem[r0:r1, :]           = tempsem_tile[r0-e0:r1-e0, :]
+                #----------------------------------------------------------------------------
+                # determine anisotropic parameters, need benchmark and further verification
+                #----------------------------------------------------------------------------
+                if anisotropic and (e1 - e0) >= gridx:
+                    # quality control
+                    slowness_sumQC_ALL          = np.broadcast_to(slowness_sumQC_tile, slownessALL.shape)
+                    diff_slowness               = np.abs(slownessALL-slowness_sumQC_ALL)
+                    ind_nonzero                 = slowness_sumQC_ALL!= 0.
+                    diff_slowness[ind_nonzero]  = diff_slowness[ind_nonzero]/slowness_sumQC_ALL[ind_nonzero]
+                    index_outlier               += diff_slowness > azi_amp_tresh
+                    # stacking to get anisotropic parameters
+                    dslow_sum_ani, dslow_un, vel_un, histArr, NmeasureAni_tile    \
+                                                = _anisotropic_stacking(np.int32(gridx), np.int32(gridy), np.float64(maxazi), np.float64(minazi),\
+                                                    np.int32(N_bin), Nmeasure_tile.astype(np.int32), aziALL.astype(np.float32),\
+                                                    slowness_sumQC_tile.astype(np.float64), slownessALL.astype(np.float64), index_outlier.astype(bool))
+                    # output row i of the anisotropic stacking is row e0 + halo + i, only rows within r0 - r1 are stored
+                    s0                          = max(r0, e0 + halo)
+                    s1                          = min(r1, e1 - halo)
+                    if s1 > s0:
+                        hy                      = (gridy - 1)/2
+                        for iout, outarr in enumerate([dslow_sum_ani, dslow_un, vel_un, histArr]):
+                            out_ani[iout, :, s0:s1, hy:Ny-hy]   = outarr[:, s0-e0-halo:s1-e0-halo, :]
+                        NmeasureAni[s0:s1, hy:Ny-hy]            = NmeasureAni_tile[s0-e0-halo:s1-e0-halo, :]
             if Nmeasure.max()< threshmeasure:
                 print ('--- No enough measurements for: '+str(per)+' sec')
                 continue
-            # discard grid points where number of raw measurements is low, added Sep 26th, 2018
-            index_discard                   = Nmeasure < 50
-            reason_nALL[:, index_discard]   = 10
-            #-----------------------------------------------
-            # Get weight for each grid point per event
-            #-----------------------------------------------
-            if use_numba:
-                validALL[reason_nALL==0]    = 1
-                weightALL                   = _get_azi_weight(aziALL, validALL)
-                weightALL[reason_nALL!=0]   = 0
-                weightALL[weightALL!=0]     = 1./weightALL[weightALL!=0]
-                weightsum                   = np.sum(weightALL, axis=0)
-            else:
-                azi_event1                  = np.broadcast_to(aziALL, (Nevent, Nevent, Nlat-2*nlat_grad, Nlon-2*nlon_grad))
-                azi_event2                  = np.swapaxes(azi_event1, 0, 1)
-                validALL[reason_nALL==0]    = 1
-                validALL4                   = np.broadcast_to(validALL, (Nevent, Nevent, Nlat-2*nlat_grad, Nlon-2*nlon_grad))
-                # use numexpr for very large array manipulations
-                del_aziALL                  = numexpr.evaluate('abs(azi_event1-azi_event2)')
-                index_azi                   = numexpr.evaluate('(1*(del_aziALL<20)+1*(del_aziALL>340))*validALL4')
-                weightALL                   = numexpr.evaluate('sum(index_azi, 0)')
-                weightALL[reason_nALL!=0]   = 0
-                weightALL[weightALL!=0]     = 1./weightALL[weightALL!=0]
-                weightsum                   = np.sum(weightALL, axis=0)
-            #-----------------------------------------------
-            # reduce large weight to some value.
-            #-----------------------------------------------
-            avgArr                          = np.zeros((Nlat-2*nlat_grad, Nlon-2*nlon_grad))
-            avgArr[Nmeasure!=0]             = weightsum[Nmeasure!=0]/Nmeasure[Nmeasure!=0]
-            # bug fixed, 02/07/2018
-            signALL                         = weightALL.copy()
-            signALL[signALL!=0]             = 1.
-            stdArr                          = np.sum( signALL*(weightALL-avgArr)**2, axis=0)
-            stdArr[Nmeasure!=0]             = stdArr[Nmeasure!=0]/Nmeasure[Nmeasure!=0]
-            stdArr                          = np.sqrt(stdArr)
-            threshhold                      = np.broadcast_to(avgArr+3.*stdArr, weightALL.shape)
-            weightALL[weightALL>threshhold] = threshhold[weightALL>threshhold] # threshhold truncated weightALL
-            # recompute weight arrays after large weight value reduction
-            weightsum                       = np.sum(weightALL, axis=0)
-            weightsumALL                    = np.broadcast_to(weightsum, weightALL.shape)
-            # weight over all events, note that before this, weightALL is weight over events in azimuth bin
-            weightALL[weightsumALL!=0]      = weightALL[weightsumALL!=0]/weightsumALL[weightsumALL!=0] 
-            ###
-            weightALL[weightALL==1.]        = 0. # data will be discarded if no other data within 20 degree
-            #-----------------------------------------------
-            # Compute mean/std of slowness
-            #-----------------------------------------------
-            slownessALL2                    = slownessALL*weightALL
-            slowness_sum                    = np.sum(slownessALL2, axis=0)
-            slowness_sumALL                 = np.broadcast_to(slowness_sum, weightALL.shape)
-            # weighted standard deviation
-            # formula: https://www.itl.nist.gov/div898/software/dataplot/refman2/ch2/weightsd.pdf
-            signALL                         = weightALL.copy()
-            signALL[signALL!=0]             = 1.
-            MArr                            = np.sum(signALL, axis=0)
-            temp                            = weightALL*(slownessALL-slowness_sumALL)**2
-            temp                            = np.sum(temp, axis=0)
-            slowness_std                    = np.zeros(temp.shape)
-            tind                            = (weightsum!=0)*(MArr!=1)*(MArr!=0)
-            slowness_std[tind]              = np.sqrt(temp[tind]/ ( weightsum[tind]*(MArr[tind]-1)/MArr[tind] ) )
-            slowness_stdALL                 = np.broadcast_to(slowness_std, weightALL.shape)
-            #-----------------------------------------------
-            # discard outliers of slowness
-            #-----------------------------------------------
-            weightALLQC                     = weightALL.copy()
-            index_outlier                   = (np.abs(slownessALL-slowness_sumALL))>2.*slowness_stdALL
-            index_outlier                   += reason_nALL != 0
-            weightALLQC[index_outlier]      = 0
-            weightsumQC                     = np.sum(weightALLQC, axis=0)
-            NmALL                           = np.sign(weightALLQC)
-            NmeasureQC                      = np.sum(NmALL, axis=0)
-            weightsumQCALL                  = np.broadcast_to(weightsumQC, weightALL.shape)
-            weightALLQC[weightsumQCALL!=0]  = weightALLQC[weightsumQCALL!=0]/weightsumQCALL[weightsumQCALL!=0]
-            temp                            = weightALLQC*slownessALL
-            slowness_sumQC                  = np.sum(temp, axis=0)
-            # new
-            signALLQC                       = weightALLQC.copy()
-            signALLQC[signALLQC!=0]         = 1.
-            MArrQC                          = np.sum(signALLQC, axis=0)
-            temp                            = weightALLQC*(slownessALL-slowness_sumQC)**2
-            temp                            = np.sum(temp, axis=0)
-            slowness_stdQC                  = np.zeros(temp.shape)
-            tind                            = (weightsumQC!=0)*(MArrQC!=1)
-            slowness_stdQC[tind]            = np.sqrt(temp[tind]/ ( weightsumQC[tind]*(MArrQC[tind]-1)/MArrQC[tind] ))
             #---------------------------------------------------------------
             # mask, velocity, and sem arrays of shape Nlat, Nlon
             #---------------------------------------------------------------
-            mask                            = np.ones((Nlat, Nlon), dtype=np.bool)
-            tempmask                        = (weightsumQC == 0)
-            mask[nlat_grad:-nlat_grad, nlon_grad:-nlon_grad] \
-                                            = tempmask
-            vel_iso                         = np.zeros((Nlat, Nlon), dtype=np.float32)
-            tempvel                         = slowness_sumQC.copy()
-            tempvel[tempvel!=0]             = 1./ tempvel[tempvel!=0]
-            vel_iso[nlat_grad:-nlat_grad, nlon_grad:-nlon_grad]\
-                                            = tempvel
-            #----------------------------------------------------------------------------------------
-            # standard error of the mean, updated on 09/20/2018
-            # formula: https://en.wikipedia.org/wiki/Weighted_arithmetic_mean#Statistical_properties
-            #----------------------------------------------------------------------------------------
-            slownessALL_temp                = slownessALL.copy()
-            slownessALL_temp[slownessALL_temp==0.]\
-                                            = 0.3
-            if np.any(weightALLQC[slownessALL==0.]> 0.):
-                raise ValueError('Check weight array!')
-            temp                            = (weightALLQC*(1./slownessALL_temp-tempvel))**2
-            temp                            = np.sum(temp, axis=0)
-            tempsem                         = np.zeros(temp.shape)
-            tind                            = (weightsumQC!=0)*(MArrQC!=1)
-            tempsem[tind]                   = np.sqrt( temp[tind] * ( MArrQC[tind]/(weightsumQC[tind])**2/(MArrQC[tind]-1) ) ) 
+            mask                            = np.ones((Nlat, Nlon), dtype=np.bool)
+            tempmask                        = (weightsumQC == 0)
+            mask[nlat_grad:-nlat_grad, nlon_grad:-nlon_grad] \
+                                            = tempmask
+            vel_iso                         = np.zeros((Nlat, Nlon), dtype=np.float32)
+            vel_iso[nlat_grad:-nlat_grad, nlon_grad:-nlon_grad]\
+                                            = tempvel
             vel_sem                         = np.zeros((Nlat, Nlon), dtype=np.float32)
             vel_sem[nlat_grad:-nlat_grad, nlon_grad:-nlon_grad]\
                                             = tempsem
@@ -2359,55 +2813,19 @@ class EikonalTomoDataSet(h5py.File):
             maskdset                        = per_group_out.create_dataset(name='mask', data=mask)
             visodset                        = per_group_out.create_dataset(name='vel_iso', data=vel_iso)
             vsemdset                        = per_group_out.create_dataset(name='vel_sem', data=vel_sem)
-            #----------------------------------------------------------------------------
-            # determine anisotropic parameters, need benchmark and further verification
-            #----------------------------------------------------------------------------
             if anisotropic:
-                # quality control
-                slowness_sumQC_ALL          = np.broadcast_to(slowness_sumQC, slownessALL.shape)
-                # # # slowness_stdQC_ALL          = np.broadcast_to(slowness_stdQC, slownessALL.shape)
-                # # # index_outlier               = (np.abs(slownessALL-slowness_sumQC_ALL))>2.*slowness_stdQC_ALL
-                diff_slowness               = np.abs(slownessALL-slowness_sumQC_ALL)
-                ind_nonzero                 = slowness_sumQC_ALL!= 0.
-                diff_slowness[ind_nonzero]  = diff_slowness[ind_nonzero]/slowness_sumQC_ALL[ind_nonzero]
-                index_outlier               += diff_slowness > azi_amp_tresh
-                # stacking to get anisotropic parameters
-                dslow_sum_ani, dslow_un, vel_un, histArr, NmeasureAni    \
-                                            = _anisotropic_stacking(gridx, gridy, maxazi, minazi, N_bin, Nmeasure, aziALL,\
-                                                slowness_sumQC, slownessALL, index_outlier.astype(bool))
                 #----------------------------
                 # save data to database
                 #----------------------------
-                out_arr         = np.zeros((N_bin, Nlat-2*nlat_grad, Nlon-2*nlon_grad))
-                out_arr[:, (gridx - 1)/2:-(gridx - 1)/2, (gridy - 1)/2:-(gridy - 1)/2]\
-                                = dslow_sum_ani
-                s_anidset       = per_group_out.create_dataset(name='slownessAni', data=out_arr)
-                
-                out_arr         = np.zeros((N_bin, Nlat-2*nlat_grad, Nlon-2*nlon_grad))
-                out_arr[:, (gridx - 1)/2:-(gridx - 1)/2, (gridy - 1)/2:-(gridy - 1)/2]\
-                                = dslow_un
-                s_anisemdset    = per_group_out.create_dataset(name='slownessAni_sem', data=out_arr)
-                
-                out_arr         = np.zeros((N_bin, Nlat-2*nlat_grad, Nlon-2*nlon_grad))
-                out_arr[:, (gridx - 1)/2:-(gridx - 1)/2, (gridy - 1)/2:-(gridy - 1)/2]\
-                                = vel_un
-                v_anisemdset    = per_group_out.create_dataset(name='velAni_sem', data=out_arr)
-                
-                out_arr         = np.zeros((N_bin, Nlat-2*nlat_grad, Nlon-2*nlon_grad))
-                out_arr[:, (gridx - 1)/2:-(gridx - 1)/2, (gridy - 1)/2:-(gridy - 1)/2]\
-                                = histArr
-                histdset        = per_group_out.create_dataset(name='histArr', data=out_arr)
-                
-                out_arr         = np.zeros((N_bin, Nlat-2*nlat_grad, Nlon-2*nlon_grad))
-                out_arr         = np.zeros((Nlat-2*nlat_grad, Nlon-2*nlon_grad))
-                out_arr[(gridx - 1)/2:-(gridx - 1)/2, (gridy - 1)/2:-(gridy - 1)/2]\
-                                = NmeasureAni
-                NmAnidset       = per_group_out.create_dataset(name='NmeasureAni', data=out_arr)
-                
+                s_anidset       = per_group_out.create_dataset(name='slownessAni', data=out_ani[0])
+                s_anisemdset    = per_group_out.create_dataset(name='slownessAni_sem', data=out_ani[1])
+                v_anisemdset    = per_group_out.create_dataset(name='velAni_sem', data=out_ani[2])
+                histdset        = per_group_out.create_dataset(name='histArr', data=out_ani[3])
+                NmAnidset       = per_group_out.create_dataset(name='NmeasureAni', data=NmeasureAni)
         return
 
     def helm_stack(self, runid=0, minazi=-180, maxazi=180, N_bin=20, threshmeasure=80, anisotropic=False, \
-                spacing_ani=0.6, use_numba=True, coverage=0.1, dv_thresh=None):
+                spacing_ani=0.6, use_numba=True, coverage=0.1, dv_thresh=None, maxmem=None):
         """
         Stack gradient results to perform Helmholtz Tomography
         =================================================================================================================
@@ -2417,6 +2835,9 @@ class EikonalTomoDataSet(h5py.File):
         N_bin           - number of bins for anisotropic parameters determination
         anisotropic     - perform anisotropic parameters determination or not
         use_numba       - use numba for large array manipulation or not, faster and much less memory requirement
+        maxmem          - memory budget in GB for stacking, None for stacking the whole grid at once
+                            if specified, the grid is split into tiles along latitude, the data of each tile is read
+                            from the database and stacked separately, the results are identical
         -----------------------------------------------------------------------------------------------------------------
         version history:
             Dec 6th, 2016   - add function to use numba, faster and much less memory consumption
@@ -2454,159 +2875,146 @@ class EikonalTomoDataSet(h5py.File):
         dnlon           = nlon_lplc - nlon_grad
         if dnlat < 0 or dnlon < 0:
             raise ValueError('nlat_lplc/nlon_lplc should not be smaller than nlat_grad/nlon_grad !')
+        halo            = 0
+        if anisotropic:
+            grid_factor = int(np.ceil(spacing_ani/dlat))
+            gridx       = grid_factor
+            gridy       = int(grid_factor*np.floor(dlon/dlat))
+            halo        = gridx
+        Nx              = Nlat-2*nlat_grad
+        Ny              = Nlon-2*nlon_grad
         for per in pers:
             print 'Stacking Helmholtz results for: '+str(per)+' sec'
             per_group   = group['%g_sec'%( per )]
-            Nevent      = len(per_group.keys())
-            # initialize data arrays 
-            Nmeasure    = np.zeros((Nlat-2*nlat_grad, Nlon-2*nlon_grad), dtype=np.int32)
-            weightALL   = np.zeros((Nevent, Nlat-2*nlat_grad, Nlon-2*nlon_grad))
-            slownessALL = np.zeros((Nevent, Nlat-2*nlat_grad, Nlon-2*nlon_grad))
-            aziALL      = np.zeros((Nevent, Nlat-2*nlat_grad, Nlon-2*nlon_grad), dtype='float32')
-            reason_nALL = np.zeros((Nevent, Nlat-2*nlat_grad, Nlon-2*nlon_grad))
-            validALL    = np.zeros((Nevent, Nlat-2*nlat_grad, Nlon-2*nlon_grad), dtype='float32')
-            #-------------------------------------------------------
-            # Loop over events to get Helmholtz maps for each event
-            #-------------------------------------------------------
-            print '--- Reading data'
-            for iev in range(Nevent):
-                evid                = per_group.keys()[iev]
-                event_group         = per_group[evid]
-                az                  = event_group['az'].value
-                #-------------------------------------------------
-                # get corrected velocities for individual event
-                #-------------------------------------------------
-                temp_vel            = event_group['corV'].value
-                temp_reason_n       = event_group['reason_n_helm'].value
-                velocity            = np.zeros((Nlat-2*nlat_grad, Nlon-2*nlon_grad), dtype=np.float32)
-                reason_n            = np.ones((Nlat-2*nlat_grad, Nlon-2*nlon_grad), dtype=np.float32)
-                if dnlat == 0 and dnlon == 0:
-                    reason_n        = temp_reason_n.copy()
-                    velocity        = temp_vel.copy()
-                elif dnlat == 0 and dnlon != 0:
-                    reason_n[:, dnlon:-dnlon]\
-                                    = temp_reason_n.copy()
-                    velocity[:, dnlon:-dnlon]\
-                                    = temp_vel.copy()
-                elif dnlat != 0 and dnlon == 0:
-                    reason_n[dnlat:-dnlat, :]\
-                                    = temp_reason_n.copy()
-                    velocity[dnlat:-dnlat, :]\
-                                    = temp_vel.copy()
-                else:
-                    reason_n[dnlat:-dnlat, dnlon:-dnlon]\
-                                    = temp_reason_n.copy()
-                    velocity[dnlat:-dnlat, dnlon:-dnlon]\
-                                    = temp_vel.copy()
-                # quality control, compare with apparent velocity
-                if dv_thresh is not None:
-                    eikonal_grp         = self['Eikonal_stack_'+str(runid)]
-                    per_eik_grp         = eikonal_grp['%g_sec'%( per )]
-                    appV                = per_eik_grp['vel_iso']
-                    appV                = appV[nlat_grad:-nlat_grad, nlon_grad:-nlon_grad]
-                    ind                 = np.logical_not(((velocity - appV) <dv_thresh) * ((velocity - appV) >-dv_thresh))
-                    reason_n[ind]       = 10.
-                # 
-                oneArr                  = np.ones((Nlat-2*nlat_grad, Nlon-2*nlon_grad), dtype=np.int32)
-                oneArr[reason_n!=0]     = 0
-                Nmeasure                += oneArr
-                slowness                = np.zeros((Nlat-2*nlat_grad, Nlon-2*nlon_grad), dtype=np.float32)
-                slowness[velocity!=0]   = 1./velocity[velocity!=0]
-                slownessALL[iev, :, :]  = slowness
-                reason_nALL[iev, :, :]  = reason_n
-                aziALL[iev, :, :]       = az
-                # quality control of coverage
-                try:
-                    Ntotal_grd              = event_group.attrs['Ntotal_grd']
-                    Nvalid_grd              = event_group.attrs['Nvalid_grd']
-                    if float(Nvalid_grd)/float(Ntotal_grd)< coverage:
-                        reason_nALL[iev, :, :]  = np.ones((Nlat-2*nlat_grad, Nlon-2*nlon_grad))
-                except:
-                    pass
-            print '--- Stacking data'
+            evLst       = _get_event_list(per_group)
+            Nevent      = len(evLst)
+            ischunked   = _is_chunked_layout(per_group)
+            # quality control of coverage
+            is_lowcov   = _get_lowcov(per_group, evLst, coverage)
+            # events are stacked in the order of event id, the rows of chunked layout are in the order of writing
+            evorder     = np.argsort(evLst, kind='mergesort')
+            # quality control, compare with apparent velocity
+            if dv_thresh is not None:
+                eikonal_grp                 = self['Eikonal_stack_'+str(runid)]
+                per_eik_grp                 = eikonal_grp['%g_sec'%( per )]
+                appV                        = per_eik_grp['vel_iso']
+                appV                        = appV[nlat_grad:-nlat_grad, nlon_grad:-nlon_grad]
+            # output arrays
+            Nmeasure        = np.zeros((Nx, Ny), dtype=np.int32)
+            slowness_sumQC  = np.zeros((Nx, Ny))
+            slowness_stdQC  = np.zeros((Nx, Ny))
+            NmeasureQC      = np.zeros((Nx, Ny))
+            weightsumQC     = np.zeros((Nx, Ny))
+            tempvel         = np.zeros((Nx, Ny))
+            tempsem         = np.zeros((Nx, Ny))
+            if anisotropic:
+                # number of measurements in each bin
+                histArr     = np.zeros((N_bin, Nx, Ny))
+                # slowness in each bin
+                slow_sum_ani= np.zeros((N_bin, Nx, Ny))
+                # slowness uncertainties for each bin
+                slow_un     = np.zeros((N_bin, Nx, Ny))
+                # velocity uncertainties for each bin
+                vel_un      = np.zeros((N_bin, Nx, Ny))
+            tiles           = _get_stack_tiles(Nx=Nx, Ny=Ny, Nevent=Nevent, maxmem=maxmem, halo=halo)
+            for r0, r1 in tiles:
+                if len(tiles) > 1:
+                    print '--- tile: rows '+str(r0)+' - '+str(r1)+' of '+str(Nx)
+                # rows of the tile, including halo rows for anisotropic stacking
+                e0                          = max(0, r0 - halo)
+                e1                          = min(Nx, r1 + halo)
+                # rows of the Helmholtz arrays (shape: Nlat-2*nlat_lplc, Nlon-2*nlon_lplc) in the tile
+                h0                          = max(e0, dnlat)
+                h1                          = min(e1, Nx - dnlat)
+                # initialize data arrays 
+                Nmeasure_tile               = np.zeros((e1-e0, Ny), dtype=np.int32)
+                slownessALL                 = np.zeros((Nevent, e1-e0, Ny))
+                aziALL                      = np.zeros((Nevent, e1-e0, Ny), dtype='float32')
+                reason_nALL                 = np.zeros((Nevent, e1-e0, Ny))
+                #-------------------------------------------------------
+                # Loop over events to get Helmholtz maps for each event
+                #-------------------------------------------------------
+                print '--- Reading data'
+                if ischunked:
+                    # read the tile of all events with one hyperslab for each quantity
+                    az_tile                 = per_group['az'][:, e0:e1, :]
+                    if h1 > h0:
+                        velocity_tile       = per_group['corV'][:, h0-dnlat:h1-dnlat, :]
+                        reason_n_tile       = per_group['reason_n_helm'][:, h0-dnlat:h1-dnlat, :]
+                for iev in range(Nevent):
+                    irow                    = evorder[iev]
+                    if ischunked:
+                        az                  = az_tile[irow]
+                    else:
+                        event_group         = per_group[evLst[irow]]
+                        az                  = event_group['az'][e0:e1, :]
+                    #-------------------------------------------------
+                    # get corrected velocities for individual event
+                    #-------------------------------------------------
+                    if dnlat == 0 and dnlon == 0:
+                        if ischunked:
+                            reason_n        = reason_n_tile[irow]
+                            velocity        = velocity_tile[irow]
+                        else:
+                            reason_n        = event_group['reason_n_helm'][e0:e1, :]
+                            velocity        = event_group['corV'][e0:e1, :]
+                    else:
+                        velocity            = np.zeros((e1-e0, Ny), dtype=np.float32)
+                        reason_n            = np.ones((e1-e0, Ny), dtype=np.float32)
+                        if h1 > h0 and ischunked:
+                            reason_n[h0-e0:h1-e0, dnlon:Ny-dnlon]\
+                                            = reason_n_tile[irow]
+                            velocity[h0-e0:h1-e0, dnlon:Ny-dnlon]\
+                                            = velocity_tile[irow]
+                        elif h1 > h0:
+                            reason_n[h0-e0:h1-e0, dnlon:Ny-dnlon]\
+                                            = event_group['reason_n_helm'][h0-dnlat:h1-dnlat, :]
+                            velocity[h0-e0:h1-e0, dnlon:Ny-dnlon]\
+                                            = event_group['corV'][h0-dnlat:h1-dnlat, :]
+                    # quality control, compare with apparent velocity
+                    if dv_thresh is not None:
+                        ind                 = np.logical_not(((velocity - appV[e0:e1, :]) <dv_thresh) * ((velocity - appV[e0:e1, :]) >-dv_thresh))
+                        reason_n[ind]       = 10.
+                    # 
+                    oneArr                  = np.ones((e1-e0, Ny), dtype=np.int32)
+                    oneArr[reason_n!=0]     = 0
+                    Nmeasure_tile           += oneArr
+                    slowness                = np.zeros((e1-e0, Ny), dtype=np.float32)
+                    slowness[velocity!=0]   = 1./velocity[velocity!=0]
+                    slownessALL[iev, :, :]  = slowness
+                    reason_nALL[iev, :, :]  = reason_n
+                    aziALL[iev, :, :]       = az
+                    if is_lowcov[irow]:
+                        reason_nALL[iev, :, :]  = np.ones((e1-e0, Ny))
+                print '--- Stacking data'
+                slowness_sumQC_tile, slowness_stdQC_tile, NmeasureQC_tile, weightsumQC_tile, tempvel_tile, tempsem_tile, index_outlier\
+                                            = _isotropic_stacking(slownessALL, aziALL, reason_nALL, Nmeasure_tile, use_numba=use_numba)
+                # store the output rows of the tile
+                Nmeasure[r0:r1, :]          = Nmeasure_tile[r0-e0:r1-e0, :]
+                slowness_sumQC[r0:r1, :]    = slowness_sumQC_tile[r0-e0:r1-e0, :]
+                slowness_stdQC[r0:r1, :]    = slowness_stdQC_tile[r0-e0:r1-e0, :]
+                NmeasureQC[r0:r1, :]        = NmeasureQC_tile[r0-e0:r1-e0, :]
+                weightsumQC[r0:r1, :]       = weightsumQC_tile[r0-e0:r1-e0, :]
+                tempvel[r0:r1, :]           = tempvel_tile[r0-e0:r1-e0, :]
+                tempsem[r0:r1, :]           = tempsem_tile[r0-e0:r1-e0, :]
+                #----------------------------------------------------------------------------
+                # determine anisotropic parameters, need benchmark and further verification
+                #----------------------------------------------------------------------------
+                if anisotropic and (e1 - e0) > 2*gridx:
+                    histArr_cutted, slow_sum_ani_cutted, slow_un_cutted, vel_un_cutted\
+                                            = _anisotropic_stacking_helm(aziALL, slownessALL, slowness_sumQC_tile, index_outlier,\
+                                                gridx, gridy, minazi, maxazi, N_bin)
+                    # output row i of the anisotropic stacking is row e0 + gridx + i, only rows within r0 - r1 are stored
+                    s0                      = max(r0, e0 + gridx)
+                    s1                      = min(r1, e1 - gridx)
+                    if s1 > s0:
+                        histArr[:, s0:s1, gridy:-gridy]     = histArr_cutted[:, s0-e0-gridx:s1-e0-gridx, :]
+                        slow_sum_ani[:, s0:s1, gridy:-gridy]= slow_sum_ani_cutted[:, s0-e0-gridx:s1-e0-gridx, :]
+                        slow_un[:, s0:s1, gridy:-gridy]     = slow_un_cutted[:, s0-e0-gridx:s1-e0-gridx, :]
+                        vel_un[:, s0:s1, gridy:-gridy]      = vel_un_cutted[:, s0-e0-gridx:s1-e0-gridx, :]
             if Nmeasure.max()< threshmeasure:
                 print ('No enough measurements for: '+str(per)+' sec')
                 continue
-            #-----------------------------------------------
-            # Get weight for each grid point per event
-            #-----------------------------------------------
-            if use_numba:
-                validALL[reason_nALL==0]    = 1
-                weightALL                   = _get_azi_weight(aziALL, validALL)
-                weightALL[reason_nALL!=0]   = 0
-                weightALL[weightALL!=0]     = 1./weightALL[weightALL!=0]
-                weightsum                   = np.sum(weightALL, axis=0)
-            else:
-                azi_event1                  = np.broadcast_to(aziALL, (Nevent, Nevent, Nlat-2*nlat_grad, Nlon-2*nlon_grad))
-                azi_event2                  = np.swapaxes(azi_event1, 0, 1)
-                validALL[reason_nALL==0]    = 1
-                validALL4                   = np.broadcast_to(validALL, (Nevent, Nevent, Nlat-2*nlat_grad, Nlon-2*nlon_grad))
-                # use numexpr for very large array manipulations
-                del_aziALL                  = numexpr.evaluate('abs(azi_event1-azi_event2)')
-                index_azi                   = numexpr.evaluate('(1*(del_aziALL<20)+1*(del_aziALL>340))*validALL4')
-                weightALL                   = numexpr.evaluate('sum(index_azi, 0)')
-                weightALL[reason_nALL!=0]   = 0
-                weightALL[weightALL!=0]     = 1./weightALL[weightALL!=0]
-                weightsum                   = np.sum(weightALL, axis=0)
-            #-----------------------------------------------
-            # reduce large weight to some value.
-            #-----------------------------------------------
-            avgArr                          = np.zeros((Nlat-2*nlat_grad, Nlon-2*nlon_grad))
-            avgArr[Nmeasure!=0]             = weightsum[Nmeasure!=0]/Nmeasure[Nmeasure!=0]
-            # bug fixed, 02/07/2018
-            signALL                         = weightALL.copy()
-            signALL[signALL!=0]             = 1.
-            stdArr                          = np.sum( signALL*(weightALL-avgArr)**2, axis=0)
-            stdArr[Nmeasure!=0]             = stdArr[Nmeasure!=0]/Nmeasure[Nmeasure!=0]
-            stdArr                          = np.sqrt(stdArr)
-            threshhold                      = np.broadcast_to(avgArr+3.*stdArr, weightALL.shape)
-            weightALL[weightALL>threshhold] = threshhold[weightALL>threshhold] # threshhold truncated weightALL
-            # recompute weight arrays after large weight value reduction
-            weightsum                       = np.sum(weightALL, axis=0)
-            weightsumALL                    = np.broadcast_to(weightsum, weightALL.shape)
-            # weight over all events, note that before this, weightALL is weight over events in azimuth bin
-            weightALL[weightsumALL!=0]      = weightALL[weightsumALL!=0]/weightsumALL[weightsumALL!=0] 
-            weightALL[weightALL==1.]        = 0. # data will be discarded if no other data within 20 degree
-            #-----------------------------------------------
-            # Compute mean/std of slowness
-            #-----------------------------------------------
-            slownessALL2                    = slownessALL*weightALL
-            slowness_sum                    = np.sum(slownessALL2, axis=0)
-            slowness_sumALL                 = np.broadcast_to(slowness_sum, weightALL.shape)
-            # weighted standard deviation
-            # formula: https://www.itl.nist.gov/div898/software/dataplot/refman2/ch2/weightsd.pdf
-            signALL                         = weightALL.copy()
-            signALL[signALL!=0]             = 1.
-            MArr                            = np.sum(signALL, axis=0)
-            temp                            = weightALL*(slownessALL-slowness_sumALL)**2
-            temp                            = np.sum(temp, axis=0)
-            slowness_std                    = np.zeros(temp.shape)
-            tind                            = (weightsum!=0)*(MArr!=1)*(MArr!=0)
-            slowness_std[tind]              = np.sqrt(temp[tind]/ ( weightsum[tind]*(MArr[tind]-1)/MArr[tind] ) )
-            slowness_stdALL                 = np.broadcast_to(slowness_std, weightALL.shape)
-            #-----------------------------------------------
-            # discard outliers of slowness
-            #-----------------------------------------------
-            weightALLQC                     = weightALL.copy()
-            index_outlier                   = (np.abs(slownessALL-slowness_sumALL))>2.*slowness_stdALL
-            index_outlier                   += reason_nALL != 0
-            weightALLQC[index_outlier]      = 0
-            weightsumQC                     = np.sum(weightALLQC, axis=0)
-            NmALL                           = np.sign(weightALLQC)
-            NmeasureQC                      = np.sum(NmALL, axis=0)
-            weightsumQCALL                  = np.broadcast_to(weightsumQC, weightALL.shape)
-            weightALLQC[weightsumQCALL!=0]  = weightALLQC[weightsumQCALL!=0]/weightsumQCALL[weightsumQCALL!=0]
-            temp                            = weightALLQC*slownessALL
-            slowness_sumQC                  = np.sum(temp, axis=0)
-            # new
-            signALLQC                       = weightALLQC.copy()
-            signALLQC[signALLQC!=0]         = 1.
-            MArrQC                          = np.sum(signALLQC, axis=0)
-            temp                            = weightALLQC*(slownessALL-slowness_sumQC)**2
-            temp                            = np.sum(temp, axis=0)
-            slowness_stdQC                  = np.zeros(temp.shape)
-            tind                            = (weightsumQC!=0)*(MArrQC!=1)*(MArrQC!=0)
-            slowness_stdQC[tind]            = np.sqrt(temp[tind]/ ( weightsumQC[tind]*(MArrQC[tind]-1)/MArrQC[tind] ))
             #---------------------------------------------------------------
             # mask, velocity, and sem arrays of shape Nlat, Nlon
             #---------------------------------------------------------------
@@ -2615,24 +3023,8 @@ class EikonalTomoDataSet(h5py.File):
             mask[nlat_grad:-nlat_grad, nlon_grad:-nlon_grad] \
                                             = tempmask
             vel_iso                         = np.zeros((Nlat, Nlon), dtype=np.float32)
-            tempvel                         = slowness_sumQC.copy()
-            tempvel[tempvel!=0]             = 1./ tempvel[tempvel!=0]
             vel_iso[nlat_grad:-nlat_grad, nlon_grad:-nlon_grad]\
                                             = tempvel
-            #----------------------------------------------------------------------------------------
-            # standard error of the mean, updated on 09/20/2018
-            # formula: https://en.wikipedia.org/wiki/Weighted_arithmetic_mean#Statistical_properties
-            #----------------------------------------------------------------------------------------
-            slownessALL_temp                = slownessALL.copy()
-            slownessALL_temp[slownessALL_temp==0.]\
-                                            = 0.3
-            if np.any(weightALLQC[slownessALL==0.]> 0.):
-                raise ValueError('Check weight array!')
-            temp                            = (weightALLQC*(1./slownessALL_temp-tempvel))**2
-            temp                            = np.sum(temp, axis=0)
-            tempsem                         = np.zeros(temp.shape)
-            tind                            = (weightsumQC!=0)*(MArrQC!=1)
-            tempsem[tind]                   = np.sqrt( temp[tind] * ( MArrQC[tind]/(weightsumQC[tind])**2/(MArrQC[tind]-1) ) ) 
             vel_sem                         = np.zeros((Nlat, Nlon), dtype=np.float32)
             vel_sem[nlat_grad:-nlat_grad, nlon_grad:-nlon_grad]\
                                             = tempsem
@@ -2647,32 +3039,11 @@ class EikonalTomoDataSet(h5py.File):
             maskdset                        = per_group_out.create_dataset(name='mask', data=mask)
             visodset                        = per_group_out.create_dataset(name='vel_iso', data=vel_iso)
             vsemdset                        = per_group_out.create_dataset(name='vel_sem', data=vel_sem)
-            #----------------------------------------------------------------------------
-            # determine anisotropic parameters, need benchmark and further verification
-            #----------------------------------------------------------------------------
-            # debug, synthetic anisotropy
-            # phi             = 72.
-            # A               = 0.01
-            # phi             = phi/180.*np.pi
-            # tempazi         = (aziALL+180.)/180.*np.pi
-            # vALL            = np.broadcast_to(slowness_sumQC.copy(), slownessALL.shape)
-            # vALL.setflags(write=1)
-            # index           = vALL==0
-            # vALL[vALL!=0]   = 1./vALL[vALL!=0]
-            # # return slownessALL, slowness_sumQC
-            # vALL            = vALL + A*np.cos(2*(tempazi-phi))
-            # vALL[index]     = 0.
-            # slownessALL     = vALL.copy()
-            # slownessALL[slownessALL!=0] \
-            #                 = 1./slownessALL[slownessALL!=0]
-            
             if anisotropic:
-                grid_factor                 = int(np.ceil(spacing_ani/dlat))
-                gridx                       = grid_factor
-                gridy                       = int(grid_factor*np.floor(dlon/dlat))
-                Nx_size                     = Nlat-2*nlat_grad
-                Ny_size                     = Nlon-2*nlon_grad
-                NmeasureAni                 = np.zeros((Nlat-2*nlat_grad, Nlon-2*nlon_grad))
+                print 'anisotropic grid factor = '+ str(gridx)+'/'+str(gridy)
+                Nx_size                     = Nx
+                Ny_size                     = Ny
+                NmeasureAni                 = np.zeros((Nx, Ny))
                 total_near_neighbor         = Nmeasure[0:-2*gridx, 0:-2*gridy] + Nmeasure[0:-2*gridx, gridy:-gridy] + \
                                     Nmeasure[0:-2*gridx, 2*gridy:Ny_size] + Nmeasure[gridx:-gridx, 0:-2*gridy] +\
                                     Nmeasure[gridx:-gridx, gridy:-gridy] + Nmeasure[gridx:-gridx, 2*gridy:Ny_size] +\
@@ -2680,114 +3051,23 @@ class EikonalTomoDataSet(h5py.File):
                                     Nmeasure[2*gridx:Nx_size, 2*gridy:Ny_size]
                 NmeasureAni[gridx:-gridx, gridy:-gridy]     \
                                             = total_near_neighbor # for quality control
-                # initialization of anisotropic parameters
-                d_bin                       = (maxazi-minazi)/N_bin
-                print 'anisotropic grid factor = '+ str(gridx)+'/'+str(gridy)
-                # number of measurements in each bin
-                histArr                     = np.zeros((N_bin, Nlat-2*nlat_grad, Nlon-2*nlon_grad))
-                histArr_cutted              = histArr[:, gridx:-gridx, gridy:-gridy]
-                # slowness in each bin
-                slow_sum_ani                = np.zeros((N_bin, Nlat-2*nlat_grad, Nlon-2*nlon_grad))
-                slow_sum_ani_cutted         = slow_sum_ani[:, gridx:-gridx, gridy:-gridy]
-                # slowness uncertainties for each bin
-                slow_un                     = np.zeros((N_bin, Nlat-2*nlat_grad, Nlon-2*nlon_grad))
-                slow_un_cutted              = slow_un[:, gridx:-gridx, gridy:-gridy]
-                # velocity uncertainties for each bin
-                vel_un                      = np.zeros((N_bin, Nlat-2*nlat_grad, Nlon-2*nlon_grad))
-                vel_un_cutted               = vel_un[:, gridx:-gridx, gridy:-gridy]
-                #
-                index_dict                  = { 0: [0, -2*gridx, 0,         -2*gridy], \
-                                                1: [0, -2*gridx, gridy,     -gridy],\
-                                                2: [0, -2*gridx, 2*gridy,   Ny_size],\
-                                                3: [gridx, -gridx, 0,       -2*gridy],\
-                                                4: [gridx, -gridx, gridy, -gridy],\
-                                                5: [gridx, -gridx, 2*gridy, Ny_size],\
-                                                6: [2*gridx, Nx_size, 0,    -2*gridy],\
-                                                7: [2*gridx, Nx_size, gridy,-gridy],\
-                                                8: [2*gridx, Nx_size, 2*gridy, Ny_size]}
-                nmin_bin                    = 2 # change
-                #----------------------------------------------------------------------------------
-                # Loop over azimuth bins to get slowness, velocity and number of measurements
-                #----------------------------------------------------------------------------------
-                for ibin in xrange(N_bin):
-                    sumNbin                     = (np.zeros((Nlat-2*nlat_grad, Nlon-2*nlon_grad)))[gridx:-gridx, gridy:-gridy]
-                    slowbin                     = (np.zeros((Nlat-2*nlat_grad, Nlon-2*nlon_grad)))[gridx:-gridx, gridy:-gridy]
-                    slow_un_ibin                = (np.zeros((Nlat-2*nlat_grad, Nlon-2*nlon_grad)))[gridx:-gridx, gridy:-gridy]
-                    velbin                      = (np.zeros((Nlat-2*nlat_grad, Nlon-2*nlon_grad)))[gridx:-gridx, gridy:-gridy]
-                    vel_un_ibin                 = (np.zeros((Nlat-2*nlat_grad, Nlon-2*nlon_grad)))[gridx:-gridx, gridy:-gridy]
-                    for i in range(9):
-                        indarr                  = index_dict[i]
-                        azi_arr                 = aziALL[:, indarr[0]:indarr[1], indarr[2]:indarr[3]]
-                        ibinarr                 = np.floor((azi_arr - minazi)/d_bin)
-                        weight_bin              = 1*(ibinarr==ibin)
-                        index_outlier_cutted    = index_outlier[:, indarr[0]:indarr[1], indarr[2]:indarr[3]]
-                        weight_bin[index_outlier_cutted] \
-                                                = 0
-                        slowsumQC_cutted        = slowness_sumQC[indarr[0]:indarr[1], indarr[2]:indarr[3]]
-                        slownessALL_cutted      = slownessALL[:, indarr[0]:indarr[1], indarr[2]:indarr[3]]
-                        # differences in slowness numexpr.evaluate('sum(index_azi, 0)')
-                        temp_dslow              = numexpr.evaluate('weight_bin*(slownessALL_cutted-slowsumQC_cutted)')
-                        temp_dslow              = numexpr.evaluate('sum(temp_dslow, 0)')
-                        # velocities
-                        temp_vel                = slownessALL_cutted.copy()
-                        temp_vel[temp_vel!=0]   = 1./temp_vel[temp_vel!=0]
-                        temp_vel                = numexpr.evaluate('weight_bin*temp_vel')
-                        temp_vel                = numexpr.evaluate('sum(temp_vel, 0)')
-                        # number of measurements in this bin
-                        N_ibin                  = numexpr.evaluate('sum(weight_bin, 0)')
-                        # quality control
-                        ind_valid               = N_ibin >= nmin_bin
-                        sumNbin[ind_valid]      += N_ibin[ind_valid]
-                        slowbin[ind_valid]      += temp_dslow[ind_valid]
-                        velbin[ind_valid]       += temp_vel[ind_valid]
-                    vel_mean                    = velbin.copy()
-                    vel_mean[sumNbin!=0]        = velbin[sumNbin!=0]/sumNbin[sumNbin!=0]
-                    dslow_mean                  = slowbin.copy()
-                    dslow_mean[sumNbin!=0]      = dslow_mean[sumNbin!=0]/sumNbin[sumNbin!=0]
-                    # compute uncertainties
-                    for i in range(9):
-                        indarr                  = index_dict[i]
-                        azi_arr                 = aziALL[:, indarr[0]:indarr[1], indarr[2]:indarr[3]]
-                        ibinarr                 = np.floor((azi_arr-minazi)/d_bin)
-                        weight_bin              = 1*(ibinarr==ibin)
-                        index_outlier_cutted    = index_outlier[:, indarr[0]:indarr[1], indarr[2]:indarr[3]]
-                        weight_bin[index_outlier_cutted] \
-                                                = 0
-                        slowsumQC_cutted        = slowness_sumQC[indarr[0]:indarr[1], indarr[2]:indarr[3]]
-                        slownessALL_cutted      = slownessALL[:, indarr[0]:indarr[1], indarr[2]:indarr[3]]
-                        temp_vel                = slownessALL_cutted.copy()
-                        temp_vel[temp_vel!=0]   = 1./temp_vel[temp_vel!=0]
-                        vel_un_ibin             = vel_un_ibin + numexpr.evaluate('sum( (weight_bin*(temp_vel-vel_mean))**2, 0)')
-                        slow_un_ibin            = slow_un_ibin + numexpr.evaluate('sum( (weight_bin*(slownessALL_cutted-slowsumQC_cutted \
-                                                                - dslow_mean))**2, 0)')
-                    #------------------------------------
-                    vel_un_ibin[sumNbin!=0]     = np.sqrt(vel_un_ibin[sumNbin!=0]/(sumNbin[sumNbin!=0]-1)/sumNbin[sumNbin!=0])
-                    vel_un_cutted[ibin, :, :]   = vel_un_ibin
-                    slow_un_ibin[sumNbin!=0]    = np.sqrt(slow_un_ibin[sumNbin!=0]/(sumNbin[sumNbin!=0]-1)/sumNbin[sumNbin!=0])
-                    slow_un_cutted[ibin, :, :]  = slow_un_ibin
-                    histArr_cutted[ibin, :, :]  = sumNbin
-                    slow_sum_ani_cutted[ibin, :, :]  \
-                                                = dslow_mean
                 #-------------------------------------------
                 N_thresh                                = 10 # change
-                slow_sum_ani_cutted[histArr_cutted<N_thresh] \
+                histArr_cutted                          = histArr[:, gridx:-gridx, gridy:-gridy]
+                slow_sum_ani[:, gridx:-gridx, gridy:-gridy][histArr_cutted<N_thresh] \
                                                         = 0
-                slow_sum_ani[:, gridx:-gridx, gridy:-gridy]\
-                                                        = slow_sum_ani_cutted
                 # uncertainties
-                slow_un_cutted[histArr_cutted<N_thresh] = 0
-                slow_un[:, gridx:-gridx, gridy:-gridy]  = slow_un_cutted
+                slow_un[:, gridx:-gridx, gridy:-gridy][histArr_cutted<N_thresh] \
+                                                        = 0
                 # convert sem of slowness to sem of velocity
-                vel_un_cutted[histArr_cutted<N_thresh]  = 0
-                vel_un[:, gridx:-gridx, gridy:-gridy]   = vel_un_cutted
-                # # # return vel_un
+                vel_un[:, gridx:-gridx, gridy:-gridy][histArr_cutted<N_thresh] \
+                                                        = 0
                 # near neighbor quality control
                 Ntotal_thresh                           = 45 # change
                 slow_sum_ani[:, NmeasureAni<Ntotal_thresh]    \
                                                         = 0 
                 slow_un[:, NmeasureAni<Ntotal_thresh]   = 0
                 vel_un[:, NmeasureAni<Ntotal_thresh]    = 0
-                histArr[:, gridx:-gridx, gridy:-gridy]  = histArr_cutted
                 # save data to database
                 s_anidset       = per_group_out.create_dataset(name='slownessAni', data=slow_sum_ani)
                 s_anisemdset    = per_group_out.create_dataset(name='slownessAni_sem', data=slow_un)
@@ -4199,10 +4479,9 @@ class EikonalTomoDataSet(h5py.File):
         #     valid               = np.where(reason_n != 0)[0]
         #     print evid, valid.size
         # return
-        evid                = per_group.keys()[iev]
-        event_group         = per_group[evid]
-        az                  = event_group['az'].value
-        reason_n            = event_group['reason_n'].value
+        evid                = _get_event_list(per_group)[iev]
+        az                  = _read_event_data(per_group, iev, evid, 'az')
+        reason_n            = _read_event_data(per_group, iev, evid, 'reason_n')
         data                = np.zeros(self.lonArr.shape)
         mask                = np.ones(self.lonArr.shape, dtype=bool)
         data[1:-1, 1:-1]    = az
@@ -4495,17 +4774,17 @@ class hybridTomoDataSet(EikonalTomoDataSet):
                 continue
             per_xcorr       = np.append(per_xcorr, per)
             per_group       = group.create_group( name='%g_sec'%( per ) )
-            Nevent          = len(in_per_group.keys())
+            in_evLst        = _get_event_list(in_per_group)
+            Nevent          = len(in_evLst)
             print 'Reading xcorr eikonal results for: '+str(per)+' sec, '+str(Nevent)+ ' events'
             for iev in range(Nevent):
                 # get data
-                evid                        = in_per_group.keys()[iev]
-                in_event_group              = in_per_group[evid]
-                az                          = in_event_group['az'].value
-                velocity                    = in_event_group['appV'].value
-                reason_n                    = in_event_group['reason_n'].value
-                Ntotal_grd                  = in_event_group.attrs['Ntotal_grd']
-                Nvalid_grd                  = in_event_group.attrs['Nvalid_grd']
+                evid                        = in_evLst[iev]
+                az                          = _read_event_data(in_per_group, iev, evid, 'az')
+                velocity                    = _read_event_data(in_per_group, iev, evid, 'appV')
+                reason_n                    = _read_event_data(in_per_group, iev, evid, 'reason_n')
+                Ntotal_grd                  = _read_event_data(in_per_group, iev, evid, 'Ntotal_grd')
+                Nvalid_grd                  = _read_event_data(in_per_group, iev, evid, 'Nvalid_grd')
                 # save data
                 event_group                 = per_group.create_group(name=evid)
                 event_group.attrs.create(name = 'Ntotal_grd', data=Ntotal_grd)
@@ -4588,17 +4867,17 @@ class hybridTomoDataSet(EikonalTomoDataSet):
                 continue
             per_quake       = np.append(per_quake, per)
             per_group       = group.create_group( name='%g_sec'%( per ) )
-            Nevent          = len(in_per_group.keys())
+            in_evLst        = _get_event_list(in_per_group)
+            Nevent          = len(in_evLst)
             print 'Reading quake eikonal results for: '+str(per)+' sec, '+str(Nevent)+ ' events'
             for iev in range(Nevent):
                 # get data
-                evid                        = in_per_group.keys()[iev]
-                in_event_group              = in_per_group[evid]
-                az                          = in_event_group['az'].value
-                velocity                    = in_event_group['appV'].value
-                reason_n                    = in_event_group['reason_n'].value
-                Ntotal_grd                  = in_event_group.attrs['Ntotal_grd']
-                Nvalid_grd                  = in_event_group.attrs['Nvalid_grd']
+                evid                        = in_evLst[iev]
+                az                          = _read_event_data(in_per_group, iev, evid, 'az')
+                velocity                    = _read_event_data(in_per_group, iev, evid, 'appV')
+                reason_n                    = _read_event_data(in_per_group, iev, evid, 'reason_n')
+                Ntotal_grd                  = _read_event_data(in_per_group, iev, evid, 'Ntotal_grd')
+                Nvalid_grd                  = _read_event_data(in_per_group, iev, evid, 'Nvalid_grd')
                 # save data
                 event_group                 = per_group.create_group(name=evid)
                 event_group.attrs.create(name = 'Ntotal_grd', data=Ntotal_grd)
@@ -5351,18 +5630,26 @@ class hybridTomoDataSet(EikonalTomoDataSet):
     
     
     
-def eikonal4mp(infield, workingdir, channel, cdist):
+def eikonal4mp(infield, workingdir, channel, cdist, return_data=False):
+    """eikonal operation of one field, the results are returned to the parent process (return_data = True)
+        or written to <workingdir>/<period>sec/<evid>_field2d.npz
+    """
     working_per     = workingdir+'/'+str(infield.period)+'sec'
     outfname        = infield.evid+'_'+infield.fieldtype+'_'+channel+'.lst'
     infield.interp_surface(workingdir=working_per, outfname=outfname)
     if not infield.check_curvature(workingdir=working_per, outpfx=infield.evid+'_'+channel+'_'):
         return
     infield.eikonal_operator(workingdir=working_per, inpfx=infield.evid+'_'+channel+'_', nearneighbor=True, cdist=cdist)
+    if return_data:
+        return infield.get_results()
     outfname_npz    = working_per+'/'+infield.evid+'_field2d'
     infield.write_binary(outfname=outfname_npz)
     return
 
-def helmhotz4mp(infieldpair, workingdir, channel, amplplc, cdist):
+def helmhotz4mp(infieldpair, workingdir, channel, amplplc, cdist, return_data=False):
+    """eikonal/Helmholtz operation of one field pair, the results are returned to the parent process (return_data = True)
+        or written to <workingdir>/<period>sec/<evid>_field2d.npz
+    """
     tfield          = infieldpair[0]
     working_per     = workingdir+'/'+str(tfield.period)+'sec'
     outfname        = tfield.evid+'_'+tfield.fieldtype+'_'+channel+'.lst'
@@ -5379,5 +5666,34 @@ def helmhotz4mp(infieldpair, workingdir, channel, amplplc, cdist):
             return
         field2dAmp.helmholtz_operator(workingdir = working_per, inpfx = field2dAmp.evid+'_Amp_'+channel+'_', lplcthresh = 0.5)
         tfield.get_lplc_amp(fieldamp = field2dAmp)
+    if return_data:
+        return tfield.get_results(amplplc = amplplc)
     tfield.write_binary(outfname = outfname_npz, amplplc = amplplc)
-    return 
\ No newline at end of file
+    return 
+
+def quake_event4mp(evtask, workingdir, fieldtype, channel, amplplc, cdist, grdinfo):
+    """eikonal/Helmholtz operation of one event for all periods, the results are returned to the parent process
+    """
+    evid, evlo, evla, perdata   = evtask
+    fdict           = { 'Tph': 2, 'Tgr': 3, 'amp': 4}
+    evlo_grd        = evlo
+    if evlo_grd < 0.:
+        evlo_grd    += 360.
+    perresults      = []
+    for per, dataArr in perdata:
+        fieldpair   = []
+        field2d     = field2d_earth.Field2d(minlon=grdinfo['minlon'], maxlon=grdinfo['maxlon'], dlon=grdinfo['dlon'],
+                        minlat=grdinfo['minlat'], maxlat=grdinfo['maxlat'], dlat=grdinfo['dlat'], period=per,
+                            evlo=evlo_grd, evla=evla, fieldtype=fieldtype, evid=evid)
+        Zarr        = dataArr[:, fdict[fieldtype]]
+        distArr     = dataArr[:, 6] # Note amplitude in added!!!
+        field2d.read_array(lonArr = dataArr[:, 0], latArr = dataArr[:, 1], ZarrIn = distArr/Zarr )
+        fieldpair.append(field2d)
+        if amplplc:
+            field2dAmp  = field2d_earth.Field2d(minlon=grdinfo['minlon'], maxlon=grdinfo['maxlon'], dlon=grdinfo['dlon'],
+                            minlat=grdinfo['minlat'], maxlat=grdinfo['maxlat'], dlat=grdinfo['dlat'], period=per,
+                                evlo=evlo_grd, evla=evla, fieldtype='amp', evid=evid)
+            field2dAmp.read_array(lonArr = dataArr[:,0], latArr = dataArr[:,1], ZarrIn = dataArr[:, fdict['amp']] )
+            fieldpair.append(field2dAmp)
+        perresults.append((per, helmhotz4mp(fieldpair, workingdir=workingdir, channel=channel, amplplc=amplplc, cdist=cdist, return_data=True)))
+    return evid, evlo, evla, perresults
@@ -4,7 +4,7 @@ A python module to perform data interpolation/computation on the surface of the
 
 :Dependencies:
     pyproj and its dependencies
-    GMT 5.x.x (for interpolation on Earth surface)
+    GMT 5.x.x (for interp_surface, gauss_smoothing, check_curvature, check_curvature_amp with method = 'gmt', the default)
     numba
     numexpr
     
@@ -19,6 +19,8 @@ import matplotlib.pyplot as plt
 from matplotlib.mlab import griddata
 import numpy.ma as ma
 import scipy.ndimage.filters 
+import scipy.sparse
+import scipy.sparse.linalg
 from scipy.ndimage import convolve
 import matplotlib
 import multiprocessing
@@ -92,11 +94,606 @@ def determine_interval(minlat=None, maxlat=None, dlon=0.2,  dlat=0.2, verbose=Tr
     return final_ratio
     
 
+#--------------------------------------------------------------------
+# in-process minimum curvature gridding with tension, an alternative of gmt surface (method = 'native')
+#   the surface minimizes (1-T)*[zxx^2 + 2*zxy^2 + zyy^2] + T*[zx^2 + zy^2]
+#   on the grid with unit aspect ratio (same as gmt surface -A1), with the
+#   data fitted through bilinear interpolation. The normal equations are
+#   solved by conjugate gradients preconditioned with a multigrid V-cycle.
+#--------------------------------------------------------------------
+
+# cache for the smoothness matrices and their multigrid hierarchy, key: (Nlat, Nlon, tension)
+_surface_cache  = {}
+
+@numba.jit(numba.void(numba.int32[:], numba.int32[:], numba.float64[:], numba.float64[:], numba.float64[:], numba.float64[:],\
+            numba.boolean), nopython=True)
+def _gauss_seidel(indptr, indices, data, invdiag, x, b, forward):
+    """one Gauss-Seidel sweep for a CSR matrix, forward or backward
+    """
+    N   = x.size
+    for k in range(N):
+        if forward:
+            i   = k
+        else:
+            i   = N - 1 - k
+        rsum    = b[i]
+        for ind in range(indptr[i], indptr[i+1]):
+            rsum    -= data[ind]*x[indices[ind]]
+        x[i]    += rsum*invdiag[i]
+    return
+
+def _diff_matrix(n, order):
+    """1D finite difference matrix for the first or second derivative, shape: (n-order, n)
+    """
+    if order == 1:
+        return scipy.sparse.diags([-np.ones(n-1), np.ones(n-1)], [0, 1], shape=(n-1, n))
+    return scipy.sparse.diags([np.ones(n-2), -2.*np.ones(n-2), np.ones(n-2)], [0, 1, 2], shape=(n-2, n))
+
+def _prolongation(n):
+    """1D linear interpolation from the coarse grid (every other point) to a grid with n points
+    """
+    nc      = (n-1)/2 + 1 + (n-1)%2
+    row     = []
+    col     = []
+    val     = []
+    for i in range(n):
+        if i % 2 == 0:
+            row.append(i); col.append(i/2); val.append(1.)
+        else:
+            row     += [i, i]
+            col     += [(i-1)/2, (i+1)/2]
+            val     += [0.5, 0.5]
+    return scipy.sparse.csr_matrix((val, (row, col)), shape=(n, nc))
+
+def _get_surface_operator(Nlat, Nlon, tension, ncoarse=1000):
+    """get the smoothness matrix of minimum curvature with tension and its multigrid hierarchy
+        the results are cached, since they only depend on the grid size and tension
+    ::: output :::
+    Klst    - list of the smoothness matrices on each level (Galerkin coarsening)
+    Plst    - list of the prolongation matrices from level l+1 to level l
+    """
+    key     = (Nlat, Nlon, float(tension))
+    if key in _surface_cache:
+        return _surface_cache[key]
+    Ix      = scipy.sparse.identity(Nlon)
+    Iy      = scipy.sparse.identity(Nlat)
+    Dxx     = scipy.sparse.kron(Iy, _diff_matrix(Nlon, 2))
+    Dyy     = scipy.sparse.kron(_diff_matrix(Nlat, 2), Ix)
+    Dxy     = scipy.sparse.kron(_diff_matrix(Nlat, 1), _diff_matrix(Nlon, 1))
+    Dx      = scipy.sparse.kron(Iy, _diff_matrix(Nlon, 1))
+    Dy      = scipy.sparse.kron(_diff_matrix(Nlat, 1), Ix)
+    K       = (1.-tension)*(Dxx.T*Dxx + Dyy.T*Dyy + 2.*Dxy.T*Dxy) + tension*(Dx.T*Dx + Dy.T*Dy)
+    Klst    = [K.tocsr()]
+    Plst    = []
+    ny      = Nlat
+    nx      = Nlon
+    while ny*nx > ncoarse and ny > 2 and nx > 2:
+        P       = scipy.sparse.kron(_prolongation(ny), _prolongation(nx)).tocsr()
+        Plst.append(P)
+        Klst.append((P.T*Klst[-1]*P).tocsr())
+        ny      = (ny-1)/2 + 1 + (ny-1)%2
+        nx      = (nx-1)/2 + 1 + (nx-1)%2
+    _surface_cache[key] = (Klst, Plst)
+    return Klst, Plst
+
+def _vcycle(Alst, Plst, lu, level, b, nsmooth=1):
+    """multigrid V-cycle with symmetric Gauss-Seidel smoothing, used as preconditioner
+    """
+    if level == len(Plst):
+        return lu.solve(b)
+    A, invdiag  = Alst[level]
+    x       = np.zeros(b.size, dtype=np.float64)
+    for i in range(nsmooth):
+        _gauss_seidel(A.indptr, A.indices, A.data, invdiag, x, b, True)
+    r       = b - A.dot(x)
+    P       = Plst[level]
+    x       += P.dot(_vcycle(Alst, Plst, lu, level+1, P.T.dot(r), nsmooth=nsmooth))
+    for i in range(nsmooth):
+        _gauss_seidel(A.indptr, A.indices, A.data, invdiag, x, b, False)
+    return x
+
+def surface(lonIn, latIn, ZIn, minlon, dlon, Nlon, minlat, dlat, Nlat, tension=0.0, maxiter=200, converge=1e-8, weight=1e3):
+    """minimum curvature gridding with tension, an in-process replacement of gmt surface
+    =======================================================================================
+    ::: input parameters :::
+    lonIn, latIn, ZIn   - input data
+    minlon, dlon, Nlon  - minimum longitude, grid interval and number of grid points in longitude
+    minlat, dlat, Nlat  - minimum latitude, grid interval and number of grid points in latitude
+    tension             - tension factor (0.0-1.0), same as -T in gmt surface
+    maxiter             - maximum number of conjugate gradient iterations
+    converge            - convergence limit of the relative residual
+    weight              - weight of the data relative to the smoothness terms
+    ---------------------------------------------------------------------------------------
+    ::: output :::
+    Zarr                - gridded data, shape: Nlat, Nlon
+    ---------------------------------------------------------------------------------------
+    Note: as in gmt surface, a least squares plane is removed before gridding and added back,
+        data outside the region are not used
+    =======================================================================================
+    """
+    x           = (np.asarray(lonIn, dtype=np.float64) - minlon)/dlon
+    y           = (np.asarray(latIn, dtype=np.float64) - minlat)/dlat
+    z           = np.asarray(ZIn, dtype=np.float64)
+    eps         = 1e-6
+    index       = (x > -eps)*(x < Nlon-1.+eps)*(y > -eps)*(y < Nlat-1.+eps)
+    x           = np.clip(x[index], 0., Nlon-1.)
+    y           = np.clip(y[index], 0., Nlat-1.)
+    z           = z[index]
+    if z.size == 0:
+        raise ValueError('No data inside the region for surface gridding!')
+    # remove the least squares plane
+    G           = np.vstack((np.ones(z.size), x, y)).T
+    plane       = np.linalg.lstsq(G, z, rcond=-1)[0]
+    zres        = z - np.dot(G, plane)
+    xArr, yArr  = np.meshgrid(np.arange(Nlon, dtype=np.float64), np.arange(Nlat, dtype=np.float64))
+    planeArr    = plane[0] + plane[1]*xArr + plane[2]*yArr
+    rms         = np.sqrt(np.mean(zres**2))
+    if rms == 0.:
+        return planeArr
+    zres        /= rms
+    #-------------------------------------------
+    # bilinear interpolation matrix for the data
+    #-------------------------------------------
+    ix          = np.minimum(np.floor(x).astype(np.int64), Nlon-2)
+    iy          = np.minimum(np.floor(y).astype(np.int64), Nlat-2)
+    fx          = x - ix
+    fy          = y - iy
+    rows        = np.repeat(np.arange(z.size), 4)
+    cols        = np.vstack((iy*Nlon+ix, iy*Nlon+ix+1, (iy+1)*Nlon+ix, (iy+1)*Nlon+ix+1)).T.ravel()
+    vals        = np.vstack(((1.-fx)*(1.-fy), fx*(1.-fy), (1.-fx)*fy, fx*fy)).T.ravel()
+    B           = scipy.sparse.csr_matrix((vals, (rows, cols)), shape=(z.size, Nlat*Nlon))
+    #-------------------------------------------
+    # normal equations and multigrid hierarchy
+    #-------------------------------------------
+    Klst, Plst  = _get_surface_operator(Nlat, Nlon, tension)
+    # tiny damping to keep the matrices definite for degenerate data distributions
+    damp        = 1e-10*weight
+    Alst        = []
+    C           = B
+    for level in range(len(Klst)):
+        Al      = (Klst[level] + weight*(C.T*C) + damp*scipy.sparse.identity(Klst[level].shape[0])).tocsr()
+        Alst.append((Al, 1./Al.diagonal()))
+        if level < len(Plst):
+            C   = C*Plst[level]
+    lu          = scipy.sparse.linalg.splu(Alst[-1][0].tocsc())
+    A           = Alst[0][0]
+    b           = weight*B.T.dot(zres)
+    #-------------------------------------------------------------------
+    # initial solution from the coarse levels (full multigrid), followed
+    # by the preconditioned conjugate gradients on the finest grid
+    #-------------------------------------------------------------------
+    blst        = [b]
+    for P in Plst:
+        blst.append(P.T.dot(blst[-1]))
+    zArr        = lu.solve(blst[-1])
+    for level in range(len(Plst)-1, -1, -1):
+        zArr    = Plst[level].dot(zArr)
+        zArr    += _vcycle(Alst, Plst, lu, level, blst[level] - Alst[level][0].dot(zArr))
+    r           = b - A.dot(zArr)
+    s           = _vcycle(Alst, Plst, lu, 0, r)
+    p           = s.copy()
+    rs          = np.dot(r, s)
+    bnorm       = np.sqrt(np.dot(b, b))
+    for it in range(maxiter):
+        if np.sqrt(np.dot(r, r)) <= converge*bnorm:
+            break
+        Ap      = A.dot(p)
+        alpha   = rs/np.dot(p, Ap)
+        zArr    += alpha*p
+        r       -= alpha*Ap
+        s       = _vcycle(Alst, Plst, lu, 0, r)
+        rs_new  = np.dot(r, s)
+        p       = s + (rs_new/rs)*p
+        rs      = rs_new
+    return zArr.reshape(Nlat, Nlon)*rms + planeArr
+
+@numba.jit(numba.float64[:, :](numba.float64[:, :], numba.float64[:], numba.float64[:], numba.float64), nopython=True)
+def _gauss_filter_sphere(Zarr, lon, lat, width):
+    """Gaussian filter with great circle distances, same as gmt grdfilter -D4 -Fg
+        width is 6 times the Gaussian sigma (in km), the weights are truncated at width/2
+        nodes near the edges are normalized by the sum of the weights of the available nodes
+    """
+    Nlat, Nlon  = Zarr.shape
+    outZ        = np.zeros((Nlat, Nlon), dtype=np.float64)
+    R           = 6371.
+    deg2rad     = np.pi/180.
+    hwidth      = width/2.
+    sigma       = width/6.
+    dlon        = abs(lon[1] - lon[0])
+    dlat        = abs(lat[1] - lat[0])
+    nlat_half   = int(np.ceil(hwidth/R/deg2rad/dlat))
+    for i in range(Nlat):
+        lat1    = lat[i]*deg2rad
+        for j in range(Nlon):
+            lon1    = lon[j]*deg2rad
+            wsum    = 0.
+            zsum    = 0.
+            for k in range(max(0, i-nlat_half), min(Nlat, i+nlat_half+1)):
+                lat2    = lat[k]*deg2rad
+                # conservative longitude range for the two latitudes
+                coslat  = min(np.cos(lat1), np.cos(lat2))
+                if coslat*R*deg2rad*dlon*Nlon <= hwidth:
+                    nlon_half   = Nlon
+                else:
+                    nlon_half   = int(np.ceil(hwidth/(R*deg2rad*dlon*coslat)))
+                for l in range(max(0, j-nlon_half), min(Nlon, j+nlon_half+1)):
+                    lon2    = lon[l]*deg2rad
+                    # haversine
+                    sdlat   = np.sin((lat2-lat1)/2.)
+                    sdlon   = np.sin((lon2-lon1)/2.)
+                    hav     = sdlat*sdlat + np.cos(lat1)*np.cos(lat2)*sdlon*sdlon
+                    dist    = 2.*R*np.arcsin(min(1., np.sqrt(hav)))
+                    if dist > hwidth:
+                        continue
+                    w       = np.exp(-0.5*(dist/sigma)**2)
+                    wsum    += w
+                    zsum    += w*Zarr[k, l]
+            outZ[i, j]  = zsum/wsum
+    return outZ
+
+#--------------------------------------------------------------------------------------------
+# near neighbor quality control in eikonal_operator
+#   the input stations are sorted by latitude, for each grid point, only the stations in the
+#   latitude strip are checked. The distance criterion is evaluated with great circle distance,
+#   only the pairs close to the distance limits (the difference between the great circle and
+#   the geodesic distance is less than 1 percent) are returned for geodesic distance computation
+#--------------------------------------------------------------------------------------------
+@numba.jit(numba.types.Tuple((numba.boolean[:, :], numba.int64[:], numba.int64[:], numba.int64[:]))(numba.float64[:], numba.float64[:],\
+            numba.float64, numba.float64, numba.float64[:], numba.float64[:], numba.float64[:], numba.float64[:], numba.boolean[:, :],\
+            numba.float64), nopython=True)
+def _near_neighbor_pairs(lon, lat, dlon, dlat, dlon_km, dlat_km, lonIn, latIn, skip, cdist):
+    """check the stations within the cdist box of each grid point
+    ==============================================================================================
+    ::: input parameters :::
+    lon, lat        - 1D arrays for grid locations
+    dlon, dlat      - grid interval
+    dlon_km/dlat_km - 1D arrays for grid interval in km
+    lonIn, latIn    - station locations, sorted by latitude
+    skip            - grid points to be skipped, shape: Nlat, Nlon
+    cdist           - distance for quality control
+    ::: output :::
+    marker          - marker array, shape: Nlat*Nlon, 4
+                        True if a station with 1 km <= distance < 2*cdist is found in the quadrant (2*E + N)
+    nodeArr         - flattened index of the grid points (ilat*Nlon + ilon) for the pairs to be checked with geodesic distance
+    staArr          - index of the stations (in the sorted arrays) for the pairs to be checked
+    quadArr         - quadrant of the stations relative to the grid points for the pairs to be checked
+    ==============================================================================================
+    """
+    Nlat        = lat.size
+    Nlon        = lon.size
+    R           = 6371.
+    deg2rad     = np.pi/180.
+    marker      = np.zeros((Nlat*Nlon, 4), dtype=np.bool_)
+    # index range of the latitude strip for each row, slightly wider than cdist
+    ibeg        = np.zeros(Nlat, dtype=np.int64)
+    iend        = np.zeros(Nlat, dtype=np.int64)
+    for ilat in range(Nlat):
+        hlat        = 1.01*cdist*dlat/dlat_km[ilat]
+        ibeg[ilat]  = np.searchsorted(latIn, lat[ilat] - hlat)
+        iend[ilat]  = np.searchsorted(latIn, lat[ilat] + hlat, side='right')
+    Npair       = 0
+    for ipass in range(2):
+        if ipass == 1:
+            nodeArr = np.zeros(Npair, dtype=np.int64)
+            staArr  = np.zeros(Npair, dtype=np.int64)
+            quadArr = np.zeros(Npair, dtype=np.int64)
+            Npair   = 0
+        for ilat in range(Nlat):
+            lat1    = lat[ilat]*deg2rad
+            for ilon in range(Nlon):
+                if skip[ilat, ilon]:
+                    continue
+                inode   = ilat*Nlon + ilon
+                for ista in range(ibeg[ilat], iend[ilat]):
+                    difflon = abs(lonIn[ista]-lon[ilon])/dlon*dlon_km[ilat]
+                    difflat = abs(latIn[ista]-lat[ilat])/dlat*dlat_km[ilat]
+                    if difflon >= cdist or difflat >= cdist:
+                        continue
+                    iquad   = 0
+                    if lonIn[ista]-lon[ilon] >= 0:
+                        iquad   += 2
+                    if latIn[ista]-lat[ilat] >= 0:
+                        iquad   += 1
+                    if marker[inode, iquad]:
+                        continue
+                    lat2    = latIn[ista]*deg2rad
+                    sdlat   = np.sin((lat2-lat1)/2.)
+                    sdlon   = np.sin((lonIn[ista]-lon[ilon])*deg2rad/2.)
+                    hav     = sdlat*sdlat + np.cos(lat1)*np.cos(lat2)*sdlon*sdlon
+                    dist    = 2.*R*np.arcsin(min(1., np.sqrt(hav)))
+                    if dist*0.99 >= 1. and dist*1.01 < 2.*cdist:
+                        marker[inode, iquad]    = True
+                    elif dist*1.01 >= 1. and dist*0.99 < 2.*cdist:
+                        if ipass == 1:
+                            nodeArr[Npair]  = inode
+                            staArr[Npair]   = ista
+                            quadArr[Npair]  = iquad
+                        Npair   += 1
+        if ipass == 0:
+            marker[:, :]    = False
+    return marker, nodeArr, staArr, quadArr
+
+#--------------------------------------------------------------------------------------------
+# fused kernels for eikonal_operator_fused/helmholtz_operator_fused
+#   gradients, propagation angles, apparent velocities, Green's theorem Laplacians and the
+#   reason_n masks are computed in one pass over the grid, the results are written into the
+#   output arrays allocated by the caller. The arithmetic follows gradient/Laplacian/get_appV
+#   and eikonal_operator/helmholtz_operator step by step, the results are identical.
+#--------------------------------------------------------------------------------------------
+# read-only 2D arrays, e.g. the arrays of the shared grid geometry
+_ro_float64_2d      = numba.types.Array(numba.float64, 2, 'A', readonly=True)
+
+@numba.jit(numba.void(_ro_float64_2d, _ro_float64_2d, numba.float64, numba.boolean, numba.float64[:, :], numba.int32[:, :]),\
+            nopython=True)
+def _check_v1HD(v1HD, v1HD02, thresh, relative, fieldArr, reason_n):
+    """compare the interpolated fields with tension = 0. and 0.2
+        fieldArr is set to zero and reason_n to 1 if the difference is larger than thresh (or thresh*v1HD if relative)
+    """
+    Nlat, Nlon  = v1HD.shape
+    for i in range(Nlat):
+        for j in range(Nlon):
+            diff    = v1HD[i, j] - v1HD02[i, j]
+            if relative:
+                tempthresh  = abs(thresh*v1HD[i, j])
+            else:
+                tempthresh  = thresh
+            if abs(diff) < tempthresh:
+                fieldArr[i, j]  = v1HD[i, j]*1.
+            else:
+                fieldArr[i, j]  = v1HD[i, j]*0.
+            if diff > tempthresh or diff < -tempthresh:
+                reason_n[i, j]  = 1
+            else:
+                reason_n[i, j]  = 0
+    return
+
+@numba.jit(numba.float64(_ro_float64_2d, _ro_float64_2d, _ro_float64_2d, numba.int64, numba.int64), nopython=True)
+def _green_lplc(Zarr, dlat_km, dlon_km, i, j):
+    """Laplacian at the grid point (i, j) with Green's theorem, same as Laplacian(method='green')
+        the gradients of the four neighbor points are computed with central differences
+    """
+    grad_xp     = ((Zarr[i, j+2] - Zarr[i, j])/2.)/dlon_km[i, j+1]
+    grad_xn     = ((Zarr[i, j] - Zarr[i, j-2])/2.)/dlon_km[i, j-1]
+    grad_yp     = ((Zarr[i+2, j] - Zarr[i, j])/2.)/dlat_km[i+1, j]
+    grad_yn     = ((Zarr[i, j] - Zarr[i-2, j])/2.)/dlat_km[i-1, j]
+    loopsum     = (grad_xp - grad_xn)*dlat_km[i, j] + (grad_yp - grad_yn)*dlon_km[i, j]
+    area        = dlat_km[i, j]*dlon_km[i, j]
+    return loopsum/area
+
+@numba.jit(numba.void(_ro_float64_2d, _ro_float64_2d, _ro_float64_2d, _ro_float64_2d, _ro_float64_2d, _ro_float64_2d,\
+            _ro_float64_2d, numba.int64, numba.int64, numba.int64, numba.int64, numba.boolean, numba.float64, numba.float64,\
+            numba.int32[:, :], numba.float64[:, :], numba.float64[:, :], numba.float64[:, :], numba.float64[:, :], numba.float64[:, :],\
+            numba.float64[:, :], numba.float64[:, :], numba.float64[:, :], numba.int32[:, :]), nopython=True)
+def _eikonal_kernel(Zarr, fieldArr, dlat_km, dlon_km, azArr, bazArr, distArr, nlat_grad, nlon_grad, nlat_lplc, nlon_lplc,\
+        checkslow, dist_per, lplcthresh, reason_full, grad_lat, grad_lon, proAngle, appV, diffaArr, az, baz, lplc, reason_n):
+    """fused kernel of eikonal_operator
+    ==============================================================================================
+    ::: input parameters :::
+    Zarr                - input field, shape: Nlat, Nlon
+    fieldArr            - quality controlled field, shape: Nlat, Nlon
+    dlat_km/dlon_km     - 2D arrays for grid interval in km
+    azArr/bazArr/distArr- azimuth/back-azimuth/distance(km) from the grid points to the event
+    nlat_grad/nlon_grad - number of grids for cutting in gradient array
+    nlat_lplc/nlon_lplc - number of grids for cutting in Laplacian array
+    checkslow           - discard the points with too large/small slowness or not
+    dist_per            - minimum epicentral distance
+    lplcthresh          - threshold value for Laplacian
+    reason_full         - reason_n array before cutting (shape: Nlat, Nlon), modified in place
+    ::: output :::
+    grad_lat/grad_lon   - gradient arrays of fieldArr
+    proAngle            - propagation angle of Zarr
+    appV                - apparent velocity
+    diffaArr            - differences between propagation angle (of fieldArr) and azimuth
+    az/baz              - azimuth/back-azimuth, zero for the discarded points
+    reason_n            - reason_n array
+        the arrays above are of shape: Nlat-2*nlat_grad, Nlon-2*nlon_grad
+    lplc                - Laplacian array of Zarr, shape: Nlat-2*nlat_lplc, Nlon-2*nlon_lplc
+    ==============================================================================================
+    """
+    Nlat, Nlon  = Zarr.shape
+    Ngrad_lat   = Nlat - 2*nlat_grad
+    Ngrad_lon   = Nlon - 2*nlon_grad
+    # if one field point has zero value, reason_n for four near neighbor points will all be set to 4
+    for i in range(Ngrad_lat):
+        for j in range(Ngrad_lon):
+            if fieldArr[i+nlat_grad, j+nlon_grad] == 0.:
+                reason_full[i+2, j+1]   = 4
+                reason_full[i, j+1]     = 4
+                reason_full[i+1, j+2]   = 4
+                reason_full[i+1, j]     = 4
+    for i in range(Ngrad_lat):
+        ii          = i + nlat_grad
+        for j in range(Ngrad_lon):
+            jj      = j + nlon_grad
+            rn      = reason_full[ii, jj]
+            # gradient of the quality controlled field
+            grad_y  = ((fieldArr[ii+1, jj] - fieldArr[ii-1, jj])/2.)/dlat_km[ii, jj]
+            grad_x  = ((fieldArr[ii, jj+1] - fieldArr[ii, jj-1])/2.)/dlon_km[ii, jj]
+            grad_lat[i, j]  = grad_y
+            grad_lon[i, j]  = grad_x
+            # if slowness is too large/small, reason_n will be set to 3
+            slowness= np.sqrt(grad_y*grad_y + grad_x*grad_x)
+            if checkslow and rn == 0 and (slowness > 0.5 or slowness < 0.2):
+                rn  = 3
+            if slowness == 0.:
+                slowness    = 0.3
+            appV[i, j]      = 1./slowness
+            # propagation angle of the input field
+            Zgrad_y = ((Zarr[ii+1, jj] - Zarr[ii-1, jj])/2.)/dlat_km[ii, jj]
+            Zgrad_x = ((Zarr[ii, jj+1] - Zarr[ii, jj-1])/2.)/dlon_km[ii, jj]
+            proAngle[i, j]  = np.arctan2(Zgrad_y, Zgrad_x)/np.pi*180.
+            # propagation deflection
+            tempaz  = 0.
+            tempbaz = 0.
+            diffa   = 0.
+            if rn == 0:
+                tempaz  = 90. - (azArr[ii, jj] + 180.)
+                tempbaz = 90. - bazArr[ii, jj]
+                if tempaz > 180.:
+                    tempaz  = tempaz - 360.
+                if tempaz < -180.:
+                    tempaz  = tempaz + 360.
+                if tempbaz > 180.:
+                    tempbaz = tempbaz - 360.
+                if tempbaz < -180.:
+                    tempbaz = tempbaz + 360.
+                diffa   = np.arctan2(grad_y, grad_x)/np.pi*180. - tempaz
+                # if epicentral distance is too small, reason_n will be set to 5, and diffaArr will be 0.
+                if distArr[ii, jj] < dist_per:
+                    diffa   = 0.
+                    rn      = 5
+            if diffa > 180.:
+                diffa   = diffa - 360.
+            if diffa < -180.:
+                diffa   = diffa + 360.
+            az[i, j]        = tempaz
+            baz[i, j]       = tempbaz
+            diffaArr[i, j]  = diffa
+            reason_n[i, j]  = rn
+    # discard grid points with large curvature
+    for i in range(Nlat - 2*nlat_lplc):
+        ii          = i + nlat_lplc
+        for j in range(Nlon - 2*nlon_lplc):
+            jj      = j + nlon_lplc
+            templplc        = _green_lplc(Zarr, dlat_km, dlon_km, ii, jj)
+            lplc[i, j]      = templplc
+            if templplc > lplcthresh or templplc < -lplcthresh:
+                reason_n[ii-nlat_grad, jj-nlon_grad]    = 6
+    return
+
+@numba.jit(numba.void(_ro_float64_2d, _ro_float64_2d, _ro_float64_2d, _ro_float64_2d, numba.int64, numba.int64,\
+            numba.float64, numba.int32[:, :], numba.float64[:, :], numba.int32[:, :]), nopython=True)
+def _helmholtz_kernel(Zarr, fieldArr, dlat_km, dlon_km, nlat_lplc, nlon_lplc, omega, reason_full, lplc, reason_n):
+    """fused kernel of helmholtz_operator
+    ==============================================================================================
+    ::: input parameters :::
+    Zarr                - field for Laplacian computation, shape: Nlat, Nlon
+    fieldArr            - quality controlled field, shape: Nlat, Nlon
+    dlat_km/dlon_km     - 2D arrays for grid interval in km
+    nlat_lplc/nlon_lplc - number of grids for cutting in Laplacian array
+    omega               - angular frequency
+    reason_full         - reason_n array before cutting (shape: Nlat, Nlon), modified in place
+    ::: output :::
+    lplc                - Laplacian array of Zarr
+    reason_n            - reason_n array
+        the arrays above are of shape: Nlat-2*nlat_lplc, Nlon-2*nlon_lplc
+    ==============================================================================================
+    """
+    Nlat, Nlon  = Zarr.shape
+    Nlplc_lat   = Nlat - 2*nlat_lplc
+    Nlplc_lon   = Nlon - 2*nlon_lplc
+    c0          = 4.
+    # if one field point has zero value, reason_n for four near neighbor points will all be set to 4
+    for i in range(Nlplc_lat):
+        for j in range(Nlplc_lon):
+            if fieldArr[i+nlat_lplc, j+nlon_lplc] == 0.:
+                reason_full[i+2, j+1]   = 4
+                reason_full[i, j+1]     = 4
+                reason_full[i+1, j+2]   = 4
+                reason_full[i+1, j]     = 4
+    for i in range(Nlplc_lat):
+        ii          = i + nlat_lplc
+        for j in range(Nlplc_lon):
+            jj      = j + nlon_lplc
+            templplc        = _green_lplc(Zarr, dlat_km, dlon_km, ii, jj)
+            lplc[i, j]      = templplc
+            # if Laplacian is too large/small, reason_n will be set to 3
+            rn              = reason_full[ii, jj]
+            if fieldArr[ii, jj] == 0.:
+                templplc    = 0.
+            thresh          = fieldArr[ii, jj]*omega*omega/c0/c0
+            if rn == 0 and (templplc > thresh or templplc < -thresh):
+                rn          = 3
+            reason_n[i, j]  = rn
+    return
+
+#--------------------------------------------------------------------------------------------
+# grid geometry shared by Field2d objects
+#   the grid geometry (grid locations, grid intervals in km, event-to-grid azimuths/distances)
+#   only depends on the grid parameters, it is computed once per process and the read-only
+#   arrays are shared by reference among all the Field2d objects with the same grid
+#--------------------------------------------------------------------------------------------
+_geometry_cache     = {}
+
+class GridGeometry(object):
+    """
+    Immutable grid geometry shared by Field2d objects, use get_grid_geometry to get the shared object
+    ===============================================================================================
+    ::: parameters :::
+    key                     - (minlon, maxlon, dlon, minlat, maxlat, dlat)
+    dlon, dlat              - grid interval
+    Nlon, Nlat              - grid number in longitude, latitude
+    lon, lat                - 1D arrays for grid locations
+    lonArr, latArr          - 2D arrays for grid locations
+    dlon_km/dlat_km         - 1D arrays for grid interval in km
+    dlon_kmArr/dlon_kmArr   - 2D arrays for grid interval in km
+    ===============================================================================================
+    """
+    # maximum number of events in the azimuth/distance cache
+    Nevent_cache            = 16
+    def __init__(self, minlon, maxlon, dlon, minlat, maxlat, dlat):
+        self.key                = (minlon, maxlon, dlon, minlat, maxlat, dlat)
+        self.dlon               = dlon
+        self.dlat               = dlat
+        self.Nlon               = int(round((maxlon-minlon)/dlon)+1)
+        self.Nlat               = int(round((maxlat-minlat)/dlat)+1)
+        self.lon                = np.arange(self.Nlon)*self.dlon+minlon
+        self.lat                = np.arange(self.Nlat)*self.dlat+minlat
+        self.lonArr, self.latArr= np.meshgrid(self.lon, self.lat)
+        az, baz, dist_lon       = geodist.inv(np.zeros(self.lat.size), self.lat, np.ones(self.lat.size)*self.dlon, self.lat) 
+        az, baz, dist_lat       = geodist.inv(np.zeros(self.lat.size), self.lat, np.zeros(self.lat.size), self.lat+self.dlat) 
+        self.dlon_km            = dist_lon/1000.
+        self.dlat_km            = dist_lat/1000.
+        self.dlon_kmArr         = (np.tile(self.dlon_km, self.Nlon).reshape(self.Nlon, self.Nlat)).T
+        self.dlat_kmArr         = (np.tile(self.dlat_km, self.Nlon).reshape(self.Nlon, self.Nlat)).T
+        for name in self.array_names():
+            getattr(self, name).setflags(write=False)
+        self._event_cache       = {}
+        return
+    
+    @staticmethod
+    def array_names():
+        return ['lon', 'lat', 'lonArr', 'latArr', 'dlon_km', 'dlat_km', 'dlon_kmArr', 'dlat_kmArr']
+    
+    def __deepcopy__(self, memo):
+        return self
+    
+    def __reduce__(self):
+        # only the key is pickled, the geometry is recomputed (once) in the receiving process
+        return (get_grid_geometry, self.key)
+    
+    def get_event_az_dist(self, evlo, evla):
+        """get azimuth/back-azimuth/distance(km) from the grid points to the event, shape: Nlat, Nlon
+            the arrays are cached for the last Nevent_cache events
+        """
+        evkey   = (evlo, evla)
+        if not evkey in self._event_cache:
+            if len(self._event_cache) >= self.Nevent_cache:
+                self._event_cache.clear()
+            az, baz, dist   = geodist.inv(self.lonArr.ravel(), self.latArr.ravel(), np.ones(self.lonArr.size)*evlo,\
+                                np.ones(self.lonArr.size)*evla) # grid points are initial points
+            az      = az.reshape(self.Nlat, self.Nlon)
+            baz     = baz.reshape(self.Nlat, self.Nlon)
+            dist    = dist.reshape(self.Nlat, self.Nlon)/1000.
+            for arr in (az, baz, dist):
+                arr.setflags(write=False)
+            self._event_cache[evkey]    = (az, baz, dist)
+        return self._event_cache[evkey]
+
+def get_grid_geometry(minlon, maxlon, dlon, minlat, maxlat, dlat):
+    """get the shared grid geometry object, a new one is created only if it is not in the cache
+    """
+    key     = (minlon, maxlon, dlon, minlat, maxlat, dlat)
+    if not key in _geometry_cache:
+        _geometry_cache[key]    = GridGeometry(minlon, maxlon, dlon, minlat, maxlat, dlat)
+    return _geometry_cache[key]
+
 class Field2d(object):
     """
     An object to analyze 2D spherical field data on Earth
     ===============================================================================================
     ::: parameters :::
+    geometry                - shared grid geometry (GridGeometry), the grid arrays below are read-only references to it
     dlon, dlat              - grid interval
     Nlon, Nlat              - grid number in longitude, latitude
     lon, lat                - 1D arrays for grid locations
@@ -140,18 +737,11 @@ class Field2d(object):
     """
     def __init__(self, minlon, maxlon, dlon, minlat, maxlat, dlat, period=10., evlo=float('inf'), evla=float('inf'), fieldtype='Tph',\
                  evid='', nlat_grad=1, nlon_grad=1, nlat_lplc=2, nlon_lplc=2):
-        self.dlon               = dlon
-        self.dlat               = dlat
-        self.Nlon               = int(round((maxlon-minlon)/dlon)+1)
-        self.Nlat               = int(round((maxlat-minlat)/dlat)+1)
-        self.lon                = np.arange(self.Nlon)*self.dlon+minlon
-        self.lat                = np.arange(self.Nlat)*self.dlat+minlat
-        self.lonArr, self.latArr= np.meshgrid(self.lon, self.lat)
+        self._set_geometry(get_grid_geometry(minlon, maxlon, dlon, minlat, maxlat, dlat))
         self.minlon             = minlon
         self.maxlon             = self.lon.max()
         self.minlat             = minlat
         self.maxlat             = self.lat.max()
-        self._get_dlon_dlat_km()
         self.period             = period
         self.evid               = evid
         self.fieldtype          = fieldtype
@@ -165,10 +755,47 @@ class Field2d(object):
         self.nlat_grad          = nlat_grad
         self.nlon_lplc          = nlon_lplc
         self.nlat_lplc          = nlat_lplc
+        #-----------------------------------------------------------
+        # interpolated quality controlled data (tension = 0., 0.2), see check_curvature
+        #-----------------------------------------------------------
+        self.v1HD               = None
+        self.v1HD02             = None
+        return
+    
+    def _set_geometry(self, geometry):
+        """set the shared grid geometry, the geometry arrays are references to the read-only arrays of the shared object
+        """
+        self.geometry           = geometry
+        self.dlon               = geometry.dlon
+        self.dlat               = geometry.dlat
+        self.Nlon               = geometry.Nlon
+        self.Nlat               = geometry.Nlat
+        for name in GridGeometry.array_names():
+            setattr(self, name, getattr(geometry, name))
+        return
+    
+    def __getstate__(self):
+        # the geometry arrays are not pickled, they are recovered from the shared geometry (see GridGeometry.__reduce__)
+        state   = self.__dict__.copy()
+        for name in GridGeometry.array_names():
+            if state.get(name, None) is getattr(self.geometry, name):
+                del state[name]
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for name in GridGeometry.array_names():
+            if not name in state:
+                setattr(self, name, getattr(self.geometry, name))
         return
     
     def copy(self):
-        return copy.deepcopy(self)
+        # the shared geometry arrays are not copied
+        memo    = {}
+        for name in GridGeometry.array_names():
+            arr             = getattr(self, name)
+            memo[id(arr)]   = arr
+        return copy.deepcopy(self, memo)
     
     def _get_dlon_dlat_km_slow(self):
         """Get longitude and latitude interval in km
@@ -297,15 +924,20 @@ class Field2d(object):
             raise TypeError('Wrong output format!')
         return
     
-    def write_binary(self, outfname, amplplc=False):
-        """write data arrays to a binary npy file
+    def get_results(self, amplplc=False):
+        """get the list of result arrays, in the same order as the arrays in the output file of write_binary
         """
         if amplplc:
-            np.savez( outfname, self.appV, self.reason_n, self.proAngle, self.az, self.baz, self.Zarr,\
-                     self.lplc_amp, self.corV, self.reason_n_helm, np.array([self.Ntotal_grd, self.Nvalid_grd]))
+            return [self.appV, self.reason_n, self.proAngle, self.az, self.baz, self.Zarr,\
+                     self.lplc_amp, self.corV, self.reason_n_helm, np.array([self.Ntotal_grd, self.Nvalid_grd])]
         else:
-            np.savez( outfname, self.appV, self.reason_n, self.proAngle, self.az, self.baz, self.Zarr,\
-                        np.array([self.Ntotal_grd, self.Nvalid_grd]))
+            return [self.appV, self.reason_n, self.proAngle, self.az, self.baz, self.Zarr,\
+                        np.array([self.Ntotal_grd, self.Nvalid_grd])]
+    
+    def write_binary(self, outfname, amplplc=False):
+        """write data arrays to a binary npy file
+        """
+        np.savez( outfname, *self.get_results(amplplc=amplplc))
         return
     
     def np2ma(self):
@@ -375,28 +1007,45 @@ class Field2d(object):
         nlon, nlon  - number of edge point in longitude/latitude to be cutted
         =======================================================================================
         """
-        self.Nlon               = self.Nlon-2*nlon
-        self.Nlat               = self.Nlat-2*nlat
         self.minlon             = self.minlon + nlon*self.dlon
         self.maxlon             = self.maxlon - nlon*self.dlon
         self.minlat             = self.minlat + nlat*self.dlat
         self.maxlat             = self.maxlat - nlat*self.dlat
-        self.lon                = np.arange(self.Nlon)*self.dlon+self.minlon
-        self.lat                = np.arange(self.Nlat)*self.dlat+self.minlat
-        self.lonArr,self.latArr = np.meshgrid(self.lon, self.lat)
+        self._set_geometry(get_grid_geometry(self.minlon, self.maxlon, self.dlon, self.minlat, self.maxlat, self.dlat))
         self.Zarr               = self.Zarr[nlat:-nlat, nlon:-nlon]
         try:
             self.reason_n       = self.reason_n[nlat:-nlat, nlon:-nlon]
         except:
             pass
-        self._get_dlon_dlat_km()
         return
     
     #--------------------------------------------------
     # functions for interpolation/gradient/Laplacian 
     #--------------------------------------------------
     
-    def interp_surface(self, workingdir, outfname, tension=0.0):
+    def interp_surface(self, workingdir=None, outfname=None, tension=0.0, method='gmt'):
+        """interpolate input data to grid point
+        =======================================================================================
+        ::: input parameters :::
+        workingdir  - working directory (method = 'gmt' only)
+        outfname    - output file name for interpolation (method = 'gmt' only)
+        tension     - input tension for surface(0.0-1.0)
+        method      - 'gmt'     : gmt surface command (interp_surface_gmt)
+                      'native'  : in-process minimum curvature gridding (see surface), no file will be written
+        ---------------------------------------------------------------------------------------
+        ::: output :::
+        self.Zarr   - interpolated field data
+        =======================================================================================
+        """
+        if method == 'gmt':
+            return self.interp_surface_gmt(workingdir=workingdir, outfname=outfname, tension=tension)
+        elif method != 'native':
+            raise ValueError('Unexpected interpolation method: '+str(method))
+        self.Zarr   = surface(self.lonArrIn, self.latArrIn, self.ZarrIn, self.minlon, self.dlon, self.Nlon,\
+                        self.minlat, self.dlat, self.Nlat, tension=tension)
+        return
+    
+    def interp_surface_gmt(self, workingdir, outfname, tension=0.0):
         """interpolate input data to grid point with gmt surface command
         =======================================================================================
         ::: input parameters :::
@@ -412,7 +1061,12 @@ class Field2d(object):
         =======================================================================================
         """
         if not os.path.isdir(workingdir):
-            os.makedirs(workingdir)
+            # the directory may be created by another process at the same time
+            try:
+                os.makedirs(workingdir)
+            except OSError:
+                if not os.path.isdir(workingdir):
+                    raise
         OutArr      = np.append(self.lonArrIn, self.latArrIn)
         OutArr      = np.append(OutArr, self.ZarrIn)
         OutArr      = OutArr.reshape(3, self.lonArrIn.size)
@@ -437,7 +1091,32 @@ class Field2d(object):
         self.Zarr   = (ZarrIn.reshape(self.Nlat, self.Nlon))[::-1, :]
         return
     
-    def gauss_smoothing(self, workingdir, outfname, tension=0.0, width=50.):
+    def gauss_smoothing(self, workingdir=None, outfname=None, tension=0.0, width=50., method='gmt'):
+        """perform a Gaussian smoothing
+        =======================================================================================
+        ::: input parameters :::
+        workingdir  - working directory (method = 'gmt' only)
+        outfname    - output file name for interpolation (method = 'gmt' only)
+        tension     - input tension for surface(0.0-1.0)
+        width       - Gaussian width in km
+        method      - 'gmt'     : gmt surface and grdfilter commands (gauss_smoothing_gmt)
+                      'native'  : in-process gridding (see surface) and Gaussian filter, no file will be written
+        ---------------------------------------------------------------------------------------
+        ::: output :::
+        self.Zarr   - smoothed field data
+        =======================================================================================
+        """
+        if method == 'gmt':
+            return self.gauss_smoothing_gmt(workingdir=workingdir, outfname=outfname, tension=tension, width=width)
+        elif method != 'native':
+            raise ValueError('Unexpected interpolation method: '+str(method))
+        Zarr        = surface(self.lonArrIn, self.latArrIn, self.ZarrIn, self.minlon, self.dlon, self.Nlon,\
+                        self.minlat, self.dlat, self.Nlat, tension=tension)
+        # width is 6 times the conventional Gaussian sigma, same as gmt grdfilter -Fg
+        self.Zarr   = _gauss_filter_sphere(Zarr, self.lon.astype(np.float64), self.lat.astype(np.float64), 6.*width)
+        return
+    
+    def gauss_smoothing_gmt(self, workingdir, outfname, tension=0.0, width=50.):
         """perform a Gaussian smoothing
         =======================================================================================
         ::: input parameters :::
@@ -451,7 +1130,12 @@ class Field2d(object):
         =======================================================================================
         """
         if not os.path.isdir(workingdir):
-            os.makedirs(workingdir)
+            # the directory may be created by another process at the same time
+            try:
+                os.makedirs(workingdir)
+            except OSError:
+                if not os.path.isdir(workingdir):
+                    raise
         OutArr      = np.append(self.lonArrIn, self.latArrIn)
         OutArr      = np.append(OutArr, self.ZarrIn)
         OutArr      = OutArr.reshape(3, self.lonArrIn.size)
@@ -622,7 +1306,77 @@ class Field2d(object):
     # functions for data quality controls
     #--------------------------------------------------
     
-    def check_curvature(self, workingdir, outpfx='', threshold=0.005):
+    def _interp_v1(self, LonLst, LatLst, ZLst):
+        """interpolate the quality controlled data with tension = 0. and 0.2
+        """
+        self.lonArrV1   = LonLst
+        self.latArrV1   = LatLst
+        self.ZarrV1     = ZLst
+        self.v1HD       = surface(LonLst, LatLst, ZLst, self.minlon, self.dlon, self.Nlon,\
+                            self.minlat, self.dlat, self.Nlat, tension=0.)
+        self.v1HD02     = surface(LonLst, LatLst, ZLst, self.minlon, self.dlon, self.Nlon,\
+                            self.minlat, self.dlat, self.Nlat, tension=0.2)
+        return
+    
+    def _get_v1HD(self, workingdir, inpfx):
+        """get the interpolated quality controlled data (tension = 0. and 0.2)
+            the in-memory arrays from check_curvature/check_curvature_amp (method = 'native') are used if available,
+            otherwise the output files of check_curvature/check_curvature_amp (method = 'gmt') are read
+            the output arrays are in the same order as the gmt grd2xyz output (from north to south)
+        """
+        if self.v1HD is not None and self.v1HD02 is not None:
+            return self.v1HD[::-1, :].ravel(), self.v1HD02[::-1, :].ravel()
+        fnamev1     = workingdir+'/'+inpfx+self.fieldtype+'_'+str(self.period)+'_v1.lst'
+        fnamev1HD   = fnamev1+'.HD'
+        fnamev1HD02 = fnamev1HD+'_0.2'
+        fieldv1HD   = np.loadtxt(fnamev1HD)[:, 2]
+        fieldv1HD02 = np.loadtxt(fnamev1HD02)[:, 2]
+        return fieldv1HD, fieldv1HD02
+    
+    def check_curvature(self, workingdir=None, outpfx='', threshold=0.005, method='gmt'):
+        """
+        Check and discard data points with large curvatures.
+        Points at boundaries will be discarded.
+        Two interpolation schemes with different tension (0, 0.2) will be applied to the quality controlled field data
+        =====================================================================================================================
+        ::: input parameters :::
+        workingdir  - working directory (method = 'gmt' only)
+        outpfx      - prefix for output files (method = 'gmt' only)
+        threshold   - threshold value for Laplacian, default - 0.005, the value is suggested in Lin et al.(2009)
+        method      - 'gmt'     : interpolation with gmt surface, results are written to files (check_curvature_gmt)
+                      'native'  : in-process interpolation (see surface), no file will be written
+        ---------------------------------------------------------------------------------------------------------------------
+        ::: output :::
+        self.lonArrV1, self.latArrV1, self.ZarrV1   - data point passing curvature checking
+        self.v1HD                                   - interpolated travel time field (method = 'native')
+        self.v1HD02                                 - interpolated travel time field with tension=0.2 (method = 'native')
+        =====================================================================================================================
+        """
+        if method == 'gmt':
+            return self.check_curvature_gmt(workingdir=workingdir, outpfx=outpfx, threshold=threshold)
+        elif method != 'native':
+            raise ValueError('Unexpected interpolation method: '+str(method))
+        self.v1HD   = None
+        self.v1HD02 = None
+        # Compute Laplacian
+        self.Laplacian(method='green')
+        tfield      = self.copy()
+        tfield.cut_edge(nlon=self.nlon_lplc, nlat=self.nlat_lplc)
+        #--------------------
+        # quality control
+        #--------------------
+        LonLst      = tfield.lonArr.reshape(tfield.lonArr.size)
+        LatLst      = tfield.latArr.reshape(tfield.latArr.size)
+        TLst        = tfield.Zarr.reshape(tfield.Zarr.size)
+        lplc        = self.lplc.reshape(self.lplc.size)
+        index       = np.where((lplc>-threshold)*(lplc<threshold))[0]
+        # 09/24/2018, if no data 
+        if index.size == 0:
+            return False
+        self._interp_v1(LonLst=LonLst[index], LatLst=LatLst[index], ZLst=TLst[index])
+        return True
+    
+    def check_curvature_gmt(self, workingdir, outpfx='', threshold=0.005):
         """
         Check and discard data points with large curvatures.
         Points at boundaries will be discarded.
@@ -642,6 +1396,9 @@ class Field2d(object):
             - 07/06/2018    : added the capability of dealing with dlon != dlat
         =====================================================================================================================
         """
+        # the files are used in eikonal_operator/helmholtz_operator
+        self.v1HD   = None
+        self.v1HD02 = None
         # Compute Laplacian
         self.Laplacian(method='green')
         tfield      = self.copy()
@@ -686,7 +1443,71 @@ class Field2d(object):
         os.remove(tempGMT)
         return True
     
-    def check_curvature_amp(self, workingdir, outpfx='', threshold=0.2):
+    def check_curvature_amp(self, workingdir=None, outpfx='', threshold=0.2, method='gmt'):
+        """
+        Check and discard data points with large curvatures, designed for amplitude field
+        Points at boundaries will be discarded.
+        Two interpolation schemes with different tension (0, 0.2) will be applied to the quality controlled field data
+        =====================================================================================================================
+        ::: input parameters :::
+        workingdir  - working directory (method = 'gmt' only)
+        outpfx      - prefix for output files (method = 'gmt' only)
+        threshold   - threshold value for Laplacian
+        method      - 'gmt'     : interpolation with gmt surface, results are written to files (check_curvature_amp_gmt)
+                      'native'  : in-process interpolation (see surface), no file will be written
+        ---------------------------------------------------------------------------------------------------------------------
+        ::: output :::
+        self.lonArrV1, self.latArrV1, self.ZarrV1   - data point passing curvature checking
+        self.v1HD                                   - interpolated amplitude field (method = 'native')
+        self.v1HD02                                 - interpolated amplitude field with tension=0.2 (method = 'native')
+        =====================================================================================================================
+        """
+        if method == 'gmt':
+            return self.check_curvature_amp_gmt(workingdir=workingdir, outpfx=outpfx, threshold=threshold)
+        elif method != 'native':
+            raise ValueError('Unexpected interpolation method: '+str(method))
+        self.v1HD   = None
+        self.v1HD02 = None
+        # Compute Laplacian
+        self.Laplacian(method='green')
+        tfield      = self.copy()
+        tfield.cut_edge(nlon=self.nlon_lplc, nlat=self.nlat_lplc)
+        threshold   = threshold*2./(3.**2)
+        #--------------------
+        # quality control
+        #--------------------
+        LonLst      = tfield.lonArr.reshape(tfield.lonArr.size)
+        LatLst      = tfield.latArr.reshape(tfield.latArr.size)
+        ampLst      = tfield.Zarr.reshape(tfield.Zarr.size)
+        # # # lplc        = self.lplc.reshape(self.lplc.size)
+        # # # lplc_corr   = lplc.copy()
+        # # # lplc_corr   = self.lplc.copy()
+        # # # lplc_corr[ampLst!=0.]\
+        # # #             = lplc[ampLst!=0.]/ampLst[ampLst!=0.]
+        # # # lplc_corr[ampLst==0.]\
+        # # #             = 0.
+        lplc_corr   = self.lplc.copy()
+        #
+        if lplc_corr.shape != tfield.Zarr.shape:
+            raise ValueError('001: '+tfield.evid)
+        #
+        lplc_corr[tfield.Zarr==0.]\
+                    = 0.
+        lplc_corr   = lplc_corr.reshape(lplc_corr.size)
+        omega       = 2.*np.pi/self.period
+        # original
+        # lplc_corr   = lplc_corr/(omega**2)
+        # index       = np.where((lplc_corr>-threshold)*(lplc_corr<threshold))[0]
+        # new
+        c0          = 4.
+        threshold   = (ampLst*omega*omega/c0/c0)
+        index       = np.where((lplc_corr>-threshold)*(lplc_corr<threshold))[0]
+        if index.size == 0:
+            return False
+        self._interp_v1(LonLst=LonLst[index], LatLst=LatLst[index], ZLst=ampLst[index])
+        return True
+    
+    def check_curvature_amp_gmt(self, workingdir, outpfx='', threshold=0.2):
         """
         Check and discard data points with large curvatures, designed for amplitude field
         Points at boundaries will be discarded.
@@ -705,6 +1526,9 @@ class Field2d(object):
             - 2018/07/06    : added the capability of dealing with dlon != dlat
         =====================================================================================================================
         """
+        # the files are used in eikonal_operator/helmholtz_operator
+        self.v1HD   = None
+        self.v1HD02 = None
         # Compute Laplacian
         self.Laplacian(method='green')
         tfield      = self.copy()
@@ -770,14 +1594,41 @@ class Field2d(object):
         os.remove(tempGMT)
         return True
         
-    def eikonal_operator(self, workingdir, inpfx='', nearneighbor=True, cdist=150., lplcthresh=0.005, lplcnearneighbor=False):
+    def _check_near_neighbor(self, fieldArr, reason_n, cdist):
+        """check each grid point if there are close-by stations located at all four quadrants (E/W, N/S)
+            fieldArr and reason_n are modified in place (0 and 2 for grid points not passing the check)
+            the stations are indexed once by latitude, all the grid points are checked in one numba pass
+        """
+        isort       = np.argsort(self.latArrIn, kind='mergesort')
+        lonIn       = np.float64(self.lonArrIn[isort])
+        latIn       = np.float64(self.latArrIn[isort])
+        marker, nodeArr, staArr, quadArr\
+                    = _near_neighbor_pairs(np.array(self.lon, dtype=np.float64), np.array(self.lat, dtype=np.float64), np.float64(self.dlon),\
+                        np.float64(self.dlat), np.array(self.dlon_km, dtype=np.float64), np.array(self.dlat_km, dtype=np.float64), lonIn, latIn, reason_n==1, np.float64(cdist))
+        # geodesic distances for the pairs close to the distance limits
+        if nodeArr.size > 0:
+            ilatArr     = nodeArr/self.Nlon
+            ilonArr     = nodeArr%self.Nlon
+            az, baz, dist \
+                        = geodist.inv(self.lon[ilonArr], self.lat[ilatArr], lonIn[staArr], latIn[staArr])
+            dist        = dist/1000.
+            ind         = (dist < cdist*2)*(dist >= 1)
+            marker[nodeArr[ind], quadArr[ind]]\
+                        = True
+        tflag       = (marker.all(axis=1)).reshape(self.Nlat, self.Nlon)
+        index       = np.logical_not(tflag)*(reason_n != 1)
+        fieldArr[index] = 0
+        reason_n[index] = 2
+        return
+    
+    def eikonal_operator(self, workingdir=None, inpfx='', nearneighbor=True, cdist=150., lplcthresh=0.005, lplcnearneighbor=False):
         """
         Generate slowness maps from travel time maps using eikonal equation
         Two interpolated travel time file with different tension will be used for quality control.
         =====================================================================================================================
         ::: input parameters :::
-        workingdir      - working directory
-        inpfx           - prefix for input files
+        workingdir      - working directory, only used for the output files of check_curvature/check_curvature_amp with method = 'gmt'
+        inpfx           - prefix for input files, only used for the output files of check_curvature/check_curvature_amp with method = 'gmt'
         nearneighbor    - do near neighbor quality control or not
         cdist           - distance for quality control, default is 12*period
         lplcthresh      - threshold value for Laplacian
@@ -793,21 +1644,7 @@ class Field2d(object):
         # Read data
         # v1: data that passes check_curvature criterion
         # v1HD and v1HD02: interpolated v1 data with tension = 0. and 0.2
-        fnamev1     = workingdir+'/'+inpfx+self.fieldtype+'_'+str(self.period)+'_v1.lst'
-        fnamev1HD   = fnamev1+'.HD'
-        fnamev1HD02 = fnamev1HD+'_0.2'
-        InarrayV1   = np.loadtxt(fnamev1)
-        loninV1     = InarrayV1[:,0]
-        latinV1     = InarrayV1[:,1]
-        fieldin     = InarrayV1[:,2]
-        Inv1HD      = np.loadtxt(fnamev1HD)
-        lonv1HD     = Inv1HD[:,0]
-        latv1HD     = Inv1HD[:,1]
-        fieldv1HD   = Inv1HD[:,2]
-        Inv1HD02    = np.loadtxt(fnamev1HD02)
-        lonv1HD02   = Inv1HD02[:,0]
-        latv1HD02   = Inv1HD02[:,1]
-        fieldv1HD02 = Inv1HD02[:,2]
+        fieldv1HD, fieldv1HD02  = self._get_v1HD(workingdir=workingdir, inpfx=inpfx)
         # Set field value to be zero if there is large difference between v1HD and v1HD02
         diffArr     = fieldv1HD-fieldv1HD02
         fieldArr    = fieldv1HD*((diffArr<2.)*(diffArr>-2.)) 
@@ -831,44 +1668,7 @@ class Field2d(object):
         # check each data point if there are close-by four stations located at E/W/N/S directions respectively
         #-------------------------------------------------------------------------------------------------------
         if nearneighbor:
-            for ilat in range(self.Nlat):
-                for ilon in range(self.Nlon):
-                    if reason_n[ilat, ilon]==1:
-                        continue
-                    lon         = self.lon[ilon]
-                    lat         = self.lat[ilat]
-                    dlon_km     = self.dlon_km[ilat]
-                    dlat_km     = self.dlat_km[ilat]
-                    difflon     = abs(self.lonArrIn-lon)/self.dlon*dlon_km
-                    difflat     = abs(self.latArrIn-lat)/self.dlat*dlat_km
-                    index       = np.where((difflon<cdist)*(difflat<cdist))[0]
-                    marker_EN   = np.zeros((2,2), dtype=np.bool)
-                    marker_nn   = 4
-                    tflag       = False
-                    for iv1 in index:
-                        lon2    = self.lonArrIn[iv1]
-                        lat2    = self.latArrIn[iv1]
-                        if lon2-lon<0:
-                            marker_E    = 0
-                        else:
-                            marker_E    = 1
-                        if lat2-lat<0:
-                            marker_N    = 0
-                        else:
-                            marker_N    = 1
-                        if marker_EN[marker_E , marker_N]:
-                            continue
-                        az, baz, dist   = geodist.inv(lon, lat, lon2, lat2) # loninArr/latinArr are initial points
-                        dist            = dist/1000.
-                        if dist< cdist*2 and dist >= 1:
-                            marker_nn   = marker_nn-1
-                            if marker_nn==0:
-                                tflag   = True
-                                break
-                            marker_EN[marker_E, marker_N]   = True
-                    if not tflag:
-                        fieldArr[ilat, ilon]    = 0
-                        reason_n[ilat, ilon]    = 2
+            self._check_near_neighbor(fieldArr=fieldArr, reason_n=reason_n, cdist=cdist)
         # Start to Compute Gradient
         tfield                      = self.copy()
         tfield.Zarr                 = fieldArr
@@ -894,12 +1694,11 @@ class Field2d(object):
         #-------------------------------------
         indexvalid                              = np.where(reason_n==0)
         diffaArr                                = np.zeros(reason_n.shape, dtype = np.float64)
-        latinArr                                = self.lat[indexvalid[0] + self.nlat_grad]
-        loninArr                                = self.lon[indexvalid[1] + self.nlon_grad]
-        evloArr                                 = np.ones(loninArr.size, dtype=np.float64)*evlo
-        evlaArr                                 = np.ones(latinArr.size, dtype=np.float64)*evla
-        az, baz, distevent                      = geodist.inv(loninArr, latinArr, evloArr, evlaArr) # loninArr/latinArr are initial points
-        distevent                               = distevent/1000.        
+        # azimuth/back-azimuth/distance from the grid points to the event, cached in the shared geometry
+        azArr, bazArr, distArr                  = self.geometry.get_event_az_dist(evlo, evla)
+        az                                      = azArr[indexvalid[0] + self.nlat_grad, indexvalid[1] + self.nlon_grad]
+        baz                                     = bazArr[indexvalid[0] + self.nlat_grad, indexvalid[1] + self.nlon_grad]
+        distevent                               = distArr[indexvalid[0] + self.nlat_grad, indexvalid[1] + self.nlon_grad]
         az                                      = az + 180.
         az                                      = 90.-az
         baz                                     = 90.-baz
@@ -968,35 +1767,21 @@ class Field2d(object):
         self.Ntotal_grd                         = reason_n.size
         return
     
-    def helmholtz_operator(self, workingdir, inpfx='', lplcthresh=0.2):
+    def helmholtz_operator(self, workingdir=None, inpfx='', lplcthresh=0.2):
         """
         Generate amplitude Laplacian maps for helmholtz tomography
         Two interpolated amplitude file with different tension will be used for quality control.
         =====================================================================================================================
         ::: input parameters :::
-        workingdir      - working directory
-        inpfx           - prefix for input files
+        workingdir      - working directory, only used for the output files of check_curvature/check_curvature_amp with method = 'gmt'
+        inpfx           - prefix for input files, only used for the output files of check_curvature/check_curvature_amp with method = 'gmt'
         lplcthresh      - threshold value for Laplacian
         =====================================================================================================================
         """
         # Read data,
         # v1: data that pass check_curvature criterion
         # v1HD and v1HD02: interpolated v1 data with tension = 0. and 0.2
-        fnamev1     = workingdir+'/'+inpfx+self.fieldtype+'_'+str(self.period)+'_v1.lst'
-        fnamev1HD   = fnamev1+'.HD'
-        fnamev1HD02 = fnamev1HD+'_0.2'
-        InarrayV1   = np.loadtxt(fnamev1)
-        loninV1     = InarrayV1[:,0]
-        latinV1     = InarrayV1[:,1]
-        fieldin     = InarrayV1[:,2]
-        Inv1HD      = np.loadtxt(fnamev1HD)
-        lonv1HD     = Inv1HD[:,0]
-        latv1HD     = Inv1HD[:,1]
-        fieldv1HD   = Inv1HD[:,2]
-        Inv1HD02    = np.loadtxt(fnamev1HD02)
-        lonv1HD02   = Inv1HD02[:,0]
-        latv1HD02   = Inv1HD02[:,1]
-        fieldv1HD02 = Inv1HD02[:,2]
+        fieldv1HD, fieldv1HD02  = self._get_v1HD(workingdir=workingdir, inpfx=inpfx)
         # Set field value to be zero if there is large difference between v1HD and v1HD02
         diffArr     = fieldv1HD - fieldv1HD02
         # new
@@ -1070,6 +1855,121 @@ class Field2d(object):
                                     = tempmask
         return
     
+    def _get_v1HD_fused(self, workingdir, inpfx, thresh, relative):
+        """get the quality controlled field and the initial reason_n array for the fused operators
+        """
+        if self.v1HD is not None and self.v1HD02 is not None:
+            v1HD        = self.v1HD
+            v1HD02      = self.v1HD02
+        else:
+            fieldv1HD, fieldv1HD02  = self._get_v1HD(workingdir=workingdir, inpfx=inpfx)
+            v1HD        = (fieldv1HD.reshape(self.Nlat, self.Nlon))[::-1, :]
+            v1HD02      = (fieldv1HD02.reshape(self.Nlat, self.Nlon))[::-1, :]
+        fieldArr    = np.empty((self.Nlat, self.Nlon), dtype=np.float64)
+        reason_n    = np.empty((self.Nlat, self.Nlon), dtype=np.int32)
+        _check_v1HD(np.asarray(v1HD, dtype=np.float64), np.asarray(v1HD02, dtype=np.float64), np.float64(thresh), relative, fieldArr, reason_n)
+        return fieldArr, reason_n
+    
+    def eikonal_operator_fused(self, workingdir=None, inpfx='', nearneighbor=True, cdist=150., lplcthresh=0.005, lplcnearneighbor=False):
+        """
+        Generate slowness maps from travel time maps using eikonal equation, same as eikonal_operator
+        The gradients, propagation angles, apparent velocities, Laplacians and the reason_n array are computed
+        in one pass (_eikonal_kernel) without temporary arrays, the results are identical to eikonal_operator.
+        =====================================================================================================================
+        ::: input parameters :::
+        workingdir      - working directory, only used for the output files of check_curvature/check_curvature_amp with method = 'gmt'
+        inpfx           - prefix for input files, only used for the output files of check_curvature/check_curvature_amp with method = 'gmt'
+        nearneighbor    - do near neighbor quality control or not
+        cdist           - distance for quality control, default is 12*period
+        lplcthresh      - threshold value for Laplacian
+        lplcnearneighbor- also discard near neighbor points for a grid point with large Laplacian
+        =====================================================================================================================
+        """
+        if cdist is None:
+            cdist   = max(12.*self.period/3., 150.)
+        # reason_n array, see eikonal_operator
+        fieldArr, reason_n  = self._get_v1HD_fused(workingdir=workingdir, inpfx=inpfx, thresh=2., relative=False)
+        if nearneighbor:
+            self._check_near_neighbor(fieldArr=fieldArr, reason_n=reason_n, cdist=cdist)
+        # same as Laplacian(method='green')
+        if self.nlat_lplc - self.nlat_grad - 1 < 0:
+            self.nlat_lplc  = self.nlat_grad + 1
+        if self.nlon_lplc - self.nlon_grad - 1 < 0:
+            self.nlon_lplc  = self.nlon_grad + 1
+        #--------------------
+        # output arrays
+        #--------------------
+        shape_grad          = (self.Nlat - 2*self.nlat_grad, self.Nlon - 2*self.nlon_grad)
+        grad_lat            = np.empty(shape_grad, dtype=np.float64)
+        grad_lon            = np.empty(shape_grad, dtype=np.float64)
+        self.proAngle       = np.empty(shape_grad, dtype=np.float64)
+        self.appV           = np.empty(shape_grad, dtype=np.float64)
+        self.diffaArr       = np.empty(shape_grad, dtype=np.float64)
+        self.az             = np.empty(shape_grad, dtype=np.float64)
+        self.baz            = np.empty(shape_grad, dtype=np.float64)
+        self.lplc           = np.empty((self.Nlat - 2*self.nlat_lplc, self.Nlon - 2*self.nlon_lplc), dtype=np.float64)
+        reason_n_grad       = np.empty(shape_grad, dtype=np.int32)
+        azArr, bazArr, distArr\
+                            = self.geometry.get_event_az_dist(self.evlo, self.evla)
+        _eikonal_kernel(np.asarray(self.Zarr, dtype=np.float64), fieldArr, self.dlat_kmArr, self.dlon_kmArr, azArr, bazArr, distArr,\
+            self.nlat_grad, self.nlon_grad, self.nlat_lplc, self.nlon_lplc, (self.fieldtype=='Tph' or self.fieldtype=='Tgr'),\
+            4.*self.period*3., np.float64(lplcthresh), reason_n, grad_lat, grad_lon, self.proAngle, self.appV, self.diffaArr,\
+            self.az, self.baz, self.lplc, reason_n_grad)
+        reason_n            = reason_n_grad
+        # near neighbor discard for large curvature
+        if lplcnearneighbor:
+            indexlplc                               = np.where(reason_n==6.)
+            ilatArr                                 = indexlplc[0] 
+            ilonArr                                 = indexlplc[1]
+            reason_n_temp                           = np.zeros(self.lonArr.shape)
+            reason_n_temp[self.nlat_grad:-self.nlat_grad, self.nlon_grad:-self.nlon_grad] \
+                                                    = reason_n.copy()
+            reason_n_temp[ilatArr+1, ilonArr]       = 6
+            reason_n_temp[ilatArr-1, ilonArr]       = 6
+            reason_n_temp[ilatArr, ilonArr+1]       = 6
+            reason_n_temp[ilatArr, ilonArr-1]       = 6
+            reason_n                                = reason_n_temp[self.nlat_grad:-self.nlat_grad, self.nlon_grad:-self.nlon_grad]
+        # store final data
+        self.grad           = [grad_lat, grad_lon]
+        self.reason_n       = reason_n
+        self.mask           = np.ones((self.Nlat, self.Nlon), dtype=np.bool)
+        self.mask[self.nlat_grad:-self.nlat_grad, self.nlon_grad:-self.nlon_grad]\
+                            = reason_n != 0
+        self.Nvalid_grd     = np.count_nonzero(reason_n==0.)
+        self.Ntotal_grd     = reason_n.size
+        return
+    
+    def helmholtz_operator_fused(self, workingdir=None, inpfx='', lplcthresh=0.2):
+        """
+        Generate amplitude Laplacian maps for helmholtz tomography, same as helmholtz_operator
+        The Laplacian and the reason_n array are computed in one pass (_helmholtz_kernel) without temporary arrays,
+        the results are identical to helmholtz_operator.
+        =====================================================================================================================
+        ::: input parameters :::
+        workingdir      - working directory, only used for the output files of check_curvature/check_curvature_amp with method = 'gmt'
+        inpfx           - prefix for input files, only used for the output files of check_curvature/check_curvature_amp with method = 'gmt'
+        lplcthresh      - not used, kept for compatibility with helmholtz_operator
+        ::: note :::
+        As in helmholtz_operator, the Laplacian is computed from the gradient stored by check_curvature_amp (i.e. from Zarr),
+        the quality controlled field is only used if there is no stored gradient.
+        =====================================================================================================================
+        """
+        # reason_n array, see helmholtz_operator
+        fieldArr, reason_n  = self._get_v1HD_fused(workingdir=workingdir, inpfx=inpfx, thresh=0.01, relative=True)
+        if hasattr(self, 'grad'):
+            Zarr            = np.asarray(self.Zarr, dtype=np.float64)
+        else:
+            Zarr            = fieldArr
+        shape_lplc          = (self.Nlat - 2*self.nlat_lplc, self.Nlon - 2*self.nlon_lplc)
+        self.lplc           = np.empty(shape_lplc, dtype=np.float64)
+        self.reason_n       = np.empty(shape_lplc, dtype=np.int32)
+        _helmholtz_kernel(Zarr, fieldArr, self.dlat_kmArr, self.dlon_kmArr, self.nlat_lplc, self.nlon_lplc,\
+                    2.*np.pi/self.period, reason_n, self.lplc, self.reason_n)
+        self.mask           = np.ones((self.Nlat, self.Nlon), dtype=np.bool)
+        self.mask[self.nlat_lplc:-self.nlat_lplc, self.nlon_lplc:-self.nlon_lplc]\
+                            = self.reason_n != 0
+        return
+    
     def get_lplc_amp(self, fieldamp):
         """
         get the amplitude Laplacian correction terms from input field
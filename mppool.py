@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+"""
+A python module providing a persistent worker pool with dynamic scheduling for the *_mp methods
+
+:Methods:
+    get_pool        - get the long-lived pool of the current process
+    pool_map        - apply a function to a list of tasks, with dynamic scheduling and timeout
+    pool_stream     - apply a function to tasks from an iterator, with a bounded number of pending tasks
+    close_pool      - close the pool and wait for the workers to exit
+    terminate_pool  - terminate the workers immediately
+    is_failure      - check if a result of pool_map is a failure marker (TaskFailure)
+
+:Dependencies:
+    multiprocessing
+
+:Copyright:
+    Author: Lili Feng
+    Graduate Research Assistant
+    CIEI, Department of Physics, University of Colorado Boulder
+    email: lili.feng@colorado.edu
+"""
+import multiprocessing
+import warnings
+import atexit
+import time
+import sys
+import traceback
+import Queue
+from functools import partial
+
+# the long-lived pool and its number of processes
+_pool       = None
+_nprocess   = None
+
+class TaskTimeoutError(RuntimeError):
+    """raised by pool_map/pool_stream if tasks are not finished within the timeout (allow_failure = False)
+    """
+    def __init__(self, message, indices):
+        RuntimeError.__init__(self, message)
+        self.indices    = indices
+
+class TaskFailure(object):
+    """failure marker stored in the results of pool_map for the tasks not finished within the timeout
+        (allow_failure = True), the callers must check the results with is_failure
+    """
+    def __init__(self, index, reason):
+        self.index      = index
+        self.reason     = reason
+    
+    def __repr__(self):
+        return 'TaskFailure(index='+str(self.index)+', reason='+self.reason+')'
+
+def is_failure(result):
+    """check if a result of pool_map is a failure marker
+    """
+    return isinstance(result, TaskFailure)
+
+def _run_chunk(func, chunk):
+    """run a chunk of tasks, the indices of the tasks are returned together with the results
+    """
+    return [(index, func(item)) for index, item in chunk]
+
+def _run_task(func, index, item):
+    """run a single task, exceptions are returned as formatted tracebacks,
+        since apply_async of python 2 has no error callback
+    """
+    try:
+        return index, True, func(item)
+    except Exception:
+        return index, False, ''.join(traceback.format_exception(*sys.exc_info()))
+
+def get_pool(nprocess=None):
+    """get the long-lived pool, a new pool is created only if there is none or the number of processes changes
+    ==============================================================================
+    ::: input parameters :::
+    nprocess    - number of processes, default is the number of cpus
+    ::: output :::
+    pool        - multiprocessing.Pool object
+    ==============================================================================
+    """
+    global _pool, _nprocess
+    if nprocess is None:
+        nprocess    = multiprocessing.cpu_count()
+    if _pool is not None and _nprocess != nprocess:
+        close_pool()
+    if _pool is None:
+        _pool       = multiprocessing.Pool(processes=nprocess)
+        _nprocess   = nprocess
+    return _pool
+
+def close_pool():
+    """close the pool and wait for the workers to finish
+    """
+    global _pool, _nprocess
+    if _pool is not None:
+        _pool.close()
+        _pool.join()
+    _pool       = None
+    _nprocess   = None
+    return
+
+def terminate_pool():
+    """terminate the workers immediately, used for hanging tasks or exceptions
+    """
+    global _pool, _nprocess
+    if _pool is not None:
+        _pool.terminate()
+        _pool.join()
+    _pool       = None
+    _nprocess   = None
+    return
+
+atexit.register(terminate_pool)
+
+def _timeout_message(undone, Ntask, timeout):
+    """message for the tasks not finished within the timeout
+    """
+    return str(len(undone))+('/'+str(Ntask) if Ntask is not None else '')+' tasks not finished within the timeout ('\
+            +str(timeout)+' sec), indices: '+str(undone[:20])+(' ...' if len(undone) > 20 else '')
+
+class _task_runner(object):
+    """run tasks with a timeout for each task
+        at most nprocess tasks are sent to the pool at once, so that each task is started by an idle worker
+        as soon as it is sent and its running time can be measured in the parent process
+        a task exceeding the timeout can only be stopped by terminating the workers,
+        the other running tasks are then restarted in a new pool
+    """
+    def __init__(self, func, nprocess, timeout):
+        self.func       = func
+        self.nprocess   = nprocess
+        self.timeout    = timeout
+        get_pool(nprocess=nprocess)
+        self.Nslot      = _nprocess
+        self.running    = {}
+        self.restart    = []
+        self.doneq      = Queue.Queue()
+    
+    def isfull(self):
+        return len(self.running) >= self.Nslot
+    
+    def isempty(self):
+        return len(self.running) == 0 and len(self.restart) == 0
+    
+    def submit(self, index, item):
+        pool    = get_pool(nprocess=self.nprocess)
+        pool.apply_async(_run_task, (self.func, index, item), callback=self.doneq.put)
+        self.running[index] = (item, time.time())
+        return
+    
+    def fill(self):
+        """restart the tasks interrupted by a termination of the pool
+        """
+        while len(self.restart) > 0 and not self.isfull():
+            index, item = self.restart.pop(0)
+            self.submit(index, item)
+        return
+    
+    def wait(self):
+        """wait for a task to finish
+        ::: output :::
+        (index, result) of the finished task, or (None, list of timed out indices)
+        """
+        while True:
+            if self.timeout is None:
+                # Queue.get without timeout can not be interrupted by KeyboardInterrupt
+                waittime    = 1e9
+            else:
+                waittime    = max(0., min([stime for item, stime in self.running.values()]) + self.timeout - time.time())
+            try:
+                index, isok, result = self.doneq.get(True, waittime)
+            except Queue.Empty:
+                now         = time.time()
+                expired     = sorted([index for index, (item, stime) in self.running.items() if now - stime >= self.timeout])
+                if len(expired) == 0:
+                    continue
+                # stragglers are killed, the other running tasks are restarted in a new pool
+                terminate_pool()
+                self.restart    = [(index, self.running[index][0]) for index in sorted(self.running) if not index in expired]\
+                                    + self.restart
+                self.running    = {}
+                # results of the terminated pool are put into the old queue and ignored
+                self.doneq      = Queue.Queue()
+                return None, expired
+            if not index in self.running:
+                continue
+            del self.running[index]
+            if not isok:
+                raise RuntimeError('task '+str(index)+' failed in worker process:\n'+result)
+            return index, result
+
+def pool_map(func, inlst, nprocess=None, chunksize=None, timeout=None, verbose=False, callback=None, allow_failure=False):
+    """apply func to each element of inlst with the long-lived pool
+        tasks are dynamically scheduled, a worker picks up the next task(chunk) as soon as it is idle
+    ==============================================================================
+    ::: input parameters :::
+    func        - function to be applied, must be picklable (module level function or functools.partial of it)
+    inlst       - list of tasks
+    nprocess    - number of processes, default is the number of cpus
+    chunksize   - number of tasks sent to a worker at once (not used if timeout is specified)
+                    default is Ntask/(16*nprocess), so that each worker gets ~16 chunks
+    timeout     - timeout for each task in sec (None for no timeout)
+                    the tasks are sent to the workers one by one and the running time of each task is checked,
+                    the workers are terminated if a task is not finished within timeout, 
+                    and the other running tasks are restarted
+    verbose     - print progress or not
+    callback    - function called in the parent process as callback(index, result) once the result of
+                    inlst[index] is received, while the workers keep computing the remaining tasks
+                    the return value of callback is stored in results instead of the result
+    allow_failure
+                - False: raise TaskTimeoutError if any task is not finished within timeout (after all the other tasks are done)
+                  True : the results of these tasks are TaskFailure markers, check them with is_failure
+    ::: output :::
+    results     - list of results, in the same order as inlst
+    ==============================================================================
+    """
+    Ntask       = len(inlst)
+    results     = [None]*Ntask
+    if Ntask == 0:
+        return results
+    Ndone       = 0
+    stime       = time.time()
+    if timeout is None:
+        pool        = get_pool(nprocess=nprocess)
+        if chunksize is None:
+            chunksize   = max(1, int(Ntask/(16*_nprocess)))
+        tasks       = list(enumerate(inlst))
+        chunks      = [tasks[i:(i+chunksize)] for i in range(0, Ntask, chunksize)]
+        it          = pool.imap_unordered(partial(_run_chunk, func), chunks)
+        try:
+            for ichunk in range(len(chunks)):
+                for index, result in it.next(1e9):
+                    if callback is not None:
+                        result      = callback(index, result)
+                    results[index]  = result
+                    Ndone           += 1
+                if verbose:
+                    print '--- '+str(Ndone)+'/'+str(Ntask)+' tasks finished, elapsed time: '+str(time.time() - stime)+' sec'
+        except BaseException:
+            # do not leave the remaining tasks running in the pool
+            terminate_pool()
+            raise
+        return results
+    #---------------------------------
+    # timeout for each task
+    #---------------------------------
+    failed      = []
+    runner      = _task_runner(func, nprocess=nprocess, timeout=timeout)
+    itask       = 0
+    try:
+        while itask < Ntask or not runner.isempty():
+            runner.fill()
+            while itask < Ntask and not runner.isfull():
+                runner.submit(itask, inlst[itask])
+                itask   += 1
+            index, result   = runner.wait()
+            if index is None:
+                failed      += result
+                warnings.warn(_timeout_message(result, Ntask, timeout), UserWarning, stacklevel=1)
+                continue
+            if callback is not None:
+                result      = callback(index, result)
+            results[index]  = result
+            Ndone           += 1
+            if verbose:
+                print '--- '+str(Ndone)+'/'+str(Ntask)+' tasks finished, elapsed time: '+str(time.time() - stime)+' sec'
+    except BaseException:
+        # do not leave the remaining tasks running in the pool
+        terminate_pool()
+        raise
+    if len(failed) > 0:
+        failed.sort()
+        if not allow_failure:
+            raise TaskTimeoutError(_timeout_message(failed, Ntask, timeout), failed)
+        for index in failed:
+            results[index]  = TaskFailure(index, 'timeout')
+    return results
+
+def pool_stream(func, initer, callback, nprocess=None, maxpending=None, timeout=None, verbose=False, allow_failure=False):
+    """apply func to each task from initer with the long-lived pool, the tasks are only taken from initer when
+        there are less than maxpending unfinished tasks, so that the tasks do not need to be kept in memory together
+    ==============================================================================
+    ::: input parameters :::
+    func        - function to be applied, must be picklable (module level function or functools.partial of it)
+    initer      - iterable of tasks (e.g. a generator)
+    callback    - function called in the parent process as callback(index, result) once the result of
+                    the index-th task is received, while the workers keep computing the pending tasks
+    nprocess    - number of processes, default is the number of cpus
+    maxpending  - maximum number of unfinished tasks, default is 2*nprocess
+                    (nprocess if timeout is specified, see pool_map)
+    timeout     - timeout for each task in sec (None for no timeout), see pool_map
+    verbose     - print progress or not
+    allow_failure
+                - False: raise TaskTimeoutError if any task is not finished within timeout (after all the other tasks are done)
+                  True : skip these tasks with a warning, callback is not called for them
+    ::: output :::
+    Ntask       - number of tasks taken from initer
+    failed      - indices of the tasks not finished within timeout (allow_failure = True)
+    ==============================================================================
+    """
+    if timeout is None:
+        get_pool(nprocess=nprocess)
+        if maxpending is None:
+            maxpending  = 2*_nprocess
+    runner      = _task_runner(func, nprocess=nprocess, timeout=timeout)
+    if maxpending is not None and timeout is None:
+        runner.Nslot    = maxpending
+    elif maxpending is not None:
+        runner.Nslot    = min(maxpending, runner.Nslot)
+    it          = iter(initer)
+    failed      = []
+    Ntask       = 0
+    Ndone       = 0
+    isend       = False
+    stime       = time.time()
+    try:
+        while True:
+            runner.fill()
+            while (not isend) and not runner.isfull():
+                try:
+                    item    = it.next()
+                except StopIteration:
+                    isend   = True
+                    break
+                runner.submit(Ntask, item)
+                Ntask       += 1
+            if runner.isempty():
+                break
+            index, result   = runner.wait()
+            if index is None:
+                failed      += result
+                warnings.warn(_timeout_message(result, None, timeout), UserWarning, stacklevel=1)
+                continue
+            Ndone           += 1
+            callback(index, result)
+            if verbose:
+                print '--- '+str(Ndone)+'/'+str(Ntask)+' tasks finished, elapsed time: '+str(time.time() - stime)+' sec'
+    except BaseException:
+        # do not leave the remaining tasks running in the pool
+        terminate_pool()
+        raise
+    failed.sort()
+    if len(failed) > 0 and not allow_failure:
+        raise TaskTimeoutError(_timeout_message(failed, Ntask, timeout), failed)
+    return Ntask, failed
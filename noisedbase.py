@@ -40,6 +40,9 @@ import glob
 from numba import jit, float32, int32, boolean, float64
 import pyfftw
 import time
+import collections
+import hashlib
+import mppool
 
 
 sta_info_default        = {'xcorr': 1, 'isnet': 0}
@@ -51,10 +54,13 @@ xcorr_sacheader_default = {'knetwk': '', 'kstnm': '', 'kcmpnm': '', 'stla': 1234
 monthdict               = {1: 'JAN', 2: 'FEB', 3: 'MAR', 4: 'APR', 5: 'MAY', 6: 'JUN', 7: 'JUL', 8: 'AUG', 9: 'SEP', 10: 'OCT', 11: 'NOV', 12: 'DEC'}
 
 
-@jit(float32[:](float32[:, :], float32[:, :], int32))
 def _CalcRecCor(arr1, arr2, lagN):
     """compute the amplitude weight for the xcorr, used for amplitude correction
-        optimized by numba
+        the weight at lag s is the total overlapping length of the records of station 1 and the records of
+        station 2 shifted by s. The overlapping length of two segments is a trapezoid function of s, which equals
+        sum(w_k * max(0, s - c_k)) with breakpoints c_k = (b1-e2, b1-b2, e1-e2, e1-b2) and weights w_k = (1, -1, -1, 1),
+        so all the lags are evaluated at once from the cumulative sums of the sorted breakpoints.
+        Results are identical to the former loop version (see tests/test_calcreccor.py)
     ==============================================================================
     ::: input parameters :::
     arr1, arr2  - the input arrays from ft_*SAC_rec,
@@ -64,56 +70,338 @@ def _CalcRecCor(arr1, arr2, lagN):
     cor_rec     - amplitude weight for the xcorr
     ==============================================================================
     """
-    N1      = arr1.shape[0]
-    N2      = arr2.shape[0]
-    # array indicating number of data points for xcorr, used for amplitude correction
-    cor_rec = np.zeros(int(2*lagN + 1), dtype=float)
-    for i in range(lagN+1):
-        cor_rec[lagN+i] = 0.
-        cor_rec[lagN-i] = 0.
-        for irec1 in range(N1):
-            for irec2 in range(N2):
-                if arr1[irec1, 0] >= arr2[irec2, 1] - i:
-                    continue
-                if arr1[irec1, 1] <= arr2[irec2, 0] - i:
-                    break
-                recB            = max(arr1[irec1, 0], arr2[irec2, 0] - i)
-                recE            = min(arr1[irec1, 1], arr2[irec2, 1] - i)
-                cor_rec[lagN+i] += recE - recB
-            for irec2 in range(N2):
-                if arr1[irec1, 0] >= arr2[irec2, 1] + i:
-                    continue
-                if arr1[irec1, 1] <= arr2[irec2, 0] + i:
-                    break
-                recB            = max(arr1[irec1, 0], arr2[irec2, 0] + i)
-                recE            = min(arr1[irec1, 1], arr2[irec2, 1] + i)
-                cor_rec[lagN-i] += recE - recB
-    cor_rec[lagN]   /= 2.
+    lagN        = int(lagN)
+    arr1        = np.asarray(arr1, dtype=np.float64).reshape(-1, 2)
+    arr2        = np.asarray(arr2, dtype=np.float64).reshape(-1, 2)
+    b1          = arr1[:, 0][:, np.newaxis]
+    e1          = arr1[:, 1][:, np.newaxis]
+    b2          = arr2[:, 0][np.newaxis, :]
+    e2          = arr2[:, 1][np.newaxis, :]
+    # segment pairs that overlap for at least one lag within [-lagN, lagN]
+    index       = ((b1 - e2) < lagN) * ((e1 - b2) > -lagN)
+    b1          = np.broadcast_to(b1, index.shape)[index]
+    e1          = np.broadcast_to(e1, index.shape)[index]
+    b2          = np.broadcast_to(b2, index.shape)[index]
+    e2          = np.broadcast_to(e2, index.shape)[index]
+    Npair       = b1.size
+    # breakpoints and slope changes of the piecewise-linear overlapping length
+    cArr        = np.concatenate((b1 - e2, b1 - b2, e1 - e2, e1 - b2))
+    wArr        = np.concatenate((np.ones(Npair), -np.ones(Npair), -np.ones(Npair), np.ones(Npair)))
+    isort       = np.argsort(cArr, kind='mergesort')
+    cArr        = cArr[isort]
+    wArr        = wArr[isort]
+    cum_w       = np.append(0., np.cumsum(wArr))
+    cum_wc      = np.append(0., np.cumsum(wArr*cArr))
+    # weight at lag s: sum over c_k < s of w_k*(s - c_k)
+    sArr        = np.arange(-lagN, lagN+1, dtype=np.float64)
+    ind         = np.searchsorted(cArr, sArr)
+    weight      = sArr*cum_w[ind] - cum_wc[ind]
+    # cor_rec[lagN+i] is the weight of station 2 shifted by -i
+    cor_rec     = weight[::-1].copy()
     return cor_rec
 
-def _amp_ph_to_xcorr(amp1, amp2, ph1, ph2, sps = 1., lagtime = 3000.):
-    """Convert amplitude and phase arrays to xcorr
+def _read_rec(fname, Nrec=84000):
+    """read the record file (ft_*SAC_rec) indicating holes in the original records
+        the whole day ([0, Nrec]) is returned if the record file does not exist
+    """
+    if os.path.isfile(fname):
+        arr     = np.loadtxt(fname)
+        if arr.size == 2:
+            arr = arr.reshape(1, 2)
+    else:
+        arr     = (np.array([0, Nrec])).reshape(1, 2)
+    return np.float32(arr)
+
+#--------------------------------------------------------------------------
+# raw SAC I/O for stacking of monthly cross-correlations
+# binary SAC header: 70 floats, 40 ints, 24 8-char strings (632 bytes),
+# followed by npts float32 data points
+#--------------------------------------------------------------------------
+SAC_HEADER_SIZE         = 632
+sac_float_index         = {'delta': 0, 'depmin': 1, 'depmax': 2, 'b': 5, 'e': 6, 'user0': 40,\
+                            'dist': 50, 'az': 51, 'baz': 52, 'depmen': 56}
+sac_int_index           = {'nvhdr': 6, 'npts': 9}
+sac_kcmpnm_offset       = 600
+
+def _sac_byteorder(hdr):
+    """determine the byte order of a raw SAC header from the header version number
+    """
+    for byteorder in ['<', '>']:
+        nvhdr   = np.frombuffer(hdr, dtype=byteorder+'i4', count=1, offset=280+4*sac_int_index['nvhdr'])[0]
+        if nvhdr == 6 or nvhdr == 7:
+            return byteorder
+    raise IOError('Not a binary SAC file!')
+
+def _read_sac_raw(fname, out=None, use_mmap=False):
+    """read a binary SAC file through raw header/data offsets, no obspy object is created
     ==============================================================================
     ::: input parameters :::
-    amp1, ph1   - amplitude and phase data arrays for station(component) 1
-    amp2, ph2   - amplitude and phase data arrays for station(component) 2
+    fname       - SAC file name
+    out         - preallocated float32 array for the data, the size must be npts
+                    a new array is created if None
+    use_mmap    - memory-map the data part instead of reading it through the file object
+    ::: output :::
+    hdr         - raw SAC header (string of 632 bytes)
+    data        - float32 data array in native byte order (out if it is given)
+    ==============================================================================
+    """
+    with open(fname, 'rb') as fid:
+        hdr         = fid.read(SAC_HEADER_SIZE)
+        if len(hdr) != SAC_HEADER_SIZE:
+            raise IOError('Incomplete SAC header: '+fname)
+        byteorder   = _sac_byteorder(hdr)
+        npts        = int(np.frombuffer(hdr, dtype=byteorder+'i4', count=1, offset=280+4*sac_int_index['npts'])[0])
+        if out is None:
+            out     = np.empty(npts, dtype=np.float32)
+        elif out.size != npts:
+            raise ValueError('Inconsistent npts: '+fname)
+        if use_mmap:
+            out[:]  = np.memmap(fname, dtype=byteorder+'f4', mode='r', offset=SAC_HEADER_SIZE, shape=(npts,))
+        else:
+            if fid.readinto(out) != 4*npts:
+                raise IOError('Incomplete SAC data: '+fname)
+            if byteorder != ('<' if np.little_endian else '>'):
+                out.byteswap(True)
+    return hdr, out
+
+def _get_sac_header(hdr):
+    """get the header values used for stacking from a raw SAC header, undefined values are None
+    """
+    byteorder   = _sac_byteorder(hdr)
+    hf          = np.frombuffer(hdr, dtype=byteorder+'f4', count=70)
+    hi          = np.frombuffer(hdr, dtype=byteorder+'i4', count=40, offset=280)
+    header      = {}
+    for name in sac_float_index.keys():
+        header[name]    = float(hf[sac_float_index[name]])
+        if header[name] == -12345.:
+            header[name]= None
+    header['npts']      = int(hi[sac_int_index['npts']])
+    header['e']         = header['b'] + (header['npts'] - 1) * header['delta']
+    kcmpnm              = hdr[sac_kcmpnm_offset:(sac_kcmpnm_offset+8)].strip('\x00 ')
+    header['kcmpnm']    = None if kcmpnm == '-12345' else kcmpnm
+    return header
+
+def _write_sac_raw(fname, hdr, data, user0):
+    """write a stacked trace as binary SAC, the raw header of the first stacked month is reused
+        with updated user0 (stacked days), e and data min/max/mean
+    """
+    byteorder   = _sac_byteorder(hdr)
+    hf          = np.frombuffer(hdr, dtype=byteorder+'f4', count=70).copy()
+    hf[sac_float_index['user0']]    = user0
+    hf[sac_float_index['e']]        = hf[sac_float_index['b']] + (data.size - 1) * hf[sac_float_index['delta']]
+    hf[sac_float_index['depmin']]   = data.min()
+    hf[sac_float_index['depmax']]   = data.max()
+    hf[sac_float_index['depmen']]   = data.mean()
+    with open(fname, 'wb') as fid:
+        fid.write(hf.tostring())
+        fid.write(hdr[280:])
+        fid.write(data.astype(byteorder+'f4').tostring())
+    return
+
+def _stack_monthly_sac(fnameLst, use_mmap=False, label=''):
+    """stack monthly cross-correlation SAC files of a station pair into preallocated arrays
+    ==============================================================================
+    ::: input parameters :::
+    fnameLst    - list of months, each element is the list of SAC file names of all channel pairs
+                    a month is skipped if any of the files is missing, unreadable or contains NaN
+    use_mmap    - memory-map the SAC data or not
+    label       - label of the station pair, used for warnings
+    ::: output :::
+    stackArr    - stacked data, shape = (Nch, npts), None if no month is stacked
+    stackday    - stacked days (sum of user0), shape = (Nch, )
+    hdrLst      - raw SAC headers of the first stacked month
+    istackLst   - indices (in fnameLst) of the stacked months
+    ==============================================================================
+    """
+    stackArr        = None
+    stackday        = None
+    hdrLst          = []
+    istackLst       = []
+    monthArr        = None
+    for imonth in range(len(fnameLst)):
+        fnames      = fnameLst[imonth]
+        Nch         = len(fnames)
+        skip_this_month = False
+        for fname in fnames:
+            if not os.path.isfile(fname):
+                skip_this_month = True
+                break
+        if skip_this_month:
+            continue
+        # data of the first stacked month are read directly into the stack array
+        if stackArr is None:
+            outArr  = None
+        else:
+            outArr  = monthArr
+        cur_hdrLst  = []
+        cur_user0   = np.zeros(Nch, dtype=np.float32)
+        for ich in range(Nch):
+            try:
+                if outArr is None:
+                    hdr, data   = _read_sac_raw(fnames[ich], use_mmap=use_mmap)
+                    outArr      = np.empty((Nch, data.size), dtype=np.float32)
+                    outArr[ich] = data
+                else:
+                    hdr, data   = _read_sac_raw(fnames[ich], out=outArr[ich], use_mmap=use_mmap)
+                user0           = np.frombuffer(hdr, dtype=_sac_byteorder(hdr)+'f4', count=1,\
+                                    offset=4*sac_float_index['user0'])[0]
+            except (IOError, ValueError):
+                warnings.warn('Unable to read SAC for: ' + label +' File: '+fnames[ich], UserWarning, stacklevel=1)
+                skip_this_month = True
+                break
+            if (np.isnan(data)).any() or abs(data.max())>1e20:
+                warnings.warn('NaN monthly SAC for: ' + label +' File: '+fnames[ich], UserWarning, stacklevel=1)
+                skip_this_month = True
+                break
+            cur_hdrLst.append(hdr)
+            cur_user0[ich]      = user0
+        if skip_this_month:
+            continue
+        if stackArr is None:
+            stackArr    = outArr
+            stackday    = cur_user0
+            hdrLst      = cur_hdrLst
+            monthArr    = np.empty(stackArr.shape, dtype=np.float32)
+        else:
+            stackArr    += monthArr
+            stackday    += cur_user0
+        istackLst.append(imonth)
+    return stackArr, stackday, hdrLst, istackLst
+
+def _get_stack_fnames(datadir, ylst, mlst, pfx, fnametype, staid1, staid2, chans1, chans2, date1=None, date2=None):
+    """get the monthly SAC file names of a station pair for stacking
+    ==============================================================================
+    ::: input parameters :::
+    datadir             - data directory
+    ylst, mlst          - year/month arrays
+    pfx                 - prefix
+    fnametype           - input sac file name type (see noiseASDF.xcorr_stack)
+    staid1, staid2      - station ids
+    chans1, chans2      - channel codes of station 1/2
+    date1, date2        - start/end date (timestamp) of station 1/2, months out of the range are skipped
+    ::: output :::
+    fnameLst            - list of months, each element is the list of file names of all channel pairs
+    monthLst            - list of months (year*100 + month) corresponding to fnameLst
+    ==============================================================================
+    """
+    netcode1, stacode1  = staid1.split('.')
+    netcode2, stacode2  = staid2.split('.')
+    fnameLst            = []
+    monthLst            = []
+    for im in range(mlst.size):
+        month           = monthdict[mlst[im]]
+        yrmonth         = str(ylst[im])+'.'+month
+        if fnametype == 1:
+            subdir      = datadir+'/'+yrmonth+'/'+pfx+'/'+staid1
+        else:
+            subdir      = datadir+'/'+yrmonth+'/'+pfx+'/'+stacode1
+        if not os.path.isdir(subdir):
+            continue
+        # skip if either of the stations out of time range
+        if date1 is not None and date2 is not None:
+            c_stime     = obspy.UTCDateTime(str(ylst[im])+'-'+str(mlst[im])+'-1')
+            try:
+                c_etime = obspy.UTCDateTime(str(ylst[im])+'-'+str(mlst[im]+1)+'-1')
+            except ValueError:
+                c_etime = obspy.UTCDateTime(str(ylst[im]+1)+'-1-1')
+            if date1[0] > c_etime.timestamp or date1[1] < c_stime.timestamp or \
+                date2[0] > c_etime.timestamp or date2[1] < c_stime.timestamp:
+                continue
+        fnames          = []
+        for chan1 in chans1:
+            for chan2 in chans2:
+                if fnametype    == 1:
+                    fname       = subdir+'/'+pfx+'_'+staid1+'_'+chan1+'_'+staid2+'_'+chan2+'.SAC'
+                elif fnametype  == 2:
+                    fname       = subdir+'/'+pfx+'_'+stacode1+'_'+stacode2+'.SAC'
+                elif fnametype  == 3:
+                    fname       = subdir+'/'+pfx+'_'+stacode1+'_'+chan1+'_'+stacode2+'_'+chan2+'.SAC'
+                fnames.append(fname)
+        fnameLst.append(fnames)
+        monthLst.append(ylst[im]*100 + mlst[im])
+    return fnameLst, monthLst
+
+#--------------------------------------------------------------------------
+# provenance records, the outputs of a stage store the hashes of the inputs
+# and the parameters as the parameters 'input_hash' and 'param_hash'
+#--------------------------------------------------------------------------
+def _update_hash(md5, arg):
+    """update md5 with numpy arrays, dictionaries, lists/tuples and other values
+    """
+    if isinstance(arg, np.ndarray):
+        md5.update(str(arg.dtype)+str(arg.shape))
+        md5.update(np.ascontiguousarray(arg).tostring())
+    elif isinstance(arg, dict):
+        for key in sorted(arg.keys()):
+            md5.update(repr(key))
+            _update_hash(md5, arg[key])
+    elif isinstance(arg, (list, tuple)):
+        md5.update(str(len(arg)))
+        for value in arg:
+            _update_hash(md5, value)
+    else:
+        md5.update(repr(arg))
+    return
+
+def _get_hash(*args):
+    """md5 hash (hex string) of the input arguments
+    """
+    md5         = hashlib.md5()
+    for arg in args:
+        _update_hash(md5, arg)
+    return md5.hexdigest()
+
+def _get_aftan_method(f77):
+    """name of the aftan code actually used, recorded in the parameter hash of the aftan results
+        an error is raised if aftanf77 is requested but the compiled fortran77 aftan is not available
+    """
+    if f77:
+        if not pyaftan.isaftanf77:
+            raise AttributeError('fortran77 aftan not imported correctly!')
+        return 'aftanf77'
+    return 'aftan'
+
+def _get_provenance(subdset):
+    """provenance hash of an auxiliary data, the combination of the recorded input/parameter hashes
+        or the hash of the data and parameters if no provenance is recorded (e.g. stacked xcorr data)
+    """
+    parameters  = subdset.parameters
+    if 'input_hash' in parameters and 'param_hash' in parameters:
+        return _get_hash(str(parameters['input_hash']), str(parameters['param_hash']))
+    return _get_hash(subdset.data.value, parameters)
+
+def _get_ftan_results(ftanparam):
+    """get the compact aftan results from a ftanParam object
+    ::: output :::
+    (arr1_1, nfout1_1, arr2_1, nfout2_1, arr1_2, nfout1_2, arr2_2, nfout2_2)
+    """
+    return (ftanparam.arr1_1, ftanparam.nfout1_1, ftanparam.arr2_1, ftanparam.nfout2_1,\
+            ftanparam.arr1_2, ftanparam.nfout1_2, ftanparam.arr2_2, ftanparam.nfout2_2)
+
+def _amp_ph_to_spec(amp, ph, dtype=complex):
+    """Convert amplitude and phase arrays to complex spectrum
+    """
+    spec        = np.zeros(amp.size, dtype=dtype)
+    spec.real   = amp*np.cos(ph)
+    spec.imag   = amp*np.sin(ph)
+    return spec
+
+def _spec_to_xcorr(spec1, spec2, sps = 1., lagtime = 3000.):
+    """Convert complex spectra to xcorr
+    ==============================================================================
+    ::: input parameters :::
+    spec1, spec2- complex spectra for station(component) 1 and 2
     sps         - target sampling rate
     lagtime     - lag time for xcorr
     ::: output :::
     out_data    - xcorr
     ==============================================================================
     """
-    N           = amp1.size
+    N           = spec1.size
     Ns          = int(2*N - 1)
     # cross-spectrum, conj(sac1)*(sac2)
-    x_sp        = np.zeros(Ns, dtype=complex) 
-    temp1       = np.zeros(N, dtype=complex)
-    temp2       = np.zeros(N, dtype=complex)
-    temp1.real  = amp1*np.cos(ph1)
-    temp1.imag  = amp1*np.sin(ph1)
-    temp2.real  = amp2*np.cos(ph2)
-    temp2.imag  = amp2*np.sin(ph2)
-    x_sp[:N]    = temp2 * np.conj(temp1)
+    x_sp        = np.zeros(Ns, dtype=complex)
+    np.multiply(spec2, np.conj(spec1), out=x_sp[:N])
     # perform inverse FFT with pyFFTW, much faster than numpy_fft, scipy.fftpack
     out         = pyfftw.interfaces.numpy_fft.ifft(x_sp)
     seis_out    = 2.*(out.real)
@@ -126,14 +414,14 @@ def _amp_ph_to_xcorr(amp1, amp2, ph1, ph2, sps = 1., lagtime = 3000.):
     out_data[(lagN+1):] = (seis_out[Ns-lagN:])[::-1]
     return out_data
 
-def _amp_ph_to_xcorr_fast(amp1, amp2, ph1, ph2, fftw_plan, sps = 1., lagtime = 3000.):
-    """Convert amplitude and phase arrays to xcorr
-        This is the fast version of _amp_ph_to_xcorr, a precomputed fftw_plan needs
-        to be prepared for speeding up
+def _spec_to_xcorr_fast(spec1, spec2, fftw_plan, sps = 1., lagtime = 3000.):
+    """Convert complex spectra to xcorr
+        This is the fast version of _spec_to_xcorr, a precomputed fftw_plan needs
+        to be prepared for speeding up. The input/output arrays of fftw_plan are
+        reused, no array is allocated for the cross-spectrum
     ==============================================================================
     ::: input parameters :::
-    amp1, ph1   - amplitude and phase data arrays for station(component) 1
-    amp2, ph2   - amplitude and phase data arrays for station(component) 2
+    spec1, spec2- complex spectra for station(component) 1 and 2
     fftw_plan   - precomputed fftw_plan
     sps         - target sampling rate
     lagtime     - lag time for xcorr
@@ -141,23 +429,16 @@ def _amp_ph_to_xcorr_fast(amp1, amp2, ph1, ph2, fftw_plan, sps = 1., lagtime = 3
     out_data    - xcorr
     ==============================================================================
     """
-    N           = amp1.size
+    N           = spec1.size
     Ns          = int(2*N - 1)
     # cross-spectrum, conj(sac1)*(sac2)
-    x_sp        = np.zeros(Ns, dtype=complex)
-    out         = np.zeros(Ns, dtype=complex)
-    temp1       = np.zeros(N, dtype=complex)
-    temp2       = np.zeros(N, dtype=complex)
-    temp1.real  = amp1*np.cos(ph1)
-    temp1.imag  = amp1*np.sin(ph1)
-    temp2.real  = amp2*np.cos(ph2)
-    temp2.imag  = amp2*np.sin(ph2)
-    x_sp[:N]    = temp2 * np.conj(temp1)
+    x_sp        = fftw_plan.input_array
+    x_sp[N:]    = 0.
+    np.multiply(spec2, np.conj(spec1), out=x_sp[:N])
     # perform inverse FFT with pyFFTW, much faster than numpy_fft, scipy.fftpack
     # the precomputed fftw_plan is used
-    fftw_plan.update_arrays(x_sp, out)
     fftw_plan.execute()
-    seis_out    = 2.*(out.real)
+    seis_out    = 2.*(fftw_plan.output_array.real)
     lagN        = int(np.floor(lagtime*sps +0.5))
     if lagN > Ns:
         raise ValueError('Lagtime npts overflow!')
@@ -167,6 +448,144 @@ def _amp_ph_to_xcorr_fast(amp1, amp2, ph1, ph2, fftw_plan, sps = 1., lagtime = 3
     out_data[(lagN+1):] = (seis_out[Ns-lagN:])[::-1]
     return out_data/Ns
 
+def _amp_ph_to_xcorr(amp1, amp2, ph1, ph2, sps = 1., lagtime = 3000.):
+    """Convert amplitude and phase arrays to xcorr
+    ==============================================================================
+    ::: input parameters :::
+    amp1, ph1   - amplitude and phase data arrays for station(component) 1
+    amp2, ph2   - amplitude and phase data arrays for station(component) 2
+    sps         - target sampling rate
+    lagtime     - lag time for xcorr
+    ::: output :::
+    out_data    - xcorr
+    ==============================================================================
+    """
+    return _spec_to_xcorr(_amp_ph_to_spec(amp1, ph1), _amp_ph_to_spec(amp2, ph2), sps=sps, lagtime=lagtime)
+
+def _amp_ph_to_xcorr_fast(amp1, amp2, ph1, ph2, fftw_plan, sps = 1., lagtime = 3000.):
+    """Convert amplitude and phase arrays to xcorr
+        This is the fast version of _amp_ph_to_xcorr, a precomputed fftw_plan needs
+        to be prepared for speeding up
+    ==============================================================================
+    ::: input parameters :::
+    amp1, ph1   - amplitude and phase data arrays for station(component) 1
+    amp2, ph2   - amplitude and phase data arrays for station(component) 2
+    fftw_plan   - precomputed fftw_plan
+    sps         - target sampling rate
+    lagtime     - lag time for xcorr
+    ::: output :::
+    out_data    - xcorr
+    ==============================================================================
+    """
+    return _spec_to_xcorr_fast(_amp_ph_to_spec(amp1, ph1), _amp_ph_to_spec(amp2, ph2), fftw_plan=fftw_plan,\
+                               sps=sps, lagtime=lagtime)
+
+class spectra_cache(object):
+    """ LRU cache of complex spectra converted from the amplitude/phase files (ft_*.SAC.am/ph)
+        keyed by the file path (ft_*.SAC under the day directory), the least recently used spectra are evicted
+        when the memory budget is exceeded
+    =================================================================================================================
+    ::: parameters :::
+    maxmem              - memory budget in MB
+    dtype               - data type of the spectra ('complex64' or 'complex128')
+    =================================================================================================================
+    """
+    def __init__(self, maxmem=1000., dtype='complex128'):
+        self.maxmem     = maxmem
+        self.dtype      = np.dtype(dtype)
+        self.nbytes     = 0
+        self.spectra    = collections.OrderedDict()
+        return
+    
+    def get(self, daydir, dayfpfx, staid, chan):
+        """get the complex spectrum of one station-channel-day
+        ==============================================================================
+        ::: input parameters :::
+        daydir      - day directory (e.g. datadir/2019.JAN/2019.JAN.1)
+        dayfpfx     - prefix of the day (e.g. 2019.JAN.1)
+        staid       - station id (network.station)
+        chan        - channel
+        ::: output :::
+        spec        - complex spectrum, None if the data is of bad quality(NaN or > 1e20)
+        stla, stlo  - station latitude/longitude from the sac header
+        ==============================================================================
+        """
+        pfx         = daydir+'/ft_'+dayfpfx+'.'+staid+'.'+chan+'.SAC'
+        key         = pfx
+        try:
+            value   = self.spectra.pop(key)
+            # re-insert as the most recently used one
+            self.spectra[key]   = value
+            return value
+        except KeyError:
+            pass
+        # I/O through obspy.io.sac.SACTrace.read() is ~ 10 times faster than obspy.read()
+        tr_amp      = obspy.io.sac.SACTrace.read(pfx+'.am')
+        tr_ph       = obspy.io.sac.SACTrace.read(pfx+'.ph')
+        amp         = tr_amp.data
+        ph          = tr_ph.data
+        # quality control
+        if (np.isnan(amp)).any() or (np.isnan(ph)).any() or np.any(amp > 1e20):
+            spec    = None
+        else:
+            spec    = _amp_ph_to_spec(amp, ph, dtype=self.dtype)
+            self.nbytes += spec.nbytes
+        value       = (spec, tr_amp.stla, tr_amp.stlo)
+        self.spectra[key]   = value
+        # evict the least recently used spectra
+        while self.nbytes > self.maxmem*1024.*1024. and len(self.spectra) > 1:
+            oldkey, oldvalue= self.spectra.popitem(last=False)
+            if oldvalue[0] is not None:
+                self.nbytes -= oldvalue[0].nbytes
+        return value
+    
+    def get_rec(self, daydir, dayfpfx, staid, chan, Nrec=84000):
+        """get the record array (ft_*SAC_rec) of one station-channel-day, the file is parsed only once
+        ==============================================================================
+        ::: input parameters :::
+        daydir      - day directory (e.g. datadir/2019.JAN/2019.JAN.1)
+        dayfpfx     - prefix of the day (e.g. 2019.JAN.1)
+        staid       - station id (network.station)
+        chan        - channel
+        Nrec        - npts of the daily record, used when the record file does not exist
+        ::: output :::
+        arr         - record array, shape = (Nseg, 2)
+        ==============================================================================
+        """
+        key         = daydir+'/ft_'+dayfpfx+'.'+staid+'.'+chan+'.SAC_rec'
+        try:
+            value   = self.spectra.pop(key)
+            self.spectra[key]   = value
+            return value[0]
+        except KeyError:
+            pass
+        arr         = _read_rec(key, Nrec=Nrec)
+        self.nbytes += arr.nbytes
+        self.spectra[key]   = (arr,)
+        while self.nbytes > self.maxmem*1024.*1024. and len(self.spectra) > 1:
+            oldkey, oldvalue= self.spectra.popitem(last=False)
+            if oldvalue[0] is not None:
+                self.nbytes -= oldvalue[0].nbytes
+        return arr
+    
+    def clear(self):
+        """clear the cache
+        """
+        self.spectra.clear()
+        self.nbytes     = 0
+        return
+
+# spectra cache of the current process, shared by all the xcorr_pair objects processed in the same process
+_spec_cache = None
+
+def _get_spectra_cache(maxmem=1000., dtype='complex128'):
+    """get the spectra cache of the current process
+    """
+    global _spec_cache
+    if _spec_cache is None or _spec_cache.maxmem != maxmem or _spec_cache.dtype != np.dtype(dtype):
+        _spec_cache = spectra_cache(maxmem=maxmem, dtype=dtype)
+    return _spec_cache
+
 class xcorr_pair(object):
     """ An object to for ambient noise cross-correlation computation
     =================================================================================================================
@@ -195,7 +614,7 @@ class xcorr_pair(object):
     
     def convert_amph_to_xcorr(self, datadir, chans=['LHZ', 'LHE', 'LHN'], ftlen = True,\
             tlen = 84000., mintlen = 20000., sps = 1., lagtime = 3000., CorOutflag = 0, \
-            fprcs = False, fastfft=True, verbose=False):
+            fprcs = False, fastfft=True, cachemem=1000., spectype='complex128', verbose=False):
         """
         Convert amplitude and phase files to xcorr
         =================================================================================================================
@@ -210,10 +629,13 @@ class xcorr_pair(object):
         CorOutflag  - 0 = only output monthly xcorr data, 1 = only daily, 2 or others = output both
         fprcs       - turn on/off (1/0) precursor signal checking, NOT implemented yet
         fastfft     - speeding up the computation by using precomputed fftw_plan or not
+        cachemem    - memory budget of the spectra cache (in MB)
+        spectype    - data type of the cached spectra ('complex64' or 'complex128')
         =================================================================================================================
         """
         if verbose:
             self.print_info()
+        spec_cache              = _get_spectra_cache(maxmem=cachemem, dtype=spectype)
         staid1                  = self.netcode1 + '.' + self.stacode1
         staid2                  = self.netcode2 + '.' + self.stacode2
         month_dir               = datadir+'/'+self.monthdir
@@ -227,54 +649,50 @@ class xcorr_pair(object):
         # construct fftw_plan for speeding up
         #---------------------------------------
         if fastfft:
-            temp_pfx        = month_dir+'/'+self.monthdir+'.'+str(self.daylst[0])+\
-                                '/ft_'+self.monthdir+'.'+str(self.daylst[0])+'.'+staid1+'.'+chans[0]+'.SAC'
-            amp_ref         = obspy.read(temp_pfx+'.am')[0]
-            Nref            = amp_ref.data.size
-            Ns              = int(2*Nref - 1)
-            temp_x_sp       = np.zeros(Ns, dtype=complex)
-            temp_out        = np.zeros(Ns, dtype=complex)
-            fftw_plan       = pyfftw.FFTW(input_array=temp_x_sp, output_array=temp_out, direction='FFTW_BACKWARD',\
+            daydir          = month_dir+'/'+self.monthdir+'.'+str(self.daylst[0])
+            spec_ref, stla, stlo\
+                            = spec_cache.get(daydir=daydir, dayfpfx=self.monthdir+'.'+str(self.daylst[0]), staid=staid1, chan=chans[0])
+            if spec_ref is not None:
+                Nref        = spec_ref.size
+                Ns          = int(2*Nref - 1)
+                temp_x_sp   = pyfftw.empty_aligned(Ns, dtype=complex)
+                temp_out    = pyfftw.empty_aligned(Ns, dtype=complex)
+                fftw_plan   = pyfftw.FFTW(input_array=temp_x_sp, output_array=temp_out, direction='FFTW_BACKWARD',\
                                 flags=('FFTW_MEASURE', ))
+            else:
+                Nref        = 0
         else:
             Nref            = 0
         #-----------------
         # loop over days
         #-----------------
         for day in self.daylst:
-            # input streams
-            st_amp1     = obspy.Stream()
-            st_ph1      = obspy.Stream()
-            st_amp2     = obspy.Stream()
-            st_ph2      = obspy.Stream()
             # daily output streams
             daily_xcorr = []
             daydir      = month_dir+'/'+self.monthdir+'.'+str(day)
-            # read amp/ph files
+            dayfpfx     = self.monthdir+'.'+str(day)
+            # get spectra from the cache, amp/ph files are read only upon cache miss
+            spec1Lst    = []
+            spec2Lst    = []
             for chan in chans:
-                pfx1    = daydir+'/ft_'+self.monthdir+'.'+str(day)+'.'+staid1+'.'+chan+'.SAC'
-                pfx2    = daydir+'/ft_'+self.monthdir+'.'+str(day)+'.'+staid2+'.'+chan+'.SAC'
-                st_amp1 += obspy.read(pfx1+'.am')
-                st_ph1  += obspy.read(pfx1+'.ph')
-                st_amp2 += obspy.read(pfx2+'.am')
-                st_ph2  += obspy.read(pfx2+'.ph')
+                spec1, stla1, stlo1 = spec_cache.get(daydir=daydir, dayfpfx=dayfpfx, staid=staid1, chan=chan)
+                spec2, stla2, stlo2 = spec_cache.get(daydir=daydir, dayfpfx=dayfpfx, staid=staid2, chan=chan)
+                spec1Lst.append(spec1)
+                spec2Lst.append(spec2)
             #-----------------------------
             # define commone sac header
             #-----------------------------
             if not init_common_header:
-                tr1                                 = st_amp1[0]
-                tr2                                 = st_amp2[0]
                 xcorr_common_sacheader['kuser0']    = self.netcode1
                 xcorr_common_sacheader['kevnm']     = self.stacode1
                 xcorr_common_sacheader['knetwk']    = self.netcode2
                 xcorr_common_sacheader['kstnm']     = self.stacode2
                 # # # xcorr_common_sacheader['kcmpnm']    = chan1+chan2
-                xcorr_common_sacheader['evla']      = tr1.stats.sac.stla
-                xcorr_common_sacheader['evlo']      = tr1.stats.sac.stlo
-                xcorr_common_sacheader['stla']      = tr2.stats.sac.stla
-                xcorr_common_sacheader['stlo']      = tr2.stats.sac.stlo
-                dist, az, baz                       = obspy.geodetics.gps2dist_azimuth(tr1.stats.sac.stla, tr1.stats.sac.stlo,\
-                                                        tr2.stats.sac.stla, tr2.stats.sac.stlo) # distance is in m
+                xcorr_common_sacheader['evla']      = stla1
+                xcorr_common_sacheader['evlo']      = stlo1
+                xcorr_common_sacheader['stla']      = stla2
+                xcorr_common_sacheader['stlo']      = stlo2
+                dist, az, baz                       = obspy.geodetics.gps2dist_azimuth(stla1, stlo1, stla2, stlo2) # distance is in m
                 xcorr_common_sacheader['dist']      = dist/1000.
                 xcorr_common_sacheader['az']        = az
                 xcorr_common_sacheader['baz']       = baz
@@ -285,61 +703,60 @@ class xcorr_pair(object):
                 xcorr_common_sacheader['user0']     = 1
                 init_common_header                  = True
             skip_this_day   = False
+            # quality control, spectra of bad quality are stored as None in the cache
+            for ich in range(chan_size):
+                if spec1Lst[ich] is None or spec2Lst[ich] is None:
+                    skip_this_day   = True
+                    break
+            #-----------------------------------------------------------------
+            # amplitude correction arrays, depending only on channel 1,
+            # computed once per station pair and day, and reused for the
+            # channels sharing the same record arrays
+            #-----------------------------------------------------------------
+            cor_recLst      = []
+            arr1Lst         = []
+            arr2Lst         = []
+            if ftlen and not skip_this_day:
+                # npts for the length of the preprocessed daily record 
+                Nrec        = int(tlen*sps)
+                for ich1 in range(chan_size):
+                    arr1    = spec_cache.get_rec(daydir=daydir, dayfpfx=dayfpfx, staid=staid1, chan=chans[ich1], Nrec=Nrec)
+                    arr2    = spec_cache.get_rec(daydir=daydir, dayfpfx=dayfpfx, staid=staid2, chan=chans[ich1], Nrec=Nrec)
+                    cor_rec = None
+                    for jch in range(ich1):
+                        if np.array_equal(arr1, arr1Lst[jch]) and np.array_equal(arr2, arr2Lst[jch]):
+                            cor_rec = cor_recLst[jch]
+                            break
+                    if cor_rec is None:
+                        cor_rec = _CalcRecCor(arr1, arr2, lagN)
+                    arr1Lst.append(arr1)
+                    arr2Lst.append(arr2)
+                    cor_recLst.append(cor_rec)
+                    # skip the day if the length of available data is too small
+                    if cor_rec[0] < mintlen*sps or cor_rec[-1] < mintlen*sps:
+                        skip_this_day   = True
+                        break
+                    # skip the day if any data point has a weight of zero
+                    if np.any(cor_rec == 0.):
+                        skip_this_day   = True
+                        break
             # compute cross-correlation
             for ich1 in range(chan_size):
                 if skip_this_day:
                     break
                 for ich2 in range(chan_size):
                     # get data arrays
-                    amp1    = st_amp1[ich1].data
-                    ph1     = st_ph1[ich1].data
-                    amp2    = st_amp2[ich2].data
-                    ph2     = st_ph2[ich2].data
-                    # quality control
-                    if (np.isnan(amp1)).any() or (np.isnan(amp2)).any() or \
-                            (np.isnan(ph1)).any() or (np.isnan(ph2)).any():
-                        skip_this_day   = True
-                        break
-                    if np.any(amp1 > 1e20) or np.any(amp2 > 1e20):
-                        skip_this_day   = True
-                        break
-                    # get amplitude correction array
-                    Namp        = amp1.size
-                    if ftlen:
-                        # npts for the length of the preprocessed daily record 
-                        Nrec    = int(tlen*sps)
-                        frec1   = daydir+'/ft_'+self.monthdir+'.'+str(day)+'.'+staid1+'.'+chans[ich1]+'.SAC_rec'
-                        frec2   = daydir+'/ft_'+self.monthdir+'.'+str(day)+'.'+staid2+'.'+chans[ich1]+'.SAC_rec'
-                        if os.path.isfile(frec1):
-                            arr1= np.loadtxt(frec1)
-                            if arr1.size == 2:
-                                arr1    = arr1.reshape(1, 2) 
-                        else:
-                            arr1= (np.array([0, Nrec])).reshape(1, 2)                            
-                        if os.path.isfile(frec2):
-                            arr2= np.loadtxt(frec2)
-                            if arr2.size == 2:
-                                arr2    = arr2.reshape(1, 2)
-                        else:
-                            arr2= (np.array([0, Nrec])).reshape(1, 2)
-                        cor_rec     = _CalcRecCor(arr1, arr2, np.int32(lagN))
-                        # skip the day if the length of available data is too small
-                        if cor_rec[0] < mintlen*sps or cor_rec[-1] < mintlen*sps:
-                            skip_this_day   = True
-                            break
-                        # skip the day if any data point has a weight of zero
-                        if np.any(cor_rec == 0.):
-                            skip_this_day   = True
-                            break
-                    # comvert amp & ph files to xcorr
+                    spec1   = spec1Lst[ich1]
+                    spec2   = spec2Lst[ich2]
+                    Namp    = spec1.size
+                    # comvert spectra to xcorr
                     if fastfft and Namp == Nref:
-                        out_data        = _amp_ph_to_xcorr_fast(amp1=amp1, ph1=ph1, amp2=amp2, ph2=ph2, sps=sps,\
-                                                                lagtime=lagtime, fftw_plan=fftw_plan)
+                        out_data        = _spec_to_xcorr_fast(spec1=spec1, spec2=spec2, sps=sps, lagtime=lagtime, fftw_plan=fftw_plan)
                     else:
-                        out_data        = _amp_ph_to_xcorr(amp1=amp1, ph1=ph1, amp2=amp2, ph2=ph2, sps=sps, lagtime=lagtime)
+                        out_data        = _spec_to_xcorr(spec1=spec1, spec2=spec2, sps=sps, lagtime=lagtime)
                     # amplitude correction
                     if ftlen:
-                        out_data    /= cor_rec
+                        out_data    /= cor_recLst[ich1]
                         out_data    *= float(2*Namp - 1)
                     # end of computing individual xcorr
                     daily_xcorr.append(out_data)
@@ -408,14 +825,362 @@ class xcorr_pair(object):
 
 def amph_to_xcorr_for_mp(in_xcorr_pair, datadir, chans=['LHZ', 'LHE', 'LHN'], ftlen = True,\
             tlen = 84000., mintlen = 20000., sps = 1., lagtime = 3000., CorOutflag = 0, \
-            fprcs = False, fastfft=True):
+            fprcs = False, fastfft=True, cachemem=1000., spectype='complex128'):
     
     in_xcorr_pair.convert_amph_to_xcorr(datadir=datadir, chans=chans, ftlen = ftlen,\
             tlen = tlen, mintlen = mintlen, sps = sps,  lagtime = lagtime, CorOutflag = CorOutflag,\
-                    fprcs = fprcs, fastfft=fastfft)
+                    fprcs = fprcs, fastfft=fastfft, cachemem=cachemem, spectype=spectype)
     # # # in_xcorr_pair.print_info()
     return
 
+def _read_amph_station_day(daydir, dayfpfx, staid, chans, ftlen=True, Nrec=84000, dtype=complex):
+    """read amplitude and phase files of all the channels for one station-day and convert them to complex spectra
+    ==============================================================================
+    ::: input parameters :::
+    daydir      - day directory (e.g. datadir/2019.JAN/2019.JAN.1)
+    dayfpfx     - prefix of the day (e.g. 2019.JAN.1)
+    staid       - station id (network.station)
+    chans       - channel list
+    ftlen       - read the record files (ft_*SAC_rec) or not
+    Nrec        - npts of the daily record, used when the record file does not exist
+    dtype       - data type of the spectra
+    ::: output :::
+    spec        - complex spectra, shape = (len(chans), N)
+    recLst      - record arrays for each channel (empty list if ftlen = False)
+    stla, stlo  - station latitude/longitude from the sac header
+    None will be returned if any file is missing or the data is of bad quality
+    ==============================================================================
+    """
+    spec        = None
+    recLst      = []
+    for ich in range(len(chans)):
+        pfx     = daydir+'/ft_'+dayfpfx+'.'+staid+'.'+chans[ich]+'.SAC'
+        if not (os.path.isfile(pfx+'.am') and os.path.isfile(pfx+'.ph')):
+            return None
+        # I/O through obspy.io.sac.SACTrace.read() is ~ 10 times faster than obspy.read()
+        tr_amp  = obspy.io.sac.SACTrace.read(pfx+'.am')
+        tr_ph   = obspy.io.sac.SACTrace.read(pfx+'.ph')
+        amp     = tr_amp.data
+        ph      = tr_ph.data
+        # quality control
+        if (np.isnan(amp)).any() or (np.isnan(ph)).any() or np.any(amp > 1e20):
+            return None
+        if spec is None:
+            spec    = np.zeros((len(chans), amp.size), dtype=dtype)
+            stla    = tr_amp.stla
+            stlo    = tr_amp.stlo
+        elif amp.size != spec.shape[1]:
+            return None
+        spec[ich]   = _amp_ph_to_spec(amp, ph, dtype=dtype)
+        if ftlen:
+            recLst.append(_read_rec(pfx+'_rec', Nrec=Nrec))
+    return spec, recLst, stla, stlo
+
+def _get_xcorr_blocksize(blockmem, Namp, chan_size, lagN, spectype='complex128', batchsize=50, CorOutflag=0):
+    """determine the block size of the batched xcorr engine from the memory budget
+    ==============================================================================
+    ::: input parameters :::
+    blockmem    - memory budget of one block (in MB)
+    Namp        - npts of the spectra
+    chan_size   - number of channels
+    lagN        - npts of the one-sided lag
+    spectype    - data type of the spectra
+    batchsize   - maximum number of station 2 in one batched inverse FFT
+    CorOutflag  - 0 = only output monthly xcorr data, 1 = only daily, 2 or others = output both
+    ::: output :::
+    blocksize   - number of stations in a row/column block
+    batchsize   - number of station 2 in one batched inverse FFT
+    ==============================================================================
+    """
+    itemsize    = np.dtype(spectype).itemsize
+    membytes    = blockmem*1024.*1024.
+    # temporary arrays of one batch: cross-spectra, irfft output and the xcorr
+    batchbytes  = float(chan_size**2)*(Namp*itemsize + (2*Namp - 1)*8. + (2*lagN + 1)*8.)
+    batchsize   = int(max(1, min(batchsize, np.floor(membytes/4./batchbytes))))
+    membytes    -= batchsize*batchbytes
+    # spectra of the row and column stations (2*blocksize)
+    specbytes   = 2.*chan_size*Namp*itemsize
+    # monthly stacks (blocksize**2)
+    if CorOutflag != 1:
+        stackbytes  = float(chan_size**2)*(2*lagN + 1)*8.
+    else:
+        stackbytes  = 0.
+    if stackbytes > 0.:
+        blocksize   = (-specbytes + np.sqrt(specbytes**2 + 4.*stackbytes*membytes))/(2.*stackbytes)
+    else:
+        blocksize   = membytes/specbytes
+    blocksize   = int(max(1, np.floor(blocksize)))
+    return blocksize, batchsize
+
+class xcorr_block(object):
+    """ An object for batched ambient noise cross-correlation computation of a block of station pairs
+        The block is a tile of the station pair matrix: station 1 in a row block and station 2 in a column block.
+        Spectra of each station-day are read only once per block and cross-correlations for all the pairs and
+        channel combinations of one source station are computed as one batched inverse FFT
+    =================================================================================================================
+    ::: parameters :::
+    stalst              - sorted list of station ids (network.station) available in the month
+    irow0, irow1        - index range of station 1 in stalst, [irow0, irow1)
+    jcol0, jcol1        - index range of station 2 in stalst, [jcol0, jcol1)
+                            pairs are (stalst[irow], stalst[jcol]) with irow0 <= irow < irow1, jcol0 <= jcol < jcol1
+                            and jcol > irow
+    monthdir            - month directory (e.g. 2019.JAN)
+    daylst              - list includes the days for xcorr
+    batchsize           - number of station 2 in one batched inverse FFT
+    =================================================================================================================
+    """
+    def __init__(self, stalst, irow0, irow1, jcol0, jcol1, monthdir, daylst, batchsize=50):
+        self.stalst     = stalst
+        self.irow0      = irow0
+        self.irow1      = irow1
+        self.jcol0      = jcol0
+        self.jcol1      = jcol1
+        self.monthdir   = monthdir
+        self.daylst     = daylst
+        self.batchsize  = batchsize
+        return
+
+    def print_info(self):
+        """print the informations of this block
+        """
+        print '--- '+ self.stalst[self.irow0]+' - '+self.stalst[self.irow1-1]+' / '+ self.stalst[self.jcol0]+' - '+\
+                self.stalst[self.jcol1-1]+' : '+self.monthdir+' '+str(len(self.daylst))+' days'
+
+    def _get_sacheader(self, irow, jcol, sps, lagN):
+        """get the common sac header of the pair (stalst[irow], stalst[jcol])
+        """
+        staid1                          = self.stalst[irow]
+        staid2                          = self.stalst[jcol]
+        netcode1, stacode1              = staid1.split('.')
+        netcode2, stacode2              = staid2.split('.')
+        i1                              = self.staind[irow]
+        i2                              = self.staind[jcol]
+        sacheader                       = xcorr_sacheader_default.copy()
+        sacheader['kuser0']             = netcode1
+        sacheader['kevnm']              = stacode1
+        sacheader['knetwk']             = netcode2
+        sacheader['kstnm']              = stacode2
+        sacheader['evla']               = self.stlaArr[i1]
+        sacheader['evlo']               = self.stloArr[i1]
+        sacheader['stla']               = self.stlaArr[i2]
+        sacheader['stlo']               = self.stloArr[i2]
+        dist, az, baz                   = obspy.geodetics.gps2dist_azimuth(self.stlaArr[i1], self.stloArr[i1],\
+                                            self.stlaArr[i2], self.stloArr[i2]) # distance is in m
+        sacheader['dist']               = dist/1000.
+        sacheader['az']                 = az
+        sacheader['baz']                = baz
+        sacheader['delta']              = 1./sps
+        sacheader['npts']               = int(2*lagN + 1)
+        sacheader['b']                  = -float(lagN/sps)
+        sacheader['e']                  = float(lagN/sps)
+        sacheader['user0']              = 1
+        return sacheader
+
+    def convert_amph_to_xcorr(self, datadir, chans=['LHZ', 'LHE', 'LHN'], ftlen = True,\
+            tlen = 84000., mintlen = 20000., sps = 1., lagtime = 3000., CorOutflag = 0, \
+            fprcs = False, fastfft=True, cachemem=1000., spectype='complex128', verbose=False):
+        """
+        Convert amplitude and phase files to xcorr for all the pairs in the block
+        =================================================================================================================
+        ::: input parameters :::
+        datadir     - directory including data and output
+        chans       - channel list
+        ftlen       - turn (on/off) cross-correlation-time-length correction for amplitude
+        tlen        - time length of daily records (in sec)
+        mintlen     - allowed minimum time length for cross-correlation (takes effect only when ftlen = True)
+        sps         - target sampling rate
+        lagtime     - cross-correlation signal half length in sec
+        CorOutflag  - 0 = only output monthly xcorr data, 1 = only daily, 2 or others = output both
+        fprcs       - turn on/off (1/0) precursor signal checking, NOT implemented yet
+        fastfft     - use pyfftw for the batched inverse FFT or not (numpy.fft)
+        cachemem    - NOT used, spectra of one day are held in memory for the whole block
+        spectype    - data type of the spectra ('complex64' or 'complex128')
+        =================================================================================================================
+        """
+        if verbose:
+            self.print_info()
+        month_dir               = datadir+'/'+self.monthdir
+        chan_size               = len(chans)
+        lagN                    = int(np.floor(lagtime*sps +0.5)) # npts for one-sided lag
+        Nrec                    = int(tlen*sps)
+        #--------------------------------------------------------------
+        # stations involved in this block (row and column stations),
+        # staind: global index in stalst -> local index in the block
+        #--------------------------------------------------------------
+        irowArr                 = np.arange(self.irow0, self.irow1)
+        jcolArr                 = np.arange(self.jcol0, self.jcol1)
+        blkstaArr               = np.union1d(irowArr, jcolArr)
+        Nblksta                 = blkstaArr.size
+        self.staind             = {}
+        for ista in range(Nblksta):
+            self.staind[blkstaArr[ista]]    = ista
+        Nrow                    = irowArr.size
+        Ncol                    = jcolArr.size
+        # monthly stack array: (irow - irow0, jcol - jcol0)
+        if CorOutflag != 1:
+            monthly_xcorr       = np.zeros((Nrow, Ncol, chan_size, chan_size, 2*lagN+1), dtype=float)
+        stacked_day             = np.zeros((Nrow, Ncol), dtype=int)
+        self.stlaArr            = np.zeros(Nblksta, dtype=float)
+        self.stloArr            = np.zeros(Nblksta, dtype=float)
+        isloc                   = np.zeros(Nblksta, dtype=bool)
+        headerdict              = {}
+        if fastfft:
+            irfft               = pyfftw.interfaces.numpy_fft.irfft
+        else:
+            irfft               = np.fft.irfft
+        #-----------------
+        # loop over days
+        #-----------------
+        for day in self.daylst:
+            daydir              = month_dir+'/'+self.monthdir+'.'+str(day)
+            dayfpfx             = self.monthdir+'.'+str(day)
+            #----------------------------------------------------
+            # read spectra of all the stations, once per day
+            #----------------------------------------------------
+            spec                = None
+            isdata              = np.zeros(Nblksta, dtype=bool)
+            recLst              = [None]*Nblksta
+            for ista in range(Nblksta):
+                outdata         = _read_amph_station_day(daydir=daydir, dayfpfx=dayfpfx, staid=self.stalst[blkstaArr[ista]],\
+                                    chans=chans, ftlen=ftlen, Nrec=Nrec, dtype=spectype)
+                if outdata is None:
+                    continue
+                cspec, recLst[ista], stla, stlo \
+                                = outdata
+                if spec is None:
+                    Namp        = cspec.shape[1]
+                    spec        = np.zeros((Nblksta, chan_size, Namp), dtype=spectype)
+                elif cspec.shape[1] != Namp:
+                    warnings.warn('Incompatible npts of spectra for: ' + self.stalst[blkstaArr[ista]] +' Day: '+dayfpfx,\
+                                  UserWarning, stacklevel=1)
+                    continue
+                spec[ista]      = cspec
+                isdata[ista]    = True
+                if not isloc[ista]:
+                    self.stlaArr[ista]  = stla
+                    self.stloArr[ista]  = stlo
+                    isloc[ista]         = True
+            if spec is None:
+                continue
+            Ns                  = int(2*Namp - 1)
+            if lagN > Ns:
+                raise ValueError('Lagtime npts overflow!')
+            #-------------------------------------------------
+            # compute cross-correlation, loop over station 1
+            #-------------------------------------------------
+            for irow in irowArr:
+                i1              = self.staind[irow]
+                if not isdata[i1]:
+                    continue
+                # station 2 indices (in the column block)
+                jArr            = np.where((jcolArr > irow)*isdata[[self.staind[jcol] for jcol in jcolArr]])[0]
+                if jArr.size == 0:
+                    continue
+                i2Arr           = np.array([self.staind[jcol] for jcol in jcolArr[jArr]], dtype=int)
+                # get amplitude correction array
+                if ftlen:
+                    cor_rec     = np.zeros((i2Arr.size, chan_size, 2*lagN+1), dtype=float)
+                    isvalid     = np.ones(i2Arr.size, dtype=bool)
+                    for ipair in range(i2Arr.size):
+                        i2      = i2Arr[ipair]
+                        for ich1 in range(chan_size):
+                            # reuse the weight of the previous channel if the record arrays are the same
+                            if ich1 > 0 and np.array_equal(recLst[i1][ich1], recLst[i1][ich1-1]) \
+                                    and np.array_equal(recLst[i2][ich1], recLst[i2][ich1-1]):
+                                cor_rec[ipair, ich1, :] = cor_rec[ipair, ich1-1, :]
+                            else:
+                                cor_rec[ipair, ich1, :] = _CalcRecCor(recLst[i1][ich1], recLst[i2][ich1], lagN)
+                            # skip the day if the length of available data is too small
+                            # or any data point has a weight of zero
+                            if cor_rec[ipair, ich1, 0] < mintlen*sps or cor_rec[ipair, ich1, -1] < mintlen*sps \
+                                    or np.any(cor_rec[ipair, ich1, :] == 0.):
+                                isvalid[ipair]  = False
+                                break
+                    jArr        = jArr[isvalid]
+                    i2Arr       = i2Arr[isvalid]
+                    cor_rec     = cor_rec[isvalid]
+                conj_spec1      = np.conj(spec[i1])
+                #--------------------------------------------------------
+                # batched cross-spectrum and inverse FFT, conj(sac1)*(sac2)
+                # 2*real(ifft) of the one-sided cross-spectrum is computed
+                # as irfft with doubled zero frequency term
+                #--------------------------------------------------------
+                for ib in range(0, i2Arr.size, self.batchsize):
+                    ci2Arr      = i2Arr[ib:(ib+self.batchsize)]
+                    cjArr       = jArr[ib:(ib+self.batchsize)]
+                    x_sp        = spec[ci2Arr][:, np.newaxis, :, :] * conj_spec1[np.newaxis, :, np.newaxis, :]
+                    x_sp[:, :, :, 0]\
+                                *= 2.
+                    seis_out    = irfft(x_sp, n=Ns, axis=-1)
+                    del x_sp
+                    out_data    = np.concatenate((seis_out[:, :, :, lagN:0:-1], seis_out[:, :, :, :1],\
+                                    seis_out[:, :, :, (Ns-1):(Ns-lagN-1):-1]), axis=-1)
+                    del seis_out
+                    # amplitude correction
+                    if ftlen:
+                        out_data    /= cor_rec[ib:(ib+self.batchsize), :, np.newaxis, :]
+                        out_data    *= float(Ns)
+                    stacked_day[irow - self.irow0, cjArr]   += 1
+                    # append to monthly data
+                    if CorOutflag != 1:
+                        monthly_xcorr[irow - self.irow0, cjArr] += out_data
+                    # output daily xcorr
+                    if CorOutflag != 0:
+                        staid1          = self.stalst[irow]
+                        out_daily_dir   = month_dir+'/COR_D/'+staid1
+                        if not os.path.isdir(out_daily_dir):
+                            try:
+                                os.makedirs(out_daily_dir)
+                            except OSError:
+                                pass
+                        for ipair in range(cjArr.size):
+                            jcol        = jcolArr[cjArr[ipair]]
+                            staid2      = self.stalst[jcol]
+                            if not (irow, jcol) in headerdict:
+                                headerdict[(irow, jcol)]    = self._get_sacheader(irow, jcol, sps, lagN)
+                            for ich1 in range(chan_size):
+                                for ich2 in range(chan_size):
+                                    out_daily_fname         = out_daily_dir+'/COR_'+staid1+'_'+chans[ich1]+\
+                                                                '_'+staid2+'_'+chans[ich2]+'_'+str(day)+'.SAC'
+                                    daily_header            = headerdict[(irow, jcol)].copy()
+                                    daily_header['kcmpnm']  = chans[ich1]+chans[ich2]
+                                    sacTr                   = obspy.io.sac.sactrace.SACTrace(data = out_data[ipair, ich1, ich2, :],\
+                                                                **daily_header)
+                                    sacTr.write(out_daily_fname)
+            if verbose:
+                print 'xcorr finished : '+dayfpfx
+        # end loop over days
+        if CorOutflag == 1:
+            return
+        #-------------------------------
+        # write monthly stacked xcorr
+        #-------------------------------
+        for irow in irowArr:
+            staid1              = self.stalst[irow]
+            out_monthly_dir     = month_dir+'/COR/'+staid1
+            for jcol in jcolArr:
+                if jcol <= irow or stacked_day[irow - self.irow0, jcol - self.jcol0] == 0:
+                    continue
+                if not os.path.isdir(out_monthly_dir):
+                    try:
+                        os.makedirs(out_monthly_dir)
+                    except OSError:
+                        pass
+                staid2          = self.stalst[jcol]
+                if not (irow, jcol) in headerdict:
+                    headerdict[(irow, jcol)]    = self._get_sacheader(irow, jcol, sps, lagN)
+                for ich1 in range(chan_size):
+                    for ich2 in range(chan_size):
+                        out_monthly_fname           = out_monthly_dir+'/COR_'+staid1+'_'+chans[ich1]+\
+                                                        '_'+staid2+'_'+chans[ich2]+'.SAC'
+                        monthly_header              = headerdict[(irow, jcol)].copy()
+                        monthly_header['kcmpnm']    = chans[ich1]+chans[ich2]
+                        monthly_header['user0']     = int(stacked_day[irow - self.irow0, jcol - self.jcol0])
+                        sacTr                       = obspy.io.sac.sactrace.SACTrace(data = monthly_xcorr[irow - self.irow0,\
+                                                        jcol - self.jcol0, ich1, ich2, :], **monthly_header)
+                        sacTr.write(out_monthly_fname)
+        return
+
 
 class beamforming_stream(obspy.Stream):
     """ An object to for ambient noise cross-correlation computation
@@ -443,41 +1208,315 @@ class noiseASDF(pyasdf.ASDFDataSet):
         """
         print information of the dataset.
         """
-        outstr  = '================================================= Ambient Noise Cross-correlation Database =================================================\n'
-        outstr  += self.__str__()+'\n'
-        outstr  += '--------------------------------------------------------------------------------------------------------------------------------------------\n'
-        if 'NoiseXcorr' in self.auxiliary_data.list():
-            outstr      += 'NoiseXcorr              - Cross-correlation seismogram\n'
-        if 'StaInfo' in self.auxiliary_data.list():
-            outstr      += 'StaInfo                 - Auxiliary station information\n'
-        if 'DISPbasic1' in self.auxiliary_data.list():
-            outstr      += 'DISPbasic1              - Basic dispersion curve, no jump correction\n'
-        if 'DISPbasic2' in self.auxiliary_data.list():
-            outstr      += 'DISPbasic2              - Basic dispersion curve, with jump correction\n'
-        if 'DISPpmf1' in self.auxiliary_data.list():
-            outstr      += 'DISPpmf1                - PMF dispersion curve, no jump correction\n'
-        if 'DISPpmf2' in self.auxiliary_data.list():
-            outstr      += 'DISPpmf2                - PMF dispersion curve, with jump correction\n'
-        if 'DISPbasic1interp' in self.auxiliary_data.list():
-            outstr      += 'DISPbasic1interp        - Interpolated DISPbasic1\n'
-        if 'DISPbasic2interp' in self.auxiliary_data.list():
-            outstr      += 'DISPbasic2interp        - Interpolated DISPbasic2\n'
-        if 'DISPpmf1interp' in self.auxiliary_data.list():
-            outstr      += 'DISPpmf1interp          - Interpolated DISPpmf1\n'
-        if 'DISPpmf2interp' in self.auxiliary_data.list():
-            outstr      += 'DISPpmf2interp          - Interpolated DISPpmf2\n'
-        if 'FieldDISPbasic1interp' in self.auxiliary_data.list():
-            outstr      += 'FieldDISPbasic1interp   - Field data of DISPbasic1\n'
-        if 'FieldDISPbasic2interp' in self.auxiliary_data.list():
-            outstr      += 'FieldDISPbasic2interp   - Field data of DISPbasic2\n'
-        if 'FieldDISPpmf1interp' in self.auxiliary_data.list():
-            outstr      += 'FieldDISPpmf1interp     - Field data of DISPpmf1\n'
-        if 'FieldDISPpmf2interp' in self.auxiliary_data.list():
-            outstr      += 'FieldDISPpmf2interp     - Field data of DISPpmf2\n'
-        outstr += '============================================================================================================================================\n'
-        print outstr
+        outstr  = '================================================= Ambient Noise Cross-correlation Database =================================================\n'
+        outstr  += self.__str__()+'\n'
+        outstr  += '--------------------------------------------------------------------------------------------------------------------------------------------\n'
+        if 'NoiseXcorr' in self.auxiliary_data.list():
+            outstr      += 'NoiseXcorr              - Cross-correlation seismogram\n'
+        if 'StaInfo' in self.auxiliary_data.list():
+            outstr      += 'StaInfo                 - Auxiliary station information\n'
+        if 'PairIndex' in self.auxiliary_data.list():
+            outstr      += 'PairIndex               - Station table and existing station pairs of each data type\n'
+        if 'DISPbasic1' in self.auxiliary_data.list():
+            outstr      += 'DISPbasic1              - Basic dispersion curve, no jump correction\n'
+        if 'DISPbasic2' in self.auxiliary_data.list():
+            outstr      += 'DISPbasic2              - Basic dispersion curve, with jump correction\n'
+        if 'DISPpmf1' in self.auxiliary_data.list():
+            outstr      += 'DISPpmf1                - PMF dispersion curve, no jump correction\n'
+        if 'DISPpmf2' in self.auxiliary_data.list():
+            outstr      += 'DISPpmf2                - PMF dispersion curve, with jump correction\n'
+        if 'DISPbasic1interp' in self.auxiliary_data.list():
+            outstr      += 'DISPbasic1interp        - Interpolated DISPbasic1\n'
+        if 'DISPbasic2interp' in self.auxiliary_data.list():
+            outstr      += 'DISPbasic2interp        - Interpolated DISPbasic2\n'
+        if 'DISPpmf1interp' in self.auxiliary_data.list():
+            outstr      += 'DISPpmf1interp          - Interpolated DISPpmf1\n'
+        if 'DISPpmf2interp' in self.auxiliary_data.list():
+            outstr      += 'DISPpmf2interp          - Interpolated DISPpmf2\n'
+        if 'FieldDISPbasic1interp' in self.auxiliary_data.list():
+            outstr      += 'FieldDISPbasic1interp   - Field data of DISPbasic1\n'
+        if 'FieldDISPbasic2interp' in self.auxiliary_data.list():
+            outstr      += 'FieldDISPbasic2interp   - Field data of DISPbasic2\n'
+        if 'FieldDISPpmf1interp' in self.auxiliary_data.list():
+            outstr      += 'FieldDISPpmf1interp     - Field data of DISPpmf1\n'
+        if 'FieldDISPpmf2interp' in self.auxiliary_data.list():
+            outstr      += 'FieldDISPpmf2interp     - Field data of DISPpmf2\n'
+        outstr += '============================================================================================================================================\n'
+        print outstr
+        return
+    
+    #==================================================================
+    # station/pair index, stored in auxiliary_data.PairIndex
+    #==================================================================
+    def _get_sta_table(self, rebuild=False, store=True):
+        """get the station table, built from StationXML and stored in the file if not exists
+        ==============================================================================
+        ::: input parameters :::
+        rebuild     - rebuild the table or not
+        store       - store the (re)built table in the file or not,
+                        if False, an out-of-date or missing table is built in memory only
+        ::: output :::
+        staLst      - station id list (network.station)
+        staArr      - station table, shape = (Nsta, 4), columns are longitude, latitude,
+                        start/end date (timestamp, -inf/inf for unknown)
+        ==============================================================================
+        """
+        staLst          = self.waveforms.list()
+        if not rebuild:
+            try:
+                staLst_index    = list(self._sta_table[0])
+            except AttributeError:
+                staLst_index    = None
+                if 'PairIndex' in self.auxiliary_data.list() and 'staid' in self.auxiliary_data.PairIndex.list():
+                    staLst_index    = list(self.auxiliary_data.PairIndex['staid'].data.value)
+                    self._sta_table = (staLst_index, self.auxiliary_data.PairIndex['stations'].data.value)
+                    self._pair_table= {}
+            # the table is out of date if the stations are changed
+            if staLst_index == staLst:
+                return self._sta_table
+        staArr          = np.zeros((len(staLst), 4), dtype=np.float64)
+        for ista in range(len(staLst)):
+            station     = self.waveforms[staLst[ista]].StationXML.networks[0].stations[0]
+            staArr[ista, 0] \
+                        = station.longitude
+            staArr[ista, 1] \
+                        = station.latitude
+            staArr[ista, 2] \
+                        = -np.inf if station.start_date is None else station.start_date.timestamp
+            staArr[ista, 3] \
+                        = np.inf if station.end_date is None else station.end_date.timestamp
+        if not store:
+            return (staLst, staArr)
+        if 'PairIndex' in self.auxiliary_data.list():
+            # pair tables refer to the station indices, remove them all
+            for name in self.auxiliary_data.PairIndex.list():
+                del self.auxiliary_data.PairIndex[name]
+        self.add_auxiliary_data(data=np.array(staLst, dtype=str), data_type='PairIndex', path='staid', parameters={})
+        self.add_auxiliary_data(data=staArr, data_type='PairIndex', path='stations',\
+                                parameters={'longitude': 0, 'latitude': 1, 'start_date': 2, 'end_date': 3})
+        self._sta_table = (staLst, staArr)
+        self._pair_table= {}
+        return self._sta_table
+    
+    def _scan_pair_index(self, data_type, staLst, staArr):
+        """scan the existing station pairs of a data type, the pair table is returned without being stored
+            (see update_pair_index for the table)
+        """
+        staDict         = dict(zip(staLst, range(len(staLst))))
+        pairLst         = []
+        if data_type in self.auxiliary_data.list():
+            group       = self.auxiliary_data[data_type]
+            for netcode1 in group.list():
+                for stacode1 in group[netcode1].list():
+                    for netcode2 in group[netcode1][stacode1].list():
+                        for stacode2 in group[netcode1][stacode1][netcode2].list():
+                            try:
+                                ista1   = staDict[netcode1+'.'+stacode1]
+                                ista2   = staDict[netcode2+'.'+stacode2]
+                            except KeyError:
+                                # station not in the database
+                                continue
+                            pairLst.append((staLst[ista1], staLst[ista2], ista1, ista2))
+        pairLst.sort()
+        pairArr         = np.zeros((len(pairLst), 5), dtype=np.float64)
+        for ipair in range(len(pairLst)):
+            ista1, ista2    = pairLst[ipair][2:]
+            dist, az, baz   = obspy.geodetics.gps2dist_azimuth(staArr[ista1, 1], staArr[ista1, 0], staArr[ista2, 1], staArr[ista2, 0])
+            pairArr[ipair, :]   = [ista1, ista2, dist/1000., az, baz]
+        return pairArr
+    
+    def update_pair_index(self, data_type='NoiseXcorr'):
+        """scan the existing station pairs of a data type (e.g. NoiseXcorr, DISPpmf2, DISPpmf2interp) and
+        store the pair table in the file
+        ==============================================================================
+        ::: input parameters :::
+        data_type   - data type with path netcode1/stacode1/netcode2/stacode2/...
+        ::: output :::
+        self.auxiliary_data.PairIndex[data_type]
+            pair table, shape = (Npair, 5), columns are index of station 1/2 in the station table,
+            distance (km), azimuth and back-azimuth
+        ==============================================================================
+        """
+        staLst, staArr  = self._get_sta_table()
+        pairArr         = self._scan_pair_index(data_type=data_type, staLst=staLst, staArr=staArr)
+        if data_type in self.auxiliary_data.PairIndex.list():
+            del self.auxiliary_data.PairIndex[data_type]
+        self.add_auxiliary_data(data=pairArr, data_type='PairIndex', path=data_type,\
+                                parameters={'ista1': 0, 'ista2': 1, 'dist': 2, 'az': 3, 'baz': 4})
+        self._pair_table[data_type] = pairArr
+        return pairArr
+    
+    def get_pair_index(self, data_type='NoiseXcorr'):
+        """get the existing station pairs of a data type from the stored index
+            nothing is written to the file, if the pair table is not stored (see update_pair_index and build_index)
+            or the station table is out of date, the station pairs are scanned in memory
+        ==============================================================================
+        ::: input parameters :::
+        data_type   - data type with path netcode1/stacode1/netcode2/stacode2/...
+        ::: output :::
+        pairLst     - list of (staid1, staid2, dist, az, baz), dist is in km
+        ==============================================================================
+        """
+        sta_table       = self._get_sta_table(store=False)
+        staLst, staArr  = sta_table
+        pairArr         = None
+        # stored station table, the stored pair tables are valid
+        if sta_table is getattr(self, '_sta_table', None):
+            try:
+                pairArr = self._pair_table[data_type]
+            except KeyError:
+                if data_type in self.auxiliary_data.PairIndex.list():
+                    pairArr = self.auxiliary_data.PairIndex[data_type].data.value
+                    self._pair_table[data_type] = pairArr
+        if pairArr is None:
+            pairArr     = self._scan_pair_index(data_type=data_type, staLst=staLst, staArr=staArr)
+        pairLst         = []
+        for ipair in range(pairArr.shape[0]):
+            pairLst.append((staLst[int(pairArr[ipair, 0])], staLst[int(pairArr[ipair, 1])],\
+                            pairArr[ipair, 2], pairArr[ipair, 3], pairArr[ipair, 4]))
+        return pairLst
+    
+    def build_index(self, data_types=['NoiseXcorr', 'DISPbasic1', 'DISPbasic2', 'DISPpmf1', 'DISPpmf2', 'DISPbasic1interp',\
+                        'DISPbasic2interp', 'DISPpmf1interp', 'DISPpmf2interp']):
+        """(re)build the station table and the pair tables of the given data types
+        """
+        self._get_sta_table(rebuild=True)
+        for data_type in data_types:
+            if data_type in self.auxiliary_data.list():
+                self.update_pair_index(data_type=data_type)
+        return
+    
+    #==================================================================
+    # stack manifest (auxiliary_data.StackManifest) and dirty pairs of
+    # the downstream stages (auxiliary_data.DirtyPairs)
+    #==================================================================
+    def _del_auxiliary_data(self, data_type, path):
+        """delete auxiliary data (or a group of it) if exists
+        ::: output :::
+        True if the data is deleted, False if not exists
+        """
+        tag_path        = path.strip('/').split('/')
+        try:
+            group       = self.auxiliary_data[data_type]
+            for tag in tag_path[:-1]:
+                group   = group[tag]
+            del group[tag_path[-1]]
+        except KeyError:
+            return False
+        return True
+    
+    def _is_uptodate(self, data_type, path, input_hash, param_hash):
+        """check the provenance record of an output
+        ::: output :::
+        True if the output exists and is computed from the same input and parameters
+        """
+        tag_path        = path.strip('/').split('/')
+        try:
+            subdset     = self.auxiliary_data[data_type]
+            for tag in tag_path:
+                subdset = subdset[tag]
+            parameters  = subdset.parameters
+        except (KeyError, AttributeError):
+            return False
+        try:
+            return str(parameters['input_hash']) == input_hash and str(parameters['param_hash']) == param_hash
+        except KeyError:
+            return False
+    
+    def get_stack_manifest(self, staid1, staid2):
+        """get the months contributed to the stack of a station pair
+        ==============================================================================
+        ::: input parameters :::
+        staid1, staid2  - station ids
+        ::: output :::
+        months          - stacked months (year*100 + month), None if there is no manifest for the pair
+        ==============================================================================
+        """
+        if staid1 > staid2:
+            staid1, staid2  = staid2, staid1
+        netcode1, stacode1  = staid1.split('.')
+        netcode2, stacode2  = staid2.split('.')
+        try:
+            return self.auxiliary_data['StackManifest'][netcode1][stacode1][netcode2][stacode2].data.value
+        except KeyError:
+            return None
+    
+    def _set_stack_manifest(self, staid1, staid2, months):
+        """store the months contributed to the stack of a station pair
+        """
+        if staid1 > staid2:
+            staid1, staid2  = staid2, staid1
+        netcode1, stacode1  = staid1.split('.')
+        netcode2, stacode2  = staid2.split('.')
+        staid_aux           = netcode1+'/'+stacode1+'/'+netcode2+'/'+stacode2
+        months              = np.unique(np.array(months, dtype=np.int32))
+        self._del_auxiliary_data(data_type='StackManifest', path=staid_aux)
+        self.add_auxiliary_data(data=months, data_type='StackManifest', path=staid_aux, parameters={'Nmonth': months.size})
+        return
+    
+    def get_dirty_pairs(self, stage):
+        """get the station pairs to be (re)processed by a stage
+        ==============================================================================
+        ::: input parameters :::
+        stage       - 'rotation' (xcorr_rotation), 'aftan' (xcorr_aftan) or 'interp' (interp_disp)
+        ::: output :::
+        pairLst     - list of (staid1, staid2)
+        ==============================================================================
+        """
+        if 'DirtyPairs' not in self.auxiliary_data.list() or stage not in self.auxiliary_data.DirtyPairs.list():
+            return []
+        pairArr     = self.auxiliary_data.DirtyPairs[stage].data.value
+        return [(str(staid1), str(staid2)) for staid1, staid2 in pairArr]
+    
+    def _set_dirty_pairs(self, stage, pairLst):
+        """store the dirty station pairs of a stage, the entry is removed if pairLst is empty
+        """
+        self._del_auxiliary_data(data_type='DirtyPairs', path=stage)
+        if len(pairLst) == 0:
+            return
+        self.add_auxiliary_data(data=np.array(sorted(pairLst), dtype=str), data_type='DirtyPairs', path=stage, parameters={})
+        return
+    
+    def mark_dirty(self, pairLst, stages=['rotation', 'aftan', 'interp']):
+        """mark station pairs dirty, i.e. their inputs of the given stages have been changed
+        ==============================================================================
+        ::: input parameters :::
+        pairLst     - list of (staid1, staid2), staid1 < staid2
+        stages      - stages to be marked
+        ==============================================================================
+        """
+        if len(pairLst) == 0:
+            return
+        for stage in stages:
+            dirtySet    = set(self.get_dirty_pairs(stage))
+            dirtySet.update(pairLst)
+            self._set_dirty_pairs(stage, list(dirtySet))
+        return
+    
+    def clear_dirty(self, stage, pairLst=None):
+        """clear the dirty station pairs of a stage
+        ==============================================================================
+        ::: input parameters :::
+        stage       - stage name
+        pairLst     - list of (staid1, staid2) to be cleared, None for all
+        ==============================================================================
+        """
+        if pairLst is None:
+            self._set_dirty_pairs(stage, [])
+        else:
+            self._set_dirty_pairs(stage, list(set(self.get_dirty_pairs(stage)) - set(pairLst)))
         return
     
+    def _get_stage_pairs(self, data_type, stage, dirty_only=False):
+        """get the station pairs to be processed by a stage from the pair index of the input data type
+            if dirty_only = True, only the dirty pairs of the stage are returned
+        """
+        pairLst     = self.get_pair_index(data_type=data_type)
+        if not dirty_only:
+            return pairLst
+        dirtySet    = set(self.get_dirty_pairs(stage))
+        return [pair for pair in pairLst if (pair[0], pair[1]) in dirtySet]
+    
     def write_stationxml(self, staxml, source='CIEI'):
         """write obspy inventory to StationXML data file
         """
@@ -986,11 +2025,13 @@ class noiseASDF(pyasdf.ASDFDataSet):
                         self.add_auxiliary_data(data=tr.data, data_type='NoiseXcorr', path=staid_aux+'/'+chan1.code+'/'+chan2.code, parameters=xcorr_header)
                 if verbose and not skipflag:
                     print 'reading xcorr data: '+netcode1+'.'+stacode1+'_'+netcode2+'.'+stacode2
+        self.update_pair_index(data_type='NoiseXcorr')
         return
         
     def compute_xcorr(self, datadir, startdate, enddate, chans=['LHZ', 'LHE', 'LHN'], \
             fskipxcorr = 0, ftlen = True, tlen = 84000., mintlen = 20000., sps = 1., lagtime = 3000., CorOutflag = 0, \
-                fprcs = False, fastfft=True, parallel=True, nprocess=None, subsize=1000):
+                fprcs = False, fastfft=True, parallel=True, nprocess=None, subsize=1000, chunksize=None, timeout=None, batch=False, \
+                    blocksize=None, blockmem=500., batchsize=50, cachemem=1000., spectype='complex128'):
         """
         compute ambient noise cross-correlation given preprocessed amplitude and phase files
         =================================================================================================================
@@ -1009,11 +2050,27 @@ class noiseASDF(pyasdf.ASDFDataSet):
         fastfft             - speeding up the computation by using precomputed fftw_plan or not
         parallel            - run the xcorr parallelly or not
         nprocess            - number of processes
-        subsize             - subsize of processing list, use to prevent lock in multiprocessing process
+        subsize             - not used, kept for backward compatibility (tasks are dynamically scheduled by mppool)
+        chunksize           - number of xcorr pairs(blocks) sent to a worker at once, default is decided by mppool.pool_map
+        timeout             - timeout for each xcorr pair(block) in sec, None for no timeout
+        batch               - use the station-major batched engine or not
+                                if True, the station pairs are divided into blocks (station 1 in a row block, station 2
+                                in a column block), spectra of each station-day are read only once per block and
+                                xcorr of all the pairs and channel combinations are computed with batched inverse FFT
+        blocksize           - number of stations in a row/column block (batch = True)
+                                None: determined from blockmem
+        blockmem            - memory budget of one block in each process (in MB, batch = True, blocksize = None)
+                                spectra, monthly stacks and the batched FFT arrays are counted
+        batchsize           - maximum number of station 2 in one batched inverse FFT (batch = True)
+        cachemem            - memory budget of the spectra cache in each process (in MB, batch = False)
+        spectype            - data type of the spectra ('complex64' or 'complex128')
         =================================================================================================================
         """
         stime   = obspy.UTCDateTime(startdate)
         etime   = obspy.UTCDateTime(enddate)
+        # the spectra cached by a previous run (serial) may be outdated if the data were re-processed
+        if _spec_cache is not None:
+            _spec_cache.clear()
         #-------------------------
         # Loop over month
         #-------------------------
@@ -1031,10 +2088,61 @@ class noiseASDF(pyasdf.ASDFDataSet):
                 c_etime = obspy.UTCDateTime(str(stime.year)+'-'+str(stime.month+1)+'-1')
             except ValueError:
                 c_etime = obspy.UTCDateTime(str(stime.year+1)+'-1-1')
+            #----------------------------------------------------------
+            # batched engine, divide station 1 into blocks of pairs
+            #----------------------------------------------------------
+            if batch:
+                stalst      = []
+                for staid in sorted(self.waveforms.list()):
+                    st_date = self.waveforms[staid].StationXML.networks[0].stations[0].start_date
+                    ed_date = self.waveforms[staid].StationXML.networks[0].stations[0].end_date
+                    if st_date > c_etime or ed_date < c_stime:
+                        continue
+                    stalst.append(staid)
+                daylst      = []
+                ctime       = obspy.UTCDateTime(str(stime.year)+'-'+str(stime.month)+'-1')
+                while(True):
+                    daydir  = month_dir+'/'+str(stime.year)+'.'+monthdict[stime.month]+'.'+str(ctime.day)
+                    if os.path.isdir(daydir):
+                        daylst.append(ctime.day)
+                    try:
+                        ctime.day   += 1
+                    except ValueError:
+                        break
+                Nsta        = len(stalst)
+                #--------------------------------------------------------------
+                # block size, determined from the npts of the spectra if not
+                # specified, the header of the first amplitude file is read
+                #--------------------------------------------------------------
+                Namp        = None
+                for day in daylst:
+                    dayfpfx = str(stime.year)+'.'+monthdict[stime.month]+'.'+str(day)
+                    for staid in stalst:
+                        infname = month_dir+'/'+dayfpfx+'/ft_'+dayfpfx+'.'+staid+'.'+chans[0]+'.SAC.am'
+                        if os.path.isfile(infname):
+                            Namp    = obspy.io.sac.SACTrace.read(infname, headonly=True).npts
+                            break
+                    if Namp is not None:
+                        break
+                if Namp is not None and Nsta > 1:
+                    lagN    = int(np.floor(lagtime*sps +0.5))
+                    Nblock, Nbatch  = _get_xcorr_blocksize(blockmem=blockmem, Namp=Namp, chan_size=len(chans), lagN=lagN,\
+                                        spectype=spectype, batchsize=batchsize, CorOutflag=CorOutflag)
+                    if blocksize is not None:
+                        Nblock  = blocksize
+                    # tiles of the upper triangle of the station pair matrix
+                    for irow0 in range(0, Nsta - 1, Nblock):
+                        irow1   = min(irow0 + Nblock, Nsta - 1)
+                        for jcol0 in range(irow0 + 1, Nsta, Nblock):
+                            jcol1   = min(jcol0 + Nblock, Nsta)
+                            xcorr_lst.append(xcorr_block(stalst=stalst, irow0=irow0, irow1=irow1, jcol0=jcol0, jcol1=jcol1,\
+                                monthdir=str(stime.year)+'.'+monthdict[stime.month], daylst=daylst, batchsize=Nbatch))
             #-------------------------
             # Loop over station 1
             #-------------------------
             for staid1 in self.waveforms.list():
+                if batch:
+                    break
                 # determine if the range of the station 1 matches current month
                 st_date1    = self.waveforms[staid1].StationXML.networks[0].stations[0].start_date
                 ed_date1    = self.waveforms[staid1].StationXML.networks[0].stations[0].end_date
@@ -1099,54 +2207,156 @@ class noiseASDF(pyasdf.ASDFDataSet):
             #--------------------------------
             # Cross-correlation computation
             #--------------------------------
-            print '--- Xcorr computating: '+str(stime.year)+'.'+monthdict[stime.month]+' : '+ str(len(xcorr_lst)) + ' pairs'
+            if batch:
+                print '--- Xcorr computating: '+str(stime.year)+'.'+monthdict[stime.month]+' : '+ str(len(xcorr_lst)) + ' blocks'
+            else:
+                print '--- Xcorr computating: '+str(stime.year)+'.'+monthdict[stime.month]+' : '+ str(len(xcorr_lst)) + ' pairs'
             if not parallel:
                 for ilst in range(len(xcorr_lst)):
                     xcorr_lst[ilst].convert_amph_to_xcorr(datadir=datadir, chans=chans, ftlen = ftlen,\
                             tlen = tlen, mintlen = mintlen, sps = sps,  lagtime = lagtime, CorOutflag = CorOutflag,\
-                                fprcs = fprcs, fastfft=fastfft, verbose=False)
+                                fprcs = fprcs, fastfft=fastfft, cachemem=cachemem, spectype=spectype, verbose=False)
             # parallelized run
             else:
                 #-----------------------------------------
                 # Computing xcorr with multiprocessing
                 #-----------------------------------------
-                if len(xcorr_lst) > subsize:
-                    Nsub            = int(len(xcorr_lst)/subsize)
-                    for isub in range(Nsub):
-                        print 'xcorr : subset:', isub, 'in', Nsub, 'sets'
-                        cxcorrLst   = xcorr_lst[isub*subsize:(isub+1)*subsize]
-                        XCORR       = partial(amph_to_xcorr_for_mp, datadir=datadir, chans=chans, ftlen = ftlen,\
-                                        tlen = tlen, mintlen = mintlen, sps = sps,  lagtime = lagtime, CorOutflag = CorOutflag,\
-                                            fprcs = fprcs, fastfft=fastfft)
-                        pool        = multiprocessing.Pool(processes=nprocess)
-                        pool.map(XCORR, cxcorrLst) #make our results with a map call
-                        pool.close() #we are not adding any more processes
-                        pool.join() #tell it to wait until all threads are done before going on
-                    cxcorrLst       = xcorr_lst[(isub+1)*subsize:]
-                    XCORR           = partial(amph_to_xcorr_for_mp, datadir=datadir, chans=chans, ftlen = ftlen,\
-                                        tlen = tlen, mintlen = mintlen, sps = sps,  lagtime = lagtime, CorOutflag = CorOutflag,\
-                                            fprcs = fprcs, fastfft=fastfft)
-                    pool            = multiprocessing.Pool(processes=nprocess)
-                    pool.map(XCORR, cxcorrLst) #make our results with a map call
-                    pool.close() #we are not adding any more processes
-                    pool.join() #tell it to wait until all threads are done before going on
-                else:
-                    XCORR           = partial(amph_to_xcorr_for_mp, datadir=datadir, chans=chans, ftlen = ftlen,\
-                                        tlen = tlen, mintlen = mintlen, sps = sps,  lagtime = lagtime, CorOutflag = CorOutflag,\
-                                            fprcs = fprcs, fastfft=fastfft)
-                    pool            = multiprocessing.Pool(processes=nprocess)
-                    pool.map(XCORR, xcorr_lst) #make our results with a map call
-                    pool.close() #we are not adding any more processes
-                    pool.join() #tell it to wait until all threads are done before going on
+                XCORR           = partial(amph_to_xcorr_for_mp, datadir=datadir, chans=chans, ftlen = ftlen,\
+                                    tlen = tlen, mintlen = mintlen, sps = sps,  lagtime = lagtime, CorOutflag = CorOutflag,\
+                                        fprcs = fprcs, fastfft=fastfft, cachemem=cachemem, spectype=spectype)
+                mppool.pool_map(XCORR, xcorr_lst, nprocess=nprocess, chunksize=chunksize, timeout=timeout)
             print '=== Xcorr computation done: '+str(stime.year)+'.'+monthdict[stime.month]
             if stime.month == 12:
                 stime       = obspy.UTCDateTime(str(stime.year + 1)+'0101')
             else:
                 stime.month += 1
+        # the workers hold the spectra caches, release them
+        if parallel:
+            mppool.close_pool()
+        return
+    
+    def _get_stack_pairs(self, fnametype=1, channels=None):
+        """get the candidate station pairs and channels for stacking
+        ===========================================================================================================
+        ::: input parameters :::
+        fnametype           - input sac file name type (see xcorr_stack)
+        channels            - list of obspy channel objects, if None, will read channel information from obspy inventory
+        ::: output :::
+        staLst, staArr      - station table (see _get_sta_table)
+        ista1Arr, ista2Arr  - station indices of the candidate pairs
+        chanLst             - channel codes of each station
+        ===========================================================================================================
+        """
+        staLst, staArr          = self._get_sta_table()
+        #-------------------------------------------------------------
+        # candidate pairs, station pairs without overlapped time are
+        # excluded beforehand
+        #-------------------------------------------------------------
+        if fnametype == 1:
+            keyArr              = np.array(staLst)
+        else:
+            keyArr              = np.array([staid.split('.')[1] for staid in staLst])
+        st_dateArr              = staArr[:, 2]
+        ed_dateArr              = staArr[:, 3]
+        ista1Arr, ista2Arr      = np.where( (keyArr[:, np.newaxis] < keyArr[np.newaxis, :])\
+                                    * np.logical_not(st_dateArr[:, np.newaxis] > ed_dateArr[np.newaxis, :])\
+                                    * np.logical_not(st_dateArr[np.newaxis, :] > ed_dateArr[:, np.newaxis]) )
+        #-------------------------------------------------------------
+        # channels for stacking of each station
+        #-------------------------------------------------------------
+        chanLst                 = []
+        for staid in staLst:
+            if channels != None:
+                chanLst.append([chan.code for chan in channels])
+                continue
+            channels_sta        = []
+            tempchans           = self.waveforms[staid].StationXML.networks[0].stations[0].channels
+            # get non-repeated component channel list
+            isZ                 = False
+            isN                 = False
+            isE                 = False
+            for tempchan in tempchans:
+                if tempchan.code[-1] == 'Z':
+                    if isZ:
+                        continue
+                    else:
+                        isZ     = True
+                if tempchan.code[-1] == 'N':
+                    if isN:
+                        continue
+                    else:
+                        isN     = True
+                if tempchan.code[-1] == 'E':
+                    if isE:
+                        continue
+                    else:
+                        isE     = True
+                channels_sta.append(tempchan.code)
+            chanLst.append(channels_sta)
+        return staLst, staArr, ista1Arr, ista2Arr, chanLst
+    
+    def _add_xcorr_stack(self, staid1, staid2, chans1, chans2, stackArr, stackday, hdrLst, dist, az, baz, outdir=None, pfx='COR',\
+                months=None):
+        """write the stacked cross-correlations of a station pair to ASDF (and sac files, optional)
+        ===========================================================================================================
+        ::: input parameters :::
+        staid1, staid2      - station ids
+        chans1, chans2      - channel codes of station 1/2
+        stackArr            - stacked data, shape = (len(chans1)*len(chans2), npts)
+        stackday            - stacked days, shape = (len(chans1)*len(chans2), )
+        hdrLst              - raw SAC headers of the first stacked month
+        dist, az, baz       - inter-station distance (km), azimuth and back-azimuth
+        outdir              - output directory (None is not to save sac files)
+        pfx                 - prefix
+        months              - stacked months (year*100 + month), stored in the stack manifest if not None
+        ===========================================================================================================
+        """
+        netcode1, stacode1          = staid1.split('.')
+        netcode2, stacode2          = staid2.split('.')
+        if outdir != None:
+            if not os.path.isdir(outdir+'/'+pfx+'/'+staid1):
+                os.makedirs(outdir+'/'+pfx+'/'+staid1)
+        # write cross-correlation header information
+        sac_header                  = _get_sac_header(hdrLst[0])
+        xcorr_header                = xcorr_header_default.copy()
+        xcorr_header['b']           = sac_header['b']
+        xcorr_header['e']           = sac_header['e']
+        xcorr_header['netcode1']    = netcode1
+        xcorr_header['netcode2']    = netcode2
+        xcorr_header['stacode1']    = stacode1
+        xcorr_header['stacode2']    = stacode2
+        xcorr_header['npts']        = sac_header['npts']
+        xcorr_header['delta']       = sac_header['delta']
+        xcorr_header['stackday']    = float(stackday[0])
+        xcorr_header['dist']        = dist
+        xcorr_header['az']          = az
+        xcorr_header['baz']         = baz
+        if staid1 > staid2:
+            staid_aux               = netcode2+'/'+stacode2+'/'+netcode1+'/'+stacode1
+        else:
+            staid_aux               = netcode1+'/'+stacode1+'/'+netcode2+'/'+stacode2
+        itrace                      = 0
+        for chan1 in chans1:
+            for chan2 in chans2:
+                if outdir != None:
+                    outfname        = outdir+'/'+pfx+'/'+staid1+'/'+ pfx+'_'+staid1+'_'+chan1+'_'+staid2+'_'+chan2+'.SAC'
+                    _write_sac_raw(outfname, hdrLst[itrace], stackArr[itrace], stackday[itrace])
+                xcorr_header['chan1']       = chan1
+                xcorr_header['chan2']       = chan2
+                # check channels
+                kcmpnm              = _get_sac_header(hdrLst[itrace])['kcmpnm']
+                if kcmpnm != None:
+                    if kcmpnm != chan1 + chan2:
+                        raise ValueError('Inconsistent channels: '+ kcmpnm+' '+ chan1+' '+ chan2)
+                self.add_auxiliary_data(data=stackArr[itrace], data_type='NoiseXcorr',\
+                                        path=staid_aux+'/'+chan1+'/'+chan2, parameters=xcorr_header)
+                itrace              += 1
+        if months is not None:
+            self._set_stack_manifest(staid1, staid2, months)
         return
     
     def xcorr_stack(self, datadir, startyear, startmonth, endyear, endmonth, pfx='COR', outdir=None, \
-                inchannels=None, fnametype=1, verbose=False):
+                inchannels=None, fnametype=1, use_mmap=False, verbose=False):
         """Stack cross-correlation data from monthly-stacked sac files
         ===========================================================================================================
         ::: input parameters :::
@@ -1160,6 +2370,7 @@ class noiseASDF(pyasdf.ASDFDataSet):
                                     =1: datadir/2011.JAN/COR/TA.G12A/COR_TA.G12A_BHZ_TA.R21A_BHZ.SAC
                                     =2: datadir/2011.JAN/COR/G12A/COR_G12A_R21A.SAC
                                     =3: datadir/2011.JAN/COR/G12A/COR_G12A_BHZ_R21A_BHZ.SAC, deprecated
+        use_mmap                - memory-map the monthly sac files or not
         -----------------------------------------------------------------------------------------------------------
         ::: output :::
         ASDF path           : self.auxiliary_data.NoiseXcorr[netcode1][stacode1][netcode2][stacode2][chan1][chan2]
@@ -1189,240 +2400,74 @@ class noiseASDF(pyasdf.ASDFDataSet):
             try:
                 if not isinstance(inchannels[0], obspy.core.inventory.channel.Channel):
                     channels    = []
-                    for inchan in inchannels:
-                        channels.append(obspy.core.inventory.channel.Channel(code=inchan, location_code='',
-                                        latitude=0, longitude=0, elevation=0, depth=0) )
-                else:
-                    channels    = inchannels
-            except:
-                inchannels      = None
-        if inchannels != None:
-            chan_str_for_print      = ''
-            for chan in channels:
-                chan_str_for_print  += chan.code+' '
-            print '--- channels for stacking : '+ chan_str_for_print
-        #--------------------------------------------------
-        # main loop for station pairs
-        #--------------------------------------------------
-        staLst                  = self.waveforms.list()
-        Nsta                    = len(staLst)
-        Ntotal_traces           = Nsta*(Nsta-1)/2
-        itrstack                = 0
-        Ntr_one_percent         = int(Ntotal_traces/100.)
-        ipercent                = 0
-        print '--- start stacking: '+str(Ntotal_traces)+' pairs'
-        for staid1 in staLst:
-            netcode1, stacode1  = staid1.split('.')
-            st_date1            = self.waveforms[staid1].StationXML.networks[0].stations[0].start_date
-            ed_date1            = self.waveforms[staid1].StationXML.networks[0].stations[0].end_date
-            lon1                = self.waveforms[staid1].StationXML.networks[0].stations[0].longitude
-            lat1                = self.waveforms[staid1].StationXML.networks[0].stations[0].latitude
-            for staid2 in staLst:
-                netcode2, stacode2  = staid2.split('.')
-                st_date2            = self.waveforms[staid2].StationXML.networks[0].stations[0].start_date
-                ed_date2            = self.waveforms[staid2].StationXML.networks[0].stations[0].end_date
-                lon2                = self.waveforms[staid2].StationXML.networks[0].stations[0].longitude
-                lat2                = self.waveforms[staid2].StationXML.networks[0].stations[0].latitude
-                if fnametype == 1:
-                    if staid1 >= staid2:
-                        continue
-                else:
-                    if stacode1 >= stacode2:
-                        continue
-                itrstack            += 1
-                # print the status of stacking
-                ipercent            = float(itrstack)/float(Ntotal_traces)*100.
-                if np.fmod(itrstack, 500) == 0 or np.fmod(itrstack, Ntr_one_percent) ==0:
-                    percent_str     = '%0.2f' %ipercent
-                    print '*** Number of traces finished stacking: '+str(itrstack)+'/'+str(Ntotal_traces)+' '+percent_str+'%'
-                # skip if no overlaped time
-                if st_date1 > ed_date2 or st_date2 > ed_date1:
-                    continue
-                stackedST           = []
-                init_stack_flag     = False
-                #-------------------------------------------------------------
-                # determin channels for stacking if not specified beforehand
-                #-------------------------------------------------------------
-                if inchannels == None:
-                    channels1       = []
-                    channels2       = []
-                    tempchans1      = self.waveforms[staid1].StationXML.networks[0].stations[0].channels
-                    tempchans2      = self.waveforms[staid2].StationXML.networks[0].stations[0].channels
-                    # get non-repeated component channel list
-                    isZ             = False
-                    isN             = False
-                    isE             = False
-                    for tempchan in tempchans1:
-                        if tempchan.code[-1] == 'Z':
-                            if isZ:
-                                continue
-                            else:
-                                isZ         = True
-                        if tempchan.code[-1] == 'N':
-                            if isN:
-                                continue
-                            else:
-                                isN         = True
-                        if tempchan.code[-1] == 'E':
-                            if isE:
-                                continue
-                            else:
-                                isE         = True
-                        channels1.append(tempchan)
-                    isZ             = False
-                    isN             = False
-                    isE             = False
-                    for tempchan in tempchans2:
-                        if tempchan.code[-1] == 'Z':
-                            if isZ:
-                                continue
-                            else:
-                                isZ         = True
-                        if tempchan.code[-1] == 'N':
-                            if isN:
-                                continue
-                            else:
-                                isN         = True
-                        if tempchan.code[-1] == 'E':
-                            if isE:
-                                continue
-                            else:
-                                isE         = True
-                        channels2.append(tempchan)
-                else:
-                    channels1       = channels
-                    channels2       = channels
-                #--------------------------------
-                # Loop over month for stacking
-                #--------------------------------
-                for im in range(mnumb):
-                    month           = monthdict[mlst[im]]
-                    yrmonth         = str(ylst[im])+'.'+month
-                    if fnametype == 1:
-                        subdir      = datadir+'/'+yrmonth+'/'+pfx+'/'+staid1
-                    else:
-                        subdir      = datadir+'/'+yrmonth+'/'+pfx+'/'+stacode1
-                    if not os.path.isdir(subdir):
-                        continue
-                    # define the first day and last day of the current month
-                    c_stime     = obspy.UTCDateTime(str(ylst[im])+'-'+str(mlst[im])+'-1')
-                    try:
-                        c_etime = obspy.UTCDateTime(str(ylst[im])+'-'+str(mlst[im]+1)+'-1')
-                    except ValueError:
-                        c_etime = obspy.UTCDateTime(str(ylst[im]+1)+'-1-1')
-                    # skip if either of the stations out of time range
-                    if st_date1 > c_etime or ed_date1 < c_stime or \
-                        st_date2 > c_etime or ed_date2 < c_stime:
-                        continue 
-                    skip_this_month = False
-                    cST             = []
-                    for chan1 in channels1:
-                        if skip_this_month:
-                            break
-                        for chan2 in channels2:
-                            if fnametype    == 1:
-                                fname   = datadir+'/'+yrmonth+'/'+pfx+'/'+staid1+'/'+pfx+'_'+staid1+'_'+chan1.code+'_'\
-                                            +staid2+'_'+chan2.code+'.SAC'
-                            elif fnametype  == 2:
-                                fname   = datadir+'/'+yrmonth+'/'+pfx+'/'+stacode1+'/'+pfx+'_'+stacode1+'_'+stacode2+'.SAC'
-                            #----------------------------------------------------------
-                            elif fnametype  == 3:
-                                fname   = ''
-                                # fname   = datadir+'/'+yrmonth+'/'+pfx+'/'+stacode1+'/'+pfx+'_'+stacode1+'_'+chan1.code+'_'\
-                                #             +stacode2+'_'+chan2.code+'.SAC'
-                            #----------------------------------------------------------
-                            if not os.path.isfile(fname):
-                                skip_this_month = True
-                                break
-                            try:
-                                # I/O through obspy.io.sac.SACTrace.read() is ~ 10 times faster than obspy.read()
-                                tr              = obspy.io.sac.SACTrace.read(fname)
-                            except TypeError:
-                                warnings.warn('Unable to read SAC for: ' + staid1 +'_'+staid2 +' Month: '+yrmonth, UserWarning, stacklevel=1)
-                                skip_this_month = True
-                                break
-                            # added on 2018-02-27
-                            # # # if (abs(tr.stats.sac.evlo - lon1) > 0.001)\
-                            # # #         or (abs(tr.stats.sac.evla - lat1) > 0.001) \
-                            # # #         or (abs(tr.stats.sac.stlo - lon2) > 0.001) \
-                            # # #         or (abs(tr.stats.sac.stla - lat2) > 0.001):
-                            # # #     print 'WARNING: Same station code but different locations detected ' + staid1 +'_'+ staid2
-                            # # #     print 'FILENAME: '+ fname
-                            # # #     skipflag= True
-                            # # #     break
-                            if (np.isnan(tr.data)).any() or abs(tr.data.max())>1e20:
-                                warnings.warn('NaN monthly SAC for: ' + staid1 +'_'+staid2 +' Month: '+yrmonth, UserWarning, stacklevel=1)
-                                skip_this_month = True
-                                break
-                            cST.append(tr)
-                    if len(cST) != (len(channels1)*len(channels2)) or skip_this_month:
-                        continue
-                    # stacking
-                    if init_stack_flag:
-                        for itr in range(len(cST)):
-                            mtr                             = cST[itr]
-                            stackedST[itr].data             += mtr.data
-                            stackedST[itr].user0            += mtr.user0
-                    else:
-                        stackedST                           = copy.deepcopy(cST)
-                        init_stack_flag                     = True
-                #------------------------------------------------------------
-                # finish stacking for a statin pair, save data
-                #------------------------------------------------------------
-                if len(stackedST) == (len(channels1)*len(channels2)):
-                    if verbose:
-                        print('Finished stacking for:'+netcode1+'.'+stacode1+'_'+netcode2+'.'+stacode2)
-                    # create sac output directory 
-                    if outdir != None:
-                        if not os.path.isdir(outdir+'/'+pfx+'/'+netcode1+'.'+stacode1):
-                            os.makedirs(outdir+'/'+pfx+'/'+netcode1+'.'+stacode1)
-                    # write cross-correlation header information
-                    xcorr_header            = xcorr_header_default.copy()
-                    xcorr_header['b']       = stackedST[0].b
-                    xcorr_header['e']       = stackedST[0].e
-                    xcorr_header['netcode1']= netcode1
-                    xcorr_header['netcode2']= netcode2
-                    xcorr_header['stacode1']= stacode1
-                    xcorr_header['stacode2']= stacode2
-                    xcorr_header['npts']    = stackedST[0].npts
-                    xcorr_header['delta']   = stackedST[0].delta
-                    xcorr_header['stackday']= stackedST[0].user0
-                    dist, az, baz           = obspy.geodetics.gps2dist_azimuth(lat1, lon1, lat2, lon2)
-                    dist                    = dist/1000.
-                    xcorr_header['dist']    = dist
-                    xcorr_header['az']      = az
-                    xcorr_header['baz']     = baz
-                    if staid1 > staid2:
-                        staid_aux           = netcode2+'/'+stacode2+'/'+netcode1+'/'+stacode1
-                    else:
-                        staid_aux           = netcode1+'/'+stacode1+'/'+netcode2+'/'+stacode2
-                    itrace                  = 0
-                    for chan1 in channels1:
-                        for chan2 in channels2:
-                            stackedTr       = stackedST[itrace]
-                            if outdir != None:
-                                outfname            = outdir+'/'+pfx+'/'+netcode1+'.'+stacode1+'/'+ pfx+'_'+netcode1+'.'+stacode1+\
-                                                        '_'+chan1.code+'_'+netcode2+'.'+stacode2+'_'+chan2.code+'.SAC'
-                                stackedTr.write(outfname)
-                            xcorr_header['chan1']   = chan1.code
-                            xcorr_header['chan2']   = chan2.code
-                            # check channels
-                            if stackedST[itrace].kcmpnm != None:
-                                if stackedST[itrace].kcmpnm != xcorr_header['chan1'] + xcorr_header['chan2']:
-                                    raise ValueError('Inconsistent channels: '+ stackedST[itrace].kcmpnm+' '+\
-                                                xcorr_header['chan1']+' '+ xcorr_header['chan2'])
-                            self.add_auxiliary_data(data=stackedTr.data, data_type='NoiseXcorr',\
-                                                    path=staid_aux+'/'+chan1.code+'/'+chan2.code, parameters=xcorr_header)
-                            itrace                  += 1
+                    for inchan in inchannels:
+                        channels.append(obspy.core.inventory.channel.Channel(code=inchan, location_code='',
+                                        latitude=0, longitude=0, elevation=0, depth=0) )
+                else:
+                    channels    = inchannels
+            except:
+                inchannels      = None
+        if inchannels != None:
+            chan_str_for_print      = ''
+            for chan in channels:
+                chan_str_for_print  += chan.code+' '
+            print '--- channels for stacking : '+ chan_str_for_print
+        #--------------------------------------------------
+        # main loop for station pairs
+        #--------------------------------------------------
+        if inchannels == None:
+            channels            = None
+        staLst, staArr, ista1Arr, ista2Arr, chanLst\
+                                = self._get_stack_pairs(fnametype=fnametype, channels=channels)
+        Nsta                    = len(staLst)
+        Ntotal_traces           = ista1Arr.size
+        itrstack                = 0
+        Ntr_one_percent         = max(1, int(Ntotal_traces/100.))
+        ipercent                = 0
+        print '--- start stacking: '+str(Ntotal_traces)+' pairs (with overlapped time), '+str(Nsta*(Nsta-1)/2)+' pairs in total'
+        for ipair in range(Ntotal_traces):
+            ista1               = ista1Arr[ipair]
+            ista2               = ista2Arr[ipair]
+            staid1              = staLst[ista1]
+            staid2              = staLst[ista2]
+            itrstack            += 1
+            # print the status of stacking
+            ipercent            = float(itrstack)/float(Ntotal_traces)*100.
+            if np.fmod(itrstack, 500) == 0 or np.fmod(itrstack, Ntr_one_percent) ==0:
+                percent_str     = '%0.2f' %ipercent
+                print '*** Number of traces finished stacking: '+str(itrstack)+'/'+str(Ntotal_traces)+' '+percent_str+'%'
+            chans1              = chanLst[ista1]
+            chans2              = chanLst[ista2]
+            #--------------------------------
+            # stacking over months
+            #--------------------------------
+            fnameLst, monthLst  = _get_stack_fnames(datadir=datadir, ylst=ylst, mlst=mlst, pfx=pfx, fnametype=fnametype,\
+                                    staid1=staid1, staid2=staid2, chans1=chans1, chans2=chans2,\
+                                    date1=staArr[ista1, 2:], date2=staArr[ista2, 2:])
+            stackArr, stackday, hdrLst, istackLst\
+                                = _stack_monthly_sac(fnameLst, use_mmap=use_mmap, label=staid1+'_'+staid2)
+            #------------------------------------------------------------
+            # finish stacking for a statin pair, save data
+            #------------------------------------------------------------
+            if stackArr is None:
+                continue
+            if verbose:
+                print('Finished stacking for:'+staid1+'_'+staid2)
+            dist, az, baz       = obspy.geodetics.gps2dist_azimuth(staArr[ista1, 1], staArr[ista1, 0], staArr[ista2, 1], staArr[ista2, 0])
+            self._add_xcorr_stack(staid1=staid1, staid2=staid2, chans1=chans1, chans2=chans2, stackArr=stackArr,\
+                    stackday=stackday, hdrLst=hdrLst, dist=dist/1000., az=az, baz=baz, outdir=outdir, pfx=pfx,\
+                    months=[monthLst[i] for i in istackLst])
+        self.update_pair_index(data_type='NoiseXcorr')
         return
     
     def xcorr_stack_mp(self, datadir, outdir, startyear, startmonth, endyear, endmonth, pfx='COR', inchannels=None,\
-                       fnametype=1, do_compute = True, subsize=1000, deletesac=False, nprocess=10):
+                       fnametype=1, do_compute = True, subsize=1000, deletesac=False, nprocess=10, chunksize=None, timeout=None,\
+                       use_mmap=False):
         """Stack cross-correlation data from monthly-stacked sac files with multiprocessing
         ===========================================================================================================
         ::: input parameters :::
         datadir                 - data directory
-        outdir                  - output directory 
+        outdir                  - output directory (None is not to save sac files)
         startyear, startmonth   - start date for stacking
         endyear, endmonth       - end date for stacking
         pfx                     - prefix
@@ -1431,9 +2476,15 @@ class noiseASDF(pyasdf.ASDFDataSet):
                                     =1: datadir/2011.JAN/COR/TA.G12A/COR_TA.G12A_BHZ_TA.R21A_BHZ.SAC
                                     =2: datadir/2011.JAN/COR/G12A/COR_G12A_R21A.SAC
                                     =3: datadir/2011.JAN/COR/G12A/COR_G12A_BHZ_R21A_BHZ.SAC
-        subsize                 - subsize of processing list, use to prevent lock in multiprocessing process
+        do_compute              - stack the monthly sac files or not
+                                    if False, the stacked sac files in outdir will be read into ASDF
+        subsize                 - number of station pairs in a subset, stacked data of a subset are kept
+                                    in memory and written to ASDF together
         deletesac               - delete output sac files
         nprocess                - number of processes
+        chunksize               - number of station pairs sent to a worker at once, default is decided by mppool.pool_map
+        timeout                 - timeout for each station pair in sec, None for no timeout
+        use_mmap                - memory-map the monthly sac files or not
         -----------------------------------------------------------------------------------------------------------
         ::: output :::
         ASDF path           : self.auxiliary_data.NoiseXcorr[netcode1][stacode1][netcode2][stacode2][chan1][chan2]
@@ -1476,138 +2527,71 @@ class noiseASDF(pyasdf.ASDFDataSet):
                 chan_str_for_print  += chan.code+' '
             print '--- channels for stacking : '+ chan_str_for_print
         #--------------------------------------------------
-        # main loop for station pairs
+        # candidate station pairs
         #--------------------------------------------------
         print '--- Preparing station pair list for stacking'
-        staLst                  = self.waveforms.list()
-        stapairInvLst           = []
-        Nsta                    = len(staLst)
-        Ntotal_traces           = Nsta*(Nsta-1)/2
-        itrstack                = 0
-        Ntr_one_percent         = int(Ntotal_traces/100.)
-        for staid1 in staLst:
-            if not os.path.isdir(outdir+'/'+pfx+'/'+staid1):
-                os.makedirs(outdir+'/'+pfx+'/'+staid1)
-            for staid2 in staLst:
-                netcode1, stacode1  = staid1.split('.')
-                netcode2, stacode2  = staid2.split('.')
-                if fnametype == 1:
-                    if staid1 >= staid2:
-                        continue
-                else:
-                    if stacode1 >= stacode2:
-                        continue
-                itrstack            += 1
-                ipercent            = float(itrstack)/float(Ntotal_traces)*100.
-                if np.fmod(itrstack, Ntr_one_percent) ==0:
-                    percent_str     = '%1.0f' %ipercent
-                    print '*** Number of traces finished preparing: '+str(itrstack)+'/'+str(Ntotal_traces)+' '+percent_str+'%'
-                inv1                = self.waveforms[staid1].StationXML
-                inv2                = self.waveforms[staid2].StationXML
-                if inchannels != None:
-                    inv1.networks[0].stations[0].channels   = channels
-                    inv2.networks[0].stations[0].channels   = channels
-                stapairInvLst.append([inv1, inv2]) 
-        #------------------------------------------------------
-        # Stacking with multiprocessing
-        #------------------------------------------------------
-        if do_compute:
-            print('Start multiprocessing stacking !')
-            if len(stapairInvLst) > subsize:
-                Nsub            = int(len(stapairInvLst)/subsize)
-                for isub in range(Nsub):
-                    print 'xcorr stacking : ', isub,'in',Nsub
-                    cstapairs   = stapairInvLst[isub*subsize:(isub+1)*subsize]
-                    STACKING    = partial(stack4mp, datadir=datadir, outdir=outdir, ylst=ylst, mlst=mlst, pfx=pfx, fnametype=fnametype)
-                    pool        = multiprocessing.Pool(processes=nprocess)
-                    pool.map(STACKING, cstapairs) #make our results with a map call
-                    pool.close() #we are not adding any more processes
-                    pool.join() #tell it to wait until all threads are done before going on
-                cstapairs       = stapairInvLst[(isub+1)*subsize:]
-                STACKING        = partial(stack4mp, datadir=datadir, outdir=outdir, ylst=ylst, mlst=mlst, pfx=pfx, fnametype=fnametype)
-                pool            = multiprocessing.Pool(processes=nprocess)
-                pool.map(STACKING, cstapairs) 
-                pool.close() 
-                pool.join() 
+        if inchannels == None:
+            channels            = None
+        staLst, staArr, ista1Arr, ista2Arr, chanLst\
+                                = self._get_stack_pairs(fnametype=fnametype, channels=channels)
+        Ntotal_traces           = ista1Arr.size
+        stapairLst              = []
+        for ipair in range(Ntotal_traces):
+            ista1               = ista1Arr[ipair]
+            ista2               = ista2Arr[ipair]
+            stapairLst.append((staLst[ista1], staLst[ista2], chanLst[ista1], chanLst[ista2], staArr[ista1, 2:], staArr[ista2, 2:]))
+        if not do_compute and outdir == None:
+            raise ValueError('outdir must be specified if do_compute = False!')
+        #------------------------------------------------------------------
+        # Stacking with multiprocessing, the stacked data are returned
+        # from workers and written to ASDF for each subset of station pairs
+        #------------------------------------------------------------------
+        print('Start multiprocessing stacking !')
+        STACKING                = partial(stack4mp, datadir=datadir, ylst=ylst, mlst=mlst, pfx=pfx, fnametype=fnametype,\
+                                    use_mmap=use_mmap)
+        Nsub                    = int(np.ceil(float(Ntotal_traces)/subsize))
+        for isub in range(Nsub):
+            print '--- subset: '+str(isub+1)+'/'+str(Nsub)
+            cstapairLst         = stapairLst[isub*subsize:(isub+1)*subsize]
+            if do_compute:
+                resultLst       = mppool.pool_map(STACKING, cstapairLst, nprocess=nprocess, chunksize=chunksize, timeout=timeout)
             else:
-                STACKING        = partial(stack4mp, datadir=datadir, outdir=outdir, ylst=ylst, mlst=mlst, pfx=pfx, fnametype=fnametype)
-                pool            = multiprocessing.Pool(processes=nprocess)
-                pool.map(STACKING, stapairInvLst) 
-                pool.close() 
-                pool.join() 
-            print('End of multiprocessing stacking !')
-        #------------------------------------------------------
-        # read stacked data
-        #------------------------------------------------------
-        print('Reading data into ASDF database')
-        itrstack                    = 0
-        for invpair in stapairInvLst:
-            # station 1
-            channels1               = invpair[0].networks[0].stations[0].channels
-            netcode1                = invpair[0].networks[0].code
-            stacode1                = invpair[0].networks[0].stations[0].code
-            # station 2
-            channels2               = invpair[1].networks[0].stations[0].channels
-            netcode2                = invpair[1].networks[0].code
-            stacode2                = invpair[1].networks[0].stations[0].code
-            skipflag                = False
-            xcorr_header            = xcorr_header_default.copy()
-            xcorr_header['netcode1']= netcode1
-            xcorr_header['netcode2']= netcode2
-            xcorr_header['stacode1']= stacode1
-            xcorr_header['stacode2']= stacode2
-            if staid1 > staid2:
-                staid_aux           = netcode2+'/'+stacode2+'/'+netcode1+'/'+stacode1
-            else:
-                staid_aux           = netcode1+'/'+stacode1+'/'+netcode2+'/'+stacode2
-            itrstack                += 1
-            ipercent                = float(itrstack)/float(Ntotal_traces)*100.
-            if np.fmod(itrstack, Ntr_one_percent) ==0:
-                percent_str         = '%0.1f' %ipercent
-                print '*** Number of traces finished preparing: '+str(itrstack)+'/'+str(Ntotal_traces)+' '+percent_str+'%'
-            for chan1 in channels1:
-                if skipflag:
-                    break
-                for chan2 in channels2:
-                    sacfname        = outdir+'/'+pfx+'/'+netcode1+'.'+stacode1+'/'+ \
-                                        pfx+'_'+netcode1+'.'+stacode1+'_'+chan1.code+'_'+netcode2+'.'+stacode2+'_'+chan2.code+'.SAC'
-                    try:
-                        tr                      = obspy.read(sacfname)[0]
-                        # cross-correlation header 
-                        xcorr_header['b']       = tr.stats.sac.b
-                        xcorr_header['e']       = tr.stats.sac.e
-                        xcorr_header['npts']    = tr.stats.npts
-                        xcorr_header['delta']   = tr.stats.delta
-                        xcorr_header['stackday']= tr.stats.sac.user0
-                        try:
-                            xcorr_header['dist']= tr.stats.sac.dist
-                            xcorr_header['az']  = tr.stats.sac.az
-                            xcorr_header['baz'] = tr.stats.sac.baz
-                        except AttributeError:
-                            lon1                = invpair[0].networks[0].stations[0].longitude
-                            lat1                = invpair[0].networks[0].stations[0].latitude
-                            lon2                = invpair[1].networks[0].stations[0].longitude
-                            lat2                = invpair[1].networks[0].stations[0].latitude
-                            dist, az, baz       = obspy.geodetics.gps2dist_azimuth(lat1, lon1, lat2, lon2)
-                            dist                = dist/1000.
-                            xcorr_header['dist']= dist
-                            xcorr_header['az']  = az
-                            xcorr_header['baz'] = baz
-                        xcorr_header['chan1']   = chan1.code
-                        xcorr_header['chan2']   = chan2.code
-                        self.add_auxiliary_data(data=tr.data, data_type='NoiseXcorr', \
-                                        path=staid_aux+'/'+chan1.code+'/'+chan2.code, parameters=xcorr_header)
-                    except IOError:
-                        skipflag                = True
-                        break
-        if deletesac:
+                # read the stacked sac files from outdir
+                resultLst       = []
+                for staid1, staid2, chans1, chans2, date1, date2 in cstapairLst:
+                    fnames      = []
+                    for chan1 in chans1:
+                        for chan2 in chans2:
+                            fnames.append(outdir+'/'+pfx+'/'+staid1+'/'+pfx+'_'+staid1+'_'+chan1+'_'+staid2+'_'+chan2+'.SAC')
+                    # stacked months are unknown for existing sac files
+                    resultLst.append(_stack_monthly_sac([fnames], use_mmap=use_mmap, label=staid1+'_'+staid2)[:3] + (None,))
+            for ipair in range(len(cstapairLst)):
+                if resultLst[ipair] is None:
+                    continue
+                stackArr, stackday, hdrLst, months\
+                                = resultLst[ipair]
+                if stackArr is None:
+                    continue
+                staid1, staid2, chans1, chans2, date1, date2\
+                                = cstapairLst[ipair]
+                ista1           = ista1Arr[isub*subsize+ipair]
+                ista2           = ista2Arr[isub*subsize+ipair]
+                dist, az, baz   = obspy.geodetics.gps2dist_azimuth(staArr[ista1, 1], staArr[ista1, 0], staArr[ista2, 1], staArr[ista2, 0])
+                self._add_xcorr_stack(staid1=staid1, staid2=staid2, chans1=chans1, chans2=chans2, stackArr=stackArr,\
+                        stackday=stackday, hdrLst=hdrLst, dist=dist/1000., az=az, baz=baz,\
+                        outdir=(outdir if do_compute else None), pfx=pfx, months=months)
+        if do_compute:
+            mppool.close_pool()
+        print('End of multiprocessing stacking !')
+        self.update_pair_index(data_type='NoiseXcorr')
+        if deletesac and outdir != None and os.path.isdir(outdir+'/'+pfx):
             shutil.rmtree(outdir+'/'+pfx)
-        print('End reading data into ASDF database')
         return
                     
     def xcorr_append(self, inasdffname, datadir, startyear, startmonth, endyear, endmonth,\
                         pfx='COR', outdir=None, inchannels=None, fnametype=1, verbose=False):
         """Append cross-correlation data from monthly-stacked sac files to an existing ASDF database
+            (the whole input database is copied, see xcorr_append_incremental for appending in place)
         ===========================================================================================================
         ::: input parameters :::
         inasdffname             - input ASDF file name
@@ -1916,181 +2900,337 @@ class noiseASDF(pyasdf.ASDFDataSet):
                                 xcorr_data          = indata.data.value
                                 self.add_auxiliary_data(data=xcorr_data, data_type='NoiseXcorr', \
                                             path=staid_aux+'/'+chan1.code+'/'+chan2.code, parameters=xcorr_header)
+        self.update_pair_index(data_type='NoiseXcorr')
+        return
+    
+    def xcorr_append_incremental(self, datadir, startyear, startmonth, endyear, endmonth, pfx='COR', inchannels=None,\
+                fnametype=1, use_mmap=False, verbose=False):
+        """Incrementally append cross-correlation data from monthly-stacked sac files to the database itself
+            only the months not recorded in the stack manifest are read, stacks and stacked days are updated in place
+            and the updated/new station pairs are marked dirty for xcorr_rotation, xcorr_aftan and interp_disp
+            the stacks are equal to those of a full re-stack within float32 rounding (the summation order differs)
+        ===========================================================================================================
+        ::: input parameters :::
+        datadir                 - data directory
+        startyear, startmonth   - start date for appending
+        endyear, endmonth       - end date for appending
+        pfx                     - prefix
+        inchannels              - input channels, if None, will read channel information from obspy inventory
+        fnametype               - input sac file name type
+                                    =1: datadir/2011.JAN/COR/TA.G12A/COR_TA.G12A_BHZ_TA.R21A_BHZ.SAC
+                                    =2: datadir/2011.JAN/COR/G12A/COR_G12A_R21A.SAC
+                                    =3: datadir/2011.JAN/COR/G12A/COR_G12A_BHZ_R21A_BHZ.SAC
+        use_mmap                - memory-map the monthly sac files or not
+        -----------------------------------------------------------------------------------------------------------
+        ::: output :::
+        ASDF path           : self.auxiliary_data.NoiseXcorr[netcode1][stacode1][netcode2][stacode2][chan1][chan2]
+        stack manifest      : self.auxiliary_data.StackManifest[netcode1][stacode1][netcode2][stacode2]
+        dirty pairs         : self.auxiliary_data.DirtyPairs[stage]
+        ===========================================================================================================
+        """
+        #----------------------------------------
+        # prepare year/month list for appending
+        #----------------------------------------
+        print('=== preparing month list for appending')
+        utcdate                 = obspy.core.utcdatetime.UTCDateTime(startyear, startmonth, 1)
+        ylst                    = np.array([], dtype=int)
+        mlst                    = np.array([], dtype=int)
+        while (utcdate.year<endyear or (utcdate.year<=endyear and utcdate.month<=endmonth) ):
+            ylst                = np.append(ylst, utcdate.year)
+            mlst                = np.append(mlst, utcdate.month)
+            try:
+                utcdate.month   +=1
+            except ValueError:
+                utcdate.year    +=1
+                utcdate.month   = 1
+        #--------------------------------------------------
+        # determine channels if inchannels is specified
+        #--------------------------------------------------
+        if inchannels != None:
+            try:
+                if not isinstance(inchannels[0], obspy.core.inventory.channel.Channel):
+                    channels    = []
+                    for inchan in inchannels:
+                        channels.append(obspy.core.inventory.channel.Channel(code=inchan, location_code='',
+                                        latitude=0, longitude=0, elevation=0, depth=0) )
+                else:
+                    channels    = inchannels
+            except:
+                inchannels      = None
+        if inchannels == None:
+            channels            = None
+        staLst, staArr, ista1Arr, ista2Arr, chanLst\
+                                = self._get_stack_pairs(fnametype=fnametype, channels=channels)
+        pairSet                 = set([(pair[0], pair[1]) for pair in self.get_pair_index(data_type='NoiseXcorr')])
+        Ntotal_traces           = ista1Arr.size
+        Ntr_one_percent         = max(1, int(Ntotal_traces/100.))
+        Nnew                    = 0
+        Nupdate                 = 0
+        Nlegacy                 = 0
+        dirtyLst                = []
+        print '--- start appending: '+str(Ntotal_traces)+' pairs'
+        for ipair in range(Ntotal_traces):
+            ista1               = ista1Arr[ipair]
+            ista2               = ista2Arr[ipair]
+            staid1              = staLst[ista1]
+            staid2              = staLst[ista2]
+            chans1              = chanLst[ista1]
+            chans2              = chanLst[ista2]
+            if np.fmod(ipair+1, Ntr_one_percent) ==0:
+                print '*** Number of traces finished appending: '+str(ipair+1)+'/'+str(Ntotal_traces)
+            fnameLst, monthLst  = _get_stack_fnames(datadir=datadir, ylst=ylst, mlst=mlst, pfx=pfx, fnametype=fnametype,\
+                                    staid1=staid1, staid2=staid2, chans1=chans1, chans2=chans2,\
+                                    date1=staArr[ista1, 2:], date2=staArr[ista2, 2:])
+            if staid1 > staid2:
+                pairkey         = (staid2, staid1)
+            else:
+                pairkey         = (staid1, staid2)
+            #---------------------------------------------------
+            # months already in the stack are excluded
+            #---------------------------------------------------
+            is_exist            = pairkey in pairSet
+            if is_exist:
+                manifest        = self.get_stack_manifest(staid1, staid2)
+                if manifest is None:
+                    Nlegacy     += 1
+                    continue
+                stacked_months  = set(manifest)
+                inewLst         = [i for i in range(len(monthLst)) if not (monthLst[i] in stacked_months)]
+                fnameLst        = [fnameLst[i] for i in inewLst]
+                monthLst        = [monthLst[i] for i in inewLst]
+            if len(fnameLst) == 0:
+                continue
+            stackArr, stackday, hdrLst, istackLst\
+                                = _stack_monthly_sac(fnameLst, use_mmap=use_mmap, label=staid1+'_'+staid2)
+            if stackArr is None:
+                continue
+            months              = [monthLst[i] for i in istackLst]
+            if is_exist:
+                #---------------------------------------------------
+                # update the stack and stacked days in place
+                #---------------------------------------------------
+                netcode1, stacode1  = pairkey[0].split('.')
+                netcode2, stacode2  = pairkey[1].split('.')
+                dsetLst         = []
+                try:
+                    subdset     = self.auxiliary_data.NoiseXcorr[netcode1][stacode1][netcode2][stacode2]
+                    for chan1 in chans1:
+                        for chan2 in chans2:
+                            dsetLst.append(subdset[chan1][chan2])
+                except KeyError:
+                    warnings.warn('Missing channels in the stack for: '+staid1+'_'+staid2+', not appended', UserWarning, stacklevel=1)
+                    continue
+                for itrace in range(len(dsetLst)):
+                    if dsetLst[itrace].data.shape != stackArr[itrace].shape:
+                        raise ValueError('Inconsistent npts for appending: '+staid1+'_'+staid2)
+                for itrace in range(len(dsetLst)):
+                    dset                        = dsetLst[itrace]
+                    dset.data[:]                = dset.data.value + stackArr[itrace]
+                    dset.data.attrs['stackday'] = dset.parameters['stackday'] + float(stackday[0])
+                self._set_stack_manifest(staid1, staid2, np.append(manifest, months))
+                Nupdate         += 1
+            else:
+                dist, az, baz   = obspy.geodetics.gps2dist_azimuth(staArr[ista1, 1], staArr[ista1, 0], staArr[ista2, 1], staArr[ista2, 0])
+                self._add_xcorr_stack(staid1=staid1, staid2=staid2, chans1=chans1, chans2=chans2, stackArr=stackArr,\
+                        stackday=stackday, hdrLst=hdrLst, dist=dist/1000., az=az, baz=baz, months=months)
+                Nnew            += 1
+            if verbose:
+                print('Finished appending for:'+staid1+'_'+staid2+', months: '+str(months))
+            dirtyLst.append(pairkey)
+        if Nlegacy > 0:
+            warnings.warn(str(Nlegacy)+' station pairs have no stack manifest and are not appended, re-stack them with xcorr_stack',\
+                          UserWarning, stacklevel=1)
+        self.mark_dirty(dirtyLst)
+        if Nnew > 0:
+            self.update_pair_index(data_type='NoiseXcorr')
+        print '--- end appending: '+str(Nupdate)+' pairs updated, '+str(Nnew)+' pairs added'
         return
     
-    def xcorr_rotation(self, outdir = None, pfx = 'COR', verbose=False):
+    def xcorr_rotation(self, outdir = None, pfx = 'COR', dirty_only=False, verbose=False):
         """Rotate cross-correlation data 
         ===========================================================================================================
         ::: input parameters :::
         outdir                  - output directory for sac files (None is not to write)
         pfx                     - prefix
+        dirty_only              - only rotate the dirty station pairs (see mark_dirty)
+        -----------------------------------------------------------------------------------------------------------
+        rotated data computed from the same input are kept, outdated rotated data are replaced
         -----------------------------------------------------------------------------------------------------------
         ::: output :::
         ASDF path           : self.auxiliary_data.NoiseXcorr[netcode1][stacode1][netcode2][stacode2][chan1][chan2]
         sac file(optional)  : outdir/COR/TA.G12A/COR_TA.G12A_BHT_TA.R21A_BHT.SAC
         ===========================================================================================================
         """
-        staLst                  = self.waveforms.list()
-        Nsta                    = len(staLst)
-        Ntotal_traces           = Nsta*(Nsta-1)/2
-        itrstack                = 0
-        Ntr_one_percent         = int(Ntotal_traces/100.)
+        # loop over existing station pairs only
+        pairLst                 = self._get_stage_pairs(data_type='NoiseXcorr', stage='rotation', dirty_only=dirty_only)
+        Ntotal_traces           = len(pairLst)
+        Ntr_one_percent         = max(1, int(Ntotal_traces/100.))
         irotate                 = 0
         print '=== start rotation: '+str(Ntotal_traces)+' pairs'
-        for staid1 in staLst:
-            lon1                    = self.waveforms[staid1].StationXML.networks[0].stations[0].longitude
-            lat1                    = self.waveforms[staid1].StationXML.networks[0].stations[0].latitude
-            for staid2 in staLst:
-                netcode1, stacode1  = staid1.split('.')
-                netcode2, stacode2  = staid2.split('.')
-                if staid1 >= staid2:
-                    continue
-                lon2                = self.waveforms[staid2].StationXML.networks[0].stations[0].longitude
-                lat2                = self.waveforms[staid2].StationXML.networks[0].stations[0].latitude
-                irotate            += 1
-                # print the status of rotation
-                ipercent            = float(irotate)/float(Ntotal_traces)*100.
-                if np.fmod(irotate, 500) == 0 or np.fmod(irotate, Ntr_one_percent) == 0:
-                    percent_str     = '%0.2f' %ipercent
-                    print '*** Number of traces finished rotation: '+str(irotate)+'/'+str(Ntotal_traces)+' '+percent_str+'%'
-                #-------------------------
-                # determine the channels
-                #-------------------------
-                chan1E  = None
-                chan1N  = None
-                chan1Z  = None
-                chan2E  = None
-                chan2N  = None
-                chan2Z  = None
-                try:
-                    channels1   = self.auxiliary_data.NoiseXcorr[netcode1][stacode1][netcode2][stacode2].list()
-                    channels2   = self.auxiliary_data.NoiseXcorr[netcode1][stacode1][netcode2][stacode2][channels1[0]].list()
-                    cpfx1       = channels1[0][:2]
-                    cpfx2       = channels2[0][:2]
-                    for chan in channels1:
-                        if chan[2]=='E':
-                            chan1E  = chan
-                        if chan[2]=='N':
-                            chan1N  = chan
-                        if chan[2]=='Z':
-                            chan1Z  = chan
-                    for chan in channels2:
-                        if chan[2]=='E':
-                            chan2E  = chan
-                        if chan[2]=='N':
-                            chan2N  = chan
-                        if chan[2]=='Z':
-                            chan2Z  = chan
-                except KeyError:
-                    continue
-                subdset             = self.auxiliary_data.NoiseXcorr[netcode1][stacode1][netcode2][stacode2]
-                if chan1E==None or chan1N==None or chan2E==None or chan2N==None:
-                    continue
-                if chan1Z==None or chan2Z==None:
-                    if verbose:
-                        print 'Do rotation(RT) for:'+staid1+' and '+staid2
-                else:
-                    if verbose:
-                        print 'Do rotation(RTZ) for:'+staid1+' and '+staid2
-                # get data
-                dsetEE      = subdset[chan1E][chan2E]
-                dsetEN      = subdset[chan1E][chan2N]
-                dsetNE      = subdset[chan1N][chan2E]
-                dsetNN      = subdset[chan1N][chan2N]
-                temp_header = dsetEE.parameters.copy()
-                chan1R      = cpfx1+'R'
-                chan1T      = cpfx1+'T'
-                chan2R      = cpfx2+'R'
-                chan2T      = cpfx2+'T'
-                # define azimuth/back-azimuth
-                theta           = temp_header['az']
-                psi             = temp_header['baz']
-                # check az/baz
-                dist, az, baz   = obspy.geodetics.gps2dist_azimuth(lat1, lon1, lat2, lon2)
-                dist            = dist/1000.
-                if abs(az - theta) > 0.01 and abs(abs(az - theta) - 360.) > 0.01:
-                    raise ValueError('computed az = '+str(az)+' stored az = '+str(theta)+' '+staid1+'_'+staid2)
-                if abs(baz - psi) > 0.01 and abs(abs(baz - psi) - 360.) > 0.01:
-                    raise ValueError('computed baz = '+str(baz)+' stored baz = '+str(psi)+' '+staid1+'_'+staid2)
-                Ctheta      = np.cos(np.pi*theta/180.)
-                Stheta      = np.sin(np.pi*theta/180.)
-                Cpsi        = np.cos(np.pi*psi/180.)
-                Spsi        = np.sin(np.pi*psi/180.)
-                #------------------------------- perform EN -> RT rotation ------------------------------
-                tempTT      = -Ctheta*Cpsi* dsetEE.data.value + Ctheta*Spsi* dsetEN.data.value - \
+        for staid1, staid2, dist, az, baz in pairLst:
+            netcode1, stacode1  = staid1.split('.')
+            netcode2, stacode2  = staid2.split('.')
+            irotate                += 1
+            # print the status of rotation
+            ipercent                = float(irotate)/float(Ntotal_traces)*100.
+            if np.fmod(irotate, 500) == 0 or np.fmod(irotate, Ntr_one_percent) == 0:
+                percent_str         = '%0.2f' %ipercent
+                print '*** Number of traces finished rotation: '+str(irotate)+'/'+str(Ntotal_traces)+' '+percent_str+'%'
+            #-------------------------
+            # determine the channels
+            #-------------------------
+            chan1E      = None
+            chan1N      = None
+            chan1Z      = None
+            chan2E      = None
+            chan2N      = None
+            chan2Z      = None
+            try:
+                channels1       = self.auxiliary_data.NoiseXcorr[netcode1][stacode1][netcode2][stacode2].list()
+                channels2       = self.auxiliary_data.NoiseXcorr[netcode1][stacode1][netcode2][stacode2][channels1[0]].list()
+                cpfx1           = channels1[0][:2]
+                cpfx2           = channels2[0][:2]
+                for chan in channels1:
+                    if chan[2]=='E':
+                        chan1E      = chan
+                    if chan[2]=='N':
+                        chan1N      = chan
+                    if chan[2]=='Z':
+                        chan1Z      = chan
+                for chan in channels2:
+                    if chan[2]=='E':
+                        chan2E      = chan
+                    if chan[2]=='N':
+                        chan2N      = chan
+                    if chan[2]=='Z':
+                        chan2Z      = chan
+            except KeyError:
+                continue
+            subdset                 = self.auxiliary_data.NoiseXcorr[netcode1][stacode1][netcode2][stacode2]
+            if chan1E==None or chan1N==None or chan2E==None or chan2N==None:
+                continue
+            if chan1Z==None or chan2Z==None:
+                if verbose:
+                    print 'Do rotation(RT) for:'+staid1+' and '+staid2
+            else:
+                if verbose:
+                    print 'Do rotation(RTZ) for:'+staid1+' and '+staid2
+            # get data
+            dsetEE          = subdset[chan1E][chan2E]
+            dsetEN          = subdset[chan1E][chan2N]
+            dsetNE          = subdset[chan1N][chan2E]
+            dsetNN          = subdset[chan1N][chan2N]
+            temp_header     = dsetEE.parameters.copy()
+            chan1R          = cpfx1+'R'
+            chan1T          = cpfx1+'T'
+            chan2R          = cpfx2+'R'
+            chan2T          = cpfx2+'T'
+            # define azimuth/back-azimuth
+            theta               = temp_header['az']
+            psi                 = temp_header['baz']
+            # check az/baz, az/baz in the pair index are computed from station coordinates
+            if abs(az - theta) > 0.01 and abs(abs(az - theta) - 360.) > 0.01:
+                raise ValueError('computed az = '+str(az)+' stored az = '+str(theta)+' '+staid1+'_'+staid2)
+            if abs(baz - psi) > 0.01 and abs(abs(baz - psi) - 360.) > 0.01:
+                raise ValueError('computed baz = '+str(baz)+' stored baz = '+str(psi)+' '+staid1+'_'+staid2)
+            # provenance of the rotated data
+            dsetLst         = [dsetEE, dsetEN, dsetNE, dsetNN]
+            if chan1Z != None and chan2Z != None:
+                dsetLst     += [subdset[chan1E][chan2Z], subdset[chan1Z][chan2E], subdset[chan1N][chan2Z], subdset[chan1Z][chan2N]]
+            input_hash      = _get_hash([_get_provenance(dset) for dset in dsetLst], theta, psi)
+            param_hash      = _get_hash('rotation')
+            staid_aux       = netcode1+'/'+stacode1+'/'+netcode2+'/'+stacode2
+            if self._is_uptodate(data_type='NoiseXcorr', path=staid_aux+'/'+chan1T+'/'+chan2T,\
+                    input_hash=input_hash, param_hash=param_hash):
+                continue
+            # remove the outdated rotated data
+            for chan_path in [chan1T, chan1R]:
+                self._del_auxiliary_data(data_type='NoiseXcorr', path=staid_aux+'/'+chan_path)
+            if chan1Z != None:
+                for chan_path in [chan1Z+'/'+chan2T, chan1Z+'/'+chan2R]:
+                    self._del_auxiliary_data(data_type='NoiseXcorr', path=staid_aux+'/'+chan_path)
+            temp_header['input_hash']   = input_hash
+            temp_header['param_hash']   = param_hash
+            Ctheta          = np.cos(np.pi*theta/180.)
+            Stheta          = np.sin(np.pi*theta/180.)
+            Cpsi            = np.cos(np.pi*psi/180.)
+            Spsi            = np.sin(np.pi*psi/180.)
+            #------------------------------- perform EN -> RT rotation ------------------------------
+            tempTT          = -Ctheta*Cpsi* dsetEE.data.value + Ctheta*Spsi* dsetEN.data.value - \
                                     Stheta*Spsi* dsetNN.data.value + Stheta*Cpsi* dsetNE.data.value
-                
-                tempRR      = - Stheta*Spsi* dsetEE.data.value - Stheta*Cpsi* dsetEN.data.value \
+            
+            tempRR          = - Stheta*Spsi* dsetEE.data.value - Stheta*Cpsi* dsetEN.data.value \
                                     -Ctheta*Cpsi*dsetNN.data.value - Ctheta*Spsi*dsetNE.data.value
-                
-                tempTR      = -Ctheta*Spsi* dsetEE.data.value - Ctheta*Cpsi* dsetEN.data.value  \
+            
+            tempTR          = -Ctheta*Spsi* dsetEE.data.value - Ctheta*Cpsi* dsetEN.data.value  \
                                     + Stheta*Cpsi*dsetNN.data.value + Stheta*Spsi*dsetNE.data.value
-                
-                tempRT      = -Stheta*Cpsi* dsetEE.data.value + Stheta*Spsi* dsetEN.data.value \
+            
+            tempRT          = -Stheta*Cpsi* dsetEE.data.value + Stheta*Spsi* dsetEN.data.value \
                                     + Ctheta*Spsi* dsetNN.data.value - Ctheta*Cpsi* dsetNE.data.value
-                #----------------------------------------------------------------------------------------
-                # save horizontal components
-                staid_aux           = netcode1+'/'+stacode1+'/'+netcode2+'/'+stacode2
-                temp_header['chan1']= chan1T
-                temp_header['chan2']= chan2T
-                self.add_auxiliary_data(data=tempTT, data_type='NoiseXcorr', path=staid_aux+'/'+chan1T+'/'+chan2T, parameters=temp_header)
-                
-                temp_header['chan1']= chan1R
-                temp_header['chan2']= chan2R
-                self.add_auxiliary_data(data=tempRR, data_type='NoiseXcorr', path=staid_aux+'/'+chan1R+'/'+chan2R, parameters=temp_header)
-                
-                temp_header['chan1']= chan1T
-                temp_header['chan2']= chan2R
-                self.add_auxiliary_data(data=tempTR, data_type='NoiseXcorr', path=staid_aux+'/'+chan1T+'/'+chan2R, parameters=temp_header)
-                
-                temp_header['chan1']= chan1R
-                temp_header['chan2']= chan2T
-                self.add_auxiliary_data(data=tempRT, data_type='NoiseXcorr', path=staid_aux+'/'+chan1R+'/'+chan2T, parameters=temp_header)
+            #----------------------------------------------------------------------------------------
+            # save horizontal components
+            temp_header['chan1']    = chan1T
+            temp_header['chan2']    = chan2T
+            self.add_auxiliary_data(data=tempTT, data_type='NoiseXcorr', path=staid_aux+'/'+chan1T+'/'+chan2T, parameters=temp_header)
+            
+            temp_header['chan1']    = chan1R
+            temp_header['chan2']    = chan2R
+            self.add_auxiliary_data(data=tempRR, data_type='NoiseXcorr', path=staid_aux+'/'+chan1R+'/'+chan2R, parameters=temp_header)
+            
+            temp_header['chan1']    = chan1T
+            temp_header['chan2']    = chan2R
+            self.add_auxiliary_data(data=tempTR, data_type='NoiseXcorr', path=staid_aux+'/'+chan1T+'/'+chan2R, parameters=temp_header)
+            
+            temp_header['chan1']    = chan1R
+            temp_header['chan2']    = chan2T
+            self.add_auxiliary_data(data=tempRT, data_type='NoiseXcorr', path=staid_aux+'/'+chan1R+'/'+chan2T, parameters=temp_header)
+            # write to sac files
+            if outdir != None:
+                self.wsac_xcorr(netcode1=netcode1, stacode1=stacode1, netcode2=netcode2,
+                        stacode2=stacode2, chan1=chan1T, chan2=chan2T, outdir=outdir, pfx=pfx)
+                self.wsac_xcorr(netcode1=netcode1, stacode1=stacode1, netcode2=netcode2,
+                        stacode2=stacode2, chan1=chan1R, chan2=chan2R, outdir=outdir, pfx=pfx)
+                self.wsac_xcorr(netcode1=netcode1, stacode1=stacode1, netcode2=netcode2,
+                        stacode2=stacode2, chan1=chan1T, chan2=chan2R, outdir=outdir, pfx=pfx)
+                self.wsac_xcorr(netcode1=netcode1, stacode1=stacode1, netcode2=netcode2,
+                        stacode2=stacode2, chan1=chan1R, chan2=chan2T, outdir=outdir, pfx=pfx)
+            # RTZ rotation
+            if chan1Z != None and chan2Z != None:
+                # get data
+                dsetEZ      = subdset[chan1E][chan2Z]
+                dsetZE      = subdset[chan1Z][chan2E]
+                dsetNZ      = subdset[chan1N][chan2Z]
+                dsetZN      = subdset[chan1Z][chan2N]
+                # ----------------------- perform ENZ -> RTZ rotation ---------------------
+                tempRZ      = Ctheta* dsetNZ.data.value + Stheta* dsetEZ.data.value
+                tempZR      = -Cpsi* dsetZN.data.value - Spsi* dsetZE.data.value
+                tempTZ      = -Stheta* dsetNZ.data.value + Ctheta* dsetEZ.data.value
+                tempZT      = Spsi* dsetZN.data.value - Cpsi* dsetZE.data.value
+                #--------------------------------------------------------------------------
+                temp_header['chan1']        = chan1R
+                temp_header['chan2']        = chan2Z
+                self.add_auxiliary_data(data=tempRZ, data_type='NoiseXcorr', path=staid_aux+'/'+chan1R+'/'+chan2Z, parameters=temp_header)
+                temp_header['chan1']        = chan1Z
+                temp_header['chan2']        = chan2R
+                self.add_auxiliary_data(data=tempZR, data_type='NoiseXcorr', path=staid_aux+'/'+chan1Z+'/'+chan2R, parameters=temp_header)
+                temp_header['chan1']        = chan1T
+                temp_header['chan2']        = chan2Z
+                self.add_auxiliary_data(data=tempTZ, data_type='NoiseXcorr', path=staid_aux+'/'+chan1T+'/'+chan2Z, parameters=temp_header)
+                temp_header['chan1']        = chan1Z
+                temp_header['chan2']        = chan2T
+                self.add_auxiliary_data(data=tempZT, data_type='NoiseXcorr', path=staid_aux+'/'+chan1Z+'/'+chan2T, parameters=temp_header)
                 # write to sac files
-                if outdir != None:
+                if outdir!=None:
                     self.wsac_xcorr(netcode1=netcode1, stacode1=stacode1, netcode2=netcode2,
-                            stacode2=stacode2, chan1=chan1T, chan2=chan2T, outdir=outdir, pfx=pfx)
+                            stacode2=stacode2, chan1=chan1R, chan2=chan2Z, outdir=outdir, pfx=pfx)                        
                     self.wsac_xcorr(netcode1=netcode1, stacode1=stacode1, netcode2=netcode2,
-                            stacode2=stacode2, chan1=chan1R, chan2=chan2R, outdir=outdir, pfx=pfx)
+                            stacode2=stacode2, chan1=chan1Z, chan2=chan2R, outdir=outdir, pfx=pfx)
                     self.wsac_xcorr(netcode1=netcode1, stacode1=stacode1, netcode2=netcode2,
-                            stacode2=stacode2, chan1=chan1T, chan2=chan2R, outdir=outdir, pfx=pfx)
+                            stacode2=stacode2, chan1=chan1T, chan2=chan2Z, outdir=outdir, pfx=pfx)
                     self.wsac_xcorr(netcode1=netcode1, stacode1=stacode1, netcode2=netcode2,
-                            stacode2=stacode2, chan1=chan1R, chan2=chan2T, outdir=outdir, pfx=pfx)
-                # RTZ rotation
-                if chan1Z != None and chan2Z != None:
-                    # get data
-                    dsetEZ  = subdset[chan1E][chan2Z]
-                    dsetZE  = subdset[chan1Z][chan2E]
-                    dsetNZ  = subdset[chan1N][chan2Z]
-                    dsetZN  = subdset[chan1Z][chan2N]
-                    # ----------------------- perform ENZ -> RTZ rotation ---------------------
-                    tempRZ  = Ctheta* dsetNZ.data.value + Stheta* dsetEZ.data.value
-                    tempZR  = -Cpsi* dsetZN.data.value - Spsi* dsetZE.data.value
-                    tempTZ  = -Stheta* dsetNZ.data.value + Ctheta* dsetEZ.data.value
-                    tempZT  = Spsi* dsetZN.data.value - Cpsi* dsetZE.data.value
-                    #--------------------------------------------------------------------------
-                    temp_header['chan1']    = chan1R
-                    temp_header['chan2']    = chan2Z
-                    self.add_auxiliary_data(data=tempRZ, data_type='NoiseXcorr', path=staid_aux+'/'+chan1R+'/'+chan2Z, parameters=temp_header)
-                    temp_header['chan1']    = chan1Z
-                    temp_header['chan2']    = chan2R
-                    self.add_auxiliary_data(data=tempZR, data_type='NoiseXcorr', path=staid_aux+'/'+chan1Z+'/'+chan2R, parameters=temp_header)
-                    temp_header['chan1']    = chan1T
-                    temp_header['chan2']    = chan2Z
-                    self.add_auxiliary_data(data=tempTZ, data_type='NoiseXcorr', path=staid_aux+'/'+chan1T+'/'+chan2Z, parameters=temp_header)
-                    temp_header['chan1']    = chan1Z
-                    temp_header['chan2']    = chan2T
-                    self.add_auxiliary_data(data=tempZT, data_type='NoiseXcorr', path=staid_aux+'/'+chan1Z+'/'+chan2T, parameters=temp_header)
-                    # write to sac files
-                    if outdir!=None:
-                        self.wsac_xcorr(netcode1=netcode1, stacode1=stacode1, netcode2=netcode2,
-                                stacode2=stacode2, chan1=chan1R, chan2=chan2Z, outdir=outdir, pfx=pfx)                        
-                        self.wsac_xcorr(netcode1=netcode1, stacode1=stacode1, netcode2=netcode2,
-                                stacode2=stacode2, chan1=chan1Z, chan2=chan2R, outdir=outdir, pfx=pfx)
-                        self.wsac_xcorr(netcode1=netcode1, stacode1=stacode1, netcode2=netcode2,
-                                stacode2=stacode2, chan1=chan1T, chan2=chan2Z, outdir=outdir, pfx=pfx)
-                        self.wsac_xcorr(netcode1=netcode1, stacode1=stacode1, netcode2=netcode2,
-                                stacode2=stacode2, chan1=chan1Z, chan2=chan2T, outdir=outdir, pfx=pfx)
+                            stacode2=stacode2, chan1=chan1Z, chan2=chan2T, outdir=outdir, pfx=pfx)
+        if dirty_only:
+            self.clear_dirty(stage='rotation', pairLst=[(pair[0], pair[1]) for pair in pairLst])
         return
     
     def count_data(self, chan1='LHZ', chan2='LHZ', threshstackday=0):
@@ -2100,39 +3240,17 @@ class noiseASDF(pyasdf.ASDFDataSet):
         Nsta                        = len(staLst)
         Ntotal_traces               = Nsta*(Nsta-1)/2
         itrace                      = 0
-        for staid1 in staLst:
-            for staid2 in staLst:
-                netcode1, stacode1  = staid1.split('.')
-                netcode2, stacode2  = staid2.split('.')
-                if staid1 >= staid2:
-                    continue
-                try:
-                    subdset         = self.auxiliary_data.NoiseXcorr[netcode1][stacode1][netcode2][stacode2][chan1][chan2]
-                except KeyError:
+        for staid1, staid2, dist, az, baz in self.get_pair_index(data_type='NoiseXcorr'):
+            netcode1, stacode1      = staid1.split('.')
+            netcode2, stacode2      = staid2.split('.')
+            try:
+                subdset             = self.auxiliary_data.NoiseXcorr[netcode1][stacode1][netcode2][stacode2][chan1][chan2]
+            except KeyError:
+                continue
+            if threshstackday > 0:
+                if subdset.parameters['stackday'] < threshstackday:
                     continue
-                if threshstackday > 0:
-                    if subdset.parameters['stackday'] < threshstackday:
-                        continue
-                itrace              += 1
-                # try:
-                #     channels1       = self.auxiliary_data.NoiseXcorr[netcode1][stacode1][netcode2][stacode2].list()
-                #     channels2       = self.auxiliary_data.NoiseXcorr[netcode1][stacode1][netcode2][stacode2][channels1[0]].list()
-                #     for chan in channels1:
-                #         if chan[-1]==channel[0]:
-                #             chan1   = chan
-                #     for chan in channels2:
-                #         if chan[-1]==channel[1]:
-                #             chan2   = chan
-                # except KeyError:
-                #     continue
-                
-                # try:
-                #     tr              = self.get_xcorr_trace(netcode1, stacode1, netcode2, stacode2, chan1, chan2)
-                #     if tr.stats.sac.user0 < threshstackday:
-                #         continue
-                #     itrace          += 1
-                # except NameError:
-                #     pass
+            itrace                  += 1
         print('Number of available xcorr traces: '+str(itrace)+'/'+str(Ntotal_traces))
         return
     
@@ -2215,131 +3333,185 @@ class noiseASDF(pyasdf.ASDFDataSet):
             os.remove('PREDICTION_R'+'_'+evid)
         return
     
+    def _add_aftan_results(self, staid_aux, results, pmf=True, basic1=True, basic2=True, pmf1=True, pmf2=True,\
+            input_hash=None, param_hash=None):
+        """save the aftan results of a station pair to the ASDF dataset
+        ==============================================================================
+        ::: input parameters :::
+        staid_aux   - path of the results (netcode1/stacode1/netcode2/stacode2/channel)
+        results     - aftan results, (arr1_1, nfout1_1, arr2_1, nfout2_1, arr1_2, nfout1_2, arr2_2, nfout2_2)
+        pmf         - pmf results are computed or not
+        basic1/basic2/pmf1/pmf2
+                    - save the corresponding results or not
+        input_hash/param_hash
+                    - provenance of the results
+        ==============================================================================
+        """
+        arr1_1, nfout1_1, arr2_1, nfout2_1, arr1_2, nfout1_2, arr2_2, nfout2_2\
+                        = results
+        provenance      = {}
+        if input_hash is not None and param_hash is not None:
+            provenance  = {'input_hash': input_hash, 'param_hash': param_hash}
+        if basic1:
+            parameters  = {'Tc': 0, 'To': 1, 'U': 2, 'C': 3, 'ampdb': 4, 'dis': 5, 'snrdb': 6, 'mhw': 7, 'amp': 8, 'Np': nfout1_1}
+            parameters.update(provenance)
+            self.add_auxiliary_data(data=arr1_1, data_type='DISPbasic1', path=staid_aux, parameters=parameters)
+        if basic2:
+            parameters  = {'Tc': 0, 'To': 1, 'U': 2, 'C': 3, 'ampdb': 4, 'snrdb': 5, 'mhw': 6, 'amp': 7, 'Np': nfout2_1}
+            parameters.update(provenance)
+            self.add_auxiliary_data(data=arr2_1, data_type='DISPbasic2', path=staid_aux, parameters=parameters)
+        if pmf:
+            if pmf1:
+                parameters  = {'Tc': 0, 'To': 1, 'U': 2, 'C': 3, 'ampdb': 4, 'dis': 5, 'snrdb': 6, 'mhw': 7, 'amp': 8, 'Np': nfout1_2}
+                parameters.update(provenance)
+                self.add_auxiliary_data(data=arr1_2, data_type='DISPpmf1', path=staid_aux, parameters=parameters)
+            if pmf2:
+                parameters  = {'Tc': 0, 'To': 1, 'U': 2, 'C': 3, 'ampdb': 4, 'snrdb': 5, 'mhw': 6, 'amp': 7, 'snr':8, 'Np': nfout2_2}
+                parameters.update(provenance)
+                self.add_auxiliary_data(data=arr2_2, data_type='DISPpmf2', path=staid_aux, parameters=parameters)
+        return
+    
     def xcorr_aftan(self, channel='ZZ', tb=0., outdir=None, inftan=pyaftan.InputFtanParam(),\
-            basic1=True, basic2=True, pmf1=True, pmf2=True, verbose=False, prephdir=None, f77=True, pfx='DISP'):
+            basic1=True, basic2=True, pmf1=True, pmf2=True, verbose=False, prephdir=None, f77=True, pfx='DISP', dirty_only=False):
         """ aftan analysis of cross-correlation data 
         =======================================================================================
         ::: input parameters :::
         channel     - channel pair for aftan analysis(e.g. 'ZZ', 'TT', 'ZR', 'RZ'...)
         tb          - begin time (default = 0.0)
         outdir      - directory for output disp txt files (default = None, no txt output)
-        inftan      - input aftan parameters
-        basic1      - save basic aftan results or not
-        basic2      - save basic aftan results(with jump correction) or not
-        pmf1        - save pmf aftan results or not
-        pmf2        - save pmf aftan results(with jump correction) or not
-        prephdir    - directory for predicted phase velocity dispersion curve
-        f77         - use aftanf77 or not
-        pfx         - prefix for output txt DISP files
-        ---------------------------------------------------------------------------------------
-        ::: output :::
-        self.auxiliary_data.DISPbasic1, self.auxiliary_data.DISPbasic2,
-        self.auxiliary_data.DISPpmf1, self.auxiliary_data.DISPpmf2
-        =======================================================================================
-        """
-        print '=== start aftan analysis'
-        staLst                      = self.waveforms.list()
-        Nsta                        = len(staLst)
-        Ntotal_traces               = Nsta*(Nsta-1)/2
-        iaftan                      = 0
-        Ntr_one_percent             = int(Ntotal_traces/100.)
-        ipercent                    = 0
-        for staid1 in staLst:
-            for staid2 in staLst:
-                netcode1, stacode1  = staid1.split('.')
-                netcode2, stacode2  = staid2.split('.')
-                if staid1 >= staid2:
-                    continue
-                # print how many traces has been processed
-                iaftan              += 1
-                if np.fmod(iaftan, Ntr_one_percent) ==0:
-                    ipercent        += 1
-                    print ('*** Number of traces finished aftan analysis: '+str(iaftan)+'/'+\
-                           str(Ntotal_traces)+' '+str(ipercent)+'%')
-                # determine channels
-                try:
-                    channels1       = self.auxiliary_data.NoiseXcorr[netcode1][stacode1][netcode2][stacode2].list()
-                    for chan in channels1:
-                        if chan[-1] == channel[0]:
-                            chan1   = chan
-                            break
-                    channels2       = self.auxiliary_data.NoiseXcorr[netcode1][stacode1][netcode2][stacode2][chan1].list()
-                    for chan in channels2:
-                        if chan[-1] == channel[1]:
-                            chan2   = chan
-                            break
-                except KeyError:
-                    continue
-                # get data
-                try:
-                    tr              = self.get_xcorr_trace(netcode1, stacode1, netcode2, stacode2, chan1, chan2)
-                except NameError:
-                    print netcode1+'.'+stacode1+'_'+chan1+'_'+netcode2+'.'+stacode2+'_'+chan2+' not exists!'
-                    continue
-                aftanTr             = pyaftan.aftantrace(tr.data, tr.stats)
-                if abs(aftanTr.stats.sac.b+aftanTr.stats.sac.e) < aftanTr.stats.delta:
-                    aftanTr.makesym()
-                else:
-                    print netcode1+'.'+stacode1+'_'+netcode2+'.'+stacode2+'_'+channel+' NOT symmetric'
-                    continue
-                if prephdir != None:
-                    phvelname       = prephdir + "/%s.%s.pre" %(netcode1+'.'+stacode1, netcode2+'.'+stacode2)
-                else:
-                    phvelname       = ''
-                if not os.path.isfile(phvelname):
-                    print phvelname+' not exists!'
-                    continue
-                if f77:
-                    aftanTr.aftanf77(pmf=inftan.pmf, piover4=inftan.piover4, vmin=inftan.vmin, vmax=inftan.vmax, tmin=inftan.tmin, tmax=inftan.tmax,
-                        tresh=inftan.tresh, ffact=inftan.ffact, taperl=inftan.taperl, snr=inftan.snr, fmatch=inftan.fmatch, nfin=inftan.nfin,
-                            npoints=inftan.npoints, perc=inftan.perc, phvelname=phvelname)
-                else:
-                    aftanTr.aftan(pmf=inftan.pmf, piover4=inftan.piover4, vmin=inftan.vmin, vmax=inftan.vmax, tmin=inftan.tmin, tmax=inftan.tmax,
-                        tresh=inftan.tresh, ffact=inftan.ffact, taperl=inftan.taperl, snr=inftan.snr, fmatch=inftan.fmatch, nfin=inftan.nfin,
-                            npoints=inftan.npoints, perc=inftan.perc, phvelname=phvelname)
-                if verbose:
-                    print 'aftan analysis for: ' + netcode1+'.'+stacode1+'_'+netcode2+'.'+stacode2+'_'+channel
-                aftanTr.get_snr(ffact=inftan.ffact) # SNR analysis
-                staid_aux           = netcode1+'/'+stacode1+'/'+netcode2+'/'+stacode2+'/'+channel
-                # save aftan results to ASDF dataset
-                if basic1:
-                    parameters      = {'Tc': 0, 'To': 1, 'U': 2, 'C': 3, 'ampdb': 4, 'dis': 5, 'snrdb': 6,\
-                                            'mhw': 7, 'amp': 8, 'Np': aftanTr.ftanparam.nfout1_1}
-                    self.add_auxiliary_data(data=aftanTr.ftanparam.arr1_1, data_type='DISPbasic1', path=staid_aux,\
-                                            parameters=parameters)
-                if basic2:
-                    parameters      = {'Tc': 0, 'To': 1, 'U': 2, 'C': 3, 'ampdb': 4, 'snrdb': 5, 'mhw': 6,\
-                                            'amp': 7, 'Np': aftanTr.ftanparam.nfout2_1}
-                    self.add_auxiliary_data(data=aftanTr.ftanparam.arr2_1, data_type='DISPbasic2', path=staid_aux,\
-                                            parameters=parameters)
-                if inftan.pmf:
-                    if pmf1:
-                        parameters  = {'Tc': 0, 'To': 1, 'U': 2, 'C': 3, 'ampdb': 4, 'dis': 5, 'snrdb': 6,\
-                                            'mhw': 7, 'amp': 8, 'Np': aftanTr.ftanparam.nfout1_2}
-                        self.add_auxiliary_data(data=aftanTr.ftanparam.arr1_2, data_type='DISPpmf1', path=staid_aux,\
-                                                parameters=parameters)
-                    if pmf2:
-                        parameters  = {'Tc': 0, 'To': 1, 'U': 2, 'C': 3, 'ampdb': 4, 'snrdb': 5, 'mhw': 6,\
-                                            'amp': 7, 'snr':8, 'Np': aftanTr.ftanparam.nfout2_2}
-                        self.add_auxiliary_data(data=aftanTr.ftanparam.arr2_2, data_type='DISPpmf2', path=staid_aux,\
-                                                parameters=parameters)
-                if outdir != None:
-                    if not os.path.isdir(outdir+'/'+pfx+'/'+staid1):
-                        os.makedirs(outdir+'/'+pfx+'/'+staid1)
-                    foutPR          = outdir+'/'+pfx+'/'+netcode1+'.'+stacode1+'/'+ \
+        inftan      - input aftan parameters
+        basic1      - save basic aftan results or not
+        basic2      - save basic aftan results(with jump correction) or not
+        pmf1        - save pmf aftan results or not
+        pmf2        - save pmf aftan results(with jump correction) or not
+        prephdir    - directory for predicted phase velocity dispersion curve
+        f77         - use aftanf77 or not
+        pfx         - prefix for output txt DISP files
+        dirty_only  - only process the dirty station pairs (see mark_dirty)
+        ---------------------------------------------------------------------------------------
+        aftan results computed from the same input and parameters are kept, outdated results are replaced
+        the txt output is still written for the up-to-date pairs if outdir is specified
+        the aftan code used (aftanf77 or aftan) is recorded in the parameter hash
+        ---------------------------------------------------------------------------------------
+        ::: output :::
+        self.auxiliary_data.DISPbasic1, self.auxiliary_data.DISPbasic2,
+        self.auxiliary_data.DISPpmf1, self.auxiliary_data.DISPpmf2
+        =======================================================================================
+        """
+        print '=== start aftan analysis'
+        aftan_method                = _get_aftan_method(f77)
+        # loop over existing station pairs only
+        pairLst                     = self._get_stage_pairs(data_type='NoiseXcorr', stage='aftan', dirty_only=dirty_only)
+        Ntotal_traces               = len(pairLst)
+        iaftan                      = 0
+        Ntr_one_percent             = max(1, int(Ntotal_traces/100.))
+        ipercent                    = 0
+        for staid1, staid2, dist, az, baz in pairLst:
+            netcode1, stacode1      = staid1.split('.')
+            netcode2, stacode2      = staid2.split('.')
+            # print how many traces has been processed
+            iaftan                  += 1
+            if np.fmod(iaftan, Ntr_one_percent) ==0:
+                ipercent            += 1
+                print ('*** Number of traces finished aftan analysis: '+str(iaftan)+'/'+\
+                       str(Ntotal_traces)+' '+str(ipercent)+'%')
+            # determine channels
+            try:
+                channels1           = self.auxiliary_data.NoiseXcorr[netcode1][stacode1][netcode2][stacode2].list()
+                for chan in channels1:
+                    if chan[-1] == channel[0]:
+                        chan1       = chan
+                        break
+                channels2           = self.auxiliary_data.NoiseXcorr[netcode1][stacode1][netcode2][stacode2][chan1].list()
+                for chan in channels2:
+                    if chan[-1] == channel[1]:
+                        chan2       = chan
+                        break
+            except KeyError:
+                continue
+            # get data
+            try:
+                tr                  = self.get_xcorr_trace(netcode1, stacode1, netcode2, stacode2, chan1, chan2)
+            except NameError:
+                print netcode1+'.'+stacode1+'_'+chan1+'_'+netcode2+'.'+stacode2+'_'+chan2+' not exists!'
+                continue
+            aftanTr                 = pyaftan.aftantrace(tr.data, tr.stats)
+            if abs(aftanTr.stats.sac.b+aftanTr.stats.sac.e) < aftanTr.stats.delta:
+                aftanTr.makesym()
+            else:
+                print netcode1+'.'+stacode1+'_'+netcode2+'.'+stacode2+'_'+channel+' NOT symmetric'
+                continue
+            if prephdir != None:
+                phvelname           = prephdir + "/%s.%s.pre" %(netcode1+'.'+stacode1, netcode2+'.'+stacode2)
+            else:
+                phvelname           = ''
+            if not os.path.isfile(phvelname):
+                print phvelname+' not exists!'
+                continue
+            # provenance of the aftan results
+            with open(phvelname, 'rb') as fid:
+                phvel_str           = fid.read()
+            input_hash              = _get_hash(_get_provenance(self.auxiliary_data.NoiseXcorr[netcode1][stacode1]\
+                                        [netcode2][stacode2][chan1][chan2]), phvel_str)
+            param_hash              = _get_hash(vars(inftan), tb, aftan_method)
+            staid_aux               = netcode1+'/'+stacode1+'/'+netcode2+'/'+stacode2+'/'+channel
+            out_types               = []
+            if basic1:
+                out_types.append('DISPbasic1')
+            if basic2:
+                out_types.append('DISPbasic2')
+            if inftan.pmf and pmf1:
+                out_types.append('DISPpmf1')
+            if inftan.pmf and pmf2:
+                out_types.append('DISPpmf2')
+            is_uptodate             = True
+            for data_type in out_types:
+                if not self._is_uptodate(data_type=data_type, path=staid_aux, input_hash=input_hash, param_hash=param_hash):
+                    is_uptodate     = False
+                    break
+            # up-to-date results are kept in ASDF, aftan is only rerun for the txt output
+            if is_uptodate and outdir == None:
+                continue
+            if f77:
+                aftanTr.aftanf77(pmf=inftan.pmf, piover4=inftan.piover4, vmin=inftan.vmin, vmax=inftan.vmax, tmin=inftan.tmin, tmax=inftan.tmax,
+                    tresh=inftan.tresh, ffact=inftan.ffact, taperl=inftan.taperl, snr=inftan.snr, fmatch=inftan.fmatch, nfin=inftan.nfin,
+                        npoints    =inftan.npoints, perc=inftan.perc, phvelname=phvelname)
+            else:
+                aftanTr.aftan(pmf=inftan.pmf, piover4=inftan.piover4, vmin=inftan.vmin, vmax=inftan.vmax, tmin=inftan.tmin, tmax=inftan.tmax,
+                    tresh=inftan.tresh, ffact=inftan.ffact, taperl=inftan.taperl, snr=inftan.snr, fmatch=inftan.fmatch, nfin=inftan.nfin,
+                        npoints    =inftan.npoints, perc=inftan.perc, phvelname=phvelname)
+            if verbose:
+                print 'aftan analysis for: ' + netcode1+'.'+stacode1+'_'+netcode2+'.'+stacode2+'_'+channel
+            aftanTr.get_snr(ffact=inftan.ffact) # SNR analysis
+            if not is_uptodate:
+                # replace the outdated aftan results in ASDF dataset
+                for data_type in ['DISPbasic1', 'DISPbasic2', 'DISPpmf1', 'DISPpmf2']:
+                    self._del_auxiliary_data(data_type=data_type, path=staid_aux)
+                self._add_aftan_results(staid_aux=staid_aux, results=_get_ftan_results(aftanTr.ftanparam), pmf=inftan.pmf,\
+                        basic1=basic1, basic2=basic2, pmf1=pmf1, pmf2=pmf2, input_hash=input_hash, param_hash=param_hash)
+            if outdir != None:
+                if not os.path.isdir(outdir+'/'+pfx+'/'+staid1):
+                    os.makedirs(outdir+'/'+pfx+'/'+staid1)
+                foutPR              = outdir+'/'+pfx+'/'+netcode1+'.'+stacode1+'/'+ \
                                         pfx+'_'+netcode1+'.'+stacode1+'_'+chan1+'_'+netcode2+'.'+stacode2+'_'+chan2+'.SAC'
-                    aftanTr.ftanparam.writeDISP(foutPR)
+                aftanTr.ftanparam.writeDISP(foutPR)
+        for data_type in ['DISPbasic1', 'DISPbasic2', 'DISPpmf1', 'DISPpmf2']:
+            if data_type in self.auxiliary_data.list():
+                self.update_pair_index(data_type=data_type)
+        if dirty_only:
+            self.clear_dirty(stage='aftan', pairLst=[(pair[0], pair[1]) for pair in pairLst])
         print '== end aftan analysis'
         return
                
-    def xcorr_aftan_mp(self, outdir, channel='ZZ', tb=0., inftan=pyaftan.InputFtanParam(), basic1=True, basic2=True,
-            pmf1=True, pmf2=True, verbose=True, prephdir=None, f77=True, pfx='DISP', subsize=1000, deletedisp=True, nprocess=None):
+    def xcorr_aftan_mp(self, outdir=None, channel='ZZ', tb=0., inftan=pyaftan.InputFtanParam(), basic1=True, basic2=True,
+            pmf1=True, pmf2=True, verbose=True, prephdir=None, f77=True, pfx='DISP', subsize=1000, deletedisp=True, nprocess=None,
+            chunksize=None, timeout=None, dirty_only=False):
         """ aftan analysis of cross-correlation data with multiprocessing
         =======================================================================================
         ::: input parameters :::
         channel     - channel pair for aftan analysis(e.g. 'ZZ', 'TT', 'ZR', 'RZ'...)
         tb          - begin time (default = 0.0)
-        outdir      - directory for output disp binary files
+        outdir      - directory for output disp binary files, only used if deletedisp = False
         inftan      - input aftan parameters
         basic1      - save basic aftan results or not
         basic2      - save basic aftan results(with jump correction) or not
@@ -2347,136 +3519,144 @@ class noiseASDF(pyasdf.ASDFDataSet):
         pmf2        - save pmf aftan results(with jump correction) or not
         prephdir    - directory for predicted phase velocity dispersion curve
         f77         - use aftanf77 or not
-        pfx         - prefix for output txt DISP files
-        subsize     - subsize of processing list, use to prevent lock in multiprocessing process
-        deletedisp  - delete output dispersion files or not
+        pfx         - prefix for output binary DISP files
+        subsize     - number of xcorr traces read and saved to ASDF for each subset
+        deletedisp  - do not keep the disp binary files (default = True)
+                        if False, the results are also written to outdir as binary files
         nprocess    - number of processes
+        chunksize   - number of xcorr traces sent to a worker at once, default is decided by mppool.pool_map
+        timeout     - timeout for each xcorr trace in sec, None for no timeout
+                        no results are saved for the traces not finished within timeout (they are kept dirty)
+        dirty_only  - only process the dirty station pairs (see mark_dirty)
+        ---------------------------------------------------------------------------------------
+        aftan results are returned from the workers and saved to ASDF by the main process,
+        no intermediate files are written (unless deletedisp = False).
+        aftan results computed from the same input and parameters are kept, outdated results are replaced
+        the binary output is still written for the up-to-date pairs if deletedisp = False
+        the aftan code used (aftanf77 or aftan) is recorded in the parameter hash
         ---------------------------------------------------------------------------------------
         ::: output :::
         self.auxiliary_data.DISPbasic1, self.auxiliary_data.DISPbasic2,
         self.auxiliary_data.DISPpmf1, self.auxiliary_data.DISPpmf2
         =======================================================================================
         """
+        if not deletedisp and outdir == None:
+            raise ValueError('outdir must be specified if deletedisp = False!')
         print 'Preparing data for aftan analysis !'
-        staLst                      = self.waveforms.list()
-        inputStream                 = []
-        for staid1 in staLst:
-            if not os.path.isdir(outdir+'/'+pfx+'/'+staid1):
-                os.makedirs(outdir+'/'+pfx+'/'+staid1)
-            for staid2 in staLst:
-                netcode1, stacode1  = staid1.split('.')
-                netcode2, stacode2  = staid2.split('.')
-                if staid1 >= staid2:
-                    continue
-                try:
-                    channels1       = self.auxiliary_data.NoiseXcorr[netcode1][stacode1][netcode2][stacode2].list()
-                    channels2       = self.auxiliary_data.NoiseXcorr[netcode1][stacode1][netcode2][stacode2][channels1[0]].list()
-                    for chan in channels1:
-                        if chan[2]==channel[0]:
-                            chan1   = chan
-                    for chan in channels2:
-                        if chan[2]==channel[1]:
-                            chan2   = chan
-                except KeyError:
-                    continue
-                try:
-                    tr              = self.get_xcorr_trace(netcode1, stacode1, netcode2, stacode2, chan1, chan2)
-                except NameError:
-                    print netcode1+'.'+stacode1+'_'+netcode2+'.'+stacode2+'_'+channel+' not exists!'
+        param_hash                  = _get_hash(vars(inftan), tb, _get_aftan_method(f77))
+        out_types                   = []
+        if basic1:
+            out_types.append('DISPbasic1')
+        if basic2:
+            out_types.append('DISPbasic2')
+        if inftan.pmf and pmf1:
+            out_types.append('DISPpmf1')
+        if inftan.pmf and pmf2:
+            out_types.append('DISPpmf2')
+        # loop over existing station pairs only
+        pairLst                     = self._get_stage_pairs(data_type='NoiseXcorr', stage='aftan', dirty_only=dirty_only)
+        taskLst                     = []
+        for staid1, staid2, dist, az, baz in pairLst:
+            netcode1, stacode1      = staid1.split('.')
+            netcode2, stacode2      = staid2.split('.')
+            # determine channels
+            try:
+                channels1           = self.auxiliary_data.NoiseXcorr[netcode1][stacode1][netcode2][stacode2].list()
+                for chan in channels1:
+                    if chan[-1] == channel[0]:
+                        chan1       = chan
+                        break
+                channels2           = self.auxiliary_data.NoiseXcorr[netcode1][stacode1][netcode2][stacode2][chan1].list()
+                for chan in channels2:
+                    if chan[-1] == channel[1]:
+                        chan2       = chan
+                        break
+            except KeyError:
+                continue
+            # provenance of the aftan results
+            phvel_str               = ''
+            if prephdir != None:
+                phvelname           = prephdir + "/%s.%s.pre" %(staid1, staid2)
+                if not os.path.isfile(phvelname):
+                    print phvelname+' not exists!'
                     continue
+                with open(phvelname, 'rb') as fid:
+                    phvel_str       = fid.read()
+            try:
+                input_hash          = _get_hash(_get_provenance(self.auxiliary_data.NoiseXcorr[netcode1][stacode1]\
+                                        [netcode2][stacode2][chan1][chan2]), phvel_str)
+            except KeyError:
+                print staid1+'_'+chan1+'_'+staid2+'_'+chan2+' not exists!'
+                continue
+            staid_aux               = netcode1+'/'+stacode1+'/'+netcode2+'/'+stacode2+'/'+channel
+            is_uptodate             = True
+            for data_type in out_types:
+                if not self._is_uptodate(data_type=data_type, path=staid_aux, input_hash=input_hash, param_hash=param_hash):
+                    is_uptodate     = False
+                    break
+            # up-to-date results are kept in ASDF, aftan is only rerun for the binary output
+            if is_uptodate and deletedisp:
+                continue
+            if not deletedisp and not os.path.isdir(outdir+'/'+pfx+'/'+staid1):
+                os.makedirs(outdir+'/'+pfx+'/'+staid1)
+            taskLst.append((netcode1, stacode1, netcode2, stacode2, chan1, chan2, staid_aux, input_hash, is_uptodate))
+        #------------------------------------------------------------------
+        # aftan with multiprocessing, the results are returned from
+        # workers and saved to ASDF for each subset of xcorr traces
+        #------------------------------------------------------------------
+        print 'Start multiprocessing aftan analysis !'
+        AFTAN                       = partial(aftan4mp, outdir=(None if deletedisp else outdir), inftan=inftan,\
+                                        prephdir=prephdir, f77=f77, pfx=pfx)
+        Ntotal_traces               = len(taskLst)
+        Nsub                        = int(np.ceil(float(Ntotal_traces)/subsize))
+        # station pairs not finished within timeout, kept dirty
+        failedLst                   = []
+        for isub in range(Nsub):
+            print '--- subset: '+str(isub+1)+'/'+str(Nsub)
+            ctaskLst                = taskLst[isub*subsize:(isub+1)*subsize]
+            inputStream             = []
+            for netcode1, stacode1, netcode2, stacode2, chan1, chan2, staid_aux, input_hash, is_uptodate in ctaskLst:
                 if verbose:
                     print 'preparing aftan data: '+ netcode1+'.'+stacode1+'_'+netcode2+'.'+stacode2+'_'+channel
-                aftanTr             = pyaftan.aftantrace(tr.data, tr.stats)
-                inputStream.append(aftanTr)
-        print 'Start multiprocessing aftan analysis !'
-        if len(inputStream) > subsize:
-            Nsub                    = int(len(inputStream)/subsize)
-            for isub in range(Nsub):
-                print 'Subset:', isub,'in',Nsub,'sets'
-                cstream             = inputStream[isub*subsize:(isub+1)*subsize]
-                AFTAN               = partial(aftan4mp, outdir=outdir, inftan=inftan, prephdir=prephdir, f77=f77, pfx=pfx)
-                pool                = multiprocessing.Pool(processes=nprocess)
-                pool.map(AFTAN, cstream) #make our results with a map call
-                pool.close() #we are not adding any more processes
-                pool.join() #tell it to wait until all threads are done before going on
-            cstream                 = inputStream[(isub+1)*subsize:]
-            AFTAN                   = partial(aftan4mp, outdir=outdir, inftan=inftan, prephdir=prephdir, f77=f77, pfx=pfx)
-            pool                    = multiprocessing.Pool(processes=nprocess)
-            pool.map(AFTAN, cstream) #make our results with a map call
-            pool.close() #we are not adding any more processes
-            pool.join() #tell it to wait until all threads are done before going on
-        else:
-            AFTAN                   = partial(aftan4mp, outdir=outdir, inftan=inftan, prephdir=prephdir, f77=f77, pfx=pfx)
-            pool                    = multiprocessing.Pool(processes=nprocess)
-            pool.map(AFTAN, inputStream) #make our results with a map call
-            pool.close() #we are not adding any more processes
-            pool.join() #tell it to wait until all threads are done before going on
-        print 'End of multiprocessing aftan analysis !'
-        print 'Reading aftan results into ASDF Dataset !'
-        for staid1 in staLst:
-            for staid2 in staLst:
-                netcode1, stacode1  = staid1.split('.')
-                netcode2, stacode2  = staid2.split('.')
-                if stacode1 >= stacode2:
-                    continue
-                try:
-                    channels1       = self.auxiliary_data.NoiseXcorr[netcode1][stacode1][netcode2][stacode2].list()
-                    channels2       = self.auxiliary_data.NoiseXcorr[netcode1][stacode1][netcode2][stacode2][channels1[0]].list()
-                    for chan in channels1:
-                        if chan[2]==channel[0]:
-                            chan1   = chan
-                    for chan in channels2:
-                        if chan[2]==channel[1]:
-                            chan2   = chan
-                except KeyError:
+                tr                  = self.get_xcorr_trace(netcode1, stacode1, netcode2, stacode2, chan1, chan2)
+                inputStream.append(pyaftan.aftantrace(tr.data, tr.stats))
+            resultLst               = mppool.pool_map(AFTAN, inputStream, nprocess=nprocess, chunksize=chunksize, timeout=timeout,\
+                                        allow_failure=True)
+            for itask in range(len(ctaskLst)):
+                netcode1, stacode1, netcode2, stacode2, chan1, chan2, staid_aux, input_hash, is_uptodate\
+                                    = ctaskLst[itask]
+                if mppool.is_failure(resultLst[itask]):
+                    print 'NO aftan results (timeout): '+ netcode1+'.'+stacode1+'_'+netcode2+'.'+stacode2+'_'+channel
+                    failedLst.append((netcode1+'.'+stacode1, netcode2+'.'+stacode2))
                     continue
-                finPR               = pfx+'/'+netcode1+'.'+stacode1+'/'+ \
-                                        pfx+'_'+netcode1+'.'+stacode1+'_'+chan1+'_'+netcode2+'.'+stacode2+'_'+chan2+'.SAC'
-                try:
-                    f10             = np.load(outdir+'/'+finPR+'_1_DISP.0.npz')
-                    f11             = np.load(outdir+'/'+finPR+'_1_DISP.1.npz')
-                    f20             = np.load(outdir+'/'+finPR+'_2_DISP.0.npz')
-                    f21             = np.load(outdir+'/'+finPR+'_2_DISP.1.npz')
-                except IOError:
-                    print 'NO aftan results: '+ netcode1+'.'+stacode1+'_'+netcode2+'.'+stacode2+'_'+channel
+                if is_uptodate:
                     continue
-                print 'Reading aftan results '+ netcode1+'.'+stacode1+'_'+netcode2+'.'+stacode2+'_'+channel
-                if deletedisp:
-                    os.remove(outdir+'/'+finPR+'_1_DISP.0.npz')
-                    os.remove(outdir+'/'+finPR+'_1_DISP.1.npz')
-                    os.remove(outdir+'/'+finPR+'_2_DISP.0.npz')
-                    os.remove(outdir+'/'+finPR+'_2_DISP.1.npz')
-                arr1_1              = f10['arr_0']
-                nfout1_1            = f10['arr_1']
-                arr2_1              = f11['arr_0']
-                nfout2_1            = f11['arr_1']
-                arr1_2              = f20['arr_0']
-                nfout1_2            = f20['arr_1']
-                arr2_2              = f21['arr_0']
-                nfout2_2            = f21['arr_1']
-                staid_aux           = netcode1+'/'+stacode1+'/'+netcode2+'/'+stacode2+'/'+channel
-                if basic1:
-                    parameters      = {'Tc': 0, 'To': 1, 'U': 2, 'C': 3, 'ampdb': 4, 'dis': 5, 'snrdb': 6, 'mhw': 7, 'amp': 8, 'Np': nfout1_1}
-                    self.add_auxiliary_data(data=arr1_1, data_type='DISPbasic1', path=staid_aux, parameters=parameters)
-                if basic2:
-                    parameters      = {'Tc': 0, 'To': 1, 'U': 2, 'C': 3, 'ampdb': 4, 'snrdb': 5, 'mhw': 6, 'amp': 7, 'Np': nfout2_1}
-                    self.add_auxiliary_data(data=arr2_1, data_type='DISPbasic2', path=staid_aux, parameters=parameters)
-                if inftan.pmf:
-                    if pmf1:
-                        parameters  = {'Tc': 0, 'To': 1, 'U': 2, 'C': 3, 'ampdb': 4, 'dis': 5, 'snrdb': 6, 'mhw': 7, 'amp': 8, 'Np': nfout1_2}
-                        self.add_auxiliary_data(data=arr1_2, data_type='DISPpmf1', path=staid_aux, parameters=parameters)
-                    if pmf2:
-                        parameters  = {'Tc': 0, 'To': 1, 'U': 2, 'C': 3, 'ampdb': 4, 'snrdb': 5, 'mhw': 6, 'amp': 7, 'snr':8, 'Np': nfout2_2}
-                        self.add_auxiliary_data(data=arr2_2, data_type='DISPpmf2', path=staid_aux, parameters=parameters)
-        if deletedisp: shutil.rmtree(outdir+'/'+pfx)
+                # remove the outdated aftan results
+                for data_type in ['DISPbasic1', 'DISPbasic2', 'DISPpmf1', 'DISPpmf2']:
+                    self._del_auxiliary_data(data_type=data_type, path=staid_aux)
+                self._add_aftan_results(staid_aux=staid_aux, results=resultLst[itask], pmf=inftan.pmf, basic1=basic1,\
+                        basic2=basic2, pmf1=pmf1, pmf2=pmf2, input_hash=input_hash, param_hash=param_hash)
+        mppool.close_pool()
+        print 'End of multiprocessing aftan analysis !'
+        if len(failedLst) > 0:
+            warnings.warn(str(len(failedLst))+' station pairs not finished within the timeout, no aftan results are saved for them',\
+                          UserWarning, stacklevel=1)
+        for data_type in ['DISPbasic1', 'DISPbasic2', 'DISPpmf1', 'DISPpmf2']:
+            if data_type in self.auxiliary_data.list():
+                self.update_pair_index(data_type=data_type)
+        if dirty_only:
+            failedSet               = set(failedLst)
+            self.clear_dirty(stage='aftan', pairLst=[(pair[0], pair[1]) for pair in pairLst if not (pair[0], pair[1]) in failedSet])
         return
     
-    def interp_disp(self, data_type='DISPpmf2', channel='ZZ', pers=np.array([]), verbose=False):
+    def interp_disp(self, data_type='DISPpmf2', channel='ZZ', pers=np.array([]), dirty_only=False, verbose=False):
         """ Interpolate dispersion curve for a given period array.
         =======================================================================================================
         ::: input parameters :::
         data_type   - dispersion data type (default = DISPpmf2, pmf aftan results after jump detection)
         pers        - period array
+        dirty_only  - only interpolate the dirty station pairs (see mark_dirty)
+        interpolated results computed from the same input and periods are kept, outdated results are replaced
         
         ::: output :::
         self.auxiliary_data.DISPbasic1interp, self.auxiliary_data.DISPbasic2interp,
@@ -2489,60 +3669,232 @@ class noiseASDF(pyasdf.ASDFDataSet):
             ntype   = 5
         if pers.size==0:
             pers    = np.append( np.arange(18.)*2.+6., np.arange(4.)*5.+45.)
-        staLst                      = self.waveforms.list()
-        Nsta                        = len(staLst)
-        Ntotal_traces               = Nsta*(Nsta-1)/2
+        # loop over existing station pairs only
+        pairLst                     = self._get_stage_pairs(data_type=data_type, stage='interp', dirty_only=dirty_only)
+        Ntotal_traces               = len(pairLst)
         iinterp                     = 0
-        Ntr_one_percent             = int(Ntotal_traces/100.)
+        Ntr_one_percent             = max(1, int(Ntotal_traces/100.))
         ipercent                    = 0
+        for staid1, staid2, dist, az, baz in pairLst:
+            netcode1, stacode1      = staid1.split('.')
+            netcode2, stacode2      = staid2.split('.')
+            iinterp                 += 1
+            if np.fmod(iinterp, Ntr_one_percent) ==0:
+                ipercent            += 1
+                print ('*** Number of traces finished interpolating dispersion curve: '+\
+                                str(iinterp)+'/'+str(Ntotal_traces)+' '+str(ipercent)+'%')
+            # only pairs stored in the forward order (staid1 < staid2) are interpolated
+            if staid1 >= staid2:
+                continue
+            try:
+                subdset             = self.auxiliary_data[data_type][netcode1][stacode1][netcode2][stacode2][channel]
+            except KeyError:
+                continue
+            # provenance of the interpolated results
+            staid_aux               = netcode1+'/'+stacode1+'/'+netcode2+'/'+stacode2+'/'+channel
+            input_hash              = _get_provenance(subdset)
+            param_hash              = _get_hash(pers, data_type)
+            if self._is_uptodate(data_type=data_type+'interp', path=staid_aux, input_hash=input_hash, param_hash=param_hash):
+                continue
+            # remove the outdated interpolated results
+            self._del_auxiliary_data(data_type=data_type+'interp', path=staid_aux)
+            data                    = subdset.data.value
+            index                   = subdset.parameters
+            if verbose:
+                print 'interpolating dispersion curve for '+ netcode1+'.'+stacode1+'_'+netcode2+'.'+stacode2+'_'+channel
+            outindex                = { 'To': 0, 'U': 1, 'C': 2,  'amp': 3, 'snr': 4, 'inbound': 5, 'Np': pers.size,\
+                                        'input_hash': input_hash, 'param_hash': param_hash}
+            Np                      = int(index['Np'])
+            if Np < 5:
+                if verbose:
+                    warnings.warn('Not enough datapoints for: '+ netcode1+'.'+stacode1+'_'+netcode2+'.'+stacode2+'_'+channel, UserWarning, stacklevel=1)
+                continue
+            # interpolation
+            obsT                    = data[index['To']][:Np]
+            U                       = np.interp(pers, obsT, data[index['U']][:Np] )
+            C                       = np.interp(pers, obsT, data[index['C']][:Np] )
+            amp                     = np.interp(pers, obsT, data[index['amp']][:Np] )
+            inbound                 = (pers > obsT[0])*(pers < obsT[-1])*1
+            # store interpolated data to interpdata array
+            interpdata              = np.append(pers, U)
+            interpdata              = np.append(interpdata, C)
+            interpdata              = np.append(interpdata, amp)
+            if data_type=='DISPpmf2':
+                snr                 = np.interp(pers, obsT, data[index['snr']][:Np] )
+                interpdata          = np.append(interpdata, snr)
+            interpdata              = np.append(interpdata, inbound)
+            interpdata              = interpdata.reshape(ntype, pers.size)
+            self.add_auxiliary_data(data=interpdata, data_type=data_type+'interp', path=staid_aux, parameters=outindex)
+        self.update_pair_index(data_type=data_type+'interp')
+        if dirty_only:
+            self.clear_dirty(stage='interp', pairLst=[(pair[0], pair[1]) for pair in pairLst])
+        return
+    
+    def get_raytomo_table(self, staLst, channel='ZZ', pers=np.array([]), data_type='DISPpmf2interp', verbose=True):
+        """
+        Gather the dispersion data of all station pairs into a columnar table in one pass
+        =======================================================================================================
+        ::: input parameters :::
+        staLst          - list of station id (netcode.stacode)
+        channel         - channel for tomography
+        pers            - period array
+        data_type       - dispersion data type (default = DISPpmf2interp, interpolated pmf aftan results)
+        ::: output :::
+        table           - dictionary of arrays, one row per station pair with data
+                            iray                    : (Npair) index of the pair among all the pairs of staLst
+                            staid1, staid2          : (Npair) station ids
+                            lat1, lon1, lat2, lon2  : (Npair) station locations, longitude in [0, 360)
+                            dist                    : (Npair) interstation distance in km
+                            C, U, snr, inbound      : (Npair, Nper) data at pers, nan if the period is not found
+                            pers                    : (Nper) period array
+        =======================================================================================================
+        """
+        Nsta            = len(staLst)
+        Ntotal_traces   = Nsta*(Nsta-1)/2
+        Ntr_one_percent = max(1, int(Ntotal_traces/100.))
+        ipercent        = 0
+        iray            = -1
+        # station coordinates are read only once for each station
+        coords          = {}
+        irayLst         = []
+        staid1Lst       = []
+        staid2Lst       = []
+        geoLst          = []
+        dataLst         = []
         for staid1 in staLst:
             for staid2 in staLst:
                 netcode1, stacode1  = staid1.split('.')
                 netcode2, stacode2  = staid2.split('.')
                 if staid1 >= staid2:
                     continue
-                iinterp             += 1
-                if np.fmod(iinterp, Ntr_one_percent) ==0:
+                # print how many rays has been processed 
+                iray                += 1
+                if verbose and np.fmod(iray+1, Ntr_one_percent) ==0:
                     ipercent        += 1
-                    print ('*** Number of traces finished interpolating dispersion curve: '+\
-                                    str(iinterp)+'/'+str(Ntotal_traces)+' '+str(ipercent)+'%')
+                    print ('*** Number of traces finished generating raytomo input: '+str(iray)+'/'+str(Ntotal_traces)+' '+str(ipercent)+'%')
+                # get data
                 try:
                     subdset         = self.auxiliary_data[data_type][netcode1][stacode1][netcode2][stacode2][channel]
-                except KeyError:
+                except:
                     continue
+                for staid in (staid1, staid2):
+                    if not staid in coords:
+                        lat, elv, lon   = self.waveforms[staid].coordinates.values()
+                        coords[staid]   = (lat, lon)
+                lat1, lon1          = coords[staid1]
+                lat2, lon2          = coords[staid2]
+                dist, az, baz       = obspy.geodetics.gps2dist_azimuth(lat1, lon1, lat2, lon2) # distance is in m
                 data                = subdset.data.value
                 index               = subdset.parameters
-                if verbose:
-                    print 'interpolating dispersion curve for '+ netcode1+'.'+stacode1+'_'+netcode2+'.'+stacode2+'_'+channel
-                outindex            = { 'To': 0, 'U': 1, 'C': 2,  'amp': 3, 'snr': 4, 'inbound': 5, 'Np': pers.size }
-                Np                  = int(index['Np'])
-                if Np < 5:
-                    if verbose:
-                        warnings.warn('Not enough datapoints for: '+ netcode1+'.'+stacode1+'_'+netcode2+'.'+stacode2+'_'+channel, UserWarning, stacklevel=1)
-                    continue
-                # interpolation
-                obsT                = data[index['To']][:Np]
-                U                   = np.interp(pers, obsT, data[index['U']][:Np] )
-                C                   = np.interp(pers, obsT, data[index['C']][:Np] )
-                amp                 = np.interp(pers, obsT, data[index['amp']][:Np] )
-                inbound             = (pers > obsT[0])*(pers < obsT[-1])*1
-                # store interpolated data to interpdata array
-                interpdata          = np.append(pers, U)
-                interpdata          = np.append(interpdata, C)
-                interpdata          = np.append(interpdata, amp)
-                if data_type=='DISPpmf2':
-                    snr             = np.interp(pers, obsT, data[index['snr']][:Np] )
-                    interpdata      = np.append(interpdata, snr)
-                interpdata          = np.append(interpdata, inbound)
-                interpdata          = interpdata.reshape(ntype, pers.size)
-                staid_aux           = netcode1+'/'+stacode1+'/'+netcode2+'/'+stacode2+'/'+channel
-                self.add_auxiliary_data(data=interpdata, data_type=data_type+'interp', path=staid_aux, parameters=outindex)
+                # index of each period in the dispersion data, -1 for missing ones
+                To                  = data[index['To']][:]
+                match               = (To[None, :] == pers[:, None])
+                ind_per             = np.where(match.any(axis=1), match.argmax(axis=1), -1)
+                perdata             = np.zeros((4, pers.size), dtype=np.float64)
+                perdata[:]          = np.nan
+                for ival, key in enumerate(['C', 'U', 'snr', 'inbound']):
+                    perdata[ival, ind_per>=0]   = data[index[key]][ind_per[ind_per>=0]]
+                irayLst.append(iray)
+                staid1Lst.append(staid1)
+                staid2Lst.append(staid2)
+                geoLst.append([lat1, lon1, lat2, lon2, dist/1000.])
+                dataLst.append(perdata)
+        geoArr          = np.array(geoLst, dtype=np.float64).reshape(-1, 5)
+        dataArr         = np.array(dataLst, dtype=np.float64).reshape(-1, 4, pers.size)
+        lon1            = geoArr[:, 1]
+        lon2            = geoArr[:, 3]
+        lon1[lon1<0]    += 360.
+        lon2[lon2<0]    += 360.
+        table           = {'iray': np.array(irayLst, dtype=np.int64), 'staid1': np.array(staid1Lst, dtype=object),
+                            'staid2': np.array(staid2Lst, dtype=object), 'lat1': geoArr[:, 0], 'lon1': lon1,
+                            'lat2': geoArr[:, 2], 'lon2': lon2, 'dist': geoArr[:, 4], 'C': dataArr[:, 0, :],
+                            'U': dataArr[:, 1, :], 'snr': dataArr[:, 2, :], 'inbound': dataArr[:, 3, :], 'pers': pers}
+        return table
+    
+    def _write_raytomo_table(self, table, outdir, outpfx='raytomo_in_', channel='ZZ', lambda_factor=3., snr_thresh=15.,\
+                             netcodelst=[], inmemory=False):
+        """
+        Select the data in the table from get_raytomo_table with vectorized masks, write them to the input files
+        of Barmine's straight ray surface wave tomography code (or return them in memory)
+        =======================================================================================================
+        ::: input parameters :::
+        table           - columnar table from get_raytomo_table
+        outdir          - output directory
+        outpfx          - prefix for output files
+        channel         - channel for tomography
+        lambda_factor   - wavelength factor for data selection
+        snr_thresh      - threshold SNR
+        netcodelst      - network list for data selection, both stations of a pair must be in it
+        inmemory        - return the selected data instead of writing the files
+        ::: output :::
+        (inmemory = True only)
+        outdict         - dictionary, outdict['%g' %per]['ph'/'gr'] is an (N, 7) array in the format of the input files:
+                            iray lat1 lon1 lat2 lon2 velocity 1.
+                            can be used directly by raytomo.RayTomoDataSet.run_smooth_sparse (indata)
+        =======================================================================================================
+        """
+        pers            = table['pers']
+        dist            = table['dist']
+        Npair           = dist.size
+        # wavelength criteria
+        mask            = dist[:, None] >= lambda_factor*pers[None, :]*3.5
+        if np.any(mask*np.isnan(table['C'])):
+            iper        = np.where((mask*np.isnan(table['C'])).any(axis=0))[0][0]
+            raise AttributeError('No interpolated dispersion curve data for period='+str(pers[iper])+' sec!')
+        # quality control
+        pvel            = table['C']
+        gvel            = table['U']
+        snr             = table['snr']
+        with np.errstate(invalid='ignore'):
+            mask        *= (table['inbound'] == 1.)
+            mask        *= (pvel >= 0)*(gvel >= 0)*(pvel <= 10)*(gvel <= 10)*(snr <= 1e10)
+            mask        *= (snr >= snr_thresh)
+        if len(netcodelst) != 0:
+            innet       = np.array([staid1.split('.')[0] in netcodelst and staid2.split('.')[0] in netcodelst \
+                            for staid1, staid2 in zip(table['staid1'], table['staid2'])], dtype=bool).reshape(Npair)
+            mask        *= innet[:, None]
+        outdict         = {}
+        if not inmemory and not os.path.isdir(outdir):
+            os.makedirs(outdir)
+        for iper in range(pers.size):
+            per         = pers[iper]
+            ind         = mask[:, iper]
+            Nsel        = ind.sum()
+            if inmemory:
+                outArr          = np.ones((Nsel, 7), dtype=np.float64)
+                outArr[:, 0]    = table['iray'][ind]
+                outArr[:, 1]    = table['lat1'][ind]
+                outArr[:, 2]    = table['lon1'][ind]
+                outArr[:, 3]    = table['lat2'][ind]
+                outArr[:, 4]    = table['lon2'][ind]
+                phArr           = outArr.copy()
+                phArr[:, 5]     = pvel[ind, iper]
+                grArr           = outArr
+                grArr[:, 5]     = gvel[ind, iper]
+                outdict['%g'%( per )]   = {'ph': phArr, 'gr': grArr}
+                continue
+            outArr          = np.empty((Nsel, 8), dtype=object)
+            outArr[:, 0]    = table['iray'][ind]
+            outArr[:, 1]    = table['lat1'][ind]
+            outArr[:, 2]    = table['lon1'][ind]
+            outArr[:, 3]    = table['lat2'][ind]
+            outArr[:, 4]    = table['lon2'][ind]
+            outArr[:, 6]    = table['staid1'][ind]
+            outArr[:, 7]    = table['staid2'][ind]
+            for key, vel in [('ph', pvel), ('gr', gvel)]:
+                fname           = outdir+'/'+outpfx+'%g'%( per ) +'_'+channel+'_'+key+'.lst'
+                outArr[:, 5]    = vel[ind, iper]
+                np.savetxt(fname, outArr, fmt='%d %g %g %g %g %g 1. %s %s 1 1 ')
+        if inmemory:
+            return outdict
         return
     
     def xcorr_raytomoinput(self, outdir, staxml=None, netcodelst=[], lambda_factor=3., snr_thresh=15., channel='ZZ',\
-                           pers=np.array([]), outpfx='raytomo_in_', data_type='DISPpmf2interp', verbose=True):
+                           pers=np.array([]), outpfx='raytomo_in_', data_type='DISPpmf2interp', verbose=True, inmemory=False):
         """
         Generate input files for Barmine's straight ray surface wave tomography code.
+        The data of all station pairs are gathered into a columnar table (get_raytomo_table) in one pass,
+        the data selection is then done with vectorized masks and each output file is written at once.
         =======================================================================================================
         ::: input parameters :::
         outdir          - output directory
@@ -2554,26 +3906,15 @@ class noiseASDF(pyasdf.ASDFDataSet):
         pers            - period array
         outpfx          - prefix for output files, default is 'raytomo_in_'
         data_type       - dispersion data type (default = DISPpmf2, pmf aftan results after jump detection)
+        inmemory        - return the selected data in memory instead of writing the files (see _write_raytomo_table)
         -------------------------------------------------------------------------------------------------------
         Output format:
         outdir/outpfx+per_channel_ph.lst
         =======================================================================================================
         """
         print ('=== Generating straight ray tomography input files')
-        if not os.path.isdir(outdir):
-            os.makedirs(outdir)
         if pers.size==0:
             pers        = np.append( np.arange(18.)*2.+6., np.arange(4.)*5.+45.)
-        # open output files
-        fph_lst         = []
-        fgr_lst         = []
-        for per in pers:
-            fname_ph    = outdir+'/'+outpfx+'%g'%( per ) +'_'+channel+'_ph.lst' %( per )
-            fname_gr    = outdir+'/'+outpfx+'%g'%( per ) +'_'+channel+'_gr.lst' %( per )
-            fph         = open(fname_ph, 'w')
-            fgr         = open(fname_gr, 'w')
-            fph_lst.append(fph)
-            fgr_lst.append(fgr)
         #--------------------------------------------------------------------------
         # added the functionality of using stations from an input StationXML file
         #--------------------------------------------------------------------------
@@ -2600,70 +3941,11 @@ class noiseASDF(pyasdf.ASDFDataSet):
                     continue
                 staLst.append(staid)
             print '--- Select stations according to network code: '+str(len(staLst))+'/'+str(len(staLst_ALL))+' (selected/all)'
-        # Loop over stations
-        Nsta            = len(staLst)
-        Ntotal_traces   = Nsta*(Nsta-1)/2
-        Ntr_one_percent = int(Ntotal_traces/100.)
-        ipercent        = 0
-        iray            = -1
-        for staid1 in staLst:
-            for staid2 in staLst:
-                netcode1, stacode1  = staid1.split('.')
-                netcode2, stacode2  = staid2.split('.')
-                if staid1 >= staid2:
-                    continue
-                # print how many rays has been processed 
-                iray                += 1
-                if np.fmod(iray+1, Ntr_one_percent) ==0:
-                    ipercent        += 1
-                    print ('*** Number of traces finished generating raytomo input: '+str(iray)+'/'+str(Ntotal_traces)+' '+str(ipercent)+'%')
-                # get data
-                try:
-                    subdset         = self.auxiliary_data[data_type][netcode1][stacode1][netcode2][stacode2][channel]
-                except:
-                    continue
-                lat1, elv1, lon1    = self.waveforms[staid1].coordinates.values()
-                lat2, elv2, lon2    = self.waveforms[staid2].coordinates.values()
-                dist, az, baz       = obspy.geodetics.gps2dist_azimuth(lat1, lon1, lat2, lon2) # distance is in m
-                dist                = dist/1000.
-                if lon1<0:
-                    lon1            +=360.
-                if lon2<0:
-                    lon2            +=360.
-                data                = subdset.data.value
-                index               = subdset.parameters
-                for iper in range(pers.size):
-                    per             = pers[iper]
-                    # wavelength criteria
-                    if dist < lambda_factor*per*3.5:
-                        continue
-                    # if dist > 1200.:
-                    #     continue 
-                    ind_per         = np.where(data[index['To']][:] == per)[0]
-                    if ind_per.size==0:
-                        raise AttributeError('No interpolated dispersion curve data for period='+str(per)+' sec!')
-                    pvel            = data[index['C']][ind_per]
-                    gvel            = data[index['U']][ind_per]
-                    snr             = data[index['snr']][ind_per]
-                    inbound         = data[index['inbound']][ind_per]
-                    # quality control
-                    if inbound != 1.:
-                        continue
-                    if pvel < 0 or gvel < 0 or pvel>10 or gvel>10 or snr >1e10:
-                        continue
-                    if snr < snr_thresh: # SNR larger than 15.
-                        continue
-                    fph             = fph_lst[iper]
-                    fgr             = fgr_lst[iper]
-                    fph.writelines("%d %g %g %g %g %g 1. %s %s 1 1 \n" %(iray, lat1, lon1, lat2, lon2, pvel, staid1, staid2))
-                    fgr.writelines("%d %g %g %g %g %g 1. %s %s 1 1 \n" %(iray, lat1, lon1, lat2, lon2, gvel, staid1, staid2))
-        for iper in range(pers.size):
-            fph                     = fph_lst[iper]
-            fgr                     = fgr_lst[iper]
-            fph.close()
-            fgr.close()
+        table           = self.get_raytomo_table(staLst, channel=channel, pers=pers, data_type=data_type, verbose=verbose)
+        outdict         = self._write_raytomo_table(table, outdir=outdir, outpfx=outpfx, channel=channel, lambda_factor=lambda_factor,\
+                            snr_thresh=snr_thresh, inmemory=inmemory)
         print ('=== end of generating straight ray tomography input files')
-        return
+        return outdict
     
     def xcorr_raytomoinput_debug(self, outdir, exclude_stalst=None, staxml=None, netcodelst=[], stacodelst=[],  lambda_factor=3.,\
                 snr_thresh=15., channel='ZZ', pers=np.array([]), outpfx='raytomo_in_', data_type='DISPpmf2interp', verbose=True):
@@ -2686,20 +3968,8 @@ class noiseASDF(pyasdf.ASDFDataSet):
         =======================================================================================================
         """
         print ('=== Generating straight ray tomography input files')
-        if not os.path.isdir(outdir):
-            os.makedirs(outdir)
         if pers.size==0:
             pers        = np.append( np.arange(18.)*2.+6., np.arange(4.)*5.+45.)
-        # open output files
-        fph_lst         = []
-        fgr_lst         = []
-        for per in pers:
-            fname_ph    = outdir+'/'+outpfx+'%g'%( per ) +'_'+channel+'_ph.lst' %( per )
-            fname_gr    = outdir+'/'+outpfx+'%g'%( per ) +'_'+channel+'_gr.lst' %( per )
-            fph         = open(fname_ph, 'w')
-            fgr         = open(fname_gr, 'w')
-            fph_lst.append(fph)
-            fgr_lst.append(fgr)
         #--------------------------------------------------------------------------
         # added the functionality of using stations from an input StationXML file
         #--------------------------------------------------------------------------
@@ -2753,69 +4023,9 @@ class noiseASDF(pyasdf.ASDFDataSet):
                         continue
                 staLst.append(staid)
             print '--- Select stations according to network code: '+str(len(staLst))+'/'+str(len(staLst_ALL))+' (selected/all)'
-        # Loop over stations
-        # return
-        Nsta            = len(staLst)
-        Ntotal_traces   = Nsta*(Nsta-1)/2
-        Ntr_one_percent = int(Ntotal_traces/100.)
-        ipercent        = 0
-        iray            = -1
-        for staid1 in staLst:
-            for staid2 in staLst:
-                netcode1, stacode1  = staid1.split('.')
-                netcode2, stacode2  = staid2.split('.')
-                if staid1 >= staid2:
-                    continue
-                # print how many rays has been processed 
-                iray                += 1
-                if np.fmod(iray+1, Ntr_one_percent) ==0:
-                    ipercent        += 1
-                    print ('*** Number of traces finished generating raytomo input: '+str(iray)+'/'+str(Ntotal_traces)+' '+str(ipercent)+'%')
-                # get data
-                try:
-                    subdset         = self.auxiliary_data[data_type][netcode1][stacode1][netcode2][stacode2][channel]
-                except:
-                    continue
-                lat1, elv1, lon1    = self.waveforms[staid1].coordinates.values()
-                lat2, elv2, lon2    = self.waveforms[staid2].coordinates.values()
-                dist, az, baz       = obspy.geodetics.gps2dist_azimuth(lat1, lon1, lat2, lon2) # distance is in m
-                dist                = dist/1000.
-                if lon1<0:
-                    lon1            +=360.
-                if lon2<0:
-                    lon2            +=360.
-                data                = subdset.data.value
-                index               = subdset.parameters
-                for iper in range(pers.size):
-                    per             = pers[iper]
-                    # wavelength criteria
-                    if dist < lambda_factor*per*3.5:
-                        continue
-                    # if dist > 1200.:
-                    #     continue 
-                    ind_per         = np.where(data[index['To']][:] == per)[0]
-                    if ind_per.size==0:
-                        raise AttributeError('No interpolated dispersion curve data for period='+str(per)+' sec!')
-                    pvel            = data[index['C']][ind_per]
-                    gvel            = data[index['U']][ind_per]
-                    snr             = data[index['snr']][ind_per]
-                    inbound         = data[index['inbound']][ind_per]
-                    # quality control
-                    if inbound != 1.:
-                        continue
-                    if pvel < 0 or gvel < 0 or pvel>10 or gvel>10 or snr >1e10:
-                        continue
-                    if snr < snr_thresh: # SNR larger than 15.
-                        continue
-                    fph             = fph_lst[iper]
-                    fgr             = fgr_lst[iper]
-                    fph.writelines("%d %g %g %g %g %g 1. %s %s 1 1 \n" %(iray, lat1, lon1, lat2, lon2, pvel, staid1, staid2))
-                    fgr.writelines("%d %g %g %g %g %g 1. %s %s 1 1 \n" %(iray, lat1, lon1, lat2, lon2, gvel, staid1, staid2))
-        for iper in range(pers.size):
-            fph                     = fph_lst[iper]
-            fgr                     = fgr_lst[iper]
-            fph.close()
-            fgr.close()
+        table           = self.get_raytomo_table(staLst, channel=channel, pers=pers, data_type=data_type, verbose=verbose)
+        self._write_raytomo_table(table, outdir=outdir, outpfx=outpfx, channel=channel, lambda_factor=lambda_factor,\
+            snr_thresh=snr_thresh)
         print ('=== end of generating straight ray tomography input files')
         return
     
@@ -2834,6 +4044,7 @@ class noiseASDF(pyasdf.ASDFDataSet):
         datatype        - dispersion data type (default = DISPpmf2interp, interpolated pmf aftan results after jump detection)
         ::: output :::
         self.auxiliary_data.FieldDISPpmf2interp
+            field data of a station computed from the same input and parameters are kept (if outdir is None)
         ============================================================================================================================
         """
         print ('=== generating arrays for eikonal tomography')
@@ -2866,6 +4077,22 @@ class noiseASDF(pyasdf.ASDFDataSet):
                     continue
                 staLst.append(staid)
             print '--- Select stations according to network code: '+str(len(staLst))+'/'+str(len(staLst_ALL))+' (selected/all)'
+        #--------------------------------------------------------------------------
+        # neighbor lists of the existing station pairs from the pair index
+        #--------------------------------------------------------------------------
+        staLst_index, staArr= self._get_sta_table()
+        staDict             = dict(zip(staLst, range(len(staLst))))
+        pairDict            = {}
+        for staid in staLst:
+            pairDict[staid] = {}
+        for staidA, staidB, dist, az, baz in self.get_pair_index(data_type=data_type):
+            if not (staidA in staDict and staidB in staDict):
+                continue
+            # data stored as staidA/staidB is used in preference to staidB/staidA
+            pairDict[staidA][staidB]    = (dist, True)
+            if not staidA in pairDict[staidB]:
+                pairDict[staidB][staidA]= (dist, False)
+        staDict_index       = dict(zip(staLst_index, range(len(staLst_index))))
         # Loop over stations
         for staid1 in staLst:
             field_lst   = []
@@ -2874,27 +4101,56 @@ class noiseASDF(pyasdf.ASDFDataSet):
                 field_lst.append(np.array([]))
                 Nfplst.append(0)
             try:
-                lat1, elv1, lon1    = self.waveforms[staid1].coordinates.values()
-            except:
+                lon1    = staArr[staDict_index[staid1], 0]
+                lat1    = staArr[staDict_index[staid1], 1]
+            except KeyError:
                 print 'WARNING: No station:' +staid1+' in the database'
                 continue
+            netcode1, stacode1  = staid1.split('.')
             Ndata       = 0
-            for staid2 in staLst:
-                if staid1 == staid2:
-                    continue
-                netcode1, stacode1  = staid1.split('.')
+            # same order of receivers as in staLst
+            recLst      = []
+            for staid2 in sorted(pairDict[staid1].keys(), key=lambda staid: staDict[staid]):
+                dist, isfirst       = pairDict[staid1][staid2]
                 netcode2, stacode2  = staid2.split('.')
+                if isfirst:
+                    subdset         = self.auxiliary_data[data_type][netcode1][stacode1][netcode2][stacode2]
+                else:
+                    subdset         = self.auxiliary_data[data_type][netcode2][stacode2][netcode1][stacode1]
                 try:
-                    subdset         = self.auxiliary_data[data_type][netcode1][stacode1][netcode2][stacode2][channel]
-                except:
-                    try:
-                        subdset     = self.auxiliary_data[data_type][netcode2][stacode2][netcode1][stacode1][channel]
-                    except:
-                        continue
+                    subdset         = subdset[channel]
+                except KeyError:
+                    continue
+                recLst.append((staid2, dist, subdset))
+            #--------------------------------------------------------------------------
+            # provenance, field data computed from the same input and parameters are
+            # kept if no txt output is required
+            #--------------------------------------------------------------------------
+            staid_aux   = netcode1+'/'+stacode1+'/'+channel
+            input_hash  = _get_hash(lon1, lat1, [(staid2, dist, staArr[staDict_index[staid2], :2], _get_provenance(subdset))\
+                                    for staid2, dist, subdset in recLst])
+            param_hash  = _get_hash(pers, lambda_factor, snr_thresh, channel, data_type)
+            if outdir is None:
+                try:
+                    perLst  = self.auxiliary_data['Field'+data_type][netcode1][stacode1][channel].list()
+                except KeyError:
+                    perLst  = []
+                is_uptodate = len(perLst) > 0
+                for perid in perLst:
+                    if not self._is_uptodate(data_type='Field'+data_type, path=staid_aux+'/'+perid,\
+                            input_hash=input_hash, param_hash=param_hash):
+                        is_uptodate = False
+                        break
+                if is_uptodate:
+                    if verbose:
+                        print 'Field data up to date for: '+staid1
+                    continue
+            # remove the outdated field data
+            self._del_auxiliary_data(data_type='Field'+data_type, path=staid_aux)
+            for staid2, dist, subdset in recLst:
                 Ndata               +=1
-                lat2, elv2, lon2    = self.waveforms[staid2].coordinates.values()
-                dist, az, baz       = obspy.geodetics.gps2dist_azimuth(lat1, lon1, lat2, lon2) # distance is in m
-                dist                = dist/1000.
+                lon2                = staArr[staDict_index[staid2], 0]
+                lat2                = staArr[staDict_index[staid2], 1]
                 if lon1<0:
                     lon1    += 360.
                 if lon2<0:
@@ -2937,7 +4193,8 @@ class noiseASDF(pyasdf.ASDFDataSet):
                 if not os.path.isdir(outdir):
                     os.makedirs(outdir)
             # save data
-            staid_aux   = netcode1+'/'+stacode1+'/'+channel
+            outindex['input_hash']  = input_hash
+            outindex['param_hash']  = param_hash
             for iper in range(pers.size):
                 per                 = pers[iper]
                 del_per             = per-int(per)
@@ -3174,80 +4431,25 @@ class noiseASDF(pyasdf.ASDFDataSet):
     #             field2d.read_array(lonArr = inlons, latArr = inlats, ZarrIn = distArr/Zarr )
         
             
-def stack4mp(invpair, datadir, outdir, ylst, mlst, pfx, fnametype):
-    stackedST       = []
-    init_stack_flag = False
-    # station 1
-    netcode1        = invpair[0].networks[0].code
-    stacode1        = invpair[0].networks[0].stations[0].code
-    channels1       = invpair[0].networks[0].stations[0].channels
-    staid1          = netcode1+'.'+stacode1
-    # station 2
-    netcode2        = invpair[1].networks[0].code
-    stacode2        = invpair[1].networks[0].stations[0].code
-    channels2       = invpair[1].networks[0].stations[0].channels
-    staid2          = netcode2+'.'+stacode2
-    mnumb           = mlst.size
-    for im in xrange(mnumb):
-        skip_this_month = False
-        cST     = []
-        for chan1 in channels1:
-            if skip_this_month:
-                break
-            for chan2 in channels2:
-                month       = monthdict[mlst[im]]
-                yrmonth     = str(ylst[im])+'.'+month
-                if fnametype    == 1:
-                    fname   = datadir+'/'+yrmonth+'/'+pfx+'/'+staid1+'/'+pfx+'_'+staid1+'_'+chan1.code+'_'+staid2+'_'+chan2.code+'.SAC'
-                elif fnametype  == 2:
-                    fname   = datadir+'/'+yrmonth+'/'+pfx+'/'+stacode1+'/'+pfx+'_'+stacode1+'_'+stacode2+'.SAC'
-                ############
-                elif fnametype  == 3:
-                    fname   = datadir+'/'+yrmonth+'/'+pfx+'/'+stacode1+'/'+pfx+'_'+stacode1+'_'+chan1.code+'_'+stacode2+'_'+chan2.code+'.SAC'
-                ############
-                if not os.path.isfile(fname):
-                    skip_this_month = True
-                    break
-                try:
-                    # # # tr              = obspy.core.read(fname)[0]
-                    tr              = obspy.io.sac.SACTrace.read(fname)
-                except TypeError:
-                    warnings.warn('Unable to read SAC for: ' + staid1 +'_'+staid2 +' Month: '+yrmonth, UserWarning, stacklevel=1)
-                    skip_this_month = True
-                if (np.isnan(tr.data)).any() or abs(tr.data.max())>1e20:
-                    warnings.warn('NaN monthly SAC for: ' + staid1 +'_'+staid2 +' Month: '+yrmonth, UserWarning, stacklevel=1)
-                    skip_this_month = True
-                    break
-                cST.append(tr)
-        if len(cST) != (len(channels1)*len(channels2)) or skip_this_month:
-            continue
-        if init_stack_flag:
-            for itr in xrange(len(cST)):
-                mtr                             = cST[itr]
-                stackedST[itr].data             += mtr.data
-                # # # stackedST[itr].stats.sac.user0  += mtr.stats.sac.user0
-                stackedST[itr].user0            += mtr.user0
-        else:
-            stackedST       = copy.deepcopy(cST)
-            init_stack_flag = True
-    if len(stackedST)== (len(channels1)*len(channels2)) :
-        # print 'Finished Stacking for:'+staid1+'_'+staid2
-        itrace              = 0
-        for chan1 in channels1:
-            for chan2 in channels2:
-                stackedTr   = stackedST[itrace]
-                outfname    = outdir+'/'+pfx+'/'+staid1+'/'+ \
-                            pfx+'_'+staid1+'_'+chan1.code+'_'+staid2+'_'+chan2.code+'.SAC'
-                if 'kcmpnm' in stackedTr.stats.sac:
-                    if stackedTr.stats.sac.kcmpnm != chan1.code + chan2.code:
-                        raise ValueError('Inconsistent channels: '+ stackedTr.stats.sac.kcmpnm+' '+\
-                                    chan1.code+' '+ chan2.code)
-                stackedTr.write(outfname, format='SAC')
-                itrace      += 1
-    return
+def stack4mp(stapair, datadir, ylst, mlst, pfx, fnametype, use_mmap=False):
+    """stack monthly cross-correlations of a station pair, the stacked data are returned instead of written to sac files
+    ::: input parameters :::
+    stapair     - (staid1, staid2, chans1, chans2, date1, date2), date1/date2 are the start/end date of station 1/2
+    ::: output :::
+    stackArr, stackday, hdrLst (see _stack_monthly_sac)
+    months      - stacked months (year*100 + month)
+    """
+    staid1, staid2, chans1, chans2, date1, date2   = stapair
+    fnameLst, monthLst  = _get_stack_fnames(datadir=datadir, ylst=ylst, mlst=mlst, pfx=pfx, fnametype=fnametype,\
+                            staid1=staid1, staid2=staid2, chans1=chans1, chans2=chans2, date1=date1, date2=date2)
+    stackArr, stackday, hdrLst, istackLst\
+                        = _stack_monthly_sac(fnameLst, use_mmap=use_mmap, label=staid1+'_'+staid2)
+    return stackArr, stackday, hdrLst, [monthLst[i] for i in istackLst]
 
 def aftan4mp(aTr, outdir, inftan, prephdir, f77, pfx):
-    # print 'aftan analysis for: '+ aTr.stats.sac.kuser0+'.'+aTr.stats.sac.kevnm+'_'+chan1+'_'+aTr.stats.network+'.'+aTr.stats.station+'_'+chan2
+    """aftan analysis of a xcorr trace, the compact results are returned to the main process
+        the results are also written to outdir as binary files if outdir is not None
+    """
     if prephdir !=None:
         phvelname   = prephdir + "/%s.%s.pre" %(aTr.stats.sac.kuser0+'.'+aTr.stats.sac.kevnm, aTr.stats.network+'.'+aTr.stats.station)
     else:
@@ -3263,12 +4465,13 @@ def aftan4mp(aTr, outdir, inftan, prephdir, f77, pfx):
             tresh=inftan.tresh, ffact=inftan.ffact, taperl=inftan.taperl, snr=inftan.snr, fmatch=inftan.fmatch, nfin=inftan.nfin,
                 npoints=inftan.npoints, perc=inftan.perc, phvelname=phvelname)
     aTr.get_snr(ffact=inftan.ffact) # SNR analysis
-    chan1           = aTr.stats.sac.kcmpnm[:3]
-    chan2           = aTr.stats.sac.kcmpnm[3:]
-    foutPR          = outdir+'/'+pfx+'/'+aTr.stats.sac.kuser0+'.'+aTr.stats.sac.kevnm+'/'+ \
+    if outdir is not None:
+        chan1       = aTr.stats.sac.kcmpnm[:3]
+        chan2       = aTr.stats.sac.kcmpnm[3:]
+        foutPR      = outdir+'/'+pfx+'/'+aTr.stats.sac.kuser0+'.'+aTr.stats.sac.kevnm+'/'+ \
                         pfx+'_'+aTr.stats.sac.kuser0+'.'+aTr.stats.sac.kevnm+'_'+chan1+'_'+aTr.stats.network+'.'+aTr.stats.station+'_'+chan2+'.SAC'
-    aTr.ftanparam.writeDISPbinary(foutPR)
-    return
+        aTr.ftanparam.writeDISPbinary(foutPR)
+    return _get_ftan_results(aTr.ftanparam)
     
     
     
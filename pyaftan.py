@@ -59,6 +59,32 @@ def _aftan_gaussian_filter(alpha, omega0, ns, indata, omsArr):
     filterred_data[ns/2-1]  = filterred_data[ns/2-1].real+0.j
     return filterred_data
 
+def _aftan_gaussian_filter_bank(alpha, omegaArr, ns, indata, omsArr):
+    """Internal Gaussian filter bank used for aftan, all the central frequencies are filtered at once
+        vectorized version of _aftan_gaussian_filter, output[k, :] is the same as
+        _aftan_gaussian_filter(alpha, omegaArr[k], ns, indata, omsArr)
+    """
+    nhalf                       = ns/2
+    omega0                      = omegaArr[:, None]
+    # only the positive frequencies are filtered, the negative frequencies are zero padded
+    domsArr                     = omsArr[None, :nhalf] - omega0
+    om2                         = -domsArr*domsArr*alpha/omega0/omega0
+    b                           = np.exp(om2)
+    b[np.abs(om2)>=40.]         = 0.
+    filterred_data              = np.zeros((omegaArr.size, ns), dtype=np.complex128)
+    filterred_data[:, :nhalf]   = indata[None, :nhalf]*b
+    filterred_data[:, 0]        /= 2
+    filterred_data[:, nhalf-1]  = filterred_data[:, nhalf-1].real+0.j
+    return filterred_data
+
+def _ifft_bank(filterS, ns):
+    """Internal batched inverse FFT along the frequency axis of a filter bank
+    """
+    if useFFTW:
+        return pyfftw.interfaces.numpy_fft.ifft(filterS, ns, axis=1)
+    else:
+        return np.fft.ifft(filterS, ns, axis=1)
+
 class ftanParam(object):
     """ An object to handle ftan output parameters
     ===========================================================================
@@ -128,6 +154,9 @@ class ftanParam(object):
     ierr_2   - completion status, =0 - O.K.,           (integer*4)
                                 =1 - some problems occures
                                 =2 - no final results
+    filtered_2  - Gaussian filter bank of the whole trace at the observed periods arr2_2[1,:], shape = (nfout2_2, npts),
+                    kept for the SNR analysis (see aftantrace.get_snr)
+    ffact_2     - factor to automatic filter parameter used for filtered_2
     ===========================================================================
     """
     def __init__(self):
@@ -151,6 +180,9 @@ class ftanParam(object):
         self.ncol_2     = 0
         self.ampo_2     = np.array([])
         self.ierr_2     = 0
+        # filter bank at the observed periods, for SNR analysis
+        self.filtered_2 = np.array([])
+        self.ffact_2    = None
         # Flag for existence of predicted phase dispersion curve
         self.preflag    = False
         self.station_id = None
@@ -427,6 +459,8 @@ class aftantrace(obspy.core.trace.Trace):
         if pmf:
             self._aftanipg(piover4=piover4, vmin=vmin, vmax=vmax, tresh=tresh, ffact=ffact, taperl=taperl,
                 snr=snr, fmatch=fmatch, nfin=nfin, npoints=npoints, perc=perc, predV=predV)
+            # filter bank at the observed periods, used by get_snr
+            self._filter_bank_obs(ffact=ffact)
         return
 
     def _aftanpg(self, piover4, vmin, vmax, tmin, tmax, tresh, ffact, taperl, nfin, npoints, perc, predV):
@@ -490,24 +524,14 @@ class aftantrace(obspy.core.trace.Trace):
         else:
             fftdata     = np.fft.fft(tdata, ns)
         omsArr          = np.arange(ns)*domega
-        phaArr          = np.zeros((ne+3-nb, nfin))
-        ampo            = np.zeros((ne+3-nb, nfin))
-        amp             = np.zeros((ne+3-nb, nfin))
-        #  main loop by frequency
-        for k in range(nfin):
-            # Gaussian filter
-            filterS     = _aftan_gaussian_filter(alpha=alpha, omega0=omegaArr[k], ns=ns, indata=fftdata, omsArr=omsArr)
-            # return fs, filterS
-            if useFFTW:
-                filterT = pyfftw.interfaces.numpy_fft.ifft(filterS, ns)
-            else:
-                filterT = np.fft.ifft(filterS, ns)
-            # need to multiply by 2 due to zero padding of negative frequencies
-            # but NO NEED to divide by ns due to the difference of numpy style and FFTW style
-            filterT     = 2.*filterT 
-            phaArr[:,k] = np.arctan2(np.imag(filterT[nb-2:ne+1]), np.real(filterT[nb-2:ne+1]))
-            ampo[:,k]   = np.abs(filterT[nb-2:ne+1])
-            amp[:,k]    = 20.*np.log10(ampo[:,k])
+        # Gaussian filter bank (nfin, ns) and batched inverse FFT for all periods
+        filterS         = _aftan_gaussian_filter_bank(alpha=alpha, omegaArr=omegaArr, ns=ns, indata=fftdata, omsArr=omsArr)
+        # need to multiply by 2 due to zero padding of negative frequencies
+        # but NO NEED to divide by ns due to the difference of numpy style and FFTW style
+        filterT         = 2.*(_ifft_bank(filterS, ns)[:, nb-2:ne+1]).T
+        phaArr          = np.arctan2(np.imag(filterT), np.real(filterT))
+        ampo            = np.abs(filterT)
+        amp             = 20.*np.log10(ampo)
         # normalization amp diagram to 100 Db with three decade cutting
         amax        = amp.max()
         amp         = amp+100.-amax
@@ -757,8 +781,9 @@ class aftantrace(obspy.core.trace.Trace):
         omstart                             = float(round(omstart/domega))*domega
         inde                                = min(inde, ns/2+2)
         pha_cor                             = np.zeros(ns, dtype='complex64')
-        for i in xrange(ns):
-            pha_cor.real[i]     = cubicspline.integrate(a=np.sqrt(omb*ome), b=omdom[i])
+        # integral of the group time curve from sqrt(omb*ome), evaluated with the antiderivative for all frequencies
+        antider                 = cubicspline.antiderivative()
+        pha_cor.real[:]         = antider(omdom) - antider(np.sqrt(omb*ome))
         pha_cor.real[:inds-1]   = 0.
         pha_cor.real[inde:]     = 0.
         dci                     = 0+1j
@@ -780,23 +805,14 @@ class aftantrace(obspy.core.trace.Trace):
             fftdata = np.fft.fft(t_env, ns)
         fftdata = fftdata/pha_cor
         omsArr  = np.arange(ns)*domega
-        phaArr  = np.zeros((ne+3-nb, nfin))
-        ampo    = np.zeros((ne+3-nb, nfin))
-        amp     = np.zeros((ne+3-nb, nfin))
-        #  main loop by frequency
-        for k in xrange(nfin):
-            # Gaussian filter
-            filterS     = _aftan_gaussian_filter(alpha=alpha, omega0=omegaArr[k], ns=ns, indata=fftdata, omsArr=omsArr)
-            if useFFTW:
-                filterT = pyfftw.interfaces.numpy_fft.ifft(filterS, ns)
-            else:
-                filterT = np.fft.ifft(filterS, ns)
-            # need to multiply by 2 due to zero padding of negative frequencies
-            # but NO NEED to divide by ns due to the difference of numpy style and FFTW style
-            filterT     = 2.*filterT 
-            phaArr[:,k] = np.arctan2(np.imag(filterT[nb-2:ne+1]), np.real(filterT[nb-2:ne+1]))
-            ampo[:,k]   = np.abs(filterT[nb-2:ne+1])
-            amp[:,k]    = 20.*np.log10(ampo[:,k])
+        # Gaussian filter bank (nfin, ns) and batched inverse FFT for all periods
+        filterS = _aftan_gaussian_filter_bank(alpha=alpha, omegaArr=omegaArr, ns=ns, indata=fftdata, omsArr=omsArr)
+        # need to multiply by 2 due to zero padding of negative frequencies
+        # but NO NEED to divide by ns due to the difference of numpy style and FFTW style
+        filterT = 2.*(_ifft_bank(filterS, ns)[:, nb-2:ne+1]).T
+        phaArr  = np.arctan2(np.imag(filterT), np.real(filterT))
+        ampo    = np.abs(filterT)
+        amp     = 20.*np.log10(ampo)
         # normalization amp diagram to 100 Db with three decade cutting
         amax        = amp.max()
         amp         = amp+100.-amax
@@ -1213,7 +1229,7 @@ class aftantrace(obspy.core.trace.Trace):
         return ss
         
     def aftanf77(self, pmf=True, piover4=-1.0, vmin=1.5, vmax=5.0, tmin=4.0, tmax=30.0, tresh=20.0,
-            ffact=1.0, taperl=1.0, snr=0.2, fmatch=1.0, nfin=64, npoints=3, perc=50., phvelname='', predV=np.array([])):
+            ffact=1.0, taperl=1.0, snr=0.2, fmatch=1.0, nfin=64, npoints=3, perc=50., phvelname='', predV=np.array([]), fallback=False):
         """ (Automatic Frequency-Time ANalysis) aftan analysis:
         ===========================================================================================================
         Input Parameters:
@@ -1233,13 +1249,19 @@ class aftantrace(obspy.core.trace.Trace):
         perc       - output segment
         phvelname  - predicted phase velocity file name
         predV      - predicted phase velocity curve, period = predV[:, 0],  Vph = predV[:, 1]
+        fallback   - use the pure python aftan if the compiled fortran77 aftan is not available (default: False, raise an error)
         
         Output:
         self.ftanparam, a object of ftanParam class, to store output aftan results
         ===========================================================================================================
         """
         if not isaftanf77:
-            raise AttributeError('fortran77 aftan not imported correctly!')
+            if not fallback:
+                raise AttributeError('fortran77 aftan not imported correctly!')
+            warnings.warn('fortran77 aftan not imported correctly, use pure python aftan instead!', UserWarning, stacklevel=1)
+            self.aftan(pmf=pmf, piover4=piover4, vmin=vmin, vmax=vmax, tmin=tmin, tmax=tmax, tresh=tresh, ffact=ffact,
+                taperl=taperl, snr=snr, fmatch=fmatch, nfin=nfin, npoints=npoints, perc=perc, phvelname=phvelname, predV=predV)
+            return
         # preparing for data
         try:
             self.ftanparam
@@ -1303,6 +1325,8 @@ class aftantrace(obspy.core.trace.Trace):
             self.ftanparam.nfout1_2,self.ftanparam.arr1_2,self.ftanparam.nfout2_2,self.ftanparam.arr2_2,self.ftanparam.tamp_2, \
                     self.ftanparam.nrow_2,self.ftanparam.ncol_2,self.ftanparam.ampo_2, self.ftanparam.ierr_2 = aftan.aftanipg(piover4,nsam, \
                         sig,tb,dt,dist,vmin,vmax,tmin2,tmax2,tresh,ffact,perc,npoints,taperl,nfin,snr,fmatch,npred,pred,nprpv,phprper,phprvel)
+            # filter bank at the observed periods, used by get_snr
+            self._filter_bank_obs(ffact=ffact)
         return
 
     def plotftan(self, plotflag=3, sacname='', cmap='ftan'):
@@ -1451,6 +1475,8 @@ class aftantrace(obspy.core.trace.Trace):
     
     def get_snr(self, ffact=1.):
         """ compute snr of the waveform
+            the filtered traces at the observed periods are taken from the filter bank kept by aftan (ftanparam.filtered_2),
+            the filter bank is only computed here if it is not available (e.g. different ffact)
         """
         fparam      = self.ftanparam
         dist        = self.stats.sac.dist
@@ -1461,10 +1487,12 @@ class aftantrace(obspy.core.trace.Trace):
             o_per   = fparam.arr2_2[1,:]
             g_vel   = fparam.arr2_2[2,:]
             snrArr  = np.ones(o_per.size, dtype=np.float64)*-1.
+            if fparam.ffact_2 != ffact or fparam.filtered_2.shape != (fparam.nfout2_2, self.stats.npts):
+                self._filter_bank_obs(ffact=ffact)
+            filtered_trs    = fparam.filtered_2
             for i in range(fparam.nfout2_2):
                 if g_vel[i]<0 or o_per[i]<0:
                     continue
-                filtered_tr = self.gaussian_filter_aftan(1./o_per[i], ffact=ffact)
                 minT        = dist/g_vel[i]-o_per[i]/2.
                 maxT        = dist/g_vel[i]+o_per[i]/2.
                 if(minT<begT):
@@ -1473,27 +1501,42 @@ class aftantrace(obspy.core.trace.Trace):
                     maxT    = endT
                 # Noise window
                 minT        = maxT + o_per[i] * 5. + 500.
-                skipflag    = False
                 if( (endT - minT) < 50. ):
-                    skipflag= True
+                    continue
                 elif( (endT - minT) < 1100. ):
                     maxT    = endT - 10.
                 else:
                     minT    = endT - 1100.
                     maxT    = endT - 100.
-                if not skipflag:
-                    ib              = (int)((minT-begT)/dt)
-                    ie              = (int)((maxT-begT)/dt)+2
-                    tempnoise       = filtered_tr[ib:ie]
-                    noiserms        = np.sqrt(( np.sum(tempnoise**2))/(ie-ib-1.) )
-                    amp             = self.ftanparam.arr2_2[7,i]
-                    if noiserms != 0.:
-                        snrArr[i]   = amp/noiserms
-                    else:
-                        snrArr[i]   = 1.
+                ib          = (int)((minT-begT)/dt)
+                ie          = (int)((maxT-begT)/dt)+2
+                tempnoise   = filtered_trs[i, ib:ie]
+                noiserms    = np.sqrt(( np.sum(tempnoise**2))/(ie-ib-1.) )
+                amp         = self.ftanparam.arr2_2[7,i]
+                if noiserms != 0.:
+                    snrArr[i]   = amp/noiserms
+                else:
+                    snrArr[i]   = 1.
             self.ftanparam.arr2_2   = np.append(fparam.arr2_2, snrArr)
             self.ftanparam.arr2_2   = self.ftanparam.arr2_2.reshape(9, o_per.size)
         return 
+    
+    def _filter_bank_obs(self, ffact=1.):
+        """ Gaussian filter bank of the whole trace at the observed periods of the phase matched filtered results,
+            stored in self.ftanparam.filtered_2 (rows of invalid periods are zero)
+            NOTE: the filter bank of aftan is applied to the tapered signal window, which does not include the noise window
+        """
+        self.ftanparam.ffact_2      = ffact
+        self.ftanparam.filtered_2   = np.array([])
+        if self.ftanparam.nfout2_2 == 0:
+            return
+        o_per                       = self.ftanparam.arr2_2[1, :self.ftanparam.nfout2_2]
+        filtered_trs                = np.zeros((o_per.size, self.stats.npts), dtype=np.float64)
+        ind_valid                   = o_per > 0.
+        if np.any(ind_valid):
+            filtered_trs[ind_valid, :]  = self.gaussian_filter_aftan_bank(1./o_per[ind_valid], ffact=ffact)
+        self.ftanparam.filtered_2   = filtered_trs
+        return
                 
     def gaussian_filter_snr(self, fcenter, fhlen=0.008):
         """
@@ -1564,4 +1607,35 @@ class aftantrace(obspy.core.trace.Trace):
         return filtered_seis
     
     
-    
\ No newline at end of file
+    
+    
+    def gaussian_filter_aftan_bank(self, fcenterArr, ffact=1.):
+        """
+        Gaussian filter bank designed for SNR analysis, vectorized version of gaussian_filter_aftan
+        the forward FFT is computed once and all the central frequencies are filtered with a batched inverse FFT
+        ====================================================================
+        Input parameters:
+        fcenterArr  - central frequency array
+        ffact       - factor to automatic filter parameter, usualy =1
+        Output:
+        filtered_seis   - filtered seismograms, shape = (fcenterArr.size, npts)
+        ====================================================================
+        """
+        npts        = self.stats.npts
+        ns          = 1<<(npts-1).bit_length()
+        df          = 1.0/self.stats.delta/ns
+        nhalf       = ns/2+1
+        fmax        = (nhalf-1)*df
+        alpha       = ffact*20.
+        fcenterArr  = np.asarray(fcenterArr, dtype=np.float64).copy()
+        fcenterArr[fcenterArr > fmax]\
+                    = fmax
+        omega0Arr   = 2.*np.pi*fcenterArr
+        omsArr      = 2.*np.pi*np.arange(ns)*df
+        if useFFTW:
+            sp      = pyfftw.interfaces.numpy_fft.fft(self.data, ns)
+        else:
+            sp      = np.fft.fft(self.data, ns)
+        filtered_sp = _aftan_gaussian_filter_bank(alpha=alpha, omegaArr=omega0Arr, ns=ns, indata=sp, omsArr=omsArr)
+        filtered_seis   = 2.*_ifft_bank(filtered_sp, ns)[:, :npts].real
+        return filtered_seis
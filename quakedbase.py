@@ -41,6 +41,7 @@ from obspy.taup import TauPyModel
 import CURefPy
 import glob
 import timeit
+import mppool
 
 sta_info_default    = {'xcorr': 1, 'isnet': 0}
 ref_header_default  = {'otime': '', 'network': '', 'station': '', 'stla': 12345, 'stlo': 12345, 'evla': 12345, 'evlo': 12345, 'evdp': 0.,
@@ -912,7 +913,7 @@ class quakeASDF(pyasdf.ASDFDataSet):
         return
     
     def get_surf_waveforms_mp(self, outdir, lon0=None, lat0=None, minDelta=-1, maxDelta=181, channel='LHZ', vmax=6.0, vmin=1.0, verbose=False,
-            subsize=1000, deletemseed=False, nprocess=None, snumb=0, enumb=None, startdate=None, enddate=None):
+            subsize=1000, deletemseed=False, nprocess=None, snumb=0, enumb=None, startdate=None, enddate=None, chunksize=None, timeout=None):
         """Get surface wave data from IRIS server with multiprocessing
         ====================================================================================================================
         ::: input parameters :::
@@ -921,9 +922,11 @@ class quakeASDF(pyasdf.ASDFDataSet):
         channel         - Channel code, e.g. 'BHZ'.
                             Last character (i.e. component) can be a wildcard (‘?’ or ‘*’) to fetch Z, N and E component.
         vmin, vmax      - minimum/maximum velocity for surface wave window
-        subsize         - subsize of processing list, use to prevent lock in multiprocessing process
+        subsize         - size of processing block, only used with snumb to skip the processed requests
         deletemseed     - delete output MiniSeed files
         nprocess        - number of processes
+        chunksize       - number of download requests sent to a worker at once, default is decided by mppool.pool_map
+        timeout         - timeout for each download request in sec, None for no timeout
         snumb, enumb    - start/end number of processing block
         =====================================================================================================================
         """
@@ -987,31 +990,13 @@ class quakeASDF(pyasdf.ASDFDataSet):
                 reqwaveLst.append( requestInfo(evnumb=evnumb, network=netcode, station=stacode, location=location, channel=channel,
                             starttime=starttime, endtime=endtime, attach_response=True) )
         print('============================= Start multiprocessing download surface wave data ===============================')
-        if len(reqwaveLst) > subsize:
-            Nsub            = int(len(reqwaveLst)/subsize)
-            # if enumb==None: enumb=Nsub
-            for isub in range(Nsub):
-                # if isub < snumb: continue
-                # if isub > enumb: continue
-                print 'Subset:', isub+1,'in',Nsub,'sets'
-                creqlst     = reqwaveLst[isub*subsize:(isub+1)*subsize]
-                GETDATA     = partial(get_waveforms4mp, outdir=outdir, client=client, pre_filt = (0.001, 0.005, 1, 100.0), verbose=verbose, rotation=False)
-                pool        = multiprocessing.Pool(processes=nprocess)
-                pool.map(GETDATA, creqlst) #make our results with a map call
-                pool.close() #we are not adding any more processes
-                pool.join() #tell it to wait until all threads are done before going on
-            creqlst         = reqwaveLst[(isub+1)*subsize:]
-            GETDATA         = partial(get_waveforms4mp, outdir=outdir, client=client, pre_filt = (0.001, 0.005, 1, 100.0), verbose=verbose, rotation=False)
-            pool            = multiprocessing.Pool(processes=nprocess)
-            pool.map(GETDATA, creqlst) #make our results with a map call
-            pool.close() #we are not adding any more processes
-            pool.join() #tell it to wait until all threads are done before going on
-        else:
-            GETDATA         = partial(get_waveforms4mp, outdir=outdir, client=client, pre_filt = (0.001, 0.005, 1, 100.0), verbose=verbose, rotation=False)
-            pool            = multiprocessing.Pool(processes=nprocess)
-            pool.map(GETDATA, reqwaveLst) #make our results with a map call
-            pool.close() #we are not adding any more processes
-            pool.join() #tell it to wait until all threads are done before going on
+        GETDATA         = partial(get_waveforms4mp, outdir=outdir, client=client, pre_filt = (0.001, 0.005, 1, 100.0), verbose=verbose, rotation=False)
+        resultLst       = mppool.pool_map(GETDATA, reqwaveLst, nprocess=nprocess, chunksize=chunksize, timeout=timeout,\
+                            allow_failure=True)
+        mppool.close_pool()
+        Nfailed         = len([result for result in resultLst if mppool.is_failure(result)])
+        if Nfailed > 0:
+            print('--- '+str(Nfailed)+'/'+str(len(reqwaveLst))+' download requests not finished within the timeout, data not saved')
         print('============================= End of multiprocessing download surface wave data ==============================')
         print('==================================== Reading downloaded surface wave data ====================================')
         evnumb              = 0
@@ -1134,7 +1119,7 @@ class quakeASDF(pyasdf.ASDFDataSet):
         return
     
     def get_body_waveforms_mp(self, outdir, minDelta=30, maxDelta=150, channel='BHE,BHN,BHZ', phase='P', startoffset=-30., endoffset=60.0,
-            verbose=False, subsize=1000, deletemseed=False, nprocess=6, snumb=0, enumb=None, rotation=True, startdate=None, enddate=None):
+            verbose=False, subsize=1000, deletemseed=False, nprocess=6, snumb=0, enumb=None, rotation=True, startdate=None, enddate=None, chunksize=None, timeout=None):
         """Get body wave data from IRIS server
         ====================================================================================================================
         ::: input parameters :::
@@ -1147,6 +1132,8 @@ class quakeASDF(pyasdf.ASDFDataSet):
         rotation        - rotate the seismogram to RT or not
         deletemseed     - delete output MiniSeed files
         nprocess        - number of processes
+        chunksize       - number of download requests sent to a worker at once, default is decided by mppool.pool_map
+        timeout         - timeout for each download request in sec, None for no timeout
         snumb, enumb    - start/end number of processing block
         =====================================================================================================================
         """
@@ -1211,31 +1198,13 @@ class quakeASDF(pyasdf.ASDFDataSet):
                 reqwaveLst.append( requestInfo(evnumb=evnumb, network=netcode, station=stacode, location=location, channel=channel,
                             starttime=starttime, endtime=endtime, attach_response=True, baz=baz) )
         print('============================= Start multiprocessing download body wave data ===============================')
-        if len(reqwaveLst) > subsize:
-            Nsub            = int(len(reqwaveLst)/subsize)
-            # if enumb==None: enumb=Nsub
-            for isub in range(Nsub):
-                # if isub < snumb: continue
-                # if isub > enumb: continue
-                print 'Subset:', isub+1,'in',Nsub,'sets'
-                creqlst     = reqwaveLst[isub*subsize:(isub+1)*subsize]
-                GETDATA     = partial(get_waveforms4mp, outdir=outdir, client=client, pre_filt = (0.04, 0.05, 20., 25.), verbose=verbose, rotation=rotation)
-                pool        = multiprocessing.Pool(processes=nprocess)
-                pool.map(GETDATA, creqlst) #make our results with a map call
-                pool.close() #we are not adding any more processes
-                pool.join() #tell it to wait until all threads are done before going on
-            creqlst         = reqwaveLst[(isub+1)*subsize:]
-            GETDATA         = partial(get_waveforms4mp, outdir=outdir, client=client, pre_filt = (0.04, 0.05, 20., 25.), verbose=verbose, rotation=rotation)
-            pool            = multiprocessing.Pool(processes=nprocess)
-            pool.map(GETDATA, creqlst) #make our results with a map call
-            pool.close() #we are not adding any more processes
-            pool.join() #tell it to wait until all threads are done before going on
-        else:
-            GETDATA         = partial(get_waveforms4mp, outdir=outdir, client=client, pre_filt = (0.04, 0.05, 20., 25.), verbose=verbose, rotation=rotation)
-            pool            = multiprocessing.Pool(processes=nprocess)
-            pool.map(GETDATA, reqwaveLst) #make our results with a map call
-            pool.close() #we are not adding any more processes
-            pool.join() #tell it to wait until all threads are done before going on
+        GETDATA         = partial(get_waveforms4mp, outdir=outdir, client=client, pre_filt = (0.04, 0.05, 20., 25.), verbose=verbose, rotation=rotation)
+        resultLst       = mppool.pool_map(GETDATA, reqwaveLst, nprocess=nprocess, chunksize=chunksize, timeout=timeout,\
+                            allow_failure=True)
+        mppool.close_pool()
+        Nfailed         = len([result for result in resultLst if mppool.is_failure(result)])
+        if Nfailed > 0:
+            print('--- '+str(Nfailed)+'/'+str(len(reqwaveLst))+' download requests not finished within the timeout, data not saved')
         print('============================= End of multiprocessing download body wave data ==============================')
         print('==================================== Reading downloaded body wave data ====================================')
         evnumb              = 0
@@ -1773,16 +1742,18 @@ class quakeASDF(pyasdf.ASDFDataSet):
         return
     
     def compute_ref_mp(self, outdir, inrefparam=CURefPy.InputRefparam(), saveampc=True, verbose=False, \
-            subsize=1000, nprocess=6, startdate=None, enddate=None, readdata=True, deleteref=True, deletepost=True, fs=40.):
+            subsize=1000, nprocess=6, startdate=None, enddate=None, readdata=True, deleteref=True, deletepost=True, fs=40., chunksize=None, timeout=None):
         """Compute receiver function and post processed data(moveout) with multiprocessing
         ====================================================================================================================
         ::: input parameters :::
         inrefparam  - input parameters for receiver function, refer to InputRefparam in CURefPy for details
         saveampc    - save amplitude corrected post processed data
-        subsize     - subsize of processing list, use to prevent lock in multiprocessing process
+        subsize     - not used, kept for backward compatibility (tasks are dynamically scheduled by mppool)
         deleteref   - delete SAC receiver function data
         deletepost  - delete npz post processed data
         nprocess    - number of processes
+        chunksize   - number of receiver function traces sent to a worker at once, default is decided by mppool.pool_map
+        timeout     - timeout for each receiver function trace in sec, None for no timeout
         =====================================================================================================================
         """
         print('================================== Receiver Function Analysis ======================================')
@@ -1856,28 +1827,9 @@ class quakeASDF(pyasdf.ASDFDataSet):
         # multiprocessing for receiver function
         #---------------------------------------
         print('Start multiprocessing receiver function analysis !')
-        if len(refLst) > subsize:
-            Nsub            = int(len(refLst)/subsize)
-            for isub in range(Nsub):
-                print 'Subset:', isub,'in',Nsub,'sets'
-                cstream     = refLst[isub*subsize:(isub+1)*subsize]
-                REF         = partial(ref4mp, outdir=outdir, inrefparam=inrefparam)
-                pool        = multiprocessing.Pool(processes=nprocess)
-                pool.map(REF, cstream) #make our results with a map call
-                pool.close() #we are not adding any more processes
-                pool.join() #tell it to wait until all threads are done before going on
-            cstream         = refLst[(isub+1)*subsize:]
-            REF             = partial(ref4mp, outdir=outdir, inrefparam=inrefparam)
-            pool            = multiprocessing.Pool(processes=nprocess)
-            pool.map(REF, cstream) #make our results with a map call
-            pool.close() #we are not adding any more processes
-            pool.join() #tell it to wait until all threads are done before going on
-        else:
-            REF             = partial(ref4mp, outdir=outdir, inrefparam=inrefparam)
-            pool            = multiprocessing.Pool(processes=nprocess)
-            pool.map(REF, refLst) #make our results with a map call
-            pool.close() #we are not adding any more processes
-            pool.join() #tell it to wait until all threads are done before going on
+        REF             = partial(ref4mp, outdir=outdir, inrefparam=inrefparam)
+        mppool.pool_map(REF, refLst, nprocess=nprocess, chunksize=chunksize, timeout=timeout)
+        mppool.close_pool()
         print('End of multiprocessing receiver function analysis !')
         if readdata:
             self.read_ref_data(datadir=outdir, saveampc=saveampc, inrefparam=inrefparam, deleteref=deleteref, deletepost=deletepost, fs=fs)
@@ -2560,7 +2512,7 @@ class quakeASDF(pyasdf.ASDFDataSet):
         return
                
     def quake_aftan_mp(self, outdir, channel='Z', tb=0., inftan=pyaftan.InputFtanParam(), basic1=True, basic2=True,
-            pmf1=True, pmf2=True, verbose=True, prephdir=None, f77=True, pfx='DISP', subsize=1000, deletedisp=True, nprocess=None):
+            pmf1=True, pmf2=True, verbose=True, prephdir=None, f77=True, pfx='DISP', subsize=1000, deletedisp=True, nprocess=None, chunksize=None, timeout=None):
         """ aftan analysis of earthquake data with multiprocessing
         =======================================================================================
         ::: input parameters :::
@@ -2575,9 +2527,11 @@ class quakeASDF(pyasdf.ASDFDataSet):
         prephdir    - directory for predicted phase velocity dispersion curve
         f77         - use aftanf77 or not
         pfx         - prefix for output txt DISP files
-        subsize     - subsize of processing list, use to prevent lock in multiprocessing process
+        subsize     - not used, kept for backward compatibility (tasks are dynamically scheduled by mppool)
         deletedisp  - delete output dispersion files or not
         nprocess    - number of processes
+        chunksize   - number of traces sent to a worker at once, default is decided by mppool.pool_map
+        timeout     - timeout for each trace in sec, None for no timeout
         ---------------------------------------------------------------------------------------
         Output:
         self.auxiliary_data.DISPbasic1, self.auxiliary_data.DISPbasic2,
@@ -2628,28 +2582,9 @@ class quakeASDF(pyasdf.ASDFDataSet):
                     print 'Preparing aftan data: ' + evid+' '+staid+'_'+channel
                 inputStream.append(aftanTr)
         print 'Start multiprocessing aftan analysis !'
-        if len(inputStream) > subsize:
-            Nsub            = int(len(inputStream)/subsize)
-            for isub in xrange(Nsub):
-                print 'Subset:', isub,'in',Nsub,'sets'
-                cstream     = inputStream[isub*subsize:(isub+1)*subsize]
-                AFTAN       = partial(aftan4mp_quake, outdir=outdir, inftan=inftan, prephdir=prephdir, f77=f77, pfx=pfx)
-                pool        = multiprocessing.Pool(processes=nprocess)
-                pool.map(AFTAN, cstream) #make our results with a map call
-                pool.close() #we are not adding any more processes
-                pool.join() #tell it to wait until all threads are done before going on
-            cstream         = inputStream[(isub+1)*subsize:]
-            AFTAN           = partial(aftan4mp_quake, outdir=outdir, inftan=inftan, prephdir=prephdir, f77=f77, pfx=pfx)
-            pool            = multiprocessing.Pool(processes=nprocess)
-            pool.map(AFTAN, cstream) #make our results with a map call
-            pool.close() #we are not adding any more processes
-            pool.join() #tell it to wait until all threads are done before going on
-        else:
-            AFTAN           = partial(aftan4mp_quake, outdir=outdir, inftan=inftan, prephdir=prephdir, f77=f77, pfx=pfx)
-            pool            = multiprocessing.Pool(processes=nprocess)
-            pool.map(AFTAN, inputStream) #make our results with a map call
-            pool.close() #we are not adding any more processes
-            pool.join() #tell it to wait until all threads are done before going on
+        AFTAN           = partial(aftan4mp_quake, outdir=outdir, inftan=inftan, prephdir=prephdir, f77=f77, pfx=pfx)
+        mppool.pool_map(AFTAN, inputStream, nprocess=nprocess, chunksize=chunksize, timeout=timeout)
+        mppool.close_pool()
         print 'End of multiprocessing aftan analysis !'
         print 'Reading aftan results into ASDF Dataset !'
         for event in self.events:
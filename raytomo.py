@@ -7,6 +7,8 @@ The code creates a datadbase based on hdf5 data format
     numpy >=1.9.1
     matplotlib >=1.4.3
     h5py 
+    scipy
+    numba
     
 :Copyright:
     Author: Lili Feng
@@ -22,6 +24,7 @@ import numpy as np
 import numpy.ma as ma
 import h5py
 import os, shutil
+import warnings
 from subprocess import call
 from mpl_toolkits.basemap import Basemap, shiftgrid, cm
 import matplotlib.pyplot as plt
@@ -30,6 +33,10 @@ from matplotlib.mlab import griddata
 import colormaps
 import obspy
 import field2d_earth
+import mppool
+import numba
+import scipy.sparse
+import scipy.sparse.linalg
 
 
 # def _get_z(inz, inlat, inlon, outlat, outlon):
@@ -172,6 +179,89 @@ def _bad_station_detector_old(inarr, thresh=1.):
         #     validarr[i] = False
     return validarr
     
+def _qc_residual(inArr, per, crifactor=0.5, crilimit=10., usemad=True, madfactor=3.):
+    """discard the data with large misfit in the residual array of the smooth run
+        id fi0 lam0 f1 lam1 vel_obs weight res_tomo res_mod delta
+    """
+    ##
+    # positive bound
+    ##
+    bounds          = {18.: 10., 16.: 25., 14.: 25., 12.: 35., 10.: 35., 8.: 40.}
+    # bounds          = {22: 10., 20.: 10., 18.: 10., 16.: 25., 14.: 25., 12.: 35., 10.: 35., 8.: 40.}
+    # bounds          = {}
+    res_tomo        = inArr[:,7]
+    if usemad:
+        from statsmodels import robust
+        mad         = robust.mad(res_tomo)
+        cri_res     = madfactor * mad
+    else:
+        cri_res     = min(crifactor*per, crilimit)
+    ###
+    validarr        = _bad_station_detector(inArr)
+    QC_arr          = inArr[validarr, :]
+    res_tomo        = QC_arr[:, 7]
+    if per in bounds.keys():
+        ind         = (res_tomo > -(cri_res))*(res_tomo < bounds[per])
+        QC_arr      = QC_arr[ind, :]
+    else:
+        QC_arr      = QC_arr[np.abs(res_tomo)<cri_res, :]
+    return QC_arr
+
+def _lonlat2index(inlon, inlat, minlon, minlat, dlon, dlat, Nlon, Nlat, tol=0.001):
+    """map longitude/latitude of points to integer grid indices by rounding against the grid origin and spacing
+    ==============================================================================
+    ::: input parameters :::
+    inlon, inlat        - longitude/latitude of the points
+    minlon, minlat      - origin of the grid
+    dlon, dlat          - grid spacing
+    Nlon, Nlat          - number of grid points
+    tol                 - tolerance (in degree) for a point to be considered on a grid node
+    ::: output :::
+    index               - (N, 2) integer array of (ilat, ilon), only points on the grid are kept
+    ==============================================================================
+    """
+    inlon       = np.asarray(inlon, dtype=np.float64)
+    inlat       = np.asarray(inlat, dtype=np.float64)
+    ilon        = np.round((inlon - minlon)/dlon).astype(np.int64)
+    ilat        = np.round((inlat - minlat)/dlat).astype(np.int64)
+    valid       = (ilon >= 0)*(ilon < Nlon)*(ilat >= 0)*(ilat < Nlat)
+    valid       *= (np.abs(minlon + ilon*dlon - inlon) < tol)*(np.abs(minlat + ilat*dlat - inlat) < tol)
+    return np.vstack((ilat[valid], ilon[valid])).T
+
+def _index2grid(data, grid_index, Nlat, Nlon):
+    """put the values of the points to a Nlat * Nlon array, grid_index is from _lonlat2index
+        grid points without data are zero
+    """
+    outArr      = np.zeros((Nlat, Nlon), dtype=np.float64)
+    outArr[grid_index[:, 0], grid_index[:, 1]] \
+                = np.asarray(data).ravel()
+    return outArr
+
+def _run_misha4mp(intask):
+    """run a temporary bash script of Misha's tomography code in a working directory, used by run_smooth/run_qc
+        intask  - (working directory, script name, script lines)
+        the exit status of the script is returned
+    """
+    workingdir, fname, lines    = intask
+    with open(workingdir+'/'+fname, 'wb') as f:
+        f.writelines(lines)
+    retcode     = call(['bash', fname], cwd=workingdir)
+    os.remove(workingdir+'/'+fname)
+    return retcode
+
+def _run_misha_tasks(tasks, nprocess, pers):
+    """run the tasks of _run_misha4mp serially (nprocess = 1) or concurrently
+    """
+    if nprocess == 1:
+        retcodes    = [_run_misha4mp(intask) for intask in tasks]
+    else:
+        retcodes    = mppool.pool_map(_run_misha4mp, tasks, nprocess=nprocess, chunksize=1)
+        mppool.close_pool()
+    for per, retcode in zip(pers, retcodes):
+        if retcode != 0:
+            warnings.warn('Tomography code failed for T = '+str(per)+' sec, exit status: '+str(retcode), UserWarning, stacklevel=1)
+    return
+
 def plot_fault_lines(mapobj, infname, lw=2, color='red'):
     with open(infname, 'rb') as fio:
         is_new  = False
@@ -215,6 +305,340 @@ def read_slab_contour(infname, depth):
             latlst.append(float(line.split()[1]))
     return ctrlst
 
+#--------------------------------------------------------------------------------------------
+# native straight ray tomography (run_smooth_sparse/run_qc_sparse)
+#   the rays are great circle paths sampled with a step of stepinte (degree), the length of
+#   each segment is assigned to the nearest grid point. The model is the relative slowness
+#   perturbation (to the best fitting homogeneous model) at the grid points, regularized with
+#   Gaussian smoothing (alpha, sigma) and path density damping (beta), see Barmin et al. (2001)
+#--------------------------------------------------------------------------------------------
+# radius of the Earth (km)
+_R_earth                = 6371.
+# the Gaussian smoothing weights are truncated at _gauss_cutoff*sigma
+_gauss_cutoff           = 3.
+# path density damping, the damping weight is beta*exp(-_path_density_lambda*path_density)
+_path_density_lambda    = 0.3
+# bin width (degree) for the azimuthal coverage, the azimuths are folded into 0 ~ 180 degree
+_azi_bin_width          = 10.
+
+@numba.jit(numba.int64(numba.float64, numba.float64, numba.float64, numba.float64, numba.float64[:], numba.float64[:], numba.float64,\
+            numba.int64[:], numba.float64[:], numba.float64[:]), nopython=True)
+def _trace_ray(phi1, lam1, phi2, lam2, lats, lons, stepinte, nodebuf, lenbuf, azibuf):
+    """trace one great circle ray (the locations are in radian)
+        the grid points (ilat*Nlon + ilon), lengths (km) and azimuths (degree) are written into the buffers
+        the number of grid points is returned
+    """
+    Nlat        = lats.size
+    Nlon        = lons.size
+    deg2rad     = np.pi/180.
+    dlat        = lats[1] - lats[0]
+    dlon        = lons[1] - lons[0]
+    # unit vectors of the two stations
+    ax          = np.cos(phi1)*np.cos(lam1)
+    ay          = np.cos(phi1)*np.sin(lam1)
+    az          = np.sin(phi1)
+    bx          = np.cos(phi2)*np.cos(lam2)
+    by          = np.cos(phi2)*np.sin(lam2)
+    bz          = np.sin(phi2)
+    cx          = ay*bz - az*by
+    cy          = az*bx - ax*bz
+    cz          = ax*by - ay*bx
+    delta       = np.arctan2(np.sqrt(cx*cx + cy*cy + cz*cz), ax*bx + ay*by + az*bz)
+    if delta == 0.:
+        return 0
+    nseg        = max(1, int(np.ceil(delta/deg2rad/stepinte)))
+    seglen      = _R_earth*delta/nseg
+    Nnode       = 0
+    for iseg in range(nseg):
+        # mid point of the segment
+        frac    = (iseg + 0.5)/nseg
+        w1      = np.sin((1. - frac)*delta)/np.sin(delta)
+        w2      = np.sin(frac*delta)/np.sin(delta)
+        px      = w1*ax + w2*bx
+        py      = w1*ay + w2*by
+        pz      = w1*az + w2*bz
+        phi     = np.arctan2(pz, np.sqrt(px*px + py*py))
+        lam     = np.arctan2(py, px)
+        # nearest grid point
+        ilat    = int(np.floor((phi/deg2rad - lats[0])/dlat + 0.5))
+        rlon    = (lam/deg2rad - lons[0]) % 360.
+        if rlon > 360. - 0.5*dlon:
+            rlon    -= 360.
+        ilon    = int(np.floor(rlon/dlon + 0.5))
+        if ilat < 0 or ilat >= Nlat or ilon < 0 or ilon >= Nlon:
+            continue
+        inode   = ilat*Nlon + ilon
+        # the ray may come back to a grid point, search from the last one
+        k       = Nnode - 1
+        while k >= 0 and nodebuf[k] != inode:
+            k   -= 1
+        if k >= 0:
+            lenbuf[k]       += seglen
+            continue
+        # azimuth from the mid point to the second station
+        dlam            = lam2 - lam
+        azi             = np.arctan2(np.sin(dlam)*np.cos(phi2), np.cos(phi)*np.sin(phi2) - np.sin(phi)*np.cos(phi2)*np.cos(dlam))
+        nodebuf[Nnode]  = inode
+        lenbuf[Nnode]   = seglen
+        azibuf[Nnode]   = (azi/deg2rad) % 360.
+        Nnode           += 1
+    return Nnode
+
+@numba.jit(numba.types.Tuple((numba.int64[:], numba.int64[:], numba.float64[:], numba.float64[:]))(numba.float64[:], numba.float64[:],\
+            numba.float64[:], numba.float64[:], numba.float64[:], numba.float64[:], numba.float64), nopython=True)
+def _ray_sensitivity(lat1, lon1, lat2, lon2, lats, lons, stepinte):
+    """great circle ray sensitivity in compressed sparse row (CSR) format
+    ==============================================================================================
+    ::: input parameters :::
+    lat1, lon1      - locations of the first stations
+    lat2, lon2      - locations of the second stations
+    lats, lons      - 1D arrays for grid locations
+    stepinte        - step of integration (degree)
+    ::: output :::
+    indptr, indices - CSR index arrays, the rows are the rays, the columns are the grid points (ilat*Nlon + ilon)
+    lengths         - length of the ray within each grid cell (km)
+    azis            - azimuth of the ray in each grid cell (degree)
+    ==============================================================================================
+    """
+    Npath       = lat1.size
+    deg2rad     = np.pi/180.
+    maxseg      = int(np.ceil(180./stepinte)) + 1
+    nodebuf     = np.zeros(maxseg, dtype=np.int64)
+    lenbuf      = np.zeros(maxseg, dtype=np.float64)
+    azibuf      = np.zeros(maxseg, dtype=np.float64)
+    indptr      = np.zeros(Npath+1, dtype=np.int64)
+    # the number of grid points of each ray is counted in the first pass
+    for ipath in range(Npath):
+        Nnode           = _trace_ray(lat1[ipath]*deg2rad, lon1[ipath]*deg2rad, lat2[ipath]*deg2rad, lon2[ipath]*deg2rad,\
+                            lats, lons, stepinte, nodebuf, lenbuf, azibuf)
+        indptr[ipath+1] = indptr[ipath] + Nnode
+    indices     = np.zeros(indptr[Npath], dtype=np.int64)
+    lengths     = np.zeros(indptr[Npath], dtype=np.float64)
+    azis        = np.zeros(indptr[Npath], dtype=np.float64)
+    for ipath in range(Npath):
+        Nnode   = _trace_ray(lat1[ipath]*deg2rad, lon1[ipath]*deg2rad, lat2[ipath]*deg2rad, lon2[ipath]*deg2rad,\
+                    lats, lons, stepinte, nodebuf, lenbuf, azibuf)
+        i0      = indptr[ipath]
+        for k in range(Nnode):
+            indices[i0+k]   = nodebuf[k]
+            lengths[i0+k]   = lenbuf[k]
+            azis[i0+k]      = azibuf[k]
+    return indptr, indices, lengths, azis
+
+@numba.jit(numba.types.Tuple((numba.int64[:], numba.int64[:], numba.float64[:]))(numba.float64[:], numba.float64[:], numba.float64),\
+            nopython=True)
+def _gauss_smoothing_matrix(lats, lons, sigma):
+    """Gaussian smoothing operator of the grid in CSR format, the rows are normalized
+        the weights are exp(-dist**2/(2*sigma**2)) with great circle distance, truncated at _gauss_cutoff*sigma
+    """
+    Nlat        = lats.size
+    Nlon        = lons.size
+    deg2rad     = np.pi/180.
+    cutoff      = _gauss_cutoff*sigma
+    dlon        = lons[1] - lons[0]
+    indptr      = np.zeros(Nlat*Nlon+1, dtype=np.int64)
+    # the distance only depends on the latitudes and the longitude difference
+    distArr     = np.zeros((Nlat, Nlon), dtype=np.float64)
+    Nentry      = 0
+    for ipass in range(2):
+        if ipass == 1:
+            indices = np.zeros(Nentry, dtype=np.int64)
+            data    = np.zeros(Nentry, dtype=np.float64)
+            Nentry  = 0
+        for i in range(Nlat):
+            lat1    = lats[i]*deg2rad
+            for k in range(Nlat):
+                lat2    = lats[k]*deg2rad
+                for l in range(Nlon):
+                    sdlat           = np.sin((lat2-lat1)/2.)
+                    sdlon           = np.sin(l*dlon*deg2rad/2.)
+                    hav             = sdlat*sdlat + np.cos(lat1)*np.cos(lat2)*sdlon*sdlon
+                    distArr[k, l]   = 2.*_R_earth*np.arcsin(min(1., np.sqrt(hav)))
+            for j in range(Nlon):
+                inode   = i*Nlon + j
+                i0      = Nentry
+                wsum    = 0.
+                for k in range(Nlat):
+                    # the minimum distance of the row is at the same longitude
+                    if distArr[k, 0] > cutoff:
+                        continue
+                    for l in range(Nlon):
+                        dist    = distArr[k, abs(l-j)]
+                        if dist > cutoff:
+                            continue
+                        if ipass == 1:
+                            w               = np.exp(-0.5*(dist/sigma)**2)
+                            indices[Nentry] = k*Nlon + l
+                            data[Nentry]    = w
+                            wsum            += w
+                        Nentry  += 1
+                if ipass == 1:
+                    for ientry in range(i0, Nentry):
+                        data[ientry]    /= wsum
+                indptr[inode+1] = Nentry
+    return indptr, indices, data
+
+def _get_pair_keys(inArr):
+    """keys of the station pairs (fi0 lam0 f1 lam1, rounded to 1e-4 degree) for the ray kernel cache
+        the two stations are sorted, the ray kernel does not depend on the order of the stations except
+        for the azimuths (differ by ~180 degree, the azimuthal coverage is computed with 0 ~ 180 degree)
+    """
+    pairs       = np.round(np.float64(inArr[:, 1:5]), 4)
+    swap        = (pairs[:, 0] > pairs[:, 2]) + ((pairs[:, 0] == pairs[:, 2])*(pairs[:, 1] > pairs[:, 3]))
+    pairs[swap] = pairs[swap][:, [2, 3, 0, 1]]
+    return pairs
+
+def _select_csr_rows(indptr, rows):
+    """indices of the entries and the indptr array of the selected rows of a CSR matrix
+    """
+    starts      = indptr[rows]
+    counts      = indptr[rows+1] - starts
+    outptr      = np.zeros(rows.size+1, dtype=np.int64)
+    np.cumsum(counts, out=outptr[1:])
+    ientry      = np.arange(outptr[-1], dtype=np.int64) + np.repeat(starts - outptr[:-1], counts)
+    return ientry, outptr
+
+def _great_circle_dist(lat1, lon1, lat2, lon2):
+    """great circle distance (km), same as the ray length in _trace_ray
+    """
+    deg2rad     = np.pi/180.
+    phi1        = lat1*deg2rad
+    phi2        = lat2*deg2rad
+    dlam        = (lon2 - lon1)*deg2rad
+    # Vincenty formula for the sphere
+    y           = np.sqrt((np.cos(phi2)*np.sin(dlam))**2 + (np.cos(phi1)*np.sin(phi2) - np.sin(phi1)*np.cos(phi2)*np.cos(dlam))**2)
+    x           = np.sin(phi1)*np.sin(phi2) + np.cos(phi1)*np.cos(phi2)*np.cos(dlam)
+    return _R_earth*np.arctan2(y, x)
+
+def _cgls(A, b, tol=1e-8, maxiter=None):
+    """conjugate gradient least squares (CGLS), minimize |Ax-b|
+    """
+    if maxiter is None:
+        maxiter = 10*A.shape[1]
+    x       = np.zeros(A.shape[1], dtype=np.float64)
+    r       = b.copy()
+    s       = A.T.dot(r)
+    p       = s.copy()
+    gamma   = np.dot(s, s)
+    gamma0  = gamma
+    for it in range(maxiter):
+        if gamma <= (tol**2)*gamma0:
+            break
+        q       = A.dot(p)
+        a       = gamma/np.dot(q, q)
+        x       += a*p
+        r       -= a*q
+        s       = A.T.dot(r)
+        gamma_new   = np.dot(s, s)
+        p       = s + (gamma_new/gamma)*p
+        gamma   = gamma_new
+    return x
+
+def _azi_coverage(indptr, indices, azis, Nnode):
+    """azimuthal coverage of the grid points from the azimuths of the rays
+        the azimuths are folded into 0 ~ 180 degree and counted in bins of _azi_bin_width degree
+        azi_coverage1 (squared sum) - sum of the squared bin counts divided by the squared number of rays
+        azi_coverage2 (max value)   - maximum bin count divided by the number of rays
+        both are 1 if all the rays are in one bin, and 0 for the grid points without rays
+    """
+    Nbin        = int(round(180./_azi_bin_width))
+    ibin        = np.minimum(np.int64((azis % 180.)/_azi_bin_width), Nbin - 1)
+    counts      = np.bincount(indices*Nbin + ibin, minlength=Nnode*Nbin).reshape(Nnode, Nbin).astype(np.float64)
+    Nray        = counts.sum(axis=1)
+    aziArr      = np.zeros((Nnode, 2), dtype=np.float64)
+    ind         = Nray > 0
+    aziArr[ind, 0]  = (counts[ind, :]**2).sum(axis=1)/Nray[ind]**2
+    aziArr[ind, 1]  = counts[ind, :].max(axis=1)/Nray[ind]
+    return aziArr
+
+def straight_ray_tomo(inArr, lats, lons, stepinte=0.2, alpha=3000., beta=100., sigma=500., solver='lsqr', tol=1e-8, maxiter=None, kernel=None):
+    """
+    isotropic straight ray tomography, the in-process counterpart of Misha's itomo_sp_cu_shn
+    =================================================================================================================
+    ::: input parameters :::
+    inArr           - input data array, id fi0 lam0 f1 lam1 vel_obs weight (same as the input file of Misha's code)
+    lats, lons      - 1D arrays for grid locations
+    stepinte        - step of integration (degree)
+    alpha           - smoothing coefficient
+    beta            - path density damping
+    sigma           - Gaussian smoothing (radius of correlation, km)
+    solver          - 'lsqr' (scipy.sparse.linalg.lsqr) or 'cgls'
+    tol             - tolerance of the solver
+    maxiter         - maximum number of iterations, default is 10*Nnode
+    kernel          - ray sensitivity of the rays in inArr (indptr, indices, lengths, azis), see _ray_sensitivity
+                        computed if not specified, RayTomoDataSet.get_ray_kernel gets it from the kernel cache
+    ::: output :::
+    velocity        - velocity at the grid points, shape: Nlat*Nlon
+    Dvelocity       - velocity perturbation (%) relative to the reference (best fitting homogeneous) velocity
+    azi_coverage    - azimuthal coverage, shape: Nlat*Nlon, 2, see _azi_coverage
+    residual        - id fi0 lam0 f1 lam1 vel_obs weight res_tomo res_mod delta
+                        res_tomo/res_mod: travel time residual (sec, observed - predicted) of the tomography/reference model
+                        delta: great circle distance (km)
+    path_density    - number of rays in each grid cell, shape: Nlat*Nlon
+    ::: note :::
+    The smoothing term is alpha*(m - S(m)), where S is the Gaussian smoothing operator with sigma.
+    The damping term is beta*exp(-0.3*path_density)*m. The model m is the relative slowness perturbation.
+    The ray sensitivity is in km and the data are the travel time residuals times the reference velocity (km),
+        so that alpha/beta/sigma are on the same scale as Misha's code (e.g. 3000/100/500 for the smooth run,
+        850/1/175 for the quality controlled run).
+    =================================================================================================================
+    """
+    lats        = np.asarray(lats, dtype=np.float64)
+    lons        = np.asarray(lons, dtype=np.float64)
+    Nnode       = lats.size*lons.size
+    Npath       = inArr.shape[0]
+    velobs      = inArr[:, 5]
+    weight      = inArr[:, 6]
+    #------------------------
+    # ray sensitivity
+    #------------------------
+    if kernel is None:
+        kernel  = _ray_sensitivity(np.float64(inArr[:, 1]), np.float64(inArr[:, 2]), np.float64(inArr[:, 3]),\
+                    np.float64(inArr[:, 4]), lats, lons, np.float64(stepinte))
+    indptr, indices, lengths, azis\
+                = kernel
+    G           = scipy.sparse.csr_matrix((lengths, indices, indptr), shape=(Npath, Nnode))
+    delta       = _great_circle_dist(inArr[:, 1], inArr[:, 2], inArr[:, 3], inArr[:, 4])
+    tobs        = delta/velobs
+    # reference model, best fitting homogeneous slowness
+    s0          = np.dot(tobs*weight**2, delta)/np.dot(delta*weight**2, delta)
+    tref        = delta*s0
+    path_density= np.bincount(indices, minlength=Nnode).astype(np.float64)
+    #------------------------
+    # regularized system
+    #------------------------
+    # ray lengths (km), the travel time residuals are converted to km with the reference velocity
+    Gw          = scipy.sparse.diags(weight).dot(G)
+    ptr, ind, dat\
+                = _gauss_smoothing_matrix(lats, lons, np.float64(sigma))
+    S           = scipy.sparse.csr_matrix((dat, ind, ptr), shape=(Nnode, Nnode))
+    F           = (scipy.sparse.identity(Nnode, format='csr') - S)*alpha
+    H           = scipy.sparse.diags(beta*np.exp(-_path_density_lambda*path_density))
+    A           = scipy.sparse.vstack([Gw, F, H], format='csr')
+    b           = np.zeros(Npath + 2*Nnode, dtype=np.float64)
+    b[:Npath]   = weight*(tobs - tref)/s0
+    if solver == 'lsqr':
+        if maxiter is None:
+            maxiter = 10*Nnode
+        model   = scipy.sparse.linalg.lsqr(A, b, atol=tol, btol=tol, iter_lim=maxiter)[0]
+    elif solver == 'cgls':
+        model   = _cgls(A, b, tol=tol, maxiter=maxiter)
+    else:
+        raise ValueError('Unexpected solver: '+solver)
+    #------------------------
+    # output
+    #------------------------
+    velocity    = 1./(s0*(1. + model))
+    Dvelocity   = (velocity*s0 - 1.)*100.
+    tpre        = tref + G.dot(model)*s0
+    residual    = np.zeros((Npath, 10), dtype=np.float64)
+    residual[:, :7] = inArr[:, :7]
+    residual[:, 7]  = tobs - tpre
+    residual[:, 8]  = tobs - tref
+    residual[:, 9]  = delta
+    azi_coverage    = _azi_coverage(indptr, indices, azis, Nnode)
+    return velocity, Dvelocity, azi_coverage, residual, path_density
+
 class RayTomoDataSet(h5py.File):
     """
     =================================================================================================================
@@ -553,7 +977,8 @@ class RayTomoDataSet(h5py.File):
     #==================================================================
     
     def run_smooth(self, datadir, outdir, datatype='ph', channel='ZZ', dlon=0.5, dlat=0.5, stepinte=0.2, lengthcell=1.0, alpha1=3000, alpha2=100, sigma=500,
-            runid=0, comments='', deletetxt=False, contourfname='./contour.ctr', IsoMishaexe='./TOMO_MISHA/itomo_sp_cu_shn', reshape=True):
+            runid=0, comments='', deletetxt=False, contourfname='./contour.ctr', IsoMishaexe='./TOMO_MISHA/itomo_sp_cu_shn', reshape=True,\
+            nprocess=1):
         """
         run Misha's tomography code with large regularization parameters.
         This function is designed to do an inital test run, the output can be used to discard outliers in aftan results.
@@ -574,6 +999,9 @@ class RayTomoDataSet(h5py.File):
         deletetxt           - delete txt output or not
         contourfname        - path to contour file (see the manual for detailed description)
         IsoMishaexe         - path to Misha's Tomography code executable (isotropic version)
+        nprocess            - number of processes running the periods concurrently (None for the number of cpus)
+                                each period is run in its own output directory (outdir/per_datatype)
+                                with a copy of the contour file, the results are saved in period order
         ------------------------------------------------------------------------------------------------------------------
         input format:
         datadir/data_pfx+'%g'%( per ) +'_'+channel+'_'+datatype+'.lst' (e.g. datadir/raytomo_10_ZZ_ph.lst)
@@ -596,33 +1024,31 @@ class RayTomoDataSet(h5py.File):
         maxlat          = self.attrs['maxlat']
         data_pfx        = self.attrs['data_pfx']
         smoothpfx       = self.attrs['smoothpfx']
-        if not os.path.isdir(outdir):
-            deleteall   = True
+        deleteall       = not os.path.isdir(outdir)
         #-----------------------------------------
         # run the tomography code for each period
         #-----------------------------------------
         print('================================= Smooth run of surface wave tomography ==================================')
+        tasks           = []
         for per in pers:
-            print('----------------------------------------------------------------------------------------------------------')
-            print('----------------------------------------- T = '+str(per)+' sec ---------------------------------------------------')
-            print('----------------------------------------------------------------------------------------------------------')
-            infname     = datadir+'/'+data_pfx+'%g'%( per ) +'_'+channel+'_'+datatype+'.lst'
-            outper      = outdir+'/'+'%g'%( per ) +'_'+datatype
+            infname     = os.path.abspath(datadir+'/'+data_pfx+'%g'%( per ) +'_'+channel+'_'+datatype+'.lst')
+            outper      = os.path.abspath(outdir+'/'+'%g'%( per ) +'_'+datatype)
             if not os.path.isdir(outper):
                 os.makedirs(outper)
+            shutil.copyfile(contourfname, outper+'/contour.ctr')
             outpfx      = outper+'/'+smoothpfx+str(alpha1)+'_'+str(sigma)+'_'+str(alpha2)
             temprunsh   = 'temp_'+'%g_Smooth.sh' %(per)
-            with open(temprunsh,'wb') as f:
-                f.writelines('%s %s %s %g <<-EOF\n' %(IsoMishaexe, infname, outpfx, per ))
-                # if paraFlag==False:
-                #     f.writelines('me \n' );
-                f.writelines('me \n4 \n5 \n%g \n6 \n%g \n%g \n%g \n' %( alpha2, alpha1, sigma, sigma) )
-                f.writelines('7 \n%g %g %g \n8 \n%g %g %g \n12 \n%g \n%g \n16 \n' %(minlat, maxlat, dlat, minlon, maxlon, dlon, stepinte, lengthcell) )
-                # if paraFlag==False:
-                #     f.writelines('v \n' );
-                f.writelines('v \nq \ngo \nEOF \n' )
-            call(['bash', temprunsh])
-            os.remove(temprunsh)
+            lines       = []
+            lines.append('%s %s %s %g <<-EOF\n' %(os.path.abspath(IsoMishaexe), infname, outpfx, per ))
+            # if paraFlag==False:
+            #     lines.append('me \n' );
+            lines.append('me \n4 \n5 \n%g \n6 \n%g \n%g \n%g \n' %( alpha2, alpha1, sigma, sigma) )
+            lines.append('7 \n%g %g %g \n8 \n%g %g %g \n12 \n%g \n%g \n16 \n' %(minlat, maxlat, dlat, minlon, maxlon, dlon, stepinte, lengthcell) )
+            # if paraFlag==False:
+            #     lines.append('v \n' );
+            lines.append('v \nq \ngo \nEOF \n' )
+            tasks.append((outper, temprunsh, lines))
+        _run_misha_tasks(tasks, nprocess=nprocess, pers=pers)
         #-----------------------------------------
         # save results to hdf5 dataset
         #-----------------------------------------
@@ -652,6 +1078,9 @@ class RayTomoDataSet(h5py.File):
             inArr       = np.loadtxt(v0fname)
             v0Arr       = inArr[:,2]
             v0dset      = subgroup.create_dataset(name='velocity', data=v0Arr)
+            # longitude-latitude array
+            lonlatArr   = inArr[:,:2]
+            lonlatdset  = subgroup.create_dataset(name='lons_lats', data=lonlatArr)
             # relative velocity perturbation
             dvfname     = outpfx+'_%g.1' %(per)+'_%_'
             inArr       = np.loadtxt(dvfname)
@@ -685,7 +1114,7 @@ class RayTomoDataSet(h5py.File):
                dlon=0.5, dlat=0.5, stepinte=0.1, lengthcell=0.5,  isotropic=False, alpha=850, beta=1, sigma=175, \
                 lengthcellAni=1.0, anipara=0, xZone=2, alphaAni0=1200, betaAni0=1, sigmaAni0=200, alphaAni2=1000, sigmaAni2=100,\
                 alphaAni4=1200, sigmaAni4=500, comments='', deletetxt=False, contourfname='./contour.ctr',\
-                IsoMishaexe='./TOMO_MISHA/itomo_sp_cu_shn', AniMishaexe='./TOMO_MISHA_AZI/tomo_sp_cu_s_shn_.1', reshape=True):
+                IsoMishaexe='./TOMO_MISHA/itomo_sp_cu_shn', AniMishaexe='./TOMO_MISHA_AZI/tomo_sp_cu_s_shn_.1', reshape=True, nprocess=1):
         """
         run Misha's tomography code with quality control based on preliminary run of run_smooth.
         This function is designed to discard outliers in aftan results (quality control), and then do tomography.
@@ -738,6 +1167,9 @@ class RayTomoDataSet(h5py.File):
         contourfname        - path to contour file (see the manual for detailed description)
         IsoMishaexe         - path to Misha's Tomography code executable (isotropic version)
         AniMishaexe         - path to Misha's Tomography code executable (anisotropic version)
+        nprocess            - number of processes running the periods concurrently (None for the number of cpus)
+                                each period is run in its own output directory (outdir/per_datatype)
+                                with a copy of the contour file, the results are saved in period order
         ------------------------------------------------------------------------------------------------------------------
         intermediate output format:
         outdir+'/'+per+'_'+datatype+'/QC_'+per+'_'+wavetype+'_'+datatype+'.lst'
@@ -771,14 +1203,8 @@ class RayTomoDataSet(h5py.File):
         if not os.path.isfile(contourfname):
             raise AttributeError('Contour file does not exist!')
         smoothgroup     = self['smooth_run_'+str(smoothid)]
-        ##
-        # positive bound
-        ##
-        bounds          = {18.: 10., 16.: 25., 14.: 25., 12.: 35., 10.: 35., 8.: 40.}
-        # bounds          = {22: 10., 20.: 10., 18.: 10., 16.: 25., 14.: 25., 12.: 35., 10.: 35., 8.: 40.}
-        # bounds          = {}
-        
-        ##
+        deleteall       = not os.path.isdir(outdir)
+        tasks           = []
         for per in pers:
             #------------------------------------------------
             # quality control based on smooth run results
@@ -789,27 +1215,10 @@ class RayTomoDataSet(h5py.File):
                 inArr       = residdset.value
             except:
                 raise AttributeError('Residual data: '+ str(per)+ ' sec does not exist!')
-            res_tomo        = inArr[:,7]
             #------------------------------------------------------
             # quality control to discard data with large misfit
             #------------------------------------------------------
-            if usemad:
-                from statsmodels import robust
-                mad         = robust.mad(res_tomo)
-                cri_res     = madfactor * mad
-            else:
-                cri_res     = min(crifactor*per, crilimit)
-            ###
-            validarr        = _bad_station_detector(inArr)
-            QC_arr          = inArr[validarr, :]
-            res_tomo        = QC_arr[:, 7]
-            
-            if per in bounds.keys():
-                ind         = (res_tomo > -(cri_res))*(res_tomo < bounds[per])
-                QC_arr      = QC_arr[ind, :]
-            else:
-                QC_arr      = QC_arr[np.abs(res_tomo)<cri_res, :]
-            ###
+            QC_arr          = _qc_residual(inArr, per, crifactor=crifactor, crilimit=crilimit, usemad=usemad, madfactor=madfactor)
             # if per in bounds.keys():
             #     ind         = (res_tomo > -(cri_res))*(res_tomo < bounds[per])
             #     QC_arr      = inArr[ind, :]
@@ -824,9 +1233,10 @@ class RayTomoDataSet(h5py.File):
             # QC_arr          = QC_arr[validarr, :]
             ####
             outArr          = QC_arr[:,:8]
-            outper          = outdir+'/'+'%g'%( per ) +'_'+datatype
+            outper          = os.path.abspath(outdir+'/'+'%g'%( per ) +'_'+datatype)
             if not os.path.isdir(outper):
                 os.makedirs(outper)
+            shutil.copyfile(contourfname, outper+'/contour.ctr')
             # old format in defined in the manual
             QCfname         = outper+'/QC_'+'%g'%( per ) +'_'+wavetype+'_'+datatype+'.lst'
             np.savetxt(QCfname, outArr, fmt='%g')
@@ -838,27 +1248,27 @@ class RayTomoDataSet(h5py.File):
             else:
                 outpfx      = outper+'/'+qcpfx+wavetype+'_'+str(alphaAni0)+'_'+str(sigmaAni0)+'_'+str(alphaAni2)+'_'+str(sigmaAni2)+'_'+str(betaAni0)
             temprunsh       = 'temp_'+'%g_QC.sh' %(per)
-            with open(temprunsh,'wb') as f:
-                f.writelines('%s %s %s %g << EOF \n' %(mishaexe, QCfname, outpfx, per ))
-                if isotropic:
-                    f.writelines('me \n4 \n5 \n%g \n6 \n%g \n%g \n%g \n' %( beta, alpha, sigma, sigma) ) # 100 --> 1., 3000. --> 850., 500. --> 175.
-                    f.writelines('7 \n%g %g %g \n8 \n%g %g %g \n12 \n%g \n%g \n16 \n' %(minlat, maxlat, dlat, minlon, maxlon, dlon, stepinte, lengthcell) )
-                    f.writelines('v \nq \ngo \nEOF \n' )
+            lines           = []
+            lines.append('%s %s %s %g << EOF \n' %(os.path.abspath(mishaexe), QCfname, outpfx, per ))
+            if isotropic:
+                lines.append('me \n4 \n5 \n%g \n6 \n%g \n%g \n%g \n' %( beta, alpha, sigma, sigma) ) # 100 --> 1., 3000. --> 850., 500. --> 175.
+                lines.append('7 \n%g %g %g \n8 \n%g %g %g \n12 \n%g \n%g \n16 \n' %(minlat, maxlat, dlat, minlon, maxlon, dlon, stepinte, lengthcell) )
+                lines.append('v \nq \ngo \nEOF \n' )
+            else:
+                if datatype=='ph':
+                    Dtype   = 'P'
                 else:
-                    if datatype=='ph':
-                        Dtype   = 'P'
-                    else:
-                        Dtype   = 'G'
-                    f.writelines('me \n4 \n5 \n%g %g %g \n6 \n%g %g %g \n' %( minlat, maxlat, dlat, minlon, maxlon, dlon) )
-                    f.writelines('10 \n%g \n%g \n%s \n%s \n%g \n%g \n11 \n%d \n' %(stepinte, xZone, wavetype, Dtype, lengthcell, lengthcellAni, anipara) )
-                    f.writelines('12 \n%g \n%g \n%g \n%g \n' %(alphaAni0, betaAni0, sigmaAni0, sigmaAni0) ) # 100 --> 1., 3000. --> 1200., 500. --> 200.
-                    f.writelines('13 \n%g \n%g \n%g \n' %(alphaAni2, sigmaAni2, sigmaAni2) )
-                    if anipara==2:
-                        f.writelines('14 \n%g \n%g \n%g \n' %(alphaAni4, sigmaAni4, sigmaAni4) )
-                    f.writelines('19 \n25 \n' )
-                    f.writelines('v \nq \ngo \nEOF \n' )
-            call(['bash', temprunsh])
-            os.remove(temprunsh)
+                    Dtype   = 'G'
+                lines.append('me \n4 \n5 \n%g %g %g \n6 \n%g %g %g \n' %( minlat, maxlat, dlat, minlon, maxlon, dlon) )
+                lines.append('10 \n%g \n%g \n%s \n%s \n%g \n%g \n11 \n%d \n' %(stepinte, xZone, wavetype, Dtype, lengthcell, lengthcellAni, anipara) )
+                lines.append('12 \n%g \n%g \n%g \n%g \n' %(alphaAni0, betaAni0, sigmaAni0, sigmaAni0) ) # 100 --> 1., 3000. --> 1200., 500. --> 200.
+                lines.append('13 \n%g \n%g \n%g \n' %(alphaAni2, sigmaAni2, sigmaAni2) )
+                if anipara==2:
+                    lines.append('14 \n%g \n%g \n%g \n' %(alphaAni4, sigmaAni4, sigmaAni4) )
+                lines.append('19 \n25 \n' )
+                lines.append('v \nq \ngo \nEOF \n' )
+            tasks.append((outper, temprunsh, lines))
+        _run_misha_tasks(tasks, nprocess=nprocess, pers=pers)
         #------------------------------------------------
         # save to hdf5 dataset
         #------------------------------------------------
@@ -907,9 +1317,8 @@ class RayTomoDataSet(h5py.File):
             v0Arr       = inArr[:,2:]
             v0dset      = subgroup.create_dataset(name='velocity', data=v0Arr)
             # longitude-latitude array
-            if not isotropic:
-                lonlatArr   = inArr[:,:2]
-                lonlatdset  = subgroup.create_dataset(name='lons_lats', data=lonlatArr)
+            lonlatArr   = inArr[:,:2]
+            lonlatdset  = subgroup.create_dataset(name='lons_lats', data=lonlatArr)
             # relative velocity perturbation
             dvfname     = outpfx+'_%g.1' %(per)+'_%_'
             inArr       = np.loadtxt(dvfname)
@@ -949,6 +1358,237 @@ class RayTomoDataSet(h5py.File):
             self.creat_reshape_data(runtype=1, runid=runid)
         return
     
+    def get_ray_kernel(self, inArr, lats, lons, stepinte, usecache=True):
+        """
+        get the ray sensitivity of the rays in inArr from the kernel cache
+        The cache stores the cell intersection lengths (CSR format) of each station pair for a grid definition
+        (ray_kernel/<grid key>), the rays of the station pairs not in the cache are traced and appended to the cache.
+        The ray geometry does not depend on the period and the regularization parameters, so all the runs with
+        the same grid share the cache.
+        =================================================================================================================
+        ::: input parameters :::
+        inArr           - input data array, id fi0 lam0 f1 lam1 ...
+        lats, lons      - 1D arrays for grid locations
+        stepinte        - step of integration (degree)
+        usecache        - use the cache or not, the rays are traced without updating the cache if False
+        ::: output :::
+        indptr, indices, lengths, azis
+                        - ray sensitivity of the rays in inArr, see _ray_sensitivity
+        =================================================================================================================
+        """
+        lats            = np.asarray(lats, dtype=np.float64)
+        lons            = np.asarray(lons, dtype=np.float64)
+        pairs           = _get_pair_keys(inArr)
+        if not usecache:
+            return _ray_sensitivity(pairs[:, 0].copy(), pairs[:, 1].copy(), pairs[:, 2].copy(), pairs[:, 3].copy(),\
+                        lats, lons, np.float64(stepinte))
+        gridkey         = '%g_%g_%g_%g_%g_%g_%g' %(lats[0], lats[-1], lats[1]-lats[0], lons[0], lons[-1], lons[1]-lons[0], stepinte)
+        group           = self.require_group('ray_kernel/'+gridkey)
+        if not 'pairs' in group.keys():
+            group.attrs.create(name = 'lats', data=lats)
+            group.attrs.create(name = 'lons', data=lons)
+            group.attrs.create(name = 'step_of_integration', data=stepinte)
+            group.create_dataset(name='pairs', shape=(0, 4), maxshape=(None, 4), dtype=np.float64, chunks=True)
+            group.create_dataset(name='indptr', data=np.zeros(1, dtype=np.int64), maxshape=(None,), chunks=True)
+            for name, dtype in (('indices', np.int32), ('lengths', np.float64), ('azis', np.float64)):
+                group.create_dataset(name=name, shape=(0,), maxshape=(None,), dtype=dtype, chunks=True)
+        # the cache is kept in memory after it is read once
+        if not hasattr(self, '_ray_kernel_cache'):
+            self._ray_kernel_cache  = {}
+        if not gridkey in self._ray_kernel_cache:
+            cpairs      = group['pairs'][()]
+            lut         = dict(zip(map(tuple, cpairs), range(cpairs.shape[0])))
+            self._ray_kernel_cache[gridkey]\
+                        = [lut, group['indptr'][()], np.int64(group['indices'][()]), group['lengths'][()], group['azis'][()]]
+        lut, cindptr, cindices, clengths, cazis\
+                        = self._ray_kernel_cache[gridkey]
+        #------------------------------------------
+        # trace the rays not in the cache
+        #------------------------------------------
+        newpairs        = []
+        for pair in map(tuple, pairs):
+            if not pair in lut:
+                lut[pair]   = len(lut)
+                newpairs.append(pair)
+        if len(newpairs) > 0:
+            newpairs    = np.array(newpairs, dtype=np.float64)
+            indptr, indices, lengths, azis\
+                        = _ray_sensitivity(newpairs[:, 0].copy(), newpairs[:, 1].copy(), newpairs[:, 2].copy(), newpairs[:, 3].copy(),\
+                            lats, lons, np.float64(stepinte))
+            cindptr     = np.append(cindptr, indptr[1:] + cindptr[-1])
+            cindices    = np.append(cindices, indices)
+            clengths    = np.append(clengths, lengths)
+            cazis       = np.append(cazis, azis)
+            Nold        = group['pairs'].shape[0]
+            Nentry_old  = group['indices'].shape[0]
+            group['pairs'].resize((Nold+newpairs.shape[0], 4))
+            group['pairs'][Nold:, :]    = newpairs
+            group['indptr'].resize((cindptr.size,))
+            group['indptr'][Nold+1:]    = cindptr[Nold+1:]
+            for name, arr in (('indices', cindices), ('lengths', clengths), ('azis', cazis)):
+                group[name].resize((arr.size,))
+                group[name][Nentry_old:]= arr[Nentry_old:]
+            self._ray_kernel_cache[gridkey]\
+                        = [lut, cindptr, cindices, clengths, cazis]
+            print '--- '+str(newpairs.shape[0])+' rays traced and added to the ray kernel cache'
+        #------------------------------------------
+        # select the rows of the rays in inArr
+        #------------------------------------------
+        rows            = np.array([lut[pair] for pair in map(tuple, pairs)], dtype=np.int64)
+        ientry, indptr  = _select_csr_rows(cindptr, rows)
+        return indptr, cindices[ientry], clengths[ientry], cazis[ientry]
+    
+    def run_smooth_sparse(self, datadir, datatype='ph', channel='ZZ', dlon=0.5, dlat=0.5, stepinte=0.2, alpha1=3000, alpha2=100, sigma=500,
+            runid=0, comments='', solver='lsqr', usecache=True, reshape=True, indata=None):
+        """
+        smooth run with the in-process sparse straight ray tomography solver (straight_ray_tomo)
+        same as run_smooth, but neither Misha's code nor the text output files are needed
+        =================================================================================================================
+        ::: input parameters :::
+        datadir             - data directory
+        datatype            - ph: phase velocity inversion, gr: group velocity inversion
+        channel             - channel for analysis (default: ZZ, xcorr ZZ component)
+        dlon/dlat           - longitude/latitude interval
+        stepinte            - step of integration (degree)
+        alpha1,alpha2,sigma - regularization parameters for isotropic tomography
+                                alpha1  : smoothing coefficient
+                                alpha2  : path density damping
+                                sigma   : Gaussian smoothing (radius of correlation)
+                                same scale as Misha's code, see straight_ray_tomo
+        runid               - id number for the run
+        comments            - comments for the run
+        solver              - 'lsqr' or 'cgls'
+        usecache            - use the ray kernel cache or not, see get_ray_kernel
+        indata              - in-memory input data (datadir is not used if given), e.g. the output of
+                                noisedbase.noiseASDF.xcorr_raytomoinput with inmemory = True
+                                indata['%g' %per][datatype] is an (N, 7) array in the same format as the input files
+        ------------------------------------------------------------------------------------------------------------------
+        input format:
+        datadir/data_pfx+'%g'%( per ) +'_'+channel+'_'+datatype+'.lst' (e.g. datadir/raytomo_10_ZZ_ph.lst)
+        =================================================================================================================
+        """
+        pers            = self.attrs['period_array']
+        data_pfx        = self.attrs['data_pfx']
+        create_group    = False
+        while (not create_group):
+            try:
+                group       = self.create_group( name = 'smooth_run_'+str(runid) )
+                create_group= True
+            except:
+                runid       += 1
+                continue
+        group.attrs.create(name = 'comments', data=comments)
+        group.attrs.create(name = 'dlon', data=dlon)
+        group.attrs.create(name = 'dlat', data=dlat)
+        group.attrs.create(name = 'step_of_integration', data=stepinte)
+        group.attrs.create(name = 'datatype', data=datatype)
+        group.attrs.create(name = 'channel', data=channel)
+        group.attrs.create(name = 'alpha1', data=alpha1)
+        group.attrs.create(name = 'alpha2', data=alpha2)
+        group.attrs.create(name = 'sigma', data=sigma)
+        group.attrs.create(name = 'solver', data=solver)
+        self._get_lon_lat_arr(dataid='smooth_run_'+str(runid))
+        print('================================= Smooth run of surface wave tomography (sparse) =========================')
+        for per in pers:
+            print('----------------------------------------- T = '+str(per)+' sec ---------------------------------------------------')
+            if indata is None:
+                infname = datadir+'/'+data_pfx+'%g'%( per ) +'_'+channel+'_'+datatype+'.lst'
+                inArr   = np.loadtxt(infname, usecols=range(7), ndmin=2)
+            else:
+                inArr   = indata['%g'%( per )][datatype]
+            kernel      = self.get_ray_kernel(inArr, lats=self.lats, lons=self.lons, stepinte=stepinte, usecache=usecache)
+            velocity, Dvelocity, azi_coverage, residual, path_density\
+                        = straight_ray_tomo(inArr, lats=self.lats, lons=self.lons, stepinte=stepinte, alpha=alpha1, beta=alpha2,\
+                            sigma=sigma, solver=solver, kernel=kernel)
+            subgroup    = group.create_group(name='%g_sec'%( per ))
+            subgroup.create_dataset(name='velocity', data=velocity)
+            subgroup.create_dataset(name='Dvelocity', data=Dvelocity)
+            subgroup.create_dataset(name='azi_coverage', data=azi_coverage)
+            subgroup.create_dataset(name='residual', data=residual)
+            subgroup.create_dataset(name='path_density', data=path_density)
+        if reshape:
+            self.creat_reshape_data(runtype=0, runid=runid)
+        print('================================= End smooth run of surface wave tomography (sparse) =====================')
+        return
+    
+    def run_qc_sparse(self, runid=0, smoothid=0, datatype='ph', wavetype='R', crifactor=0.5, crilimit=10., usemad=True, madfactor=3.,
+               dlon=0.5, dlat=0.5, stepinte=0.1, alpha=850, beta=1, sigma=175, comments='', solver='lsqr', usecache=True, reshape=True):
+        """
+        isotropic quality controlled run with the in-process sparse straight ray tomography solver (straight_ray_tomo)
+        same as run_qc with isotropic = True, but neither Misha's code nor the text output files are needed
+        =================================================================================================================
+        ::: input parameters :::
+        smoothid            - smooth run id number
+        datatype            - data type
+                                ph      : phase velocity inversion
+                                gr      : group velocity inversion
+        wavetype            - wave type
+                                R       : Rayleigh
+                                L       : Love
+        crifactor/crilimit  - criteria for quality control
+                                largest residual is min( crifactor*period, crilimit)
+        usemad/madfactor    - use madfactor*mad of the residuals as the criteria instead
+        dlon/dlat           - longitude/latitude interval
+        stepinte            - step of integration (degree)
+        alpha,beta,sigma    - regularization parameters for isotropic tomography
+                                alpha   : smoothing coefficient
+                                beta    : path density damping
+                                sigma   : Gaussian smoothing (radius of correlation)
+                                same scale as Misha's code, see straight_ray_tomo
+        comments            - comments for the run
+        solver              - 'lsqr' or 'cgls'
+        usecache            - use the ray kernel cache or not, see get_ray_kernel
+        =================================================================================================================
+        """
+        pers            = self.attrs['period_array']
+        smoothgroup     = self['smooth_run_'+str(smoothid)]
+        create_group    = False
+        while (not create_group):
+            try:
+                group       = self.create_group( name = 'qc_run_'+str(runid) )
+                create_group= True
+            except:
+                runid       += 1
+                continue
+        group.attrs.create(name = 'isotropic', data=True)
+        group.attrs.create(name = 'datatype', data=datatype)
+        group.attrs.create(name = 'wavetype', data=wavetype)
+        group.attrs.create(name = 'crifactor', data=crifactor)
+        group.attrs.create(name = 'crilimit', data=crilimit)
+        group.attrs.create(name = 'dlon', data=dlon)
+        group.attrs.create(name = 'dlat', data=dlat)
+        group.attrs.create(name = 'step_of_integration', data=stepinte)
+        # no main cell in the sparse solver, the model is defined at the grid points
+        group.attrs.create(name = 'lengthcell', data=0.)
+        group.attrs.create(name = 'alpha', data=alpha)
+        group.attrs.create(name = 'beta', data=beta)
+        group.attrs.create(name = 'sigma', data=sigma)
+        group.attrs.create(name = 'comments', data=comments)
+        group.attrs.create(name = 'smoothid', data='smooth_run_'+str(smoothid))
+        group.attrs.create(name = 'solver', data=solver)
+        self._get_lon_lat_arr(dataid='qc_run_'+str(runid))
+        for per in pers:
+            try:
+                # id fi0 lam0 f1 lam1 vel_obs weight res_tomo res_mod delta
+                inArr   = smoothgroup['%g_sec'%( per )+'/residual'].value
+            except:
+                raise AttributeError('Residual data: '+ str(per)+ ' sec does not exist!')
+            QC_arr      = _qc_residual(inArr, per, crifactor=crifactor, crilimit=crilimit, usemad=usemad, madfactor=madfactor)
+            kernel      = self.get_ray_kernel(QC_arr, lats=self.lats, lons=self.lons, stepinte=stepinte, usecache=usecache)
+            velocity, Dvelocity, azi_coverage, residual, path_density\
+                        = straight_ray_tomo(QC_arr[:, :7], lats=self.lats, lons=self.lons, stepinte=stepinte, alpha=alpha, beta=beta,\
+                            sigma=sigma, solver=solver, kernel=kernel)
+            # same shapes as the output of the isotropic version of Misha's code
+            subgroup    = group.create_group(name='%g_sec'%( per ))
+            subgroup.create_dataset(name='velocity', data=velocity.reshape(-1, 1))
+            subgroup.create_dataset(name='Dvelocity', data=Dvelocity)
+            subgroup.create_dataset(name='azi_coverage', data=azi_coverage)
+            subgroup.create_dataset(name='residual', data=residual)
+            subgroup.create_dataset(name='path_density', data=path_density.reshape(-1, 1))
+        if reshape:
+            self.creat_reshape_data(runtype=1, runid=runid)
+        return
+    
     def creat_reshape_data(self, runtype=0, runid=0):
         """
         convert data to Nlat * Nlon shape and store the mask
@@ -971,32 +1611,36 @@ class RayTomoDataSet(h5py.File):
         else:
             isotropic   = True
         #-----------------
+        # grid indices (ilat, ilon) of the output points, computed once per run
+        #-----------------
+        tempgrp         = ingrp['%g_sec'%( pers[0] )]
+        minlon          = self.attrs['minlon']
+        minlat          = self.attrs['minlat']
+        dlon            = ingrp.attrs['dlon']
+        dlat            = ingrp.attrs['dlat']
+        if 'lons_lats' in tempgrp.keys():
+            lonlat_arr1 = tempgrp['lons_lats'].value
+        else:
+            # locations not stored (sparse solver or older runs), the points are the full grid, latitude major
+            lonlat_arr1 = np.vstack((self.lonArr.ravel(), self.latArr.ravel())).T
+        gridindex1      = _lonlat2index(lonlat_arr1[:,0], lonlat_arr1[:,1], minlon, minlat, dlon, dlat, self.Nlon, self.Nlat)
+        if 'lons_lats_rea' in tempgrp.keys():
+            lonlat_arr2 = tempgrp['lons_lats_rea'].value
+            gridindex2  = _lonlat2index(lonlat_arr2[:,0], lonlat_arr2[:,1], minlon, minlat, dlon, dlat, self.Nlon, self.Nlat)
+        else:
+            # no resolution analysis (isotropic run), same points as the velocity
+            gridindex2  = gridindex1
+        outgrp.create_dataset(name='grid_index1', data=gridindex1)
+        outgrp.create_dataset(name='grid_index2', data=gridindex2)
+        #-----------------
         # mask array
         #-----------------
         if not isotropic:
             mask1       = np.ones((self.Nlat, self.Nlon), dtype=np.bool)
             mask2       = np.ones((self.Nlat, self.Nlon), dtype=np.bool)
-            tempgrp     = ingrp['%g_sec'%( pers[0] )]
-            # get value for mask1 array
-            lonlat_arr1 = tempgrp['lons_lats'].value
-            inlon       = lonlat_arr1[:,0]
-            inlat       = lonlat_arr1[:,1]
-            for i in range(inlon.size):
-                lon                         = inlon[i]
-                lat                         = inlat[i]
-                # index                       = np.where((self.lonArr==lon)*(self.latArr==lat))
-                index                       = np.where((abs(self.lonArr-lon)<0.001)*(abs(self.latArr-lat)<0.001))
-                mask1[index[0], index[1]]   = False
-            # get value for mask2 array
-            lonlat_arr2 = tempgrp['lons_lats_rea'].value
-            inlon       = lonlat_arr2[:,0]
-            inlat       = lonlat_arr2[:,1]
-            for i in range(inlon.size):
-                lon                         = inlon[i]
-                lat                         = inlat[i]
-                # index                       = np.where((self.lonArr==lon)*(self.latArr==lat))
-                index                       = np.where((abs(self.lonArr-lon)<0.001)*(abs(self.latArr-lat)<0.001))
-                mask2[index[0], index[1]]   = False
+            # get value for mask1/mask2 array
+            mask1[gridindex1[:,0], gridindex1[:,1]] = False
+            mask2[gridindex2[:,0], gridindex2[:,1]] = False
             outgrp.create_dataset(name='mask1', data=mask1)
             outgrp.create_dataset(name='mask2', data=mask2)
             index1      = np.logical_not(mask1)
@@ -1019,27 +1663,27 @@ class RayTomoDataSet(h5py.File):
             opergrp         = outgrp.create_group(name='%g_sec'%( per ))
             if isotropic:
                 # velocity
-                outv        = velocity.reshape(self.Nlat, self.Nlon)
+                outv        = _index2grid(velocity, gridindex1, self.Nlat, self.Nlon)
                 v0dset      = opergrp.create_dataset(name='velocity', data=outv)
                 v0dset.attrs.create(name='Nlat', data=self.Nlat)
                 v0dset.attrs.create(name='Nlon', data=self.Nlon)
                 # relative velocity perturbation
-                outdv       = dv.reshape(self.Nlat, self.Nlon)
+                outdv       = _index2grid(dv, gridindex1, self.Nlat, self.Nlon)
                 dvdset      = opergrp.create_dataset(name='Dvelocity', data=outdv)
                 dvdset.attrs.create(name='Nlat', data=self.Nlat)
                 dvdset.attrs.create(name='Nlon', data=self.Nlon)
                 # azimuthal coverage, squared sum
-                outazicov   = (azicov[:, 0]).reshape(self.Nlat, self.Nlon)
+                outazicov   = _index2grid(azicov[:, 0], gridindex1, self.Nlat, self.Nlon)
                 azidset     = opergrp.create_dataset(name='azi_coverage1', data=outazicov)
                 azidset.attrs.create(name='Nlat', data=self.Nlat)
                 azidset.attrs.create(name='Nlon', data=self.Nlon)
                 # azimuthal coverage, max value
-                outazicov   = (azicov[:, 1]).reshape(self.Nlat, self.Nlon)
+                outazicov   = _index2grid(azicov[:, 1], gridindex1, self.Nlat, self.Nlon)
                 azidset     = opergrp.create_dataset(name='azi_coverage2', data=outazicov)
                 azidset.attrs.create(name='Nlat', data=self.Nlat)
                 azidset.attrs.create(name='Nlon', data=self.Nlon)
                 # path density
-                outpathden  = pathden.reshape(self.Nlat, self.Nlon)
+                outpathden  = _index2grid(pathden, gridindex1, self.Nlat, self.Nlon)
                 pddset      = opergrp.create_dataset(name='path_density', data=outpathden)
                 pddset.attrs.create(name='Nlat', data=self.Nlat)
                 pddset.attrs.create(name='Nlon', data=self.Nlon)
@@ -2012,34 +2656,31 @@ class RayTomoDataSet(h5py.File):
         #--------------------------------------------------
         # get the mask array for the interpolated data
         #--------------------------------------------------
-        mask_inv        = grp['mask_inv']
+        mask_inv        = grp['mask_inv'].value
         index_inv       = np.logical_not(mask_inv)
         lons            = np.arange(int((maxlon-minlon)/dlon)+1)*dlon+minlon
         lats            = np.arange(int((maxlat-minlat)/dlat)+1)*dlat+minlat
         Nlon            = lons.size
         Nlat            = lats.size
         lonArr, latArr  = np.meshgrid(lons, lats)
-        mask            = np.ones((Nlat, Nlon), dtype=np.bool)
         # determine the mask array for interpolated data
         # if there is one(or more) non-masked data points nearby a interpolated grid point, the interpolated value is considerred valid
-        for i in range(Nlat):
-            for j in range(Nlon):
-                clat    = lats[i]
-                clon    = lons[j]
-                ind_lon = np.where(clon<=self.lons)[0][0]      
-                ind_lat = np.where(clat<=self.lats)[0][0]
-                if (clon - self.lons[ind_lon])< 0.001 and (clat - self.lats[ind_lat])<0.001:
-                    mask[i, j]  = mask_inv[ind_lat, ind_lon]
-                    continue
-                mask[i, j]      = mask[i, j]*mask_inv[ind_lat, ind_lon]
-                if ind_lat > 0:
-                    mask[i, j]      = mask[i, j]*mask_inv[ind_lat-1, ind_lon]
-                    if ind_lon > 0:
-                        mask[i, j]  = mask[i, j]*mask_inv[ind_lat-1, ind_lon-1]
-                if ind_lon > 0:
-                    mask[i, j]      = mask[i, j]*mask_inv[ind_lat, ind_lon-1]
-                    if ind_lat > 0:
-                        mask[i, j]  = mask[i, j]*mask_inv[ind_lat-1, ind_lon-1]
+        # index of the first inversion grid point not smaller than each interpolated grid point
+        ind_lon         = np.searchsorted(self.lons, lons, side='left')
+        ind_lat         = np.searchsorted(self.lats, lats, side='left')
+        if ind_lon[-1] >= self.Nlon or ind_lat[-1] >= self.Nlat:
+            raise ValueError('interpolated grid is out of the inversion grid!')
+        indlonArr, indlatArr\
+                        = np.meshgrid(ind_lon, ind_lat)
+        isnode          = ((lonArr - self.lons[indlonArr]) < 0.001)*((latArr - self.lats[indlatArr]) < 0.001)
+        # neighbouring inversion grid points, the missing ones at the lower boundaries are skipped
+        prelon          = np.maximum(indlonArr-1, 0)
+        prelat          = np.maximum(indlatArr-1, 0)
+        mask_near       = mask_inv[indlatArr, indlonArr]
+        mask_near       *= np.logical_or(indlatArr == 0, mask_inv[prelat, indlonArr])
+        mask_near       *= np.logical_or(indlonArr == 0, mask_inv[indlatArr, prelon])
+        mask_near       *= np.logical_or((indlatArr == 0)+(indlonArr == 0), mask_inv[prelat, prelon])
+        mask            = np.where(isnode, mask_inv[indlatArr, indlonArr], mask_near)
         grp.create_dataset(name = 'mask_'+sfx, data=mask)
         for per in pers:
             working_per = workingdir+'/'+str(per)+'sec'
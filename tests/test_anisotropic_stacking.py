@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Equivalence tests of the compiled anisotropic stacking functions in eikonaltomo
+    against the former (per-bin) implementations, kept here as references
+
+usage:
+    python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import eikonaltomo
+
+#-------------------------------------------------
+# reference implementations
+#-------------------------------------------------
+def _anisotropic_stacking_ref(gridx, gridy, maxazi, minazi, N_bin, Nmeasure, aziALL,\
+        slowness_sumQC, slownessALL, index_outlier):
+    """former per-bin version of eikonaltomo._anisotropic_stacking (pure python)
+    """
+    Nevent, Nx, Ny  = aziALL.shape
+    Nx_trim         = Nx - (gridx - 1)
+    Ny_trim         = Ny - (gridy - 1)
+    NmeasureAni     = np.zeros((Nx_trim, Ny_trim), dtype=np.float64)
+    for ishift_x in range(gridx):
+        for ishift_y in range(gridy):
+            NmeasureAni += Nmeasure[ishift_x:ishift_x+Nx_trim, ishift_y:ishift_y+Ny_trim]
+    d_bin           = float((maxazi-minazi)/N_bin)
+    histArr         = np.zeros((N_bin, Nx_trim, Ny_trim))
+    dslow_sum_ani   = np.zeros((N_bin, Nx_trim, Ny_trim))
+    dslow_un        = np.zeros((N_bin, Nx_trim, Ny_trim))
+    vel_un          = np.zeros((N_bin, Nx_trim, Ny_trim))
+    for ibin in range(N_bin):
+        for ix in range(Nx_trim):
+            for iy in range(Ny_trim):
+                dslowLst    = []
+                velLst      = []
+                for ishift_x in range(gridx):
+                    for ishift_y in range(gridy):
+                        for iev in range(Nevent):
+                            azi         = aziALL[iev, ix + ishift_x, iy + ishift_y]
+                            if np.floor((azi - minazi)/d_bin) != ibin:
+                                continue
+                            if index_outlier[iev, ix + ishift_x, iy + ishift_y]:
+                                continue
+                            slow        = slownessALL[iev, ix + ishift_x, iy + ishift_y]
+                            dslowLst.append(slow - slowness_sumQC[ix + ishift_x, iy + ishift_y])
+                            velLst.append(1./slow if slow != 0. else 0.)
+                Nbin        = len(dslowLst)
+                if Nbin < 2:
+                    continue
+                dslowArr    = np.array(dslowLst)
+                velArr      = np.array(velLst)
+                histArr[ibin, ix, iy]       = Nbin
+                dslow_sum_ani[ibin, ix, iy] = dslowArr.mean()
+                dslow_un[ibin, ix, iy]      = np.sqrt(((dslowArr - dslowArr.mean())**2).sum()/(Nbin - 1)/Nbin)
+                vel_un[ibin, ix, iy]        = np.sqrt(((velArr - velArr.mean())**2).sum()/(Nbin - 1)/Nbin)
+    return dslow_sum_ani, dslow_un, vel_un, histArr, NmeasureAni
+
+def _anisotropic_stacking_helm_ref(aziALL, slownessALL, slowness_sumQC, index_outlier, gridx, gridy, minazi, maxazi, N_bin):
+    """former numexpr version of eikonaltomo._anisotropic_stacking_helm (numexpr sums replaced by numpy)
+    """
+    Nevent, Nx_size, Ny_size        = aziALL.shape
+    d_bin                           = (maxazi-minazi)/N_bin
+    histArr_cutted                  = np.zeros((N_bin, Nx_size-2*gridx, Ny_size-2*gridy))
+    slow_sum_ani_cutted             = np.zeros((N_bin, Nx_size-2*gridx, Ny_size-2*gridy))
+    slow_un_cutted                  = np.zeros((N_bin, Nx_size-2*gridx, Ny_size-2*gridy))
+    vel_un_cutted                   = np.zeros((N_bin, Nx_size-2*gridx, Ny_size-2*gridy))
+    index_dict                      = { 0: [0, -2*gridx, 0,         -2*gridy], \
+                                        1: [0, -2*gridx, gridy,     -gridy],\
+                                        2: [0, -2*gridx, 2*gridy,   Ny_size],\
+                                        3: [gridx, -gridx, 0,       -2*gridy],\
+                                        4: [gridx, -gridx, gridy, -gridy],\
+                                        5: [gridx, -gridx, 2*gridy, Ny_size],\
+                                        6: [2*gridx, Nx_size, 0,    -2*gridy],\
+                                        7: [2*gridx, Nx_size, gridy,-gridy],\
+                                        8: [2*gridx, Nx_size, 2*gridy, Ny_size]}
+    nmin_bin                        = 2
+    for ibin in xrange(N_bin):
+        sumNbin                     = np.zeros((Nx_size-2*gridx, Ny_size-2*gridy))
+        slowbin                     = np.zeros((Nx_size-2*gridx, Ny_size-2*gridy))
+        slow_un_ibin                = np.zeros((Nx_size-2*gridx, Ny_size-2*gridy))
+        velbin                      = np.zeros((Nx_size-2*gridx, Ny_size-2*gridy))
+        vel_un_ibin                 = np.zeros((Nx_size-2*gridx, Ny_size-2*gridy))
+        for i in range(9):
+            indarr                  = index_dict[i]
+            azi_arr                 = aziALL[:, indarr[0]:indarr[1], indarr[2]:indarr[3]]
+            ibinarr                 = np.floor((azi_arr - minazi)/d_bin)
+            weight_bin              = 1*(ibinarr==ibin)
+            weight_bin[index_outlier[:, indarr[0]:indarr[1], indarr[2]:indarr[3]]] \
+                                    = 0
+            slowsumQC_cutted        = slowness_sumQC[indarr[0]:indarr[1], indarr[2]:indarr[3]]
+            slownessALL_cutted      = slownessALL[:, indarr[0]:indarr[1], indarr[2]:indarr[3]]
+            temp_dslow              = (weight_bin*(slownessALL_cutted-slowsumQC_cutted)).sum(axis=0)
+            temp_vel                = slownessALL_cutted.copy()
+            temp_vel[temp_vel!=0]   = 1./temp_vel[temp_vel!=0]
+            temp_vel                = (weight_bin*temp_vel).sum(axis=0)
+            N_ibin                  = weight_bin.sum(axis=0)
+            ind_valid               = N_ibin >= nmin_bin
+            sumNbin[ind_valid]      += N_ibin[ind_valid]
+            slowbin[ind_valid]      += temp_dslow[ind_valid]
+            velbin[ind_valid]       += temp_vel[ind_valid]
+        vel_mean                    = velbin.copy()
+        vel_mean[sumNbin!=0]        = velbin[sumNbin!=0]/sumNbin[sumNbin!=0]
+        dslow_mean                  = slowbin.copy()
+        dslow_mean[sumNbin!=0]      = dslow_mean[sumNbin!=0]/sumNbin[sumNbin!=0]
+        for i in range(9):
+            indarr                  = index_dict[i]
+            azi_arr                 = aziALL[:, indarr[0]:indarr[1], indarr[2]:indarr[3]]
+            ibinarr                 = np.floor((azi_arr-minazi)/d_bin)
+            weight_bin              = 1*(ibinarr==ibin)
+            weight_bin[index_outlier[:, indarr[0]:indarr[1], indarr[2]:indarr[3]]] \
+                                    = 0
+            slowsumQC_cutted        = slowness_sumQC[indarr[0]:indarr[1], indarr[2]:indarr[3]]
+            slownessALL_cutted      = slownessALL[:, indarr[0]:indarr[1], indarr[2]:indarr[3]]
+            temp_vel                = slownessALL_cutted.copy()
+            temp_vel[temp_vel!=0]   = 1./temp_vel[temp_vel!=0]
+            vel_un_ibin             = vel_un_ibin + ((weight_bin*(temp_vel-vel_mean))**2).sum(axis=0)
+            slow_un_ibin            = slow_un_ibin + ((weight_bin*(slownessALL_cutted-slowsumQC_cutted \
+                                                    - dslow_mean))**2).sum(axis=0)
+        vel_un_ibin[sumNbin!=0]     = np.sqrt(vel_un_ibin[sumNbin!=0]/(sumNbin[sumNbin!=0]-1)/sumNbin[sumNbin!=0])
+        vel_un_cutted[ibin, :, :]   = vel_un_ibin
+        slow_un_ibin[sumNbin!=0]    = np.sqrt(slow_un_ibin[sumNbin!=0]/(sumNbin[sumNbin!=0]-1)/sumNbin[sumNbin!=0])
+        slow_un_cutted[ibin, :, :]  = slow_un_ibin
+        histArr_cutted[ibin, :, :]  = sumNbin
+        slow_sum_ani_cutted[ibin, :, :]  \
+                                    = dslow_mean
+    return histArr_cutted, slow_sum_ani_cutted, slow_un_cutted, vel_un_cutted
+
+def _random_dataset(Nevent, Nx, Ny, seed):
+    """random azimuth/slowness arrays with NaN azimuths, outliers and zero slowness
+    """
+    rng                 = np.random.RandomState(seed)
+    aziALL              = rng.uniform(-180., 180., (Nevent, Nx, Ny)).astype(np.float32)
+    aziALL[rng.rand(Nevent, Nx, Ny) < 0.05] \
+                        = np.nan
+    slownessALL         = rng.uniform(0.25, 0.35, (Nevent, Nx, Ny))
+    slownessALL[rng.rand(Nevent, Nx, Ny) < 0.05] \
+                        = 0.
+    slowness_sumQC      = rng.uniform(0.28, 0.32, (Nx, Ny))
+    index_outlier       = rng.rand(Nevent, Nx, Ny) < 0.1
+    Nmeasure            = rng.randint(0, Nevent, (Nx, Ny)).astype(np.int32)
+    return aziALL, slownessALL, slowness_sumQC, index_outlier, Nmeasure
+
+class TestAnisotropicStacking(unittest.TestCase):
+
+    def test_eikonal_stacking(self):
+        gridx, gridy, N_bin = 3, 2, 20
+        minazi, maxazi      = -180., 180.
+        aziALL, slownessALL, slowness_sumQC, index_outlier, Nmeasure \
+                            = _random_dataset(60, 9, 8, seed=0)
+        outArr              = eikonaltomo._anisotropic_stacking(np.int32(gridx), np.int32(gridy), np.float64(maxazi), np.float64(minazi),\
+                                np.int32(N_bin), Nmeasure, aziALL, slowness_sumQC, slownessALL, index_outlier)
+        refArr              = _anisotropic_stacking_ref(gridx, gridy, np.float32(maxazi), np.float32(minazi), N_bin,\
+                                Nmeasure.astype(np.float64), aziALL, slowness_sumQC, slownessALL, index_outlier)
+        for out, ref in zip(outArr, refArr):
+            self.assertEqual(out.shape, ref.shape)
+            np.testing.assert_allclose(out, ref, rtol=1e-8, atol=1e-12)
+
+    def test_helm_stacking(self):
+        gridx, gridy, N_bin = 2, 3, 20
+        minazi, maxazi      = -180, 180
+        aziALL, slownessALL, slowness_sumQC, index_outlier, Nmeasure \
+                            = _random_dataset(20, 12, 13, seed=1)
+        outArr              = eikonaltomo._anisotropic_stacking_helm(aziALL, slownessALL, slowness_sumQC, index_outlier,\
+                                gridx, gridy, minazi, maxazi, N_bin)
+        refArr              = _anisotropic_stacking_helm_ref(aziALL, slownessALL, slowness_sumQC, index_outlier,\
+                                gridx, gridy, minazi, maxazi, N_bin)
+        # bins with measurements excluded from the mean but none included (unnormalized uncertainties)
+        self.assertTrue(np.any((refArr[0] == 0)*(refArr[2] > 0)))
+        for out, ref in zip(outArr, refArr):
+            self.assertEqual(out.shape, ref.shape)
+            np.testing.assert_allclose(out, ref, rtol=1e-8, atol=1e-12)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+Equivalence test of the compiled azimuthal weight function in eikonaltomo (sorted azimuths, binary search)
+    against the former pairwise version, kept here as a reference
+
+usage:
+    python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import eikonaltomo
+
+def _get_azi_weight_ref(aziALL, validALL):
+    """former version of eikonaltomo._get_azi_weight, all pairs of events are compared (pure python)
+    """
+    Nevent, Nlon, Nlat  = aziALL.shape
+    weightALL           = np.zeros((Nevent, Nlon, Nlat), dtype=np.float32)
+    for ilon in xrange(Nlon):
+        for ilat in xrange(Nlat):
+            for i in xrange(Nevent):
+                for j in xrange(Nevent):
+                    delAzi                      = abs(aziALL[i, ilon, ilat] - aziALL[j, ilon, ilat])
+                    if delAzi < 20. or delAzi > 340.:
+                        weightALL[i, ilon, ilat]+= validALL[i, ilon, ilat]
+    return weightALL
+
+def _random_dataset(Nevent, Nlon, Nlat, seed, integer=False):
+    """random azimuths with NaN values, integer azimuths give differences exactly at the limits (20 and 340 deg)
+    """
+    rng                 = np.random.RandomState(seed)
+    aziALL              = rng.uniform(-180., 180., (Nevent, Nlon, Nlat))
+    if integer:
+        aziALL          = np.round(aziALL/10.)*10.
+    aziALL              = aziALL.astype(np.float32)
+    aziALL[rng.rand(Nevent, Nlon, Nlat) < 0.1] \
+                        = np.nan
+    validALL            = (rng.rand(Nevent, Nlon, Nlat) < 0.8).astype(np.float32)
+    return aziALL, validALL
+
+class TestAziWeight(unittest.TestCase):
+
+    def test_azi_weight(self):
+        aziALL, validALL    = _random_dataset(50, 5, 4, seed=0)
+        weightALL           = eikonaltomo._get_azi_weight(aziALL, validALL)
+        np.testing.assert_array_equal(weightALL, _get_azi_weight_ref(aziALL, validALL))
+
+    def test_azi_weight_limits(self):
+        aziALL, validALL    = _random_dataset(60, 4, 3, seed=1, integer=True)
+        weightALL           = eikonaltomo._get_azi_weight(aziALL, validALL)
+        self.assertTrue(np.any(weightALL > 1.))
+        np.testing.assert_array_equal(weightALL, _get_azi_weight_ref(aziALL, validALL))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Equivalence test of the amplitude weight of the xcorr (noisedbase._CalcRecCor)
+    against the former loop version, kept here as a reference
+
+usage:
+    python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import noisedbase
+
+def _CalcRecCor_ref(arr1, arr2, lagN):
+    """former loop version of noisedbase._CalcRecCor (pure python)
+    """
+    N1      = arr1.shape[0]
+    N2      = arr2.shape[0]
+    cor_rec = np.zeros(int(2*lagN + 1), dtype=float)
+    for i in range(lagN+1):
+        for irec1 in range(N1):
+            for irec2 in range(N2):
+                if arr1[irec1, 0] >= arr2[irec2, 1] - i:
+                    continue
+                if arr1[irec1, 1] <= arr2[irec2, 0] - i:
+                    break
+                recB            = max(arr1[irec1, 0], arr2[irec2, 0] - i)
+                recE            = min(arr1[irec1, 1], arr2[irec2, 1] - i)
+                cor_rec[lagN+i] += recE - recB
+            for irec2 in range(N2):
+                if arr1[irec1, 0] >= arr2[irec2, 1] + i:
+                    continue
+                if arr1[irec1, 1] <= arr2[irec2, 0] + i:
+                    break
+                recB            = max(arr1[irec1, 0], arr2[irec2, 0] + i)
+                recE            = min(arr1[irec1, 1], arr2[irec2, 1] + i)
+                cor_rec[lagN-i] += recE - recB
+    cor_rec[lagN]   /= 2.
+    return cor_rec
+
+def _random_rec(rng, Nrec, Nseg):
+    """sorted non-overlapping record segments (begin/end sample indices) within [0, Nrec]
+    """
+    bounds  = np.sort(rng.choice(np.arange(1, Nrec), 2*Nseg, replace=False))
+    return np.float32(bounds.reshape(Nseg, 2))
+
+class TestCalcRecCor(unittest.TestCase):
+
+    def test_random_records(self):
+        rng     = np.random.RandomState(0)
+        for itest in range(20):
+            arr1    = _random_rec(rng, 3000, rng.randint(1, 6))
+            arr2    = _random_rec(rng, 3000, rng.randint(1, 6))
+            lagN    = int(rng.randint(10, 400))
+            cor_rec = noisedbase._CalcRecCor(arr1, arr2, lagN)
+            self.assertEqual(cor_rec.size, 2*lagN+1)
+            np.testing.assert_allclose(cor_rec, _CalcRecCor_ref(arr1, arr2, lagN), rtol=1e-6, atol=1e-6)
+
+    def test_whole_day(self):
+        # no holes in the records
+        arr     = np.float32([[0, 84000]])
+        lagN    = 3000
+        np.testing.assert_allclose(noisedbase._CalcRecCor(arr, arr, lagN), _CalcRecCor_ref(arr, arr, lagN), rtol=1e-6)
+
+if __name__ == '__main__':
+    unittest.main()
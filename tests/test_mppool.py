@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the persistent worker pool (mppool): ordering of the results, timeouts and failures of the tasks
+
+usage:
+    python -m unittest discover tests
+"""
+import os
+import sys
+import time
+import warnings
+import unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import mppool
+
+def _square(x):
+    return x*x
+
+def _square_or_hang(x):
+    """task 3 does not finish within the timeout
+    """
+    if x == 3:
+        time.sleep(60.)
+    else:
+        time.sleep(0.05)
+    return x*x
+
+def _square_or_fail(x):
+    if x == 3:
+        raise ValueError('bad task')
+    return x*x
+
+class TestPool(unittest.TestCase):
+
+    def tearDown(self):
+        mppool.close_pool()
+
+    def test_pool_map(self):
+        results     = mppool.pool_map(_square, range(50), nprocess=2, chunksize=3)
+        self.assertEqual(results, [x*x for x in range(50)])
+        # callback is called in the parent process, its return value is stored
+        results     = mppool.pool_map(_square, range(10), nprocess=2, timeout=30., callback=lambda i, r: (i, r))
+        self.assertEqual(results, [(x, x*x) for x in range(10)])
+        self.assertEqual(mppool.pool_map(_square, [], nprocess=2), [])
+
+    def test_pool_map_timeout(self):
+        with warnings.catch_warnings(record=True) as wlst:
+            warnings.simplefilter('always')
+            results = mppool.pool_map(_square_or_hang, range(8), nprocess=2, timeout=2., allow_failure=True)
+        self.assertEqual(len(wlst), 1)
+        self.assertTrue(mppool.is_failure(results[3]))
+        self.assertEqual(results[3].index, 3)
+        self.assertEqual(results[3].reason, 'timeout')
+        self.assertEqual([results[i] for i in range(8) if i != 3], [x*x for x in range(8) if x != 3])
+        # the pool is usable after the stragglers are terminated
+        self.assertEqual(mppool.pool_map(_square, range(5), nprocess=2), [0, 1, 4, 9, 16])
+
+    def test_pool_map_timeout_error(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            with self.assertRaises(mppool.TaskTimeoutError) as cm:
+                mppool.pool_map(_square_or_hang, range(6), nprocess=2, timeout=2.)
+        self.assertEqual(cm.exception.indices, [3])
+
+    def test_pool_map_exception(self):
+        # exceptions in the workers are raised in the parent process, with or without timeout
+        with self.assertRaises(ValueError):
+            mppool.pool_map(_square_or_fail, range(6), nprocess=2, chunksize=1)
+        with self.assertRaises(RuntimeError) as cm:
+            mppool.pool_map(_square_or_fail, range(6), nprocess=2, timeout=30.)
+        self.assertTrue('bad task' in str(cm.exception))
+
+    def test_pool_stream(self):
+        outdict     = {}
+        def callback(index, result):
+            outdict[index]  = result
+        Ntask, failed   = mppool.pool_stream(_square, iter(range(20)), callback, nprocess=2, maxpending=3)
+        self.assertEqual(Ntask, 20)
+        self.assertEqual(failed, [])
+        self.assertEqual(outdict, dict([(x, x*x) for x in range(20)]))
+
+    def test_pool_stream_timeout(self):
+        outdict     = {}
+        def callback(index, result):
+            outdict[index]  = result
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            Ntask, failed   = mppool.pool_stream(_square_or_hang, iter(range(8)), callback, nprocess=2, timeout=2.,\
+                                allow_failure=True)
+            self.assertEqual(Ntask, 8)
+            self.assertEqual(failed, [3])
+            self.assertEqual(outdict, dict([(x, x*x) for x in range(8) if x != 3]))
+            with self.assertRaises(mppool.TaskTimeoutError):
+                mppool.pool_stream(_square_or_hang, iter(range(6)), callback, nprocess=2, timeout=2.)
+
+    def test_close_pool(self):
+        pool        = mppool.get_pool(nprocess=2)
+        self.assertTrue(mppool.get_pool(nprocess=2) is pool)
+        mppool.close_pool()
+        self.assertTrue(mppool._pool is None)
+        self.assertFalse(mppool.get_pool(nprocess=2) is pool)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the station/pair index of noisedbase.noiseASDF (auxiliary_data.PairIndex)
+
+usage:
+    python -m unittest discover tests
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import obspy
+from obspy.core.inventory import Inventory, Network, Station, Channel, Site
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import noisedbase
+
+def _inventory(stations):
+    inv     = Inventory(networks=[], source='test')
+    for netcode, stacode, lon, lat in stations:
+        chan    = Channel(code='LHZ', location_code='', latitude=lat, longitude=lon, elevation=0., depth=0.)
+        sta     = Station(code=stacode, latitude=lat, longitude=lon, elevation=0., site=Site(name=stacode),\
+                    channels=[chan], creation_date=obspy.UTCDateTime(2000, 1, 1))
+        inv     += Inventory(networks=[Network(code=netcode, stations=[sta])], source='test')
+    return inv
+
+def _add_disp(dset, staid1, staid2):
+    netcode1, stacode1  = staid1.split('.')
+    netcode2, stacode2  = staid2.split('.')
+    dset.add_auxiliary_data(data=np.zeros((9, 5)), data_type='DISPpmf2', path=netcode1+'/'+stacode1+'/'+netcode2+'/'+stacode2+'/ZZ',\
+                            parameters={'Np': 5})
+
+class TestPairIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dset   = noisedbase.noiseASDF(self.tmpdir+'/test.h5')
+        self.dset.add_stationxml(_inventory([('AK', 'AAA', -150., 60.), ('AK', 'BBB', -148., 61.), ('TA', 'CCC', -145., 62.5)]))
+        _add_disp(self.dset, 'AK.AAA', 'AK.BBB')
+        _add_disp(self.dset, 'AK.BBB', 'TA.CCC')
+        _add_disp(self.dset, 'AK.AAA', 'XX.ZZZ') # station not in the database
+
+    def tearDown(self):
+        del self.dset
+        shutil.rmtree(self.tmpdir)
+
+    def _check_pairs(self, pairLst):
+        self.assertEqual([(pair[0], pair[1]) for pair in pairLst], [('AK.AAA', 'AK.BBB'), ('AK.BBB', 'TA.CCC')])
+        dist, az, baz   = obspy.geodetics.gps2dist_azimuth(60., -150., 61., -148.)
+        np.testing.assert_allclose(pairLst[0][2:], [dist/1000., az, baz])
+
+    def test_get_pair_index_readonly(self):
+        # no index stored, the pairs are scanned in memory and nothing is written
+        pairLst     = self.dset.get_pair_index(data_type='DISPpmf2')
+        self._check_pairs(pairLst)
+        self.assertFalse('PairIndex' in self.dset.auxiliary_data.list())
+
+    def test_build_index(self):
+        self.dset.build_index(data_types=['DISPpmf2'])
+        self.assertTrue('DISPpmf2' in self.dset.auxiliary_data.PairIndex.list())
+        self._check_pairs(self.dset.get_pair_index(data_type='DISPpmf2'))
+        self.dset.add_stationxml(_inventory([('XX', 'ZZZ', -147., 59.)]))
+        # out-of-date station table, the pairs are scanned in memory, the stored tables are unchanged
+        pairLst     = self.dset.get_pair_index(data_type='DISPpmf2')
+        self.assertEqual(len(pairLst), 3)
+        self.assertEqual(list(self.dset.auxiliary_data.PairIndex['staid'].data.value), ['AK.AAA', 'AK.BBB', 'TA.CCC'])
+        self.dset.update_pair_index(data_type='DISPpmf2')
+        self.assertEqual(len(self.dset.auxiliary_data.PairIndex['staid'].data.value), 4)
+        self.assertEqual(self.dset.get_pair_index(data_type='DISPpmf2'), pairLst)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Equivalence test of the SNR analysis in pyaftan (filter bank kept by aftan)
+    against the former per-period version, kept here as a reference
+
+usage:
+    python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+import numpy as np
+import obspy
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pyaftan
+
+def _get_snr_ref(aTr, ffact=1.):
+    """former version of pyaftan.aftantrace.get_snr, each period is filtered separately
+    """
+    fparam      = aTr.ftanparam
+    dist        = aTr.stats.sac.dist
+    begT        = aTr.stats.sac.b
+    endT        = aTr.stats.sac.e
+    dt          = aTr.stats.delta
+    o_per       = fparam.arr2_2[1,:]
+    g_vel       = fparam.arr2_2[2,:]
+    snrArr      = np.ones(o_per.size, dtype=np.float64)*-1.
+    for i in range(fparam.nfout2_2):
+        if g_vel[i]<0 or o_per[i]<0:
+            continue
+        filtered_tr = aTr.gaussian_filter_aftan(1./o_per[i], ffact=ffact)
+        minT        = dist/g_vel[i]-o_per[i]/2.
+        maxT        = dist/g_vel[i]+o_per[i]/2.
+        if(minT<begT):
+            minT    = begT
+        if(maxT>endT):
+            maxT    = endT
+        minT        = maxT + o_per[i] * 5. + 500.
+        if( (endT - minT) < 50. ):
+            continue
+        elif( (endT - minT) < 1100. ):
+            maxT    = endT - 10.
+        else:
+            minT    = endT - 1100.
+            maxT    = endT - 100.
+        ib          = (int)((minT-begT)/dt)
+        ie          = (int)((maxT-begT)/dt)+2
+        tempnoise   = filtered_tr[ib:ie]
+        noiserms    = np.sqrt(( np.sum(tempnoise**2))/(ie-ib-1.) )
+        if noiserms != 0.:
+            snrArr[i]   = fparam.arr2_2[7,i]/noiserms
+        else:
+            snrArr[i]   = 1.
+    return snrArr
+
+def _synthetic_trace(dist=800., npts=3001, dt=1., seed=0):
+    """dispersive wave packet (group velocity 2.8 - 3.6 km/s) with random noise
+    """
+    rng         = np.random.RandomState(seed)
+    time        = np.arange(npts)*dt
+    data        = np.zeros(npts)
+    for per in np.arange(6., 40., 1.):
+        U       = 2.8 + 0.8*(per - 6.)/34.
+        data    += np.cos(2.*np.pi/per*(time - dist/U))*np.exp(-((time - dist/U)/(2.*per))**2)
+    data        += 0.05*rng.randn(npts)
+    tr          = obspy.Trace(data=data)
+    tr.stats.delta  = dt
+    tr.stats.sac    = obspy.core.util.attribdict.AttribDict({'b': 0., 'e': (npts-1)*dt, 'dist': dist})
+    aTr         = pyaftan.aftantrace(tr.data, tr.stats)
+    return aTr
+
+class TestSNR(unittest.TestCase):
+
+    def test_get_snr(self):
+        aTr     = _synthetic_trace()
+        aTr.aftan(pmf=True, piover4=-1., vmin=1.5, vmax=5.0, tmin=6., tmax=40., ffact=1., nfin=32)
+        self.assertGreater(aTr.ftanparam.nfout2_2, 0)
+        self.assertEqual(aTr.ftanparam.filtered_2.shape, (aTr.ftanparam.nfout2_2, aTr.stats.npts))
+        snr_ref = _get_snr_ref(aTr, ffact=1.)
+        aTr.get_snr(ffact=1.)
+        self.assertEqual(aTr.ftanparam.arr2_2.shape[0], 9)
+        self.assertTrue(np.any(snr_ref > 0.))
+        np.testing.assert_allclose(aTr.ftanparam.arr2_2[8, :], snr_ref, rtol=1e-8)
+
+    def test_get_snr_ffact(self):
+        # filter bank is recomputed for a different filter parameter
+        aTr     = _synthetic_trace(seed=1)
+        aTr.aftan(pmf=True, piover4=-1., vmin=1.5, vmax=5.0, tmin=6., tmax=40., ffact=1., nfin=32)
+        snr_ref = _get_snr_ref(aTr, ffact=2.)
+        aTr.get_snr(ffact=2.)
+        np.testing.assert_allclose(aTr.ftanparam.arr2_2[8, :], snr_ref, rtol=1e-8)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Equivalence test of the ray tomography input writer of noisedbase.noiseASDF (columnar table, vectorized selection)
+    against the former per pair/period version, kept here as a reference
+
+usage:
+    python -m unittest discover tests
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import obspy
+from obspy.core.inventory import Inventory, Network, Station, Channel, Site
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import noisedbase
+
+def _xcorr_raytomoinput_ref(dset, outdir, netcodelst=[], lambda_factor=3., snr_thresh=15., channel='ZZ',\
+        pers=np.array([]), outpfx='raytomo_in_', data_type='DISPpmf2interp'):
+    """former version of noisedbase.noiseASDF.xcorr_raytomoinput, the lines are written for each pair and period
+    """
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    fph_lst         = []
+    fgr_lst         = []
+    for per in pers:
+        fph_lst.append(open(outdir+'/'+outpfx+'%g'%( per ) +'_'+channel+'_ph.lst', 'w'))
+        fgr_lst.append(open(outdir+'/'+outpfx+'%g'%( per ) +'_'+channel+'_gr.lst', 'w'))
+    staLst          = [staid for staid in dset.waveforms.list() if len(netcodelst) == 0 or staid.split('.')[0] in netcodelst]
+    iray            = -1
+    try:
+        for staid1 in staLst:
+            for staid2 in staLst:
+                netcode1, stacode1  = staid1.split('.')
+                netcode2, stacode2  = staid2.split('.')
+                if staid1 >= staid2:
+                    continue
+                iray                += 1
+                try:
+                    subdset         = dset.auxiliary_data[data_type][netcode1][stacode1][netcode2][stacode2][channel]
+                except:
+                    continue
+                lat1, elv1, lon1    = dset.waveforms[staid1].coordinates.values()
+                lat2, elv2, lon2    = dset.waveforms[staid2].coordinates.values()
+                dist, az, baz       = obspy.geodetics.gps2dist_azimuth(lat1, lon1, lat2, lon2)
+                dist                = dist/1000.
+                if lon1<0:
+                    lon1            +=360.
+                if lon2<0:
+                    lon2            +=360.
+                data                = subdset.data.value
+                index               = subdset.parameters
+                for iper in range(pers.size):
+                    per             = pers[iper]
+                    if dist < lambda_factor*per*3.5:
+                        continue
+                    ind_per         = np.where(data[index['To']][:] == per)[0]
+                    if ind_per.size==0:
+                        raise AttributeError('No interpolated dispersion curve data for period='+str(per)+' sec!')
+                    pvel            = data[index['C']][ind_per]
+                    gvel            = data[index['U']][ind_per]
+                    snr             = data[index['snr']][ind_per]
+                    inbound         = data[index['inbound']][ind_per]
+                    if inbound != 1.:
+                        continue
+                    if pvel < 0 or gvel < 0 or pvel>10 or gvel>10 or snr >1e10:
+                        continue
+                    if snr < snr_thresh:
+                        continue
+                    fph_lst[iper].writelines("%d %g %g %g %g %g 1. %s %s 1 1 \n" %(iray, lat1, lon1, lat2, lon2, pvel, staid1, staid2))
+                    fgr_lst[iper].writelines("%d %g %g %g %g %g 1. %s %s 1 1 \n" %(iray, lat1, lon1, lat2, lon2, gvel, staid1, staid2))
+    finally:
+        for fph, fgr in zip(fph_lst, fgr_lst):
+            fph.close()
+            fgr.close()
+    return
+
+def _inventory(stations):
+    inv     = Inventory(networks=[], source='test')
+    for netcode, stacode, lon, lat in stations:
+        chan    = Channel(code='LHZ', location_code='', latitude=lat, longitude=lon, elevation=0., depth=0.)
+        sta     = Station(code=stacode, latitude=lat, longitude=lon, elevation=0., site=Site(name=stacode),\
+                    channels=[chan], creation_date=obspy.UTCDateTime(2000, 1, 1))
+        inv     += Inventory(networks=[Network(code=netcode, stations=[sta])], source='test')
+    return inv
+
+def _add_disp(dset, staid1, staid2, pers, rng):
+    """interpolated dispersion data with random velocities, snr and inbound flags (some of them fail the selection)
+    """
+    netcode1, stacode1  = staid1.split('.')
+    netcode2, stacode2  = staid2.split('.')
+    Nper        = pers.size
+    data        = np.zeros((6, Nper))
+    data[0, :]  = pers
+    data[1, :]  = rng.uniform(2.5, 4., Nper)
+    data[2, :]  = rng.uniform(3., 4.5, Nper)
+    data[2, rng.rand(Nper) < 0.1]   = 11.
+    data[3, :]  = rng.uniform(0., 1., Nper)
+    data[4, :]  = rng.uniform(5., 50., Nper)
+    data[5, :]  = rng.rand(Nper) < 0.8
+    dset.add_auxiliary_data(data=data, data_type='DISPpmf2interp', path=netcode1+'/'+stacode1+'/'+netcode2+'/'+stacode2+'/ZZ',\
+                            parameters={'To': 0, 'U': 1, 'C': 2,  'amp': 3, 'snr': 4, 'inbound': 5, 'Np': Nper})
+
+class TestRayTomoInput(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dset   = noisedbase.noiseASDF(self.tmpdir+'/test.h5')
+        self.dset.add_stationxml(_inventory([('AK', 'AAA', -165., 60.), ('AK', 'BBB', -150., 65.), ('AK', 'CCC', -147.5, 61.),\
+                        ('TA', 'DDD', -140., 68.), ('TA', 'EEE', -158., 57.5), ('XV', 'FFF', -149., 64.)]))
+        self.pers   = np.array([10., 16., 20., 30., 40., 60.])
+        rng         = np.random.RandomState(0)
+        staLst      = self.dset.waveforms.list()
+        for staid1 in staLst:
+            for staid2 in staLst:
+                # one pair without data
+                if staid1 >= staid2 or (staid1, staid2) == ('AK.BBB', 'TA.DDD'):
+                    continue
+                _add_disp(self.dset, staid1, staid2, self.pers, rng)
+
+    def tearDown(self):
+        del self.dset
+        shutil.rmtree(self.tmpdir)
+
+    def _check_files(self, outdir, refdir, pers):
+        Nline       = 0
+        for per in pers:
+            for key in ['ph', 'gr']:
+                fname   = 'raytomo_in_%g_ZZ_%s.lst' %(per, key)
+                with open(os.path.join(outdir, fname)) as f:
+                    lines   = f.read().splitlines()
+                with open(os.path.join(refdir, fname)) as f:
+                    reflines= f.read().splitlines()
+                self.assertEqual(lines, reflines)
+                Nline   += len(lines)
+        self.assertGreater(Nline, 0)
+
+    def test_write_files(self):
+        outdir  = self.tmpdir+'/out'
+        refdir  = self.tmpdir+'/ref'
+        self.dset.xcorr_raytomoinput(outdir=outdir, pers=self.pers, verbose=False)
+        _xcorr_raytomoinput_ref(self.dset, outdir=refdir, pers=self.pers)
+        self._check_files(outdir, refdir, self.pers)
+        # short pairs are removed by the wavelength criteria at long periods
+        Nline   = [len(np.loadtxt(os.path.join(outdir, 'raytomo_in_%g_ZZ_ph.lst' %per), dtype=str, ndmin=2)) for per in [10., 60.]]
+        self.assertGreater(Nline[0], Nline[1])
+
+    def test_netcodelst(self):
+        outdir  = self.tmpdir+'/out'
+        refdir  = self.tmpdir+'/ref'
+        self.dset.xcorr_raytomoinput(outdir=outdir, pers=self.pers, netcodelst=['AK', 'TA'], snr_thresh=10., verbose=False)
+        _xcorr_raytomoinput_ref(self.dset, outdir=refdir, pers=self.pers, netcodelst=['AK', 'TA'], snr_thresh=10.)
+        self._check_files(outdir, refdir, self.pers)
+
+    def test_inmemory(self):
+        refdir  = self.tmpdir+'/ref'
+        outdict = self.dset.xcorr_raytomoinput(outdir=None, pers=self.pers, verbose=False, inmemory=True)
+        _xcorr_raytomoinput_ref(self.dset, outdir=refdir, pers=self.pers)
+        for per in self.pers:
+            for key in ['ph', 'gr']:
+                fname   = os.path.join(refdir, 'raytomo_in_%g_ZZ_%s.lst' %(per, key))
+                refArr  = np.loadtxt(fname, usecols=range(7)).reshape(-1, 7)
+                outArr  = outdict['%g' %per][key]
+                self.assertEqual(outArr.shape, refArr.shape)
+                # the files are written with %g (6 significant digits)
+                np.testing.assert_allclose(outArr, refArr, rtol=1e-5)
+
+    def test_missing_period(self):
+        pers    = np.append(self.pers, 8.)
+        with self.assertRaises(AttributeError):
+            self.dset.xcorr_raytomoinput(outdir=self.tmpdir+'/out', pers=pers, verbose=False)
+        with self.assertRaises(AttributeError):
+            _xcorr_raytomoinput_ref(self.dset, outdir=self.tmpdir+'/ref', pers=pers)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the reshaping of the ray tomography results to Nlat * Nlon arrays (raytomo.RayTomoDataSet.creat_reshape_data)
+
+usage:
+    python -m unittest discover tests
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import raytomo
+
+class TestReshape(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dset   = raytomo.RayTomoDataSet(self.tmpdir+'/test.h5')
+        self.dset.set_input_parameters(minlon=200., maxlon=203., minlat=55., maxlat=57., pers=np.array([10., 20.]))
+        self.lons   = np.arange(7)*0.5+200.
+        self.lats   = np.arange(5)*0.5+55.
+
+    def tearDown(self):
+        self.dset.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _smooth_run(self, order, store_lonlat):
+        """isotropic smooth run with the points in the given order (indices of the latitude major grid)
+        """
+        lonArr, latArr  = np.meshgrid(self.lons, self.lats)
+        lonlatArr       = np.vstack((lonArr.ravel(), latArr.ravel())).T[order, :]
+        group           = self.dset.create_group(name='smooth_run_0')
+        group.attrs.create(name='dlon', data=0.5)
+        group.attrs.create(name='dlat', data=0.5)
+        for per in [10., 20.]:
+            subgroup    = group.create_group(name='%g_sec'%( per ))
+            # values of the point are the grid index
+            values      = np.arange(lonArr.size, dtype=np.float64)[order] + per
+            subgroup.create_dataset(name='velocity', data=values)
+            subgroup.create_dataset(name='Dvelocity', data=-values)
+            subgroup.create_dataset(name='azi_coverage', data=np.vstack((values, 2.*values)).T)
+            subgroup.create_dataset(name='path_density', data=values.reshape(-1, 1))
+            if store_lonlat:
+                subgroup.create_dataset(name='lons_lats', data=lonlatArr)
+        self.dset.creat_reshape_data(runtype=0, runid=0)
+        return self.dset['reshaped_smooth_run_0']
+
+    def _check(self, outgrp):
+        Nlat, Nlon  = self.lats.size, self.lons.size
+        for per in [10., 20.]:
+            ref     = np.arange(Nlat*Nlon, dtype=np.float64).reshape(Nlat, Nlon) + per
+            pergrp  = outgrp['%g_sec'%( per )]
+            np.testing.assert_array_equal(pergrp['velocity'].value, ref)
+            np.testing.assert_array_equal(pergrp['Dvelocity'].value, -ref)
+            np.testing.assert_array_equal(pergrp['azi_coverage1'].value, ref)
+            np.testing.assert_array_equal(pergrp['azi_coverage2'].value, 2.*ref)
+            np.testing.assert_array_equal(pergrp['path_density'].value, ref)
+
+    def test_reshape_full_grid(self):
+        # no locations stored, same as the former reshape
+        outgrp      = self._smooth_run(order=np.arange(35), store_lonlat=False)
+        self.assertEqual(outgrp['grid_index1'].value.shape, (35, 2))
+        self.assertEqual(outgrp['grid_index2'].value.shape, (35, 2))
+        self._check(outgrp)
+
+    def test_reshape_grid_index(self):
+        # points in an arbitrary order, placed by the grid indices
+        order       = np.random.RandomState(0).permutation(35)
+        outgrp      = self._smooth_run(order=order, store_lonlat=True)
+        self._check(outgrp)
+
+if __name__ == '__main__':
+    unittest.main()
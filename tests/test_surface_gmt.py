@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Comparison of the in-process minimum curvature gridding (field2d_earth.surface, method = 'native')
+    against the gmt surface grids stored in test_mp/80.0sec (input: *.lst, output of gmt grd2xyz: *.lst.HD*)
+
+tolerances, relative to the range of the input data:
+    dense input (curvature checked fields *_v1.lst, holes filled by surface, tension = 0.0 and 0.2)
+        maximum difference  <= 5e-3, rms difference <= 2e-4 on the whole grid
+    sparse input (travel time/amplitude at 114 stations, tension = 0.0)
+        rms difference      <= 2e-2 at the grid points within 50 km of a station
+        the two solutions differ in the data gaps, where gmt surface stops at its (loose) default convergence limit
+
+usage:
+    python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import field2d_earth
+
+datadir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'test_mp', '80.0sec')
+
+def _read_reference(infname, gmtfname):
+    """read the input data and the gmt grid (rows from the maximum latitude, grd2xyz)
+    """
+    inArr       = np.loadtxt(os.path.join(datadir, infname))
+    gmtArr      = np.loadtxt(os.path.join(datadir, gmtfname))
+    lons        = np.unique(gmtArr[:, 0])
+    lats        = np.unique(gmtArr[:, 1])
+    Zgmt        = (gmtArr[:, 2].reshape(lats.size, lons.size))[::-1, :]
+    return inArr, lons, lats, Zgmt
+
+def _station_distance(inArr, lons, lats):
+    """distance (km) of the grid points to the nearest input point, local flat earth approximation
+    """
+    lonArr, latArr  = np.meshgrid(lons, lats)
+    coslat          = np.cos(np.radians(lats.mean()))
+    dist            = np.ones(lonArr.shape)*np.inf
+    for lon, lat in inArr[:, :2]:
+        dist        = np.minimum(dist, 111.19*np.sqrt(((lonArr - lon)*coslat)**2 + (latArr - lat)**2))
+    return dist
+
+@unittest.skipUnless(os.path.isdir(datadir), 'gmt reference grids not available')
+class TestSurfaceGMT(unittest.TestCase):
+
+    def _native(self, inArr, lons, lats, tension):
+        return field2d_earth.surface(inArr[:, 0], inArr[:, 1], inArr[:, 2], lons[0], lons[1]-lons[0], lons.size,\
+                    lats[0], lats[1]-lats[0], lats.size, tension=tension)
+
+    def _check_dense(self, infname, gmtfname, tension):
+        inArr, lons, lats, Zgmt = _read_reference(infname, gmtfname)
+        diff        = np.abs(self._native(inArr, lons, lats, tension) - Zgmt)/np.ptp(inArr[:, 2])
+        self.assertLessEqual(diff.max(), 5e-3)
+        self.assertLessEqual(np.sqrt(np.mean(diff**2)), 2e-4)
+
+    def _check_sparse(self, infname, gmtfname, tension):
+        inArr, lons, lats, Zgmt = _read_reference(infname, gmtfname)
+        diff        = np.abs(self._native(inArr, lons, lats, tension) - Zgmt)/np.ptp(inArr[:, 2])
+        diff        = diff[_station_distance(inArr, lons, lats) < 50.]
+        self.assertLessEqual(np.sqrt(np.mean(diff**2)), 2e-2)
+
+    def test_travel_time_dense(self):
+        self._check_dense('E10811_Z_Tph_80.0_v1.lst', 'E10811_Z_Tph_80.0_v1.lst.HD', tension=0.)
+        self._check_dense('E10811_Z_Tph_80.0_v1.lst', 'E10811_Z_Tph_80.0_v1.lst.HD_0.2', tension=0.2)
+
+    def test_amplitude_dense(self):
+        self._check_dense('E10811_Amp_Z_amp_80.0_v1.lst', 'E10811_Amp_Z_amp_80.0_v1.lst.HD', tension=0.)
+        self._check_dense('E10811_Amp_Z_amp_80.0_v1.lst', 'E10811_Amp_Z_amp_80.0_v1.lst.HD_0.2', tension=0.2)
+
+    def test_station_data(self):
+        self._check_sparse('E10811_Tph_Z.lst', 'E10811_Tph_Z.lst.HD', tension=0.)
+        self._check_sparse('E10811_Amp_Z.lst', 'E10811_Amp_Z.lst.HD', tension=0.)
+
+if __name__ == '__main__':
+    unittest.main()